@@ -0,0 +1,4 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+"""Benchmarks of the SAML Groups plugin."""
@@ -0,0 +1,100 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+"""Benchmark the group objects and the memory allocated by ACL checks.
+
+An ACL check looks a group up by name and checks whether a user is a member of it, and listing the
+groups of a user builds a group object for each of them. For both, the number of distinct group
+objects created per call, the peak memory allocated per call and the time per call are printed.
+Run with
+
+    python -m benchmarks.bench_acl_check [--database-uri URI] [--checks N]
+"""
+
+import time
+import tracemalloc
+from typing import Callable, List, Set
+
+from flask import Flask
+
+from benchmarks.common import create_app, create_identity_provider, get_parser
+from flask_multipass_saml_groups.group_provider.sql import SQLGroupProvider
+
+USERS = 100
+GROUPS_PER_USER = 20
+DEFAULT_CHECKS = 2000
+
+
+def measure(name: str, func: Callable[[int], List[object]], checks: int) -> None:
+    """Call a function repeatedly and print the group objects and memory allocated per call.
+
+    Args:
+        name: The name of the measured operation.
+        func: The function to call with the number of the call, returning the group objects.
+        checks: The number of calls.
+    """
+    start = time.perf_counter()
+    for i in range(checks):
+        func(i)
+    elapsed = time.perf_counter() - start
+    objects: Set[int] = set()
+    # the returned groups are kept alive, so that every group object created is counted once
+    kept: List[object] = []
+    peak = 0
+    tracemalloc.start()
+    try:
+        for i in range(checks):
+            current, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            groups = func(i)
+            peak += tracemalloc.get_traced_memory()[1] - current
+            kept.extend(groups)
+            objects.update(id(g) for g in groups)
+    finally:
+        tracemalloc.stop()
+    print(
+        f"{name:>12}: {len(objects) / checks:6.2f} group objects/call, "
+        f"peak {peak / checks / 1024:6.1f}KiB/call, {elapsed * 1e6 / checks:7.1f}us/call"
+    )
+
+
+def run(app: Flask, checks: int) -> None:
+    """Fill the database and measure ACL checks and listings of the groups of users.
+
+    Args:
+        app: The flask app.
+        checks: The number of calls per measured operation.
+    """
+    group_provider = SQLGroupProvider(create_identity_provider(app, {}))
+    with app.app_context():
+        for user in range(USERS):
+            group_provider.sync_user_groups(
+                f"user{user}",
+                [f"group{(user + i) % (2 * GROUPS_PER_USER)}" for i in range(GROUPS_PER_USER)],
+            )
+
+        def check(i: int) -> List[object]:
+            group = group_provider.get_group(f"group{i % (2 * GROUPS_PER_USER)}")
+            assert group is not None
+            group.has_member(f"user{i % USERS}")
+            return [group]
+
+        measure("acl check", check, checks)
+        measure(
+            "user groups",
+            lambda i: list(group_provider.get_user_groups(f"user{i % USERS}")),
+            checks,
+        )
+
+
+def main() -> None:
+    """Run the benchmark."""
+    parser = get_parser(__doc__.splitlines()[0])
+    parser.add_argument("--checks", type=int, default=DEFAULT_CHECKS)
+    args = parser.parse_args()
+    with create_app(args.database_uri) as app:
+        run(app, args.checks)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+"""Benchmark the login throughput with and without write coalescing.
+
+Simulates a login storm after a new team has been created in the identity provider: many
+threads concurrently sync new users into the same new groups. Run with
+
+    python -m benchmarks.bench_coalescing [--database-uri URI] [--threads N] [--logins N]
+"""
+
+from threading import Barrier, Lock, Thread
+from typing import List
+
+from flask import Flask
+
+from benchmarks.common import create_app, create_identity_provider, get_parser, timed
+from flask_multipass_saml_groups.group_provider.sql import SQLGroupProvider
+
+GROUP_NAMES = ["new-team", "new-team-admins", "all-staff"]
+
+
+def run(app: Flask, write_coalescing_ms: int, threads: int, logins: int) -> None:
+    """Run the login storm and print the throughput.
+
+    Args:
+        app: The flask app.
+        write_coalescing_ms: The write_coalescing_ms setting of the group provider.
+        threads: The number of concurrently logging in threads.
+        logins: The number of logins per thread.
+    """
+    identity_provider = create_identity_provider(app, {"write_coalescing_ms": write_coalescing_ms})
+    with app.app_context():
+        group_provider = SQLGroupProvider(identity_provider=identity_provider)
+    barrier = Barrier(threads + 1)
+    errors: List[Exception] = []
+    errors_lock = Lock()
+
+    def _login_storm(thread_id: int) -> None:
+        barrier.wait()
+        for login in range(logins):
+            with app.app_context():
+                try:
+                    group_provider.sync_user_groups(
+                        f"{write_coalescing_ms}-{thread_id}-{login}", GROUP_NAMES
+                    )
+                except Exception as exc:  # pylint: disable=broad-exception-caught
+                    with errors_lock:
+                        errors.append(exc)
+
+    workers = [Thread(target=_login_storm, args=(i,)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+
+    def _wait() -> None:
+        barrier.wait()
+        for worker in workers:
+            worker.join()
+
+    elapsed = timed(_wait)
+    total = threads * logins
+    print(
+        f"write_coalescing_ms={write_coalescing_ms:>3}: {total} logins in {elapsed:.2f}s, "
+        f"{total / elapsed:.0f} logins/s, {len(errors)} failed"
+    )
+
+
+def main() -> None:
+    """Run the benchmark."""
+    parser = get_parser(__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--logins", type=int, default=50)
+    args = parser.parse_args()
+    for write_coalescing_ms in (0, 2, 5):
+        with create_app(args.database_uri) as app:
+            run(app, write_coalescing_ms, args.threads, args.logins)
+
+
+if __name__ == "__main__":
+    main()
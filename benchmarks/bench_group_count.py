@@ -0,0 +1,84 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+"""Benchmark the sync of users asserting an increasing number of groups.
+
+Syncs users with 10, 1k and 10k groups: a first sync adding all groups, an unchanged sync and
+a sync replacing half of the groups. The time per group and the peak memory should stay flat as
+the number of groups grows. Run with
+
+    python -m benchmarks.bench_group_count [--database-uri URI] [--group-counts N ...]
+"""
+
+import tracemalloc
+from functools import partial
+from typing import Callable, List, Tuple
+
+from flask import Flask
+
+from benchmarks.common import create_app, create_identity_provider, get_parser, timed
+from flask_multipass_saml_groups.group_provider.sql import SQLGroupProvider
+
+DEFAULT_GROUP_COUNTS = [10, 1000, 10000]
+REPEATS = 3
+
+
+def measure(func: Callable[[], None]) -> Tuple[float, int]:
+    """Measure the wall clock time and the peak of the memory allocated by a function.
+
+    Args:
+        func: The function to call.
+
+    Returns:
+        The number of seconds the call took and the peak allocated memory in bytes.
+    """
+    tracemalloc.start()
+    try:
+        elapsed = timed(func)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return elapsed, peak
+
+
+def run(app: Flask, group_counts: List[int]) -> None:
+    """Sync users with the given numbers of groups and print the results.
+
+    Args:
+        app: The flask app.
+        group_counts: The numbers of groups asserted by the users.
+    """
+    group_provider = SQLGroupProvider(create_identity_provider(app, {}))
+    with app.app_context():
+        for count in group_counts:
+            for repeat in range(REPEATS):
+                identifier = f"user{count}-{repeat}"
+                groups = [f"group{i}" for i in range(count)]
+                replaced = groups[: count // 2] + [f"other{i}" for i in range(count - count // 2)]
+                for step, group_names in (
+                    ("add", groups),
+                    ("unchanged", groups),
+                    ("replace half", replaced),
+                ):
+                    elapsed, peak = measure(
+                        partial(group_provider.sync_user_groups, identifier, group_names)
+                    )
+                    if repeat == REPEATS - 1:
+                        print(
+                            f"{count:>6} groups, {step:>12}: {elapsed * 1000:9.1f}ms, "
+                            f"{elapsed * 1e6 / count:7.1f}us/group, "
+                            f"peak {peak / 1024:8.0f}KiB, {peak / count:6.0f}B/group"
+                        )
+
+
+def main() -> None:
+    """Run the benchmark."""
+    parser = get_parser(__doc__.splitlines()[0])
+    parser.add_argument("--group-counts", type=int, nargs="+", default=DEFAULT_GROUP_COUNTS)
+    args = parser.parse_args()
+    with create_app(args.database_uri) as app:
+        run(app, args.group_counts)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+"""Benchmark the membership inserts and lookups with the old and the new indexes.
+
+Compares the separate indexes on group_id and user_id created by the initial migration with
+the single index on (user_id, group_id). Run with
+
+    python -m benchmarks.bench_indexes [--database-uri URI] [--users N] [--lookups N]
+"""
+
+import random
+import statistics
+import time
+from typing import List
+
+from flask import Flask
+from indico.core.db import db
+from sqlalchemy import text
+
+from benchmarks.common import PROVIDER, create_app, get_parser, timed
+from flask_multipass_saml_groups.group_provider.bulk import get_memberships, insert_memberships
+from flask_multipass_saml_groups.models.saml_groups import SCHEMA
+
+GROUPS = 500
+GROUPS_PER_USER = 10
+USERS_PER_TRANSACTION = 100
+
+LAYOUTS = {
+    "before": [
+        ("ix_saml_group_members_group_id", "group_id"),
+        ("ix_saml_group_members_user_id", "user_id"),
+    ],
+    "after": [("ix_saml_group_members_user_id_group_id", "user_id, group_id")],
+}
+
+
+def create_indexes(layout: str) -> None:
+    """Replace the indexes of the members table created from the models by those of a layout.
+
+    Args:
+        layout: The name of the layout.
+    """
+    with db.engine.begin() as connection:
+        for name, _ in LAYOUTS["after"]:
+            connection.execute(text(f"DROP INDEX {SCHEMA}.{name}"))
+        for name, columns in LAYOUTS[layout]:
+            if connection.dialect.name == "sqlite":
+                statement = f"CREATE INDEX {SCHEMA}.{name} ON saml_group_members ({columns})"
+            else:
+                statement = f"CREATE INDEX {name} ON {SCHEMA}.saml_group_members ({columns})"
+            connection.execute(text(statement))
+
+
+def run(app: Flask, layout: str, users: int, lookups: int) -> None:
+    """Insert the memberships, look up the groups of random users and print the results.
+
+    Args:
+        app: The flask app.
+        layout: The name of the index layout.
+        users: The number of users to insert.
+        lookups: The number of lookups to time.
+    """
+    rng = random.Random(0)
+    batches = [
+        [
+            (f"user{user}", f"group{group}")
+            for user in range(first, min(first + USERS_PER_TRANSACTION, users))
+            for group in rng.sample(range(GROUPS), GROUPS_PER_USER)
+        ]
+        for first in range(0, users, USERS_PER_TRANSACTION)
+    ]
+
+    with app.app_context():
+        create_indexes(layout)
+
+        def _insert() -> None:
+            for batch in batches:
+                with db.engine.begin() as connection:
+                    insert_memberships(connection, PROVIDER, batch)
+
+        elapsed = timed(_insert)
+        with db.engine.connect() as connection:
+            # let the planner know the table and its visibility map, as autovacuum would
+            if connection.dialect.name == "postgresql":
+                connection.execution_options(isolation_level="AUTOCOMMIT").execute(
+                    text(f"VACUUM ANALYZE {SCHEMA}.saml_group_members")
+                )
+
+        latencies: List[float] = []
+        with db.engine.connect() as connection:
+            for user in rng.sample(range(users), lookups):
+                start = time.perf_counter()
+                get_memberships(connection, PROVIDER, [f"user{user}"])
+                latencies.append((time.perf_counter() - start) * 1000)
+
+    print(
+        f"{layout:>6}: {users * GROUPS_PER_USER / elapsed:.0f} memberships/s inserted, lookup "
+        f"mean {statistics.mean(latencies):.3f}ms, "
+        f"p95 {statistics.quantiles(latencies, n=20)[-1]:.3f}ms"
+    )
+
+
+def main() -> None:
+    """Run the benchmark."""
+    parser = get_parser(__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--lookups", type=int, default=2000)
+    args = parser.parse_args()
+    for layout in LAYOUTS:
+        with create_app(args.database_uri) as app:
+            run(app, layout, args.users, args.lookups)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+"""Benchmark listing the member counts of all groups.
+
+The member counts maintained by the writes are compared with counting the memberships with a
+GROUP BY, for all groups ordered by name and for the largest groups. The median time of each
+query is printed. Run with
+
+    python -m benchmarks.bench_member_counts [--database-uri URI] [--users N] [--groups N]
+"""
+
+import statistics
+import time
+from typing import Callable, Iterator
+
+from flask import Flask
+from indico.core.db import db
+from sqlalchemy import func, select, text
+from sqlalchemy.engine import Connection
+
+from benchmarks.common import PROVIDER, create_app, get_parser
+from flask_multipass_saml_groups.group_provider.bulk import get_groups_with_counts
+from flask_multipass_saml_groups.group_provider.transfer import Membership, import_memberships
+from flask_multipass_saml_groups.models.saml_groups import SAMLGroup as DBGroup
+from flask_multipass_saml_groups.models.saml_groups import group_members_table
+
+DEFAULT_USERS = 20000
+DEFAULT_GROUPS = 2000
+GROUPS_PER_USER = 25
+LARGEST = 20
+REPEAT = 20
+
+
+def memberships(users: int, groups: int) -> Iterator[Membership]:
+    """Generate the memberships of users in groups of very different sizes.
+
+    Args:
+        users: The number of users.
+        groups: The number of groups.
+
+    Yields:
+        The group names and user identifiers.
+    """
+    for user in range(users):
+        for i in range(GROUPS_PER_USER):
+            # the groups with low numbers are shared by many more users
+            yield f"group{(user * i * i) % groups}", f"user{user}"
+
+
+def count_memberships(connection: Connection, by_size: bool, limit: int) -> list:
+    """Count the members of the groups with a GROUP BY over the memberships.
+
+    Args:
+        connection: The connection to use.
+        by_size: Whether to order the groups by decreasing member count instead of by name.
+        limit: The maximum number of groups to return.
+
+    Returns:
+        The group names and member counts.
+    """
+    groups = DBGroup.__table__
+    member_count = func.count(group_members_table.c.user_id)
+    order_by = [member_count.desc(), groups.c.name] if by_size else [groups.c.name]
+    return connection.execute(
+        select(groups.c.name, member_count)
+        .select_from(groups.outerjoin(group_members_table))
+        .where(groups.c.provider == PROVIDER)
+        .group_by(groups.c.name)
+        .order_by(*order_by)
+        .limit(limit)
+    ).all()
+
+
+def measure(name: str, query: Callable[[Connection], list]) -> None:
+    """Run a query repeatedly and print its median time.
+
+    Args:
+        name: The name of the measured query.
+        query: The function running the query on a connection.
+    """
+    timings = []
+    with db.engine.connect() as connection:
+        for _ in range(REPEAT):
+            start = time.perf_counter()
+            query(connection)
+            timings.append(time.perf_counter() - start)
+    print(f"{name:>28}: {statistics.median(timings) * 1000:8.2f}ms")
+
+
+def run(app: Flask, users: int, groups: int) -> None:
+    """Fill the database and measure the queries of the member counts.
+
+    Args:
+        app: The flask app.
+        users: The number of users.
+        groups: The number of groups.
+    """
+    with app.app_context():
+        with db.engine.begin() as connection:
+            import_memberships(connection, PROVIDER, memberships(users, groups))
+        if db.engine.dialect.name == "postgresql":
+            with db.engine.connect() as connection:
+                connection.execution_options(isolation_level="AUTOCOMMIT").execute(
+                    text("VACUUM ANALYZE")
+                )
+        total = groups + 1
+        measure("group by, all by name", lambda c: count_memberships(c, False, total))
+        measure("counts, all by name", lambda c: get_groups_with_counts(c, PROVIDER))
+        measure(f"group by, {LARGEST} largest", lambda c: count_memberships(c, True, LARGEST))
+        measure(
+            f"counts, {LARGEST} largest",
+            lambda c: get_groups_with_counts(c, PROVIDER, by_size=True, limit=LARGEST),
+        )
+        with db.engine.connect() as connection:
+            assert count_memberships(connection, True, total) == [
+                tuple(row) for row in get_groups_with_counts(connection, PROVIDER, by_size=True)
+            ]
+
+
+def main() -> None:
+    """Run the benchmark."""
+    parser = get_parser(__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=DEFAULT_USERS)
+    parser.add_argument("--groups", type=int, default=DEFAULT_GROUPS)
+    args = parser.parse_args()
+    with create_app(args.database_uri) as app:
+        run(app, args.users, args.groups)
+
+
+if __name__ == "__main__":
+    main()
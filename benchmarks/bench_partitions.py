@@ -0,0 +1,162 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+"""Check that the sync of a user only scans the partition of that user.
+
+Hash-partitions the membership table on user_id as the partition_group_members migration does,
+syncs the groups of a user and runs EXPLAIN ANALYZE on each statement of the sync reading the
+membership table. The partitions scanned by each statement are printed, and the check fails if
+a statement scans more than one. Requires PostgreSQL. Run with
+
+    python -m benchmarks.bench_partitions --database-uri URI [--partitions N] [--users N]
+"""
+
+import json
+import sys
+from typing import Any, Dict, Iterator, List, Tuple
+
+from flask import Flask
+from indico.core.db import db
+from sqlalchemy import event, text
+
+from benchmarks.common import PROVIDER, create_app, get_parser
+from flask_multipass_saml_groups.group_provider.bulk import insert_memberships, sync_memberships
+from flask_multipass_saml_groups.models.saml_groups import SCHEMA
+
+GROUPS_PER_USER = 10
+TABLE = "saml_group_members"
+
+
+def partition_members_table(partitions: int) -> None:
+    """Replace the membership table by a table hash-partitioned on user_id.
+
+    Args:
+        partitions: The number of partitions.
+    """
+    with db.engine.begin() as connection:
+        connection.execute(text(f"DROP TABLE {SCHEMA}.{TABLE}"))
+        connection.execute(
+            text(
+                f"CREATE TABLE {SCHEMA}.{TABLE} (group_id INTEGER NOT NULL, "
+                "user_id INTEGER NOT NULL, PRIMARY KEY (group_id, user_id)) "
+                "PARTITION BY HASH (user_id)"
+            )
+        )
+        for remainder in range(partitions):
+            connection.execute(
+                text(
+                    f"CREATE TABLE {SCHEMA}.{TABLE}_p{remainder} PARTITION OF {SCHEMA}.{TABLE} "
+                    f"FOR VALUES WITH (MODULUS {partitions}, REMAINDER {remainder})"
+                )
+            )
+        connection.execute(
+            text(
+                f"CREATE INDEX ix_{TABLE}_user_id_group_id ON {SCHEMA}.{TABLE} (user_id, group_id)"
+            )
+        )
+
+
+def capture_sync(identifier: str, group_names: List[str]) -> List[Tuple[str, Any]]:
+    """Sync the groups of a user in a transaction which is rolled back.
+
+    Args:
+        identifier: The identifier of the user.
+        group_names: The names of the groups of the user.
+
+    Returns:
+        The statements and parameters sent to the database reading the membership table.
+    """
+    statements: List[Tuple[str, Any]] = []
+
+    def _capture(_connection: Any, _cursor: Any, statement: str, parameters: Any, *_: Any) -> None:
+        if TABLE in statement and not statement.lstrip().upper().startswith("INSERT"):
+            statements.append((statement, parameters))
+
+    with db.engine.connect() as connection:
+        transaction = connection.begin()
+        event.listen(connection, "before_cursor_execute", _capture)
+        sync_memberships(connection, PROVIDER, {identifier: group_names})
+        event.remove(connection, "before_cursor_execute", _capture)
+        transaction.rollback()
+    return statements
+
+
+def scanned_partitions(plan: Dict) -> Iterator[str]:
+    """Find the partitions of the membership table a plan has scanned.
+
+    Args:
+        plan: A node of the plan returned by EXPLAIN (ANALYZE, FORMAT JSON).
+
+    Yields:
+        The names of the partitions scanned at least once.
+    """
+    relation = plan.get("Relation Name", "")
+    if relation.startswith(f"{TABLE}_p") and plan.get("Actual Loops", 0):
+        yield relation
+    for child in plan.get("Plans", []):
+        yield from scanned_partitions(child)
+
+
+def run(app: Flask, partitions: int, users: int) -> bool:
+    """Sync a user of a partitioned membership table and print the scanned partitions.
+
+    Args:
+        app: The flask app.
+        partitions: The number of partitions.
+        users: The number of users to insert.
+
+    Returns:
+        True if no statement scanned more than one partition.
+    """
+    with app.app_context():
+        partition_members_table(partitions)
+        with db.engine.begin() as connection:
+            insert_memberships(
+                connection,
+                PROVIDER,
+                [
+                    (f"user{user}", f"group{(user + i) % (users // 2)}")
+                    for user in range(users)
+                    for i in range(GROUPS_PER_USER)
+                ],
+            )
+        with db.engine.connect() as connection:
+            connection.execution_options(isolation_level="AUTOCOMMIT").execute(
+                text(f"ANALYZE {SCHEMA}.{TABLE}")
+            )
+
+        # remove the user from one group and add it to a new one
+        group_names = [f"group{i}" for i in range(1, GROUPS_PER_USER)] + ["new-group"]
+        pruned = True
+        for statement, parameters in capture_sync("user0", group_names):
+            with db.engine.connect() as connection:
+                transaction = connection.begin()
+                result = connection.exec_driver_sql(
+                    f"EXPLAIN (ANALYZE, FORMAT JSON) {statement}", parameters
+                )
+                plan = result.scalar()
+                transaction.rollback()
+            plan = plan if isinstance(plan, list) else json.loads(plan)
+            scanned = sorted(set(scanned_partitions(plan[0]["Plan"])))
+            pruned = pruned and len(scanned) <= 1
+            print(
+                f"{len(scanned)}/{partitions} partitions {scanned}: {' '.join(statement.split())}"
+            )
+    return pruned
+
+
+def main() -> None:
+    """Run the check."""
+    parser = get_parser(__doc__.splitlines()[0])
+    parser.add_argument("--partitions", type=int, default=8)
+    parser.add_argument("--users", type=int, default=2000)
+    args = parser.parse_args()
+    if not args.database_uri:
+        parser.error("partitioning requires a PostgreSQL --database-uri")
+    with create_app(args.database_uri) as app:
+        if not run(app, args.partitions, args.users):
+            sys.exit("A statement of the sync scanned more than one partition")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+"""Benchmark the first ACL checks of a worker with and without warm-up.
+
+After the connection pool and the compiled statements have been dropped, as in a freshly started
+worker, concurrent ACL checks are run once on a cold provider and once on a provider which has
+been warmed up. The duration of the warm-up and the latency of the first checks are printed.
+Run with
+
+    python -m benchmarks.bench_warm_up [--database-uri URI] [--groups N] [--threads N]
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from flask import Flask
+from indico.core.db import db
+
+from benchmarks.common import PROVIDER, create_app, create_identity_provider, get_parser
+from flask_multipass_saml_groups.group_provider.bulk import insert_memberships
+from flask_multipass_saml_groups.group_provider.sql import SQLGroupProvider
+
+DEFAULT_GROUPS = 10000
+DEFAULT_THREADS = 5
+WARM_UP_BUDGET = 5
+
+
+def first_checks(app: Flask, group_provider: SQLGroupProvider, threads: int) -> List[float]:
+    """Run one ACL check per thread at the same time.
+
+    Args:
+        app: The flask app.
+        group_provider: The group provider.
+        threads: The number of concurrent checks.
+
+    Returns:
+        The latency of each check in seconds.
+    """
+
+    def check(i: int) -> float:
+        with app.app_context():
+            start = time.perf_counter()
+            group = group_provider.get_group(f"group{i}")
+            assert group is not None
+            group.has_member(f"user{i}")
+            return time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return list(executor.map(check, range(threads)))
+
+
+def run(app: Flask, groups: int, threads: int) -> None:
+    """Fill the database and measure the first ACL checks of a cold and a warm provider.
+
+    Args:
+        app: The flask app.
+        groups: The number of groups.
+        threads: The number of concurrent checks.
+    """
+    with app.app_context():
+        with db.engine.begin() as connection:
+            insert_memberships(
+                connection, PROVIDER, [(f"user{i}", f"group{i}") for i in range(groups)]
+            )
+    for warm in (False, True):
+        with app.app_context():
+            # a new worker starts without connections and compiled statements
+            db.engine.dispose()
+            db.engine._compiled_cache.clear()  # pylint: disable=protected-access
+            group_provider = SQLGroupProvider(create_identity_provider(app, {}))
+            warm_up = "     -"
+            if warm:
+                start = time.perf_counter()
+                preloaded = group_provider.warm_up(time.monotonic() + WARM_UP_BUDGET)
+                warm_up = f"{(time.perf_counter() - start) * 1000:6.1f}ms ({preloaded} groups)"
+        latencies = first_checks(app, group_provider, threads)
+        print(
+            f"{'warm' if warm else 'cold':>4}: warm-up {warm_up}, first checks "
+            f"avg {sum(latencies) / len(latencies) * 1000:6.2f}ms, "
+            f"max {max(latencies) * 1000:6.2f}ms"
+        )
+
+
+def main() -> None:
+    """Run the benchmark."""
+    parser = get_parser(__doc__.splitlines()[0])
+    parser.add_argument("--groups", type=int, default=DEFAULT_GROUPS)
+    parser.add_argument("--threads", type=int, default=DEFAULT_THREADS)
+    args = parser.parse_args()
+    with create_app(args.database_uri) as app:
+        run(app, args.groups, args.threads)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+"""Common functions for the benchmarks.
+
+The benchmarks run against a local database. By default a temporary SQLite database is created,
+a PostgreSQL database can be used by passing its URI. The plugin tables of that database are
+dropped and recreated, so never point a benchmark at a database holding real data.
+"""
+
+import argparse
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, Optional
+
+from flask import Flask
+from flask_multipass import IdentityProvider, Multipass
+from indico.core.db import db
+from sqlalchemy import event, text
+
+from flask_multipass_saml_groups.models.saml_groups import (
+    SCHEMA,
+)
+from flask_multipass_saml_groups.models.saml_groups import SAMLGroup as DBGroup
+from flask_multipass_saml_groups.models.saml_groups import (
+    SAMLMembershipChange,
+    SAMLUser,
+    SAMLUserAttributes,
+    group_ancestors_table,
+    group_member_counts_table,
+    group_members_table,
+)
+
+# the name of the identity provider of the benchmarks
+PROVIDER = "saml_groups"
+TABLES = [
+    DBGroup.__table__,
+    SAMLUser.__table__,
+    SAMLUserAttributes.__table__,
+    group_members_table,
+    SAMLMembershipChange.__table__,
+    group_ancestors_table,
+    group_member_counts_table,
+]
+
+
+def get_parser(description: str) -> argparse.ArgumentParser:
+    """Create an argument parser with the options shared by all benchmarks.
+
+    Args:
+        description: The description of the benchmark.
+
+    Returns:
+        The argument parser.
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "--database-uri",
+        help="URI of a scratch PostgreSQL database, defaults to a temporary SQLite database",
+    )
+    return parser
+
+
+@contextmanager
+def create_app(database_uri: Optional[str] = None) -> Iterator[Flask]:
+    """Create a flask app with empty plugin tables.
+
+    Args:
+        database_uri: The URI of the database, None for a temporary SQLite database.
+
+    Yields:
+        The flask app.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        app = Flask("benchmark")
+        app.config["SQLALCHEMY_DATABASE_URI"] = database_uri or f"sqlite:///{tmp_dir}/indico.db"
+        db.init_app(app)
+        Multipass(app)
+        with app.app_context():
+            if db.engine.dialect.name == "sqlite":
+                plugin_db = Path(tmp_dir) / "plugin.db"
+
+                # pylint: disable-next=unused-variable
+                @event.listens_for(db.engine, "connect")
+                def _attach(dbapi_connection: Any, _: Any) -> None:
+                    dbapi_connection.execute(f"attach '{plugin_db}' as {SCHEMA}")
+
+            else:
+                with db.engine.begin() as connection:
+                    connection.execute(text(f"CREATE SCHEMA IF NOT EXISTS {SCHEMA}"))
+            _drop_tables()
+            for table in TABLES:
+                table.create(bind=db.engine)
+        yield app
+        with app.app_context():
+            _drop_tables()
+            db.engine.dispose()
+
+
+def _drop_tables() -> None:
+    """Drop the plugin tables if they exist."""
+    for table in reversed(TABLES):
+        table.drop(bind=db.engine, checkfirst=True)
+
+
+def create_identity_provider(app: Flask, settings: Dict) -> IdentityProvider:
+    """Create an identity provider to pass to a group provider.
+
+    Args:
+        app: The flask app.
+        settings: The settings of the identity provider.
+
+    Returns:
+        The identity provider.
+    """
+    with app.app_context():
+        return IdentityProvider(
+            multipass=app.extensions["multipass"].multipass, name=PROVIDER, settings=settings
+        )
+
+
+def timed(func: Callable[[], None]) -> float:
+    """Measure the wall clock time of a function.
+
+    Args:
+        func: The function to call.
+
+    Returns:
+        The number of seconds the call took.
+    """
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
@@ -0,0 +1,495 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+"""The indico command line commands of the plugin."""
+
+import os
+import time
+from datetime import timedelta
+from typing import IO, Callable, Iterator, Optional, Tuple
+
+import alembic.command
+import alembic.config
+import click
+from indico.cli.core import cli_group
+from indico.core.config import config
+from indico.core.db import db
+from indico.util.date_time import now_utc
+from sqlalchemy import Column, create_engine, select
+from sqlalchemy.engine import Connection
+from sqlalchemy.pool import NullPool
+from sqlalchemy.sql.elements import ColumnElement
+
+from flask_multipass_saml_groups import migration_env
+from flask_multipass_saml_groups.group_provider.bulk import (
+    get_member_count_mismatches,
+    rebuild_group_ancestors,
+    rebuild_group_names,
+    rebuild_member_counts,
+)
+from flask_multipass_saml_groups.group_provider.cleanup import (
+    DeletedBatch,
+    delete_old_changes,
+    delete_orphaned_groups,
+    delete_stale_users,
+)
+from flask_multipass_saml_groups.group_provider.reconcile import (
+    DEFAULT_RECONCILE_BATCH_SIZE,
+    ReconcileOptions,
+    read_directory,
+    reconcile_memberships,
+)
+from flask_multipass_saml_groups.group_provider.sharded import get_shards
+from flask_multipass_saml_groups.group_provider.transfer import (
+    DEFAULT_TRANSFER_BATCH_SIZE,
+    FORMATS,
+    export_memberships,
+    import_memberships,
+    read_memberships,
+    write_memberships,
+)
+from flask_multipass_saml_groups.models.saml_groups import SAMLGroup as DBGroup
+from flask_multipass_saml_groups.models.saml_groups import SAMLUser
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_PAUSE = 0.1
+MIGRATIONS_PATH = migration_env.MIGRATIONS_PATH
+PROVIDER_TYPE = "saml_groups"
+
+
+def _resolve_provider(ctx: click.Context, param: click.Parameter, value: Optional[str]) -> str:
+    """Get the name of the identity provider, by default the only one of the plugin.
+
+    Args:
+        ctx: The context of the command.
+        param: The provider option.
+        value: The name given on the command line, None if not given.
+
+    Raise:
+        BadParameter: If no name is given and not exactly one identity provider of the plugin
+            is configured.
+
+    Returns:
+        The name of the identity provider.
+    """
+    if value:
+        return value
+    names = [
+        name
+        for name, settings in config.IDENTITY_PROVIDERS.items()
+        if settings.get("type") == PROVIDER_TYPE
+    ]
+    if len(names) != 1:
+        raise click.BadParameter(
+            f"is required unless exactly one identity provider of type {PROVIDER_TYPE} is "
+            f"configured, found {len(names)}",
+            ctx=ctx,
+            param=param,
+        )
+    return names[0]
+
+
+_provider_option = click.option(
+    "--provider",
+    callback=_resolve_provider,
+    help="The name of the identity provider of the groups, by default the only one configured.",
+)
+
+
+@cli_group(name="saml-groups")
+def cli() -> None:
+    """Manage the SAML groups."""
+
+
+def _iter_id_batches(
+    column: Column, batch_size: int, *conditions: ColumnElement
+) -> Iterator[Tuple[int, int]]:
+    """Split the ids of the rows of a table into batches of existing ids.
+
+    Each batch continues after the last id of the previous one, so gaps in the ids do not make
+    batches smaller, and the ids of each batch are read in their own short transaction.
+
+    Args:
+        column: The id column of the table.
+        batch_size: The number of ids per batch.
+        conditions: The conditions selecting the rows.
+
+    Yields:
+        The first and the last id of each batch.
+    """
+    last_id = 0
+    while True:
+        with db.engine.connect() as connection:
+            ids = (
+                connection.execute(
+                    select(column)
+                    .where(column > last_id, *conditions)
+                    .order_by(column)
+                    .limit(batch_size)
+                )
+                .scalars()
+                .all()
+            )
+        if not ids:
+            return
+        last_id = ids[-1]
+        yield ids[0], last_id
+
+
+@cli.command("repair-group-names")
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=DEFAULT_BATCH_SIZE,
+    show_default=True,
+    help="The number of users updated per transaction.",
+)
+def repair_group_names(batch_size: int) -> None:
+    """Recompute the denormalized group names of all users from their memberships.
+
+    Each batch of users is updated in its own short transaction, so the command can run while
+    the plugin is in use.
+
+    Args:
+        batch_size: The number of users updated per transaction.
+    """
+    last_id = 0
+    for first_id, last_id in _iter_id_batches(SAMLUser.__table__.c.id, batch_size):
+        with db.engine.begin() as connection:
+            rebuild_group_names(connection, first_id, last_id)
+    click.echo(f"Recomputed the group names of the users up to id {last_id}")
+
+
+@cli.command("rebuild-group-hierarchy")
+@_provider_option
+@click.option(
+    "--separator",
+    required=True,
+    help="The separator of the levels of the group names, the group_hierarchy_separator setting.",
+)
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=DEFAULT_BATCH_SIZE,
+    show_default=True,
+    help="The number of groups updated per transaction.",
+)
+def rebuild_group_hierarchy(provider: str, separator: str, batch_size: int) -> None:
+    """Recompute the ancestors of all groups from their names, creating the missing ancestors.
+
+    Run after enabling the group_hierarchy_separator setting or changing its value, and after
+    the import and reconcile commands, which do not create the ancestors of new groups. Each
+    batch of groups is updated in its own short transaction.
+
+    Args:
+        provider: The name of the identity provider of the groups.
+        separator: The separator of the levels of the group names.
+        batch_size: The number of groups updated per transaction.
+    """
+    if not separator:
+        raise click.BadParameter("must not be empty", param_hint="--separator")
+    groups = DBGroup.__table__
+    last_id = 0
+    for first_id, last_id in _iter_id_batches(
+        groups.c.id, batch_size, groups.c.provider == provider
+    ):
+        with db.engine.begin() as connection:
+            rebuild_group_ancestors(connection, provider, first_id, last_id, separator)
+    click.echo(f"Recomputed the ancestors of the groups up to id {last_id}")
+
+
+@cli.command("verify-member-counts")
+@click.option("--rebuild", is_flag=True, help="Recompute the wrong member counts.")
+def verify_member_counts(rebuild: bool) -> None:
+    """Compare the member counts of the groups with their memberships.
+
+    The groups whose counts are wrong are printed, and the command fails if there are any.
+    With --rebuild, their counts are recomputed in a single transaction, during which the writes
+    of memberships wait.
+
+    Args:
+        rebuild: Whether to recompute the wrong member counts.
+
+    Raise:
+        ClickException: If member counts are wrong and not rebuilt.
+    """
+    with db.engine.begin() as connection:
+        if rebuild:
+            mismatches = rebuild_member_counts(connection)
+        else:
+            mismatches = get_member_count_mismatches(connection)
+    for name, stored, actual in mismatches:
+        click.echo(f"{name}: {stored} counted, {actual} members")
+    if rebuild:
+        click.echo(f"Rebuilt the member counts of {len(mismatches)} groups")
+    elif mismatches:
+        raise click.ClickException(f"The member counts of {len(mismatches)} groups are wrong")
+    else:
+        click.echo("The member counts of all groups are correct")
+
+
+def _delete_in_batches(delete: Callable[[Connection, int], DeletedBatch], pause: float) -> int:
+    """Delete batches in separate transactions until no rows are left to examine.
+
+    Args:
+        delete: The function deleting a batch on the connection after the last id of the
+            previous batch.
+        pause: The number of seconds to wait between batches.
+
+    Returns:
+        The total number of deleted rows.
+    """
+    total = 0
+    last_id: Optional[int] = 0
+    while True:
+        with db.engine.begin() as connection:
+            deleted, last_id = delete(connection, last_id or 0)
+        total += deleted
+        if last_id is None:
+            return total
+        time.sleep(pause)
+
+
+@cli.command("cleanup")
+@click.option(
+    "--days",
+    type=click.IntRange(min=1),
+    required=True,
+    help="Delete the users and groups without members not seen for this number of days.",
+)
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=DEFAULT_BATCH_SIZE,
+    show_default=True,
+    help="The number of rows deleted per transaction.",
+)
+@click.option(
+    "--pause",
+    type=click.FloatRange(min=0),
+    default=DEFAULT_PAUSE,
+    show_default=True,
+    help="The number of seconds to wait between batches.",
+)
+@click.option(
+    "--change-days",
+    type=click.IntRange(min=1),
+    help="Also delete the entries of the change log older than this number of days.",
+)
+def cleanup(days: int, batch_size: int, pause: float, change_days: Optional[int]) -> None:
+    """Delete the users and the groups without members which have not been seen for a while.
+
+    The users are deleted first, with their memberships, so that the groups left without
+    members by them are deleted in the same run. Each batch is deleted in its own short
+    transaction, so the command can run while the plugin is in use.
+
+    Args:
+        days: The number of days after which users and groups without members are deleted.
+        batch_size: The number of rows deleted per transaction.
+        pause: The number of seconds to wait between batches.
+        change_days: The number of days after which the entries of the change log are deleted,
+            None to keep them.
+    """
+    cutoff = now_utc() - timedelta(days=days)
+    users = _delete_in_batches(lambda c, i: delete_stale_users(c, cutoff, batch_size, i), pause)
+    groups = 0
+    while True:
+        # the ancestors left without descendants precede them, so they are deleted by a new pass
+        deleted = _delete_in_batches(
+            lambda c, i: delete_orphaned_groups(c, cutoff, batch_size, i), pause
+        )
+        if not deleted:
+            break
+        groups += deleted
+    click.echo(f"Deleted {users} users and {groups} groups not seen for {days} days")
+    if change_days is not None:
+        change_cutoff = now_utc() - timedelta(days=change_days)
+        changes = _delete_in_batches(
+            lambda c, i: delete_old_changes(c, change_cutoff, batch_size, i), pause
+        )
+        click.echo(f"Deleted {changes} changes older than {change_days} days")
+
+
+@cli.command("export")
+@_provider_option
+@click.option(
+    "--format",
+    "format_",
+    type=click.Choice(FORMATS),
+    default=FORMATS[0],
+    show_default=True,
+    help="The format of the file.",
+)
+@click.argument("output", type=click.File("w"), default="-")
+def export(provider: str, format_: str, output: IO[str]) -> None:
+    """Export all groups and their members to OUTPUT, the standard output by default.
+
+    Each record holds a group name and the identifier of one of its members, groups without
+    members are exported with an empty identifier.
+
+    Args:
+        provider: The name of the identity provider of the groups.
+        format_: The format of the file, jsonl or csv.
+        output: The file to write to.
+    """
+    with db.engine.connect() as connection:
+        count = write_memberships(export_memberships(connection, provider), output, format_)
+    click.echo(f"Exported {count} records", err=True)
+
+
+@cli.command("import")
+@_provider_option
+@click.option(
+    "--format",
+    "format_",
+    type=click.Choice(FORMATS),
+    default=FORMATS[0],
+    show_default=True,
+    help="The format of the file.",
+)
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=DEFAULT_TRANSFER_BATCH_SIZE,
+    show_default=True,
+    help="The number of records sent to the database at once.",
+)
+@click.argument("input_", metavar="INPUT", type=click.File("r"), default="-")
+def import_(provider: str, format_: str, batch_size: int, input_: IO[str]) -> None:
+    """Import groups and members from INPUT, the standard input by default.
+
+    The groups, users and memberships of the file are added to the existing ones in a single
+    transaction.
+
+    Args:
+        provider: The name of the identity provider of the groups.
+        format_: The format of the file, jsonl or csv.
+        batch_size: The number of records sent to the database at once.
+        input_: The file to read from.
+    """
+    with db.engine.begin() as connection:
+        count = import_memberships(
+            connection, provider, read_memberships(input_, format_), batch_size
+        )
+    click.echo(f"Imported {count} records", err=True)
+
+
+@cli.command("reconcile")
+@_provider_option
+@click.option(
+    "--format",
+    "format_",
+    type=click.Choice(FORMATS),
+    default=FORMATS[0],
+    show_default=True,
+    help="The format of the file.",
+)
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=DEFAULT_RECONCILE_BATCH_SIZE,
+    show_default=True,
+    help="The number of users synced per transaction.",
+)
+@click.option(
+    "--pause",
+    type=click.FloatRange(min=0),
+    default=DEFAULT_PAUSE,
+    show_default=True,
+    help="The number of seconds to wait between transactions.",
+)
+@click.option("--dry-run", is_flag=True, help="Only print the summary of the differences.")
+@click.argument("input_", metavar="INPUT", type=click.File("r"), default="-")
+# the parameters are the options of the command
+# pylint: disable-next=too-many-arguments
+def reconcile(
+    *, provider: str, format_: str, batch_size: int, pause: float, dry_run: bool, input_: IO[str]
+) -> None:
+    """Make the stored users members of exactly their groups in a full export of the IdP.
+
+    INPUT, the standard input by default, lists the groups of every user of the identity
+    provider sorted by identifier: in jsonl, one object with the identifier and the list of
+    groups per user, in csv, rows of identifier and group. Stored users missing from the export
+    are removed from all groups, users of the export which have never logged in are skipped.
+
+    Args:
+        provider: The name of the identity provider of the export.
+        format_: The format of the file, jsonl or csv.
+        batch_size: The number of users synced per transaction.
+        pause: The number of seconds to wait between transactions.
+        dry_run: Whether to only print the summary of the differences.
+        input_: The file to read from.
+    """
+    summary = reconcile_memberships(
+        db.engine,
+        provider,
+        read_directory(input_, format_),
+        options=ReconcileOptions(batch_size=batch_size, pause=pause, dry_run=dry_run),
+    )
+    for name in (
+        "users_compared",
+        "users_changed",
+        "users_not_stored",
+        "memberships_added",
+        "memberships_removed",
+    ):
+        click.echo(f"{name}: {summary.get(name, 0)}")
+
+
+def _upgrade_database(uri: str, schema: str, revision: str) -> None:
+    """Run the migrations of the plugin on the plugin tables in a schema of a database.
+
+    Args:
+        uri: The SQLAlchemy URI of the database.
+        schema: The schema of the plugin tables.
+        revision: The revision to upgrade to.
+    """
+    engine = create_engine(uri, poolclass=NullPool)
+    try:
+        with engine.connect() as connection:
+            alembic_config = alembic.config.Config(
+                attributes={
+                    migration_env.CONNECTION_ATTRIBUTE: connection,
+                    migration_env.SCHEMA_ATTRIBUTE: schema,
+                }
+            )
+            alembic_config.set_main_option(
+                "script_location", os.path.dirname(migration_env.__file__)
+            )
+            alembic_config.set_main_option("version_locations", MIGRATIONS_PATH)
+            alembic.command.upgrade(alembic_config, revision)
+    finally:
+        engine.dispose()
+
+
+@cli.command("upgrade-shards")
+@_provider_option
+@click.option(
+    "--revision",
+    default="head",
+    show_default=True,
+    help="The revision of the plugin migrations to upgrade the shards to.",
+)
+def upgrade_shards(provider: str, revision: str) -> None:
+    """Create or upgrade the plugin tables on every shard of a sharded identity provider.
+
+    Runs the migrations of the plugin on each shard in turn, as indico db --plugin saml_groups
+    upgrade does on the Indico database, on the schema of the shard. A shard using the
+    plugin_saml_groups schema shares the version table of Indico's migrations in the public
+    schema, so that a shard can be the Indico database. The other shards keep their version table
+    in their schema.
+
+    Args:
+        provider: The name of the identity provider whose shards are upgraded.
+        revision: The revision to upgrade the shards to.
+
+    Raise:
+        UsageError: If the identity provider has no valid shards setting.
+    """
+    try:
+        shards = get_shards(config.IDENTITY_PROVIDERS.get(provider, {}))
+    except ValueError as exc:
+        raise click.UsageError(str(exc)) from exc
+    for index, (uri, schema) in enumerate(shards):
+        _upgrade_database(uri, schema, revision)
+        click.echo(f"Upgraded shard {index} to {revision}")
@@ -0,0 +1,150 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+"""Filtering of the asserted SAML groups before they are stored."""
+
+import re
+from typing import Dict, List, Optional, Pattern, Sequence, Tuple
+
+from flask_multipass_saml_groups.metrics import CounterSet, Histogram
+
+GROUP_INCLUDE_PATTERNS_SETTING = "group_include_patterns"
+GROUP_EXCLUDE_PATTERNS_SETTING = "group_exclude_patterns"
+GROUP_INCLUDE_PREFIXES_SETTING = "group_include_prefixes"
+GROUP_EXCLUDE_PREFIXES_SETTING = "group_exclude_prefixes"
+MAX_GROUPS_SETTING = "max_groups"
+GROUP_COUNT_BUCKET = 10
+
+
+def _get_strings(settings: Dict, setting: str) -> Tuple[str, ...]:
+    """Read a setting containing a list of strings.
+
+    Args:
+        settings: The settings of the identity provider.
+        setting: The name of the setting.
+
+    Raise:
+        ValueError: If the setting is not a list of strings.
+
+    Returns:
+        The strings, empty if the setting is not set.
+    """
+    values = settings.get(setting, [])
+    if not isinstance(values, (list, tuple)) or not all(isinstance(v, str) for v in values):
+        raise ValueError(f"{setting} {values} must be a list of strings")
+    return tuple(values)
+
+
+def _compile_patterns(settings: Dict, setting: str) -> Optional[Pattern[str]]:
+    """Compile the regular expressions of a setting into a single one matching any of them.
+
+    Args:
+        settings: The settings of the identity provider.
+        setting: The name of the setting.
+
+    Raise:
+        ValueError: If the setting is not a list of valid regular expressions.
+
+    Returns:
+        The compiled expression, None if the setting is empty.
+    """
+    patterns = _get_strings(settings, setting)
+    if not patterns:
+        return None
+    for pattern in patterns:
+        try:
+            re.compile(pattern)
+        except re.error as exc:
+            raise ValueError(f"{setting} contains the invalid pattern {pattern}: {exc}") from exc
+    return re.compile("|".join(f"(?:{p})" for p in patterns))
+
+
+class GroupFilter:  # pylint: disable=too-few-public-methods
+    """Drop the asserted groups which should not be stored.
+
+    A group is kept if it matches any of the include patterns or prefixes, or if none are set,
+    and matches none of the exclude patterns and prefixes. The patterns are regular expressions
+    searched anywhere in the group name. If more than max_groups groups are left, the first
+    ones in alphabetical order are kept, so that the same groups are kept at every login.
+
+    Attrs:
+        metrics (CounterSet): The number of asserted and kept groups and of the groups dropped
+            because they were not_included, excluded or over_limit.
+        group_count_histogram (Histogram): The number of groups asserted per login.
+    """
+
+    def __init__(self, settings: Dict):
+        """Read and compile the filter settings.
+
+        Args:
+            settings: The settings of the identity provider.
+
+        Raise:
+            ValueError: If the pattern or prefix settings are not lists of strings, a pattern is
+                invalid or the max_groups setting is not a positive integer.
+        """
+        self._include = _compile_patterns(settings, GROUP_INCLUDE_PATTERNS_SETTING)
+        self._exclude = _compile_patterns(settings, GROUP_EXCLUDE_PATTERNS_SETTING)
+        self._include_prefixes = _get_strings(settings, GROUP_INCLUDE_PREFIXES_SETTING)
+        self._exclude_prefixes = _get_strings(settings, GROUP_EXCLUDE_PREFIXES_SETTING)
+        self._max_groups: Optional[int] = settings.get(MAX_GROUPS_SETTING)
+        if self._max_groups is not None and (
+            not isinstance(self._max_groups, int) or self._max_groups <= 0
+        ):
+            raise ValueError(f"{MAX_GROUPS_SETTING} {self._max_groups} must be a positive integer")
+        self.metrics = CounterSet()
+        self.group_count_histogram = Histogram(bucket_width=GROUP_COUNT_BUCKET)
+
+    def _is_included(self, group_name: str) -> bool:
+        """Check whether a group matches the include patterns or prefixes.
+
+        Args:
+            group_name: The name of the group.
+
+        Returns:
+            True if no include rule is set or the group matches one of them.
+        """
+        if self._include is None and not self._include_prefixes:
+            return True
+        return bool(
+            (self._include is not None and self._include.search(group_name))
+            or group_name.startswith(self._include_prefixes)
+        )
+
+    def _is_excluded(self, group_name: str) -> bool:
+        """Check whether a group matches the exclude patterns or prefixes.
+
+        Args:
+            group_name: The name of the group.
+
+        Returns:
+            True if the group matches one of the exclude rules.
+        """
+        return bool(
+            (self._exclude is not None and self._exclude.search(group_name))
+            or group_name.startswith(self._exclude_prefixes)
+        )
+
+    def apply(self, group_names: Sequence[str]) -> List[str]:
+        """Drop the groups which should not be stored and count them.
+
+        Args:
+            group_names: The names of the asserted groups.
+
+        Returns:
+            The distinct names of the kept groups, sorted.
+        """
+        asserted = sorted(set(group_names))
+        self.group_count_histogram.observe(len(asserted))
+        included = [n for n in asserted if self._is_included(n)]
+        kept = [n for n in included if not self._is_excluded(n)]
+        over_limit = 0
+        if self._max_groups is not None and len(kept) > self._max_groups:
+            over_limit = len(kept) - self._max_groups
+            kept = kept[: self._max_groups]
+        self.metrics.inc("asserted", len(asserted))
+        self.metrics.inc("kept", len(kept))
+        self.metrics.inc("not_included", len(asserted) - len(included))
+        self.metrics.inc("excluded", len(included) - len(kept) - over_limit)
+        self.metrics.inc("over_limit", over_limit)
+        return kept
@@ -0,0 +1,195 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+"""Storage and search of the identity attributes of the users.
+
+The attributes mapped by the identity provider at the last login of a user are kept, so that
+identities can be retrieved and searched without the user logging in. A search matches the
+lower-cased attributes exactly or by prefix, which is served by the indexes of the attributes on
+PostgreSQL.
+"""
+
+from typing import Dict, Iterable, List, Mapping, Optional, Set, Tuple
+
+from sqlalchemy import and_, false, func, or_, select
+from sqlalchemy.engine import Connection
+from sqlalchemy.sql.elements import ColumnElement
+
+from flask_multipass_saml_groups.group_provider.bulk import (
+    chunked,
+    get_user_ids,
+    insert_or_update,
+    lock_identifiers,
+)
+from flask_multipass_saml_groups.models.saml_groups import (
+    SAMLUser,
+    SAMLUserAttributes,
+    get_identifier_key,
+)
+
+ATTRIBUTE_NAMES = ("first_name", "last_name", "email", "affiliation")
+# a search criterion matching words of the first or last name, as sent by Indico
+NAME_CRITERION = "name"
+LIKE_ESCAPE = "\\"
+
+Attributes = Dict[str, Optional[str]]
+
+
+def store_attributes(
+    connection: Connection, provider: str, identifier: str, attributes: Mapping
+) -> None:
+    """Store the attributes of a user, creating the user if it does not exist yet.
+
+    The user is locked like for a sync, so that it is not deleted concurrently. The row of the
+    user is only written if one of the attributes has changed.
+
+    Args:
+        connection: The connection to use.
+        provider: The name of the identity provider of the user.
+        identifier: The unique user identifier used by the provider.
+        attributes: The mapped identity attributes, of which those in ATTRIBUTE_NAMES are kept.
+    """
+    lock_identifiers(connection, [identifier])
+    user_id = get_user_ids(connection, provider, [identifier])[identifier]
+    connection.execute(
+        insert_or_update(connection, SAMLUserAttributes.__table__),
+        {"user_id": user_id, **{name: attributes.get(name) for name in ATTRIBUTE_NAMES}},
+    )
+
+
+def get_attributes(
+    connection: Connection, provider: str, identifiers: Iterable[str]
+) -> Dict[str, Attributes]:
+    """Get the attributes of users.
+
+    Args:
+        connection: The connection to use.
+        provider: The name of the identity provider of the users.
+        identifiers: The unique user identifiers used by the provider.
+
+    Returns:
+        A mapping of the identifiers of the existing users to their attributes, whose values are
+        None if they have not been stored.
+    """
+    users = SAMLUser.__table__
+    attributes = SAMLUserAttributes.__table__
+    columns = [attributes.c[name] for name in ATTRIBUTE_NAMES]
+    result: Dict[str, Attributes] = {}
+    for chunk in chunked({get_identifier_key(i) for i in identifiers}):
+        rows = connection.execute(
+            select(users.c.identifier, *columns)
+            .select_from(users.outerjoin(attributes))
+            .where(users.c.provider == provider, users.c.identifier_key.in_(chunk))
+        )
+        result.update((row[0], dict(zip(ATTRIBUTE_NAMES, row[1:]))) for row in rows)
+    return result
+
+
+def search_attributes(
+    connection: Connection,
+    provider: str,
+    criteria: Mapping[str, Set[str]],
+    exact: bool = False,
+    limit: Optional[int] = None,
+) -> Tuple[List[Tuple[str, Attributes]], int]:
+    """Search users by their attributes.
+
+    A user matches if each criterion matches one of its values. The name criterion matches
+    users whose first or last name starts with each of the words of the value. Users without an
+    email address are never found, since applications identify the found users by it.
+
+    Args:
+        connection: The connection to use.
+        provider: The name of the identity provider of the users.
+        criteria: The attribute names and the values to search for.
+        exact: Whether the attributes must be equal to the values instead of starting with them.
+            The comparison ignores the case.
+        limit: The maximum number of users to return, None for all.
+
+    Returns:
+        The identifiers and attributes of the matching users ordered by identifier, and the
+        total number of matching users.
+    """
+    conditions = [_match_criterion(name, values, exact) for name, values in criteria.items()]
+    if not conditions:
+        return [], 0
+    users = SAMLUser.__table__
+    attributes = SAMLUserAttributes.__table__
+    condition = and_(users.c.provider == provider, attributes.c.email.isnot(None), *conditions)
+    query = (
+        select(users.c.identifier, *(attributes.c[name] for name in ATTRIBUTE_NAMES))
+        .select_from(attributes.join(users))
+        .where(condition)
+        .order_by(users.c.identifier)
+        .limit(limit)
+    )
+    found = [(row[0], dict(zip(ATTRIBUTE_NAMES, row[1:]))) for row in connection.execute(query)]
+    total = len(found)
+    if limit is not None and total == limit:
+        total = connection.execute(
+            select(func.count()).select_from(attributes.join(users)).where(condition)
+        ).scalar_one()
+    return found, total
+
+
+def _match_criterion(name: str, values: Set[str], exact: bool) -> ColumnElement:
+    """Create the condition of a search criterion.
+
+    Args:
+        name: The name of the attribute or name for the first or last name.
+        values: The values to search for, of which one must match.
+        exact: Whether the attribute must be equal to the value instead of starting with it.
+
+    Returns:
+        The condition, which is false for attributes which are not stored.
+    """
+    attributes = SAMLUserAttributes.__table__
+    if name == NAME_CRITERION:
+        return or_(*(_match_name(value, exact) for value in values))
+    if name not in ATTRIBUTE_NAMES:
+        return false()
+    return or_(*(_match_value(attributes.c[name], value, exact) for value in values))
+
+
+def _match_name(value: str, exact: bool) -> ColumnElement:
+    """Match each word of a value with the first or the last name.
+
+    Args:
+        value: The words to search for, separated by spaces or commas.
+        exact: Whether the names must be equal to the words instead of starting with them.
+
+    Returns:
+        The condition, which is false if the value contains no words.
+    """
+    attributes = SAMLUserAttributes.__table__
+    words = value.replace(",", " ").split()
+    if not words:
+        return false()
+    return and_(
+        *(
+            or_(
+                _match_value(attributes.c.first_name, word, exact),
+                _match_value(attributes.c.last_name, word, exact),
+            )
+            for word in words
+        )
+    )
+
+
+def _match_value(column: ColumnElement, value: str, exact: bool) -> ColumnElement:
+    """Compare an attribute with a value ignoring the case.
+
+    Args:
+        column: The column of the attribute.
+        value: The value to search for.
+        exact: Whether the attribute must be equal to the value instead of starting with it.
+
+    Returns:
+        The condition.
+    """
+    value = value.lower()
+    if exact:
+        return func.lower(column) == value
+    for special in (LIKE_ESCAPE, "%", "_"):
+        value = value.replace(special, LIKE_ESCAPE + special)
+    return func.lower(column).like(f"{value}%", escape=LIKE_ESCAPE)
@@ -3,9 +3,111 @@
 """Defines the interface for a group provider."""
 
 from abc import ABCMeta, abstractmethod
-from typing import Iterable, Optional
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
 
-from flask_multipass import Group, IdentityProvider
+from flask_multipass import Group, IdentityInfo, IdentityProvider
+from flask_multipass.util import convert_app_data
+
+# the group names of the all_of, any_of and none_of parts of a set expression
+MemberExpression = Tuple[Set[str], Set[str], Set[str]]
+
+
+def check_member_expression(
+    all_of: Iterable[str], any_of: Iterable[str], none_of: Iterable[str]
+) -> MemberExpression:
+    """Check a set expression over the members of groups.
+
+    Args:
+        all_of: The names of the groups the users must all be members of.
+        any_of: The names of the groups the users must be a member of at least one of.
+        none_of: The names of the groups the users must not be members of.
+
+    Raise:
+        ValueError: If neither all_of nor any_of is given, which would select the users who are
+            not members of any group.
+
+    Returns:
+        The distinct group names of each part of the expression.
+    """
+    all_of, any_of, none_of = set(all_of), set(any_of), set(none_of)
+    if not all_of and not any_of:
+        raise ValueError("The expression must contain groups in all_of or any_of")
+    return all_of, any_of, none_of
+
+
+def sort_group_counts(
+    counts: Iterable[Tuple[str, int]], by_size: bool = False, limit: Optional[int] = None
+) -> List[Tuple[str, int]]:
+    """Sort group names with their member counts.
+
+    Args:
+        counts: The group names and member counts.
+        by_size: Whether to order the groups by decreasing member count instead of by name.
+            Groups with the same count are ordered by name.
+        limit: The maximum number of groups to return, None for all.
+
+    Returns:
+        The sorted group names and member counts.
+    """
+    if by_size:
+        return sorted(counts, key=lambda c: (-c[1], c[0]))[:limit]
+    return sorted(counts)[:limit]
+
+
+def make_identity_info(
+    provider: IdentityProvider, identifier: str, attributes: Optional[Dict[str, Optional[str]]]
+) -> IdentityInfo:
+    """Create the identity information of a user from its stored attributes.
+
+    Args:
+        provider: The identity provider of the user, whose mapping is applied to the attributes.
+        identifier: The unique user identifier used by the provider.
+        attributes: The stored attributes, None if there are none.
+
+    Returns:
+        The identity information.
+    """
+    mapping = provider.settings.get("mapping") or {}
+    return IdentityInfo(provider, identifier, **convert_app_data(attributes or {}, mapping))
+
+
+# pylint: disable-next=unused-argument
+def no_pending_group_names(identifier: str) -> Optional[List[str]]:
+    """Get the groups of a user not applied yet, of which there are none.
+
+    Args:
+        identifier: The unique user identifier used by the provider.
+
+    Returns:
+        None.
+    """
+    return None
+
+
+def get_pending_lookup(
+    identity_provider: IdentityProvider,
+) -> Callable[[str], Optional[List[str]]]:
+    """Get the function looking up the groups of a user which a deferred sync has not applied yet.
+
+    Args:
+        identity_provider: The identity provider of the groups.
+
+    Returns:
+        The get_pending_group_names method of the identity provider, or no_pending_group_names if
+        the identity provider does not defer the syncs.
+    """
+    return getattr(identity_provider, "get_pending_group_names", no_pending_group_names)
 
 
 class GroupProvider(metaclass=ABCMeta):
@@ -13,9 +115,12 @@ class GroupProvider(metaclass=ABCMeta):
 
     Attrs:
         group_class (type): The class to use for groups.
+        supports_identity_attributes (bool): If the provider stores the identity attributes of
+            the users
     """
 
     group_class = Group
+    supports_identity_attributes = False
 
     def __init__(self, identity_provider: IdentityProvider):
         """Initialize the group provider.
@@ -24,6 +129,31 @@ class GroupProvider(metaclass=ABCMeta):
             identity_provider: The associated identity provider. Usually required because the group
                 needs to know the identity provider.
         """
+        self._identity_provider = identity_provider
+
+    def expand_group_names(self, group_names: Iterable[str]) -> List[str]:
+        """Add the groups a user is a member of through membership in the given groups.
+
+        This implementation adds none.
+
+        Args:
+            group_names: The names of the groups.
+
+        Returns:
+            The sorted distinct names of the groups.
+        """
+        return sorted(set(group_names))
+
+    def make_group(self, name: str) -> Group:
+        """Create a group object without checking that the group exists.
+
+        Args:
+            name: The name of the group.
+
+        Returns:
+            An instance of group_class.
+        """
+        return self.group_class(provider=self._identity_provider, name=name)
 
     @abstractmethod
     def add_group(self, name: str) -> None:  # pragma: no cover
@@ -83,3 +213,131 @@ class GroupProvider(metaclass=ABCMeta):
             identifier: The unique user identifier used by the provider.
             group_name: The name of the group.
         """
+
+    def find_member_identifiers(
+        self, all_of: Iterable[str] = (), any_of: Iterable[str] = (), none_of: Iterable[str] = ()
+    ) -> Iterator[str]:
+        """Find the users who are members of all of, any of and none of the given groups.
+
+        For instance, the members of A and B but not C are found with all_of=["A", "B"] and
+        none_of=["C"]. This implementation intersects the members of the groups in Python,
+        providers should evaluate the expression in their storage instead.
+
+        Args:
+            all_of: The names of the groups the users must all be members of.
+            any_of: The names of the groups the users must be a member of at least one of.
+            none_of: The names of the groups the users must not be members of.
+
+        Raise:
+            ValueError: If neither all_of nor any_of is given.
+
+        Returns:
+            An iterator over the sorted unique user identifiers.
+        """
+        all_of, any_of, none_of = check_member_expression(all_of, any_of, none_of)
+
+        def get_identifiers(group_name: str) -> Set[str]:
+            group = self.get_group(group_name)
+            return {m.identifier for m in group.get_members()} if group else set()
+
+        candidates = [get_identifiers(name) for name in all_of]
+        if any_of:
+            candidates.append(set().union(*map(get_identifiers, any_of)))
+        identifiers = set.intersection(*candidates).difference(*map(get_identifiers, none_of))
+        return iter(sorted(identifiers))
+
+    def get_groups_with_counts(
+        self, by_size: bool = False, limit: Optional[int] = None
+    ) -> List[Tuple[str, int]]:
+        """Get the names of all groups with their numbers of members.
+
+        This implementation lists the members of every group, providers should maintain the
+        counts in their storage instead.
+
+        Args:
+            by_size: Whether to order the groups by decreasing member count instead of by name.
+                Groups with the same count are ordered by name.
+            limit: The maximum number of groups to return, None for all.
+
+        Returns:
+            The group names and member counts.
+        """
+        counts = [(g.name, sum(1 for _ in g.get_members())) for g in self.get_groups()]
+        return sort_group_counts(counts, by_size, limit)
+
+    def set_identity_attributes(self, identifier: str, attributes: Mapping) -> None:
+        """Store the identity attributes of a user.
+
+        This implementation does nothing.
+
+        Args:
+            identifier: The unique user identifier used by the provider.
+            attributes: The identity attributes mapped by the identity provider.
+        """
+
+    # pylint: disable-next=unused-argument
+    def get_identity_attributes(self, identifier: str) -> Optional[Dict[str, Optional[str]]]:
+        """Get the stored identity attributes of a user.
+
+        This implementation stores no attributes.
+
+        Args:
+            identifier: The unique user identifier used by the provider.
+
+        Returns:
+            The attributes, None if the user does not exist.
+        """
+        return None
+
+    def search_identity_attributes(  # pylint: disable=unused-argument
+        self, criteria: Mapping[str, Set[str]], exact: bool = False, limit: Optional[int] = None
+    ) -> Tuple[List[Tuple[str, Dict[str, Optional[str]]]], int]:
+        """Search users by their stored identity attributes.
+
+        This implementation stores no attributes.
+
+        Args:
+            criteria: The attribute names and the values to search for.
+            exact: Whether the attributes must be equal to the values instead of starting with
+                them.
+            limit: The maximum number of users to return, None for all.
+
+        Returns:
+            The identifiers and attributes of the matching users and the total number of
+            matching users.
+        """
+        return [], 0
+
+    # pylint: disable-next=unused-argument
+    def warm_up(self, deadline: float) -> int:
+        """Prepare the provider for the first requests, e.g. by opening database connections.
+
+        This implementation does nothing.
+
+        Args:
+            deadline: The time.monotonic() value after which no more work is started.
+
+        Returns:
+            The number of groups loaded ahead of the requests.
+        """
+        return 0
+
+    def sync_user_groups(
+        self, identifier: str, group_names: Sequence[str], attributes: Optional[Mapping] = None
+    ) -> None:
+        """Make the user a member of exactly the given groups and store its identity attributes.
+
+        Args:
+            identifier: The unique user identifier used by the provider.
+            group_names: The names of all groups the user belongs to.
+            attributes: The identity attributes mapped by the identity provider, None to keep
+                the stored ones.
+        """
+        for group in self.get_user_groups(identifier=identifier):
+            if group.name not in group_names:
+                self.remove_group_member(group_name=group.name, identifier=identifier)
+
+        for group_name in group_names:
+            self.add_group_member(group_name=group_name, identifier=identifier)
+        if attributes is not None:
+            self.set_identity_attributes(identifier, attributes)
@@ -0,0 +1,926 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+"""Set-based statements writing many group memberships at once."""
+
+from collections import Counter
+from datetime import datetime, timedelta
+from hashlib import blake2b
+from itertools import islice
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+)
+
+from indico.util.date_time import now_utc
+from sqlalchemy import String, Table, and_, exists, func, literal, null, or_, select, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Connection
+from sqlalchemy.sql import Select
+from sqlalchemy.sql.dml import Insert
+from sqlalchemy.sql.elements import ColumnElement
+
+from flask_multipass_saml_groups.group_provider.changelog import append_changes
+from flask_multipass_saml_groups.models.saml_groups import SAMLGroup as DBGroup
+from flask_multipass_saml_groups.models.saml_groups import (
+    SAMLUser,
+    get_identifier_key,
+    group_ancestors_table,
+    group_member_counts_table,
+    group_members_table,
+)
+
+_INSERT_FUNCTIONS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+# the last_seen_at of users and groups is refreshed by a sync only once it is older than this,
+# so that the syncs of a day write it once
+LAST_SEEN_RESOLUTION = timedelta(days=1)
+
+# the number of values bound per IN list or multi-row statement, which keeps the statements of
+# users with thousands of groups below the bound parameter limit of SQLite and of bounded size
+IN_CHUNK_SIZE = 1000
+
+T = TypeVar("T")
+
+
+class WriteOptions(NamedTuple):
+    """The settings of the identity provider affecting the membership writes.
+
+    Attrs:
+        separator: The separator of hierarchical group names, see get_group_ids.
+        group_names: Whether to refresh the denormalized group names of the changed users, which
+            are cleared otherwise.
+        change_log: Whether to append the changes to the change log.
+    """
+
+    separator: Optional[str] = None
+    group_names: bool = True
+    change_log: bool = True
+
+
+class SyncState(NamedTuple):
+    """The state of users read by a sync.
+
+    Attrs:
+        memberships: The memberships as returned by get_memberships, including the existing
+            users without groups.
+        users_seen: The last_seen_at of the existing users, keyed by identifier.
+        groups_seen: The last_seen_at of their current groups, keyed by name.
+    """
+
+    memberships: Dict[str, Dict[str, Tuple[int, int]]]
+    users_seen: Dict[str, datetime]
+    groups_seen: Dict[str, datetime]
+
+
+def chunked(values: Iterable[T], size: int = IN_CHUNK_SIZE) -> Iterator[List[T]]:
+    """Split values into chunks.
+
+    Args:
+        values: The values, sorted if the chunks must be processed in a stable order.
+        size: The maximum number of values per chunk.
+
+    Yields:
+        The chunks.
+    """
+    iterator = iter(values)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def insert_ignore(connection: Connection, table: Table) -> Insert:
+    """Create an INSERT statement which skips rows violating a unique constraint.
+
+    Args:
+        connection: The connection the statement will be executed on.
+        table: The table to insert into.
+
+    Raise:
+        ValueError: If the database of the connection is not supported.
+
+    Returns:
+        The INSERT ... ON CONFLICT DO NOTHING statement.
+    """
+    return _get_insert(connection)(table).on_conflict_do_nothing()
+
+
+def insert_or_update(connection: Connection, table: Table) -> Insert:
+    """Create an INSERT statement which updates the rows conflicting on the primary key.
+
+    The conflicting rows are only written if one of their values differs.
+
+    Args:
+        connection: The connection the statement will be executed on.
+        table: The table to insert into.
+
+    Raise:
+        ValueError: If the database of the connection is not supported.
+
+    Returns:
+        The INSERT ... ON CONFLICT DO UPDATE statement.
+    """
+    statement = _get_insert(connection)(table)
+    columns = [c for c in table.c if not c.primary_key]
+    return statement.on_conflict_do_update(
+        index_elements=table.primary_key.columns,
+        set_={c.name: statement.excluded[c.name] for c in columns},
+        where=or_(*(c.is_distinct_from(statement.excluded[c.name]) for c in columns)),
+    )
+
+
+def _get_insert(connection: Connection) -> Callable[[Table], Insert]:
+    """Get the function creating the INSERT statements of the database of a connection.
+
+    Args:
+        connection: The connection the statement will be executed on.
+
+    Raise:
+        ValueError: If the database of the connection is not supported.
+
+    Returns:
+        The insert function of the dialect, which supports ON CONFLICT.
+    """
+    try:
+        return _INSERT_FUNCTIONS[connection.dialect.name]
+    except KeyError as exc:
+        raise ValueError(f"Unsupported database {connection.dialect.name}") from exc
+
+
+def get_user_ids(
+    connection: Connection, provider: str, identifiers: Iterable[str]
+) -> Dict[str, int]:
+    """Get the ids of users, creating the users which do not exist yet.
+
+    Args:
+        connection: The connection to use.
+        provider: The name of the identity provider of the users.
+        identifiers: The unique user identifiers used by the provider.
+
+    Returns:
+        A mapping of identifiers to user ids.
+    """
+    users = SAMLUser.__table__
+    identifiers = set(identifiers)
+    if not identifiers:
+        return {}
+    keys = {get_identifier_key(i): i for i in identifiers}
+    connection.execute(
+        insert_ignore(connection, users),
+        [
+            {"provider": provider, "identifier": i, "identifier_key": k}
+            for k, i in sorted(keys.items())
+        ],
+    )
+    user_ids: Dict[str, int] = {}
+    for chunk in chunked(keys):
+        rows = connection.execute(
+            select(users.c.identifier_key, users.c.id).where(
+                users.c.provider == provider, users.c.identifier_key.in_(chunk)
+            )
+        )
+        user_ids.update((keys[key], user_id) for key, user_id in rows)
+    return user_ids
+
+
+def get_group_ids(
+    connection: Connection,
+    provider: str,
+    group_names: Iterable[str],
+    separator: Optional[str] = None,
+) -> Dict[str, int]:
+    """Get the ids of groups, creating the groups which do not exist yet.
+
+    Args:
+        connection: The connection to use.
+        provider: The name of the identity provider of the groups.
+        group_names: The names of the groups.
+        separator: The separator of the levels of hierarchical group names, None if the groups
+            are not hierarchical. If set, the missing ancestors of the groups are created too.
+
+    Returns:
+        A mapping of group names to group ids.
+    """
+    groups = DBGroup.__table__
+    group_names = set(group_names)
+    if not group_names:
+        return {}
+    connection.execute(
+        insert_ignore(connection, groups),
+        [{"provider": provider, "name": n} for n in sorted(group_names)],
+    )
+    group_ids: Dict[str, int] = {}
+    for chunk in chunked(group_names):
+        rows = connection.execute(
+            select(groups.c.name, groups.c.id).where(
+                groups.c.provider == provider, groups.c.name.in_(chunk)
+            )
+        )
+        group_ids.update(rows.all())
+    if separator:
+        add_group_ancestors(connection, provider, group_ids, separator)
+    return group_ids
+
+
+def get_ancestor_names(group_name: str, separator: str) -> List[str]:
+    """Get the names of the ancestors of a hierarchical group.
+
+    Args:
+        group_name: The name of the group, e.g. eng/platform/sre.
+        separator: The separator of the levels, e.g. /.
+
+    Returns:
+        The names of the ancestors from the root, e.g. eng and eng/platform.
+    """
+    parts = group_name.split(separator)
+    prefixes = (separator.join(parts[:level]) for level in range(1, len(parts)))
+    return [prefix for prefix in prefixes if prefix]
+
+
+def add_group_ancestors(
+    connection: Connection, provider: str, group_ids: Mapping[str, int], separator: str
+) -> None:
+    """Add the missing rows of groups to the closure of the group hierarchy.
+
+    The rows of a group are written once, when the group is first seen with the hierarchy
+    enabled, which is recorded by the row of the group being its own ancestor. The missing
+    ancestor groups are created with their rows.
+
+    Args:
+        connection: The connection to use.
+        provider: The name of the identity provider of the groups.
+        group_ids: A mapping of the group names to their ids.
+        separator: The separator of the levels of the group names.
+    """
+    ancestors = group_ancestors_table
+    known: Set[int] = set()
+    for chunk in chunked(sorted(group_ids.values())):
+        known.update(
+            connection.execute(
+                select(ancestors.c.group_id).where(
+                    ancestors.c.group_id.in_(chunk),
+                    ancestors.c.ancestor_id == ancestors.c.group_id,
+                )
+            ).scalars()
+        )
+    missing = {name for name, group_id in group_ids.items() if group_id not in known}
+    if not missing:
+        return
+    # the ancestors of the ancestors are among the ancestors, so all their ids are read at once
+    lineages = {name: get_ancestor_names(name, separator) for name in missing}
+    for name in {a for names in lineages.values() for a in names} - group_ids.keys():
+        lineages[name] = get_ancestor_names(name, separator)
+    ids = dict(group_ids)
+    ids.update(get_group_ids(connection, provider, lineages.keys() - ids.keys()))
+    rows = sorted(
+        {(ids[a], ids[name]) for name, names in lineages.items() for a in [name, *names]}
+    )
+    connection.execute(
+        insert_ignore(connection, ancestors),
+        [{"ancestor_id": ancestor_id, "group_id": group_id} for ancestor_id, group_id in rows],
+    )
+
+
+def rebuild_group_ancestors(
+    connection: Connection, provider: str, first_id: int, last_id: int, separator: str
+) -> None:
+    """Recompute the closure of the group hierarchy for the groups of a provider in a range.
+
+    Args:
+        connection: The connection to use.
+        provider: The name of the identity provider of the groups.
+        first_id: The first group id of the range.
+        last_id: The last group id of the range.
+        separator: The separator of the levels of the group names.
+    """
+    groups = DBGroup.__table__
+    group_ids = select(groups.c.id).where(
+        groups.c.provider == provider, groups.c.id.between(first_id, last_id)
+    )
+    connection.execute(
+        group_ancestors_table.delete().where(group_ancestors_table.c.group_id.in_(group_ids))
+    )
+    rows = connection.execute(group_ids.add_columns(groups.c.name))
+    add_group_ancestors(connection, provider, {name: id_ for id_, name in rows}, separator)
+
+
+def insert_memberships(
+    connection: Connection,
+    provider: str,
+    memberships: Iterable[Tuple[str, str]],
+    options: WriteOptions = WriteOptions(),
+) -> None:
+    """Add users to groups, creating missing users and groups.
+
+    Memberships which already exist are skipped. The group names of the users, or cleared if
+    disabled by the options, and the member counts of the groups are refreshed and the added
+    memberships are appended to the change log, if enabled by the options.
+
+    Args:
+        connection: The connection to use.
+        provider: The name of the identity provider of the users and groups.
+        memberships: Pairs of user identifiers and group names.
+        options: The settings of the identity provider affecting the writes.
+    """
+    memberships = set(memberships)
+    if not memberships:
+        return
+    identifiers = {identifier for identifier, _ in memberships}
+    lock_identifiers(connection, identifiers)
+    current = get_memberships(connection, provider, identifiers)
+    added = {(i, n) for i, n in memberships if n not in current.get(i, {})}
+    if not added:
+        return
+    group_ids = _insert_memberships(connection, provider, added, options.separator)
+    refresh_group_names(
+        connection, provider, {identifier for identifier, _ in added}, clear=not options.group_names
+    )
+    add_member_counts(connection, added=(group_ids[name] for _, name in added))
+    if options.change_log:
+        append_changes(connection, provider, added=added)
+
+
+def _insert_memberships(
+    connection: Connection,
+    provider: str,
+    memberships: Set[Tuple[str, str]],
+    separator: Optional[str],
+) -> Dict[str, int]:
+    """Add users to groups, creating missing users and groups.
+
+    Args:
+        connection: The connection to use.
+        provider: The name of the identity provider of the users and groups.
+        memberships: Pairs of user identifiers and group names.
+        separator: The separator of hierarchical group names, see get_group_ids.
+
+    Returns:
+        A mapping of the group names to their ids.
+    """
+    user_ids = get_user_ids(connection, provider, (identifier for identifier, _ in memberships))
+    group_ids = get_group_ids(connection, provider, (name for _, name in memberships), separator)
+    connection.execute(
+        insert_ignore(connection, group_members_table),
+        [
+            {"group_id": group_ids[group_name], "user_id": user_ids[identifier]}
+            for identifier, group_name in sorted(memberships)
+        ],
+    )
+    return group_ids
+
+
+def delete_memberships(
+    connection: Connection,
+    provider: str,
+    memberships: Iterable[Tuple[str, str]],
+    options: WriteOptions = WriteOptions(),
+) -> None:
+    """Remove users from groups.
+
+    Memberships, users and groups which do not exist are skipped. The group names of the users,
+    or cleared if disabled by the options, and the member counts of the groups are refreshed and
+    the removed memberships are appended to the change log, if enabled by the options.
+
+    Args:
+        connection: The connection to use.
+        provider: The name of the identity provider of the users and groups.
+        memberships: Pairs of user identifiers and group names.
+        options: The settings of the identity provider affecting the writes.
+    """
+    memberships = set(memberships)
+    if not memberships:
+        return
+    identifiers = {identifier for identifier, _ in memberships}
+    lock_identifiers(connection, identifiers)
+    current = get_memberships(connection, provider, identifiers)
+    removed = {(i, n): current[i][n] for i, n in memberships if n in current.get(i, {})}
+    if not removed:
+        return
+    _delete_memberships(connection, removed.values())
+    refresh_group_names(
+        connection,
+        provider,
+        {identifier for identifier, _ in removed},
+        clear=not options.group_names,
+    )
+    add_member_counts(connection, removed=(group_id for group_id, _ in removed.values()))
+    if options.change_log:
+        append_changes(connection, provider, removed=removed)
+
+
+def _delete_memberships(connection: Connection, ids: Iterable[Tuple[int, int]]) -> None:
+    """Delete memberships by their ids, with one statement per user and chunk of groups.
+
+    Args:
+        connection: The connection to use.
+        ids: Pairs of group and user ids.
+    """
+    group_ids: Dict[int, List[int]] = {}
+    for group_id, user_id in sorted(ids):
+        group_ids.setdefault(user_id, []).append(group_id)
+    for user_id, user_group_ids in sorted(group_ids.items()):
+        for chunk in chunked(user_group_ids):
+            connection.execute(
+                group_members_table.delete().where(
+                    group_members_table.c.user_id == user_id,
+                    group_members_table.c.group_id.in_(chunk),
+                )
+            )
+
+
+def add_member_counts(
+    connection: Connection, added: Iterable[int] = (), removed: Iterable[int] = ()
+) -> None:
+    """Update the member counts of groups by the added and removed memberships.
+
+    The counts are updated in a single statement in the order of the group ids, so that
+    concurrent writers lock them in the same order. As the counts of popular groups are updated
+    by many writers, this should be the last write before the change log is appended to.
+
+    Args:
+        connection: The connection to use.
+        added: The group ids of the added memberships, once per membership.
+        removed: The group ids of the removed memberships, once per membership.
+    """
+    deltas = Counter(added)
+    deltas.subtract(removed)
+    rows = [
+        {"group_id": group_id, "member_count": delta}
+        for group_id, delta in sorted(deltas.items())
+        if delta
+    ]
+    if rows:
+        connection.execute(_add_member_counts(connection), rows)
+
+
+def add_member_counts_from_select(connection: Connection, query: Select) -> None:
+    """Update the member counts of groups by the numbers of added members selected by a query.
+
+    Args:
+        connection: The connection to use.
+        query: The query selecting the group ids and their numbers of added members, ordered by
+            group id.
+    """
+    connection.execute(_add_member_counts(connection, query))
+
+
+def _add_member_counts(connection: Connection, query: Optional[Select] = None) -> Insert:
+    """Create the statement adding to the member counts of groups, creating the missing counts.
+
+    Args:
+        connection: The connection the statement will be executed on.
+        query: The query selecting the group ids and the numbers to add, None for a statement
+            with parameters.
+
+    Returns:
+        The INSERT ... ON CONFLICT DO UPDATE statement.
+    """
+    counts = group_member_counts_table
+    insert = _get_insert(connection)(counts)
+    if query is not None:
+        insert = insert.from_select([counts.c.group_id, counts.c.member_count], query)
+    return insert.on_conflict_do_update(
+        index_elements=[counts.c.group_id],
+        set_={"member_count": counts.c.member_count + insert.excluded.member_count},
+    )
+
+
+def lock_key(identifier: str) -> int:
+    """Derive the advisory lock key of a user.
+
+    Args:
+        identifier: The unique user identifier used by the provider.
+
+    Returns:
+        A signed 64 bit integer which is stable across processes.
+    """
+    digest = blake2b(identifier.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+def lock_identifiers(connection: Connection, identifiers: Iterable[str]) -> None:
+    """Serialize the syncs of the given users until the end of the transaction.
+
+    Uses transaction level advisory locks on PostgreSQL, acquired in a stable order so that
+    concurrent batches cannot deadlock. Other databases serialize all writers anyway.
+
+    Args:
+        connection: The connection whose transaction holds the locks.
+        identifiers: The unique user identifiers used by the provider.
+    """
+    if connection.dialect.name != "postgresql":
+        return
+    for identifier in sorted(set(identifiers)):
+        connection.execute(select(func.pg_advisory_xact_lock(lock_key(identifier))))
+
+
+def get_memberships(
+    connection: Connection, provider: str, identifiers: Iterable[str]
+) -> Dict[str, Dict[str, Tuple[int, int]]]:
+    """Get the current memberships of users.
+
+    Args:
+        connection: The connection to use.
+        provider: The name of the identity provider of the users.
+        identifiers: The unique user identifiers used by the provider.
+
+    Returns:
+        A mapping of identifiers to a mapping of the names of their groups to the group and
+        user ids of the membership. Users without groups are omitted.
+    """
+    memberships = get_sync_state(connection, provider, identifiers).memberships
+    return {identifier: groups for identifier, groups in memberships.items() if groups}
+
+
+def is_member(connection: Connection, provider: str, identifier: str, group_name: str) -> bool:
+    """Check if a user is a member of a group without loading the other memberships.
+
+    Args:
+        connection: The connection to use.
+        provider: The name of the identity provider of the user and the group.
+        identifier: The unique user identifier used by the provider.
+        group_name: The name of the group.
+
+    Returns:
+        True if the user is a member of the group, False otherwise.
+    """
+    users = SAMLUser.__table__
+    groups = DBGroup.__table__
+    query = select(
+        exists().where(
+            group_members_table.c.user_id == users.c.id,
+            group_members_table.c.group_id == groups.c.id,
+            users.c.provider == provider,
+            users.c.identifier_key == get_identifier_key(identifier),
+            groups.c.provider == provider,
+            groups.c.name == group_name,
+        )
+    )
+    return bool(connection.execute(query).scalar())
+
+
+def get_sync_state(connection: Connection, provider: str, identifiers: Iterable[str]) -> SyncState:
+    """Get the current memberships of users and when they and their groups were last seen.
+
+    Args:
+        connection: The connection to use.
+        provider: The name of the identity provider of the users.
+        identifiers: The unique user identifiers used by the provider.
+
+    Returns:
+        The memberships and last_seen_at of the users and their groups.
+    """
+    memberships: Dict[str, Dict[str, Tuple[int, int]]] = {}
+    users_seen: Dict[str, datetime] = {}
+    groups_seen: Dict[str, datetime] = {}
+    for chunk in chunked({get_identifier_key(i) for i in identifiers}):
+        rows = connection.execute(_select_sync_state(provider, chunk))
+        for identifier, user_seen, group_name, group_seen, group_id, user_id in rows:
+            user_groups = memberships.setdefault(identifier, {})
+            users_seen[identifier] = user_seen
+            if group_name is not None:
+                user_groups[group_name] = (group_id, user_id)
+                groups_seen[group_name] = group_seen
+    return SyncState(memberships, users_seen, groups_seen)
+
+
+def _select_sync_state(provider: str, identifier_keys: List[bytes]) -> Select:
+    """Select the memberships of users and when they and their groups were last seen.
+
+    Args:
+        provider: The name of the identity provider of the users.
+        identifier_keys: The identifier keys of the users.
+
+    Returns:
+        The query, returning a row per membership and a row without group for each user
+        without groups.
+    """
+    users = SAMLUser.__table__
+    groups = DBGroup.__table__
+    return (
+        select(
+            users.c.identifier,
+            users.c.last_seen_at,
+            groups.c.name,
+            groups.c.last_seen_at,
+            group_members_table.c.group_id,
+            group_members_table.c.user_id,
+        )
+        .select_from(users.outerjoin(group_members_table.join(groups)))
+        .where(users.c.provider == provider, users.c.identifier_key.in_(identifier_keys))
+    )
+
+
+def sync_memberships(
+    connection: Connection,
+    provider: str,
+    user_groups: Mapping[str, Iterable[str]],
+    touch_last_seen: bool = True,
+    options: WriteOptions = WriteOptions(),
+) -> None:
+    """Make users members of exactly the given groups.
+
+    The users are locked first and only the differences to their current memberships are
+    written, so a sync which finds the memberships already applied by a concurrent sync of the
+    same user writes nothing. The group names of the changed users are refreshed, or cleared if
+    disabled by the options, and the changes are appended to the change log if enabled by the
+    options, after the member counts of
+    the groups have been updated. The last_seen_at of the users and of their groups is refreshed if
+    it is older than LAST_SEEN_RESOLUTION, which the current memberships are read together with.
+
+    Args:
+        connection: The connection to use, its transaction must be committed by the caller.
+        provider: The name of the identity provider of the users and groups.
+        user_groups: A mapping of user identifiers to the names of all their groups.
+        touch_last_seen: Whether to refresh the last_seen_at of the users and their groups,
+            False if the groups do not come from a login of the users.
+        options: The settings of the identity provider affecting the writes.
+    """
+    desired: Dict[str, Set[str]] = {i: set(names) for i, names in user_groups.items()}
+    if not desired:
+        return
+    lock_identifiers(connection, desired)
+    state = get_sync_state(connection, provider, desired)
+    current = state.memberships
+
+    removed = {
+        (identifier, name): ids
+        for identifier, names in desired.items()
+        for name, ids in current.get(identifier, {}).items()
+        if name not in names
+    }
+    added = {
+        (identifier, name)
+        for identifier, names in desired.items()
+        for name in names
+        if name not in current.get(identifier, {})
+    }
+    group_ids: Dict[str, int] = {}
+    if removed:
+        _delete_memberships(connection, removed.values())
+    if added:
+        group_ids = _insert_memberships(connection, provider, added, options.separator)
+    changed = {i for i, names in desired.items() if names != set(current.get(i, {}))}
+    refresh_group_names(connection, provider, changed, clear=not options.group_names)
+    if touch_last_seen:
+        _touch_last_seen(connection, provider, desired, state, added)
+    add_member_counts(
+        connection,
+        added=(group_ids[name] for _, name in added),
+        removed=(group_id for group_id, _ in removed.values()),
+    )
+    if options.change_log:
+        append_changes(connection, provider, added=added, removed=removed)
+
+
+def _touch_last_seen(
+    connection: Connection,
+    provider: str,
+    desired: Dict[str, Set[str]],
+    state: SyncState,
+    added: Set[Tuple[str, str]],
+) -> None:
+    """Refresh the last_seen_at of synced users and their groups if it is stale.
+
+    Args:
+        connection: The connection to use.
+        provider: The name of the identity provider of the users and groups.
+        desired: A mapping of the synced user identifiers to the names of all their groups.
+        state: The state of the users read by the sync.
+        added: The pairs of user identifiers and group names of the added memberships.
+    """
+    now = now_utc()
+    cutoff = now - LAST_SEEN_RESOLUTION
+    desired_names = set().union(*desired.values())
+    users = SAMLUser.__table__
+    _touch(
+        connection,
+        users.c.identifier_key,
+        {get_identifier_key(i) for i, seen in state.users_seen.items() if seen < cutoff},
+        now,
+        users.c.provider == provider,
+    )
+    # the groups which were not among the current ones of the users were not read
+    groups = DBGroup.__table__
+    _touch(
+        connection,
+        groups.c.name,
+        {n for n, seen in state.groups_seen.items() if seen < cutoff and n in desired_names}
+        | {name for _, name in added if name not in state.groups_seen},
+        now,
+        and_(groups.c.provider == provider, groups.c.last_seen_at < cutoff),
+    )
+
+
+def _touch(
+    connection: Connection,
+    column: ColumnElement,
+    values: Set,
+    now: datetime,
+    condition: ColumnElement,
+) -> None:
+    """Set the last_seen_at of rows, with one statement per chunk of IN_CHUNK_SIZE.
+
+    Args:
+        connection: The connection to use.
+        column: The column of the users or groups table identifying the rows.
+        values: The values of the column identifying the rows.
+        now: The new last_seen_at.
+        condition: The condition the rows must also match, at least their identity provider.
+    """
+    table = column.table
+    # sorted, so that concurrent updates lock the rows in the same order
+    for chunk in chunked(sorted(values)):
+        connection.execute(
+            table.update().where(condition, column.in_(chunk)).values(last_seen_at=now)
+        )
+
+
+def _get_group_names_query(connection: Connection, users: Table) -> ColumnElement:
+    """Create the expression aggregating the names of the groups of each user.
+
+    Args:
+        connection: The connection the query will be executed on.
+        users: The users table the subquery is correlated with.
+
+    Returns:
+        The expression, returning the group names as sorted array on PostgreSQL and as JSON
+        array on other databases.
+    """
+    groups = DBGroup.__table__
+    names = (
+        select(groups.c.name)
+        .select_from(group_members_table.join(groups))
+        .where(group_members_table.c.user_id == users.c.id)
+    )
+    if connection.dialect.name == "postgresql":
+        aggregated = names.with_only_columns(
+            func.array_agg(postgresql.aggregate_order_by(groups.c.name, groups.c.name))
+        )
+        return func.coalesce(aggregated.scalar_subquery(), literal([], postgresql.ARRAY(String)))
+    return names.with_only_columns(func.json_group_array(groups.c.name)).scalar_subquery()
+
+
+def update_group_names(connection: Connection, condition: ColumnElement) -> None:
+    """Recompute the denormalized group names of the users matching a condition.
+
+    Args:
+        connection: The connection to use.
+        condition: The condition on the users table selecting the users.
+    """
+    users = SAMLUser.__table__
+    connection.execute(
+        users.update()
+        .where(condition)
+        .values(group_names=_get_group_names_query(connection, users))
+    )
+
+
+def refresh_group_names(
+    connection: Connection, provider: str, identifiers: Iterable[str], clear: bool = False
+) -> None:
+    """Recompute the denormalized group names of users from their memberships.
+
+    The users must have been locked in the transaction of the connection, so that concurrent
+    writes of their memberships are visible. If the names are not maintained, they are cleared
+    instead, so that they are never outdated and the users are read from the memberships until
+    the names are recomputed. Users whose names are already cleared are not written again.
+
+    Args:
+        connection: The connection to use.
+        provider: The name of the identity provider of the users.
+        identifiers: The unique user identifiers used by the provider.
+        clear: Whether to clear the names instead of recomputing them.
+    """
+    users = SAMLUser.__table__
+    keys = sorted({get_identifier_key(i) for i in identifiers})
+    for chunk in chunked(keys):
+        condition = and_(users.c.provider == provider, users.c.identifier_key.in_(chunk))
+        if clear:
+            connection.execute(
+                users.update()
+                .where(condition, users.c.group_names.isnot(None))
+                .values(group_names=null())
+            )
+        else:
+            update_group_names(connection, condition)
+
+
+def rebuild_group_names(connection: Connection, first_id: int, last_id: int) -> None:
+    """Recompute the denormalized group names of a range of users from their memberships.
+
+    The users are locked first, so that the names are not overwritten by those of a concurrent
+    write of their memberships.
+
+    Args:
+        connection: The connection to use.
+        first_id: The first user id of the range.
+        last_id: The last user id of the range.
+    """
+    users = SAMLUser.__table__
+    condition = users.c.id.between(first_id, last_id)
+    lock_identifiers(
+        connection, connection.execute(select(users.c.identifier).where(condition)).scalars()
+    )
+    update_group_names(connection, condition)
+
+
+def get_groups_with_counts(
+    connection: Connection, provider: str, by_size: bool = False, limit: Optional[int] = None
+) -> List[Tuple[str, int]]:
+    """Get the names of the groups of a provider with their numbers of direct members.
+
+    The counts are read from the member counts maintained by the writes, without counting the
+    memberships.
+
+    Args:
+        connection: The connection to use.
+        provider: The name of the identity provider of the groups.
+        by_size: Whether to order the groups by decreasing member count instead of by name.
+            Groups with the same count are ordered by name.
+        limit: The maximum number of groups to return, None for all.
+
+    Returns:
+        The group names and member counts.
+    """
+    groups = DBGroup.__table__
+    member_count = func.coalesce(group_member_counts_table.c.member_count, 0)
+    order_by = [member_count.desc(), groups.c.name] if by_size else [groups.c.name]
+    rows = connection.execute(
+        select(groups.c.name, member_count)
+        .select_from(groups.outerjoin(group_member_counts_table))
+        .where(groups.c.provider == provider)
+        .order_by(*order_by)
+        .limit(limit)
+    )
+    return list(rows)
+
+
+def _select_member_count_mismatches() -> Select:
+    """Create the query of the groups whose member count differs from their memberships.
+
+    Returns:
+        The query selecting the group ids, names, stored counts and actual counts, ordered by
+        group id.
+    """
+    groups = DBGroup.__table__
+    counts = group_member_counts_table
+    actual = (
+        select(group_members_table.c.group_id, func.count().label("member_count"))
+        .group_by(group_members_table.c.group_id)
+        .subquery()
+    )
+    stored_count = func.coalesce(counts.c.member_count, 0)
+    actual_count = func.coalesce(actual.c.member_count, 0)
+    return (
+        select(groups.c.id, groups.c.name, stored_count, actual_count)
+        .select_from(groups.outerjoin(counts).outerjoin(actual, actual.c.group_id == groups.c.id))
+        .where(stored_count != actual_count)
+        .order_by(groups.c.id)
+    )
+
+
+def get_member_count_mismatches(connection: Connection) -> List[Tuple[str, int, int]]:
+    """Compare the member counts of all groups with their memberships.
+
+    Args:
+        connection: The connection to use.
+
+    Returns:
+        The names, stored counts and actual counts of the groups whose counts are wrong.
+    """
+    rows = connection.execute(_select_member_count_mismatches())
+    return [(name, stored, actual) for _, name, stored, actual in rows]
+
+
+def rebuild_member_counts(connection: Connection) -> List[Tuple[str, int, int]]:
+    """Recompute the member counts of all groups which differ from their memberships.
+
+    On PostgreSQL, the counts are locked against updates until the end of the transaction, so
+    that the writes of memberships which are not visible to the recount update the counts after
+    it. The writes of memberships wait for the commit.
+
+    Args:
+        connection: The connection to use.
+
+    Returns:
+        The names, previous counts and recomputed counts of the repaired groups.
+    """
+    counts = group_member_counts_table
+    if connection.dialect.name == "postgresql":
+        connection.execute(text(f"LOCK TABLE {counts.schema}.{counts.name} IN EXCLUSIVE MODE"))
+    rows = connection.execute(_select_member_count_mismatches()).all()
+    if rows:
+        connection.execute(
+            insert_or_update(connection, counts),
+            [{"group_id": id_, "member_count": actual} for id_, _, _, actual in rows],
+        )
+    return [(name, stored, actual) for _, name, stored, actual in rows]
@@ -0,0 +1,165 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+"""The append-only log of the membership changes, read incrementally by its consumers.
+
+Each write of memberships appends its changes as the last statement of its transaction. The
+sequence numbers are drawn before the commit, so concurrent writers may commit them out of order.
+A consumer reading the changes after the last sequence number it has seen must therefore only
+read below a committed watermark, the sequence numbers no transaction in flight can still
+commit. On PostgreSQL, the writers hold an advisory lock in shared mode from the append until the
+commit, so they do not wait for each other. A reader takes the lock exclusively, which waits for
+the appends in flight to commit, and reads the changes while holding it, so that every change
+below the last one it reads is visible. As nothing else is locked after the append, this cannot
+deadlock. The group provider appends to the log only if its membership_change_log setting is
+True, and the cleanup deletes the old entries.
+"""
+
+from datetime import datetime
+from typing import Iterable, List, NamedTuple, Tuple
+
+from indico.util.date_time import now_utc
+from sqlalchemy import func, select
+from sqlalchemy.engine import Connection
+from sqlalchemy.sql import Select
+
+from flask_multipass_saml_groups.models.saml_groups import SAMLMembershipChange
+
+ADD = "add"
+REMOVE = "remove"
+DEFAULT_CHANGES_LIMIT = 1000
+# the two-key form of the advisory locks does not overlap with the keys of the user locks
+_CHANGE_LOG_LOCK = (0x5A4D, 1)
+
+
+class MembershipChange(NamedTuple):
+    """A change of a membership.
+
+    Attrs:
+        sequence: The sequence number of the change.
+        action: add or remove.
+        group_name: The name of the group.
+        identifier: The unique user identifier used by the provider.
+        changed_at: When the change was written.
+    """
+
+    sequence: int
+    action: str
+    group_name: str
+    identifier: str
+    changed_at: datetime
+
+
+def lock_change_log(connection: Connection, exclusive: bool = False) -> None:
+    """Lock the change log until the end of the transaction.
+
+    Args:
+        connection: The connection whose transaction holds the lock.
+        exclusive: Whether to wait for the appends in flight and block new ones, to read the
+            changes, instead of taking the lock shared with the other appends.
+    """
+    if connection.dialect.name != "postgresql":
+        return
+    if exclusive:
+        connection.execute(select(func.pg_advisory_xact_lock(*_CHANGE_LOG_LOCK)))
+    else:
+        connection.execute(select(func.pg_advisory_xact_lock_shared(*_CHANGE_LOG_LOCK)))
+
+
+def append_changes(
+    connection: Connection,
+    provider: str,
+    added: Iterable[Tuple[str, str]] = (),
+    removed: Iterable[Tuple[str, str]] = (),
+) -> None:
+    """Append added and removed memberships to the log in a single statement.
+
+    This must be the last write of the transaction, see the module documentation.
+
+    Args:
+        connection: The connection to use.
+        provider: The name of the identity provider of the users and groups.
+        added: Pairs of user identifiers and group names of the added memberships.
+        removed: Pairs of user identifiers and group names of the removed memberships.
+    """
+    changes = [(REMOVE, i, n) for i, n in sorted(removed)] + [
+        (ADD, i, n) for i, n in sorted(added)
+    ]
+    if not changes:
+        return
+    lock_change_log(connection)
+    now = now_utc()
+    connection.execute(
+        SAMLMembershipChange.__table__.insert(),
+        [
+            {
+                "provider": provider,
+                "action": action,
+                "group_name": n,
+                "identifier": i,
+                "changed_at": now,
+            }
+            for action, i, n in changes
+        ],
+    )
+
+
+def append_changes_from_select(connection: Connection, query: Select) -> None:
+    """Append changes of memberships selected by a query to the log.
+
+    This must be the last write of the transaction, see the module documentation.
+
+    Args:
+        connection: The connection to use.
+        query: The query selecting the provider, action, group name, identifier and time of the
+            changes.
+    """
+    lock_change_log(connection)
+    changes = SAMLMembershipChange.__table__
+    connection.execute(
+        changes.insert().from_select(
+            [
+                changes.c.provider,
+                changes.c.action,
+                changes.c.group_name,
+                changes.c.identifier,
+                changes.c.changed_at,
+            ],
+            query,
+        )
+    )
+
+
+def get_changes(
+    connection: Connection, provider: str, since: int = 0, limit: int = DEFAULT_CHANGES_LIMIT
+) -> List[MembershipChange]:
+    """Get the changes of the memberships of a provider after a sequence number.
+
+    The change log is locked exclusively during the read, see the module documentation, so the
+    read must run on the primary in a short transaction of the read committed isolation level,
+    which must be ended by the caller.
+
+    Args:
+        connection: The connection to use.
+        provider: The name of the identity provider of the users and groups.
+        since: The sequence number of the last change seen by the caller, 0 for all changes.
+        limit: The maximum number of changes to return.
+
+    Returns:
+        The changes in the order of their sequence numbers.
+    """
+    lock_change_log(connection, exclusive=True)
+    changes = SAMLMembershipChange.__table__
+    rows = connection.execute(
+        select(
+            changes.c.id,
+            changes.c.action,
+            changes.c.group_name,
+            changes.c.identifier,
+            changes.c.changed_at,
+        )
+        .where(changes.c.provider == provider, changes.c.id > since)
+        .order_by(changes.c.id)
+        .limit(limit)
+    )
+    return [MembershipChange(*row) for row in rows]
@@ -0,0 +1,191 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+"""Batched deletion of the users and groups which are no longer asserted by the identity provider.
+
+Each function deletes at most one batch in the transaction of the given connection, so that the
+caller can commit after each batch and keep the locks short. The batches are paginated by id:
+each batch continues after the last row examined by the previous one, so the rows which are kept
+are read only once by a run. The old entries of the change log are deleted in the same way.
+"""
+
+from datetime import datetime
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import and_, exists, select
+from sqlalchemy.engine import Connection
+
+from flask_multipass_saml_groups.group_provider.bulk import add_member_counts, lock_identifiers
+from flask_multipass_saml_groups.group_provider.changelog import append_changes
+from flask_multipass_saml_groups.models.saml_groups import SAMLGroup as DBGroup
+from flask_multipass_saml_groups.models.saml_groups import (
+    SAMLMembershipChange,
+    SAMLUser,
+    SAMLUserAttributes,
+    group_ancestors_table,
+    group_member_counts_table,
+    group_members_table,
+)
+
+
+class DeletedBatch(NamedTuple):
+    """The result of deleting a batch.
+
+    Attrs:
+        deleted: The number of deleted rows.
+        last_id: The id of the last row examined, after which the next batch continues, or None
+            if no rows were left to examine.
+    """
+
+    deleted: int
+    last_id: Optional[int]
+
+
+def delete_stale_users(
+    connection: Connection, cutoff: datetime, limit: int, after_id: int = 0
+) -> DeletedBatch:
+    """Delete a batch of users last seen before a cutoff with their memberships and attributes.
+
+    The stale users of all identity providers are deleted together. They are locked like for a
+    sync and checked again, so a user synced concurrently is kept. The member counts of their
+    groups are updated and the removed memberships are appended to the change log. The cutoff
+    must be at least LAST_SEEN_RESOLUTION in the past for a sync to refresh the last_seen_at of
+    the users it sees.
+
+    Args:
+        connection: The connection to use.
+        cutoff: The users last seen before are deleted.
+        limit: The maximum number of users to delete.
+        after_id: The last_id of the previous batch, 0 for the first batch.
+
+    Returns:
+        The number of deleted users and the id of the last user examined.
+    """
+    users = SAMLUser.__table__
+    groups = DBGroup.__table__
+    stale = users.c.last_seen_at < cutoff
+    rows = connection.execute(
+        select(users.c.id, users.c.identifier)
+        .where(users.c.id > after_id, stale)
+        .order_by(users.c.id)
+        .limit(limit)
+    ).all()
+    if not rows:
+        return DeletedBatch(0, None)
+    lock_identifiers(connection, (identifier for _, identifier in rows))
+    user_ids = select(users.c.id).where(users.c.id.in_([id_ for id_, _ in rows]), stale)
+    removed = connection.execute(
+        select(users.c.provider, users.c.identifier, groups.c.name, groups.c.id)
+        .select_from(group_members_table.join(users).join(groups))
+        .where(users.c.id.in_(user_ids))
+    ).all()
+    connection.execute(
+        group_members_table.delete().where(group_members_table.c.user_id.in_(user_ids))
+    )
+    attributes = SAMLUserAttributes.__table__
+    connection.execute(attributes.delete().where(attributes.c.user_id.in_(user_ids)))
+    deleted = connection.execute(users.delete().where(users.c.id.in_(user_ids))).rowcount
+    add_member_counts(connection, removed=(group_id for _, _, _, group_id in removed))
+    _append_removed_changes(connection, removed)
+    return DeletedBatch(deleted, rows[-1][0])
+
+
+def _append_removed_changes(
+    connection: Connection, removed: Iterable[Tuple[str, str, str, int]]
+) -> None:
+    """Append the removed memberships of the users of several identity providers to the log.
+
+    Args:
+        connection: The connection to use.
+        removed: The identity provider, user identifier, group name and group id of each
+            removed membership.
+    """
+    provider_changes: Dict[str, List[Tuple[str, str]]] = {}
+    for provider, identifier, group_name, _ in removed:
+        provider_changes.setdefault(provider, []).append((identifier, group_name))
+    for provider, changes in sorted(provider_changes.items()):
+        append_changes(connection, provider, removed=changes)
+
+
+def delete_orphaned_groups(
+    connection: Connection, cutoff: datetime, limit: int, after_id: int = 0
+) -> DeletedBatch:
+    """Delete a batch of groups without members which were last seen before a cutoff.
+
+    The ancestors of hierarchical groups are kept as long as they have descendants, they are
+    deleted by a later pass over the groups once their descendants have been deleted.
+
+    Args:
+        connection: The connection to use.
+        cutoff: The groups without members last seen before are deleted.
+        limit: The maximum number of groups to delete.
+        after_id: The last_id of the previous batch, 0 for the first batch.
+
+    Returns:
+        The number of deleted groups and the id of the last group examined.
+    """
+    groups = DBGroup.__table__
+    ancestors = group_ancestors_table
+    orphaned = and_(
+        groups.c.last_seen_at < cutoff,
+        ~exists().where(group_members_table.c.group_id == groups.c.id),
+        ~exists().where(
+            ancestors.c.ancestor_id == groups.c.id, ancestors.c.group_id != groups.c.id
+        ),
+    )
+    group_ids = (
+        connection.execute(
+            select(groups.c.id)
+            .where(groups.c.id > after_id, orphaned)
+            .order_by(groups.c.id)
+            .limit(limit)
+        )
+        .scalars()
+        .all()
+    )
+    if not group_ids:
+        return DeletedBatch(0, None)
+    deleted_ids = select(groups.c.id).where(groups.c.id.in_(group_ids), orphaned)
+    connection.execute(ancestors.delete().where(ancestors.c.group_id.in_(deleted_ids)))
+    connection.execute(
+        group_member_counts_table.delete().where(
+            group_member_counts_table.c.group_id.in_(deleted_ids)
+        )
+    )
+    deleted = connection.execute(groups.delete().where(groups.c.id.in_(deleted_ids))).rowcount
+    return DeletedBatch(deleted, group_ids[-1])
+
+
+def delete_old_changes(
+    connection: Connection, cutoff: datetime, limit: int, after_id: int = 0
+) -> DeletedBatch:
+    """Delete a batch of the entries of the change log written before a cutoff.
+
+    The changes of all identity providers are deleted together, the oldest first. A consumer
+    which has not read the changes before they are deleted misses them.
+
+    Args:
+        connection: The connection to use.
+        cutoff: The changes written before are deleted.
+        limit: The maximum number of changes to delete.
+        after_id: The last_id of the previous batch, 0 for the first batch.
+
+    Returns:
+        The number of deleted changes and the sequence number of the last deleted change.
+    """
+    changes = SAMLMembershipChange.__table__
+    # the sequence numbers increase with the time of the changes, so the primary key finds them
+    change_ids = (
+        connection.execute(
+            select(changes.c.id)
+            .where(changes.c.id > after_id, changes.c.changed_at < cutoff)
+            .order_by(changes.c.id)
+            .limit(limit)
+        )
+        .scalars()
+        .all()
+    )
+    if not change_ids:
+        return DeletedBatch(0, None)
+    deleted = connection.execute(changes.delete().where(changes.c.id.in_(change_ids))).rowcount
+    return DeletedBatch(deleted, change_ids[-1])
@@ -0,0 +1,210 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+"""A single writer coalescing the membership writes of concurrent logins."""
+
+import logging
+import time
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from queue import Empty, SimpleQueue
+from threading import Lock, Thread
+from typing import Dict, List, Mapping, Optional, Sequence, Tuple
+
+from flask import Flask, current_app
+from indico.core.db import db
+
+from flask_multipass_saml_groups.group_provider.attributes import store_attributes
+from flask_multipass_saml_groups.group_provider.bulk import (
+    WriteOptions,
+    lock_identifiers,
+    sync_memberships,
+)
+
+# the future is resolved to True once the request is written, to False if the caller must write
+# it itself
+_Request = Tuple[str, Tuple[str, ...], Optional[Mapping], "Future[bool]"]
+
+MAX_BATCH_SIZE = 500
+WRITE_TIMEOUT = 10.0
+
+logger = logging.getLogger(__name__)
+
+
+class CoalescingMembershipWriter:  # pylint: disable=too-few-public-methods
+    """Batch the membership writes of concurrent logins into bulk statements.
+
+    Callers block until their memberships and identity attributes have been committed. A single
+    thread writes up to max_batch_size requests in one transaction, so that e.g. hundreds of
+    users logging in with the same new group create it only once. If more requests are queued
+    behind the first one, the requests arriving within the batch interval are collected too. If a
+    batch contains several requests for the same user, the last one wins. If writing a batch
+    fails, each caller retries its own request in its own transaction and thread, so that only
+    the callers whose requests fail again get the error. If the writer has not taken a request
+    within the timeout, e.g. because it is stuck, the caller writes the request itself. If the
+    writer thread stops, the callers of its batch get the error and the next request starts a
+    new writer.
+
+    Attrs:
+        interval (float): The number of seconds requests are collected before they are written.
+        provider (str): The name of the identity provider of the users and groups.
+        options (WriteOptions): The settings of the identity provider affecting the writes.
+        max_batch_size (int): The maximum number of requests written in one transaction.
+        timeout (float): The number of seconds a caller waits for the writer before writing its
+            request itself.
+    """
+
+    timeout = WRITE_TIMEOUT
+
+    def __init__(
+        self,
+        interval: float,
+        provider: str,
+        options: WriteOptions = WriteOptions(),
+        max_batch_size: int = MAX_BATCH_SIZE,
+    ):
+        """Initialize the writer.
+
+        Args:
+            interval: The number of seconds requests are collected before they are written.
+            provider: The name of the identity provider of the users and groups.
+            options: The settings of the identity provider affecting the writes.
+            max_batch_size: The maximum number of requests written in one transaction.
+        """
+        self.interval = interval
+        self.provider = provider
+        self.options = options
+        self.max_batch_size = max_batch_size
+        self._queue: "SimpleQueue[_Request]" = SimpleQueue()
+        self._lock = Lock()
+        self._thread: Optional[Thread] = None
+
+    def sync(
+        self, identifier: str, group_names: Sequence[str], attributes: Optional[Mapping] = None
+    ) -> None:
+        """Make a user a member of exactly the given groups and wait until it is committed.
+
+        Must be called within a Flask app context. Missing users and groups are created.
+
+        Args:
+            identifier: The unique user identifier used by the provider.
+            group_names: The names of all groups the user belongs to.
+            attributes: The identity attributes to store in the same transaction, None to keep
+                the stored ones.
+        """
+        # pylint: disable-next=protected-access
+        app = current_app._get_current_object()  # type: ignore[attr-defined]
+        future: "Future[bool]" = Future()
+        request = (identifier, tuple(group_names), attributes, future)
+        self._queue.put(request)
+        self._ensure_started(app)
+        try:
+            written = future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            # the writer is still writing the request if it cannot be cancelled anymore
+            written = False if future.cancel() else future.result()
+        if not written:
+            self._write(app, [request])
+
+    def _ensure_started(self, app: Flask) -> None:
+        """Start the writer thread unless it is already running.
+
+        Args:
+            app: The Flask app whose context is used to access the database.
+        """
+        with self._lock:
+            if self._thread is None:
+                self._thread = Thread(
+                    target=self._run, args=(app,), name="saml-groups-writer", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self, app: Flask) -> None:
+        """Write batches of requests until the writer fails.
+
+        If the writer fails outside of the transaction of a batch, the callers of the batch get
+        the error and the next request starts a new writer. Requests which are already queued are
+        written by the new writer or, after the timeout, by their callers.
+
+        Args:
+            app: The Flask app whose context is used to access the database.
+        """
+        batch: List[_Request] = []
+        try:
+            while True:
+                batch = self._next_batch()
+                self._write_batch(app, batch)
+        except Exception as exc:  # pylint: disable=broad-exception-caught
+            logger.exception("The membership writer of %s stopped", self.provider)
+            for *_, future in batch:
+                if not future.done():
+                    future.set_exception(exc)
+        finally:
+            with self._lock:
+                self._thread = None
+
+    def _next_batch(self) -> List[_Request]:
+        """Wait for a request and collect the requests queued behind it.
+
+        If other requests are already queued, the requests arriving within the batch interval are
+        collected too.
+
+        Returns:
+            The collected requests, at most max_batch_size. Further requests stay queued for the
+            next batch.
+        """
+        batch = [self._queue.get()]
+        if not self._queue.empty():
+            time.sleep(self.interval)
+        while len(batch) < self.max_batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def _write_batch(self, app: Flask, batch: List[_Request]) -> None:
+        """Write the memberships of a batch in one transaction and notify the callers.
+
+        The requests whose callers stopped waiting are skipped. If the transaction fails, e.g.
+        because of a deadlock or one invalid request, the callers are notified to write their
+        requests themselves, each in its own transaction. The caller of a batch of one request
+        gets the error instead.
+
+        Args:
+            app: The Flask app whose context is used to access the database.
+            batch: The requests to write.
+        """
+        batch = [request for request in batch if request[3].set_running_or_notify_cancel()]
+        if not batch:
+            return
+        try:
+            self._write(app, batch)
+        except Exception as exc:  # pylint: disable=broad-exception-caught
+            if len(batch) == 1:
+                batch[0][3].set_exception(exc)
+                return
+            for *_, future in batch:
+                future.set_result(False)
+        else:
+            for *_, future in batch:
+                future.set_result(True)
+
+    def _write(self, app: Flask, batch: List[_Request]) -> None:
+        """Write the memberships and identity attributes of a batch in one transaction.
+
+        Args:
+            app: The Flask app whose context is used to access the database.
+            batch: The requests to write.
+        """
+        user_groups: Dict[str, Tuple[str, ...]] = {
+            identifier: group_names for identifier, group_names, _, _ in batch
+        }
+        with app.app_context(), db.engine.begin() as connection:
+            # all users are locked at once, in the order used by the sync
+            lock_identifiers(connection, user_groups)
+            for identifier, _, attributes, _ in batch:
+                if attributes is not None:
+                    store_attributes(connection, self.provider, identifier, attributes)
+            # last, as the sync appends to the change log
+            sync_memberships(connection, self.provider, user_groups, options=self.options)
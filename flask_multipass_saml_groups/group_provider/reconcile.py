@@ -0,0 +1,204 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+"""Reconciliation of the stored memberships with a full export of the identity provider.
+
+The export and the stored users are both read as streams sorted by identifier and compared with a
+merge-join, so that memory stays bounded whatever the number of users. The export is sorted by
+code point, which is the order of the binary collation used for the stored identifiers.
+"""
+
+import csv
+import json
+import time
+from collections import Counter
+from itertools import groupby, islice
+from typing import IO, Any, Dict, Iterable, Iterator, NamedTuple, Optional, Set, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.engine import Connection, Engine
+
+from flask_multipass_saml_groups.group_provider.bulk import sync_memberships
+from flask_multipass_saml_groups.models.saml_groups import SAMLGroup as DBGroup
+from flask_multipass_saml_groups.models.saml_groups import SAMLUser, group_members_table
+
+DEFAULT_RECONCILE_BATCH_SIZE = 1000
+_BINARY_COLLATIONS = {"postgresql": "C", "sqlite": "BINARY"}
+
+UserGroups = Tuple[str, Set[str]]
+
+
+class ReconcileOptions(NamedTuple):
+    """The options of a reconciliation.
+
+    Attrs:
+        batch_size: The number of users synced per transaction.
+        pause: The number of seconds to wait between transactions.
+        dry_run: Whether to only compute the summary without applying the differences.
+    """
+
+    batch_size: int = DEFAULT_RECONCILE_BATCH_SIZE
+    pause: float = 0
+    dry_run: bool = False
+
+
+def read_directory(file: IO[str], format_: str) -> Iterator[UserGroups]:
+    """Read the groups of all users from an export of the identity provider.
+
+    In the jsonl format, each line is an object with the identifier and the list of groups of
+    a user. In the csv format, each row holds an identifier and a group, or an empty group for a
+    user without groups, and the rows of a user are consecutive.
+
+    Args:
+        file: The text file to read from, sorted by identifier.
+        format_: jsonl or csv.
+
+    Raise:
+        ValueError: If the format is not supported, a record is invalid or the users are not
+            sorted by identifier.
+
+    Yields:
+        The identifiers and the group names of the users, in the order of the file.
+    """
+    users: Iterable[UserGroups]
+    if format_ == "jsonl":
+        users = _read_jsonl_users(file)
+    elif format_ == "csv":
+        rows = csv.DictReader(file)
+        users = (
+            (identifier, {row["group"] for row in user_rows if row.get("group")})
+            for identifier, user_rows in groupby(rows, key=lambda row: row.get("identifier"))
+        )
+    else:
+        raise ValueError(f"Unsupported format {format_}")
+    previous: Optional[str] = None
+    for identifier, group_names in users:
+        if not identifier:
+            raise ValueError(f"User after {previous} has no identifier")
+        if previous is not None and identifier <= previous:
+            raise ValueError(f"Users are not sorted by identifier at {identifier}")
+        previous = identifier
+        yield identifier, group_names
+
+
+def _read_jsonl_users(file: IO[str]) -> Iterator[UserGroups]:
+    """Read the users of a jsonl export.
+
+    Args:
+        file: The text file to read from.
+
+    Raise:
+        ValueError: If a record is invalid.
+
+    Yields:
+        The identifiers and the group names of the users.
+    """
+    for number, line in enumerate(file, start=1):
+        if not line.strip():
+            continue
+        record: Dict[str, Any] = json.loads(line)
+        identifier = record.get("identifier")
+        group_names = record.get("groups")
+        if not isinstance(identifier, str) or not isinstance(group_names, list):
+            raise ValueError(f"Line {number} must contain an identifier and a list of groups")
+        yield identifier, set(group_names)
+
+
+def stream_user_groups(
+    connection: Connection, provider: str, batch_size: int
+) -> Iterator[UserGroups]:
+    """Read the groups of the stored users of a provider, sorted by identifier in code point order.
+
+    The users are read by a single query through a server-side cursor where supported.
+
+    Args:
+        connection: The connection to use, which must not be used for writes meanwhile.
+        provider: The name of the identity provider of the users.
+        batch_size: The number of rows fetched at once.
+
+    Yields:
+        The identifiers and the group names of the users.
+    """
+    users = SAMLUser.__table__
+    groups = DBGroup.__table__
+    identifier = users.c.identifier.collate(_BINARY_COLLATIONS[connection.dialect.name])
+    result = connection.execution_options(stream_results=True, max_row_buffer=batch_size).execute(
+        select(users.c.identifier, groups.c.name)
+        .select_from(users.outerjoin(group_members_table.join(groups)))
+        .where(users.c.provider == provider)
+        .order_by(identifier)
+    )
+    for user_identifier, rows in groupby(result, key=lambda row: row[0]):
+        yield user_identifier, {name for _, name in rows if name is not None}
+
+
+def diff_user_groups(
+    stored: Iterable[UserGroups], directory: Iterable[UserGroups], summary: Counter
+) -> Iterator[UserGroups]:
+    """Merge-join the stored users with the export and return the users whose groups differ.
+
+    Users of the export which are not stored are skipped, since they have never logged in.
+    Stored users missing from the export are removed from all their groups.
+
+    Args:
+        stored: The stored users and their groups, sorted by identifier.
+        directory: The users and their groups of the export, sorted by identifier.
+        summary: The counter of users_compared, users_changed, users_not_stored,
+            memberships_added and memberships_removed, updated while iterating.
+
+    Yields:
+        The identifiers and the groups of the export of the users whose groups differ.
+    """
+    exported = iter(directory)
+    next_exported = next(exported, None)
+    for identifier, current in stored:
+        while next_exported is not None and next_exported[0] < identifier:
+            summary["users_not_stored"] += 1
+            next_exported = next(exported, None)
+        desired: Set[str] = set()
+        if next_exported is not None and next_exported[0] == identifier:
+            desired = next_exported[1]
+            next_exported = next(exported, None)
+        summary["users_compared"] += 1
+        if desired != current:
+            summary["users_changed"] += 1
+            summary["memberships_added"] += len(desired - current)
+            summary["memberships_removed"] += len(current - desired)
+            yield identifier, desired
+    if next_exported is not None:
+        summary["users_not_stored"] += 1 + sum(1 for _ in exported)
+
+
+def reconcile_memberships(
+    engine: Engine,
+    provider: str,
+    directory: Iterable[UserGroups],
+    *,
+    options: ReconcileOptions = ReconcileOptions(),
+) -> Dict[str, int]:
+    """Apply the differences between the stored memberships and a full export.
+
+    The differences are applied in batches of users, each synced in its own transaction which
+    locks the users and writes only what still differs at that time. The last_seen_at of the
+    users is left unchanged, since they have not logged in.
+
+    Args:
+        engine: The engine of the database.
+        provider: The name of the identity provider of the export.
+        directory: The users and their groups of the export, sorted by identifier.
+        options: The batch size, pause and dry run of the reconciliation.
+
+    Returns:
+        The summary of the differences, see diff_user_groups.
+    """
+    summary: Counter = Counter()
+    with engine.connect() as reader:
+        stored = stream_user_groups(reader, provider, options.batch_size)
+        changes = diff_user_groups(stored, directory, summary)
+        while batch := list(islice(changes, options.batch_size)):
+            if options.dry_run:
+                continue
+            with engine.begin() as connection:
+                sync_memberships(connection, provider, dict(batch), touch_last_seen=False)
+            time.sleep(options.pause)
+    return dict(summary)
@@ -0,0 +1,127 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+"""Routing of read-only queries to a read replica of the database."""
+
+import time
+from contextlib import contextmanager
+from threading import Lock
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from flask import has_request_context, session
+from indico.core.db import db
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import QueuePool
+
+PIN_SESSION_KEY = "_flask_multipass_saml_groups_primary_until"
+
+
+def fill_pool(engine: Engine, deadline: float) -> int:
+    """Open the connections of the pool of an engine before they are needed.
+
+    All connections of the pool which are not in use are checked out at once, which connects the
+    missing ones, and returned to the pool. No more connections than the pool size are held, so
+    that filling the pool never waits for a connection used elsewhere.
+
+    Args:
+        engine: The engine whose pool is filled.
+        deadline: The time.monotonic() value after which no more connections are opened.
+
+    Returns:
+        The number of connections checked out, idle in the pool afterwards.
+    """
+    pool = engine.pool
+    size = pool.size() - pool.checkedout() if isinstance(pool, QueuePool) else 1
+    connections: List[Connection] = []
+    try:
+        while len(connections) < size and time.monotonic() < deadline:
+            connections.append(engine.connect())
+    finally:
+        for connection in connections:
+            connection.close()
+    return len(connections)
+
+
+class ReadRouter:
+    """Send read-only queries to a replica unless they must see a recent write.
+
+    After a write, the reads concerning the written users are pinned to the primary for a
+    window covering the replication lag. The pin is kept in the process for the identifiers,
+    e.g. for the login request or a deferred sync, and in the Flask session of the request
+    which wrote, so that subsequent requests of that user served by other processes also read
+    from the primary.
+
+    Attrs:
+        engine (Engine): The engine of the replica or None if all reads go to the primary.
+        pin_seconds (float): The number of seconds reads are pinned to the primary after a write.
+    """
+
+    def __init__(self, replica_uri: Optional[str], pin_seconds: float):
+        """Initialize the router.
+
+        Args:
+            replica_uri: The SQLAlchemy URI of the replica, None to read from the primary.
+            pin_seconds: The number of seconds reads are pinned to the primary after a write.
+        """
+        self.engine: Optional[Engine] = (
+            create_engine(replica_uri, pool_pre_ping=True) if replica_uri else None
+        )
+        self.pin_seconds = pin_seconds
+        self._lock = Lock()
+        self._pinned: Dict[str, float] = {}
+
+    def pin(self, identifiers: Iterable[str] = ()) -> None:
+        """Pin the reads concerning the given users and the current Flask session to the primary.
+
+        Args:
+            identifiers: The unique user identifiers whose memberships have been written.
+        """
+        if self.engine is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._pinned = {i: t for i, t in self._pinned.items() if t > now}
+            for identifier in identifiers:
+                self._pinned[identifier] = now + self.pin_seconds
+        if has_request_context():
+            session[PIN_SESSION_KEY] = time.time() + self.pin_seconds
+
+    def is_pinned(self, identifier: Optional[str] = None) -> bool:
+        """Check if reads must go to the primary.
+
+        Args:
+            identifier: The unique user identifier the read concerns, if any.
+
+        Returns:
+            True if the user or the current Flask session wrote within the pin window.
+        """
+        if has_request_context() and session.get(PIN_SESSION_KEY, 0) > time.time():
+            return True
+        if identifier is None:
+            return False
+        with self._lock:
+            return self._pinned.get(identifier, 0) > time.monotonic()
+
+    @contextmanager
+    def read_session(self, identifier: Optional[str] = None) -> Iterator[Session]:
+        """Provide a session for read-only queries.
+
+        The objects loaded from a replica session must not be used after the block is left.
+
+        Args:
+            identifier: The unique user identifier the read concerns, if any.
+
+        Yields:
+            Indico's session if there is no replica or the read is pinned, a replica session
+            otherwise.
+        """
+        if self.engine is None or self.is_pinned(identifier):
+            yield db.session
+            return
+        with Session(bind=self.engine) as replica_session:
+            yield replica_session
+
+
+PRIMARY = ReadRouter(replica_uri=None, pin_seconds=0)
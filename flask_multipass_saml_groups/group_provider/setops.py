@@ -0,0 +1,133 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+"""Set algebra over the members of groups, evaluated by the database.
+
+An expression selects the members of all of some groups, of any of some groups and of none of
+some groups. It is compiled to INTERSECT, UNION and EXCEPT of the user ids of the memberships of
+each group, which are read from the primary key of the memberships. With the denormalized group
+names on PostgreSQL, it is compiled to array operators served by their GIN index instead, for the
+users whose names have been computed. With hierarchical groups, the members of a group include
+those of its descendants, which are read through the closure of the hierarchy.
+"""
+
+from sqlalchemy import except_, intersect, select, union, union_all
+from sqlalchemy.sql import CompoundSelect, Select
+
+from flask_multipass_saml_groups.group_provider.base import MemberExpression
+from flask_multipass_saml_groups.models.saml_groups import SAMLGroup as DBGroup
+from flask_multipass_saml_groups.models.saml_groups import (
+    SAMLUser,
+    group_ancestors_table,
+    group_members_table,
+)
+
+
+def _select_user_ids(provider: str, group_name: str, hierarchical: bool) -> Select:
+    """Select the ids of the members of a group.
+
+    Args:
+        provider: The name of the identity provider of the group.
+        group_name: The name of the group.
+        hierarchical: Whether to include the members of the descendants of the group.
+
+    Returns:
+        The query.
+    """
+    groups = DBGroup.__table__
+    if hierarchical:
+        ancestors = group_ancestors_table
+        return (
+            select(group_members_table.c.user_id)
+            .select_from(
+                group_members_table.join(
+                    ancestors, ancestors.c.group_id == group_members_table.c.group_id
+                ).join(groups, groups.c.id == ancestors.c.ancestor_id)
+            )
+            .where(groups.c.provider == provider, groups.c.name == group_name)
+        )
+    return (
+        select(group_members_table.c.user_id)
+        .select_from(group_members_table.join(groups))
+        .where(groups.c.provider == provider, groups.c.name == group_name)
+    )
+
+
+def _flatten(compound: CompoundSelect) -> Select:
+    """Wrap a compound select in a plain select.
+
+    SQLite does not allow compound selects to be nested, so they are wrapped in a subquery.
+
+    Args:
+        compound: The compound select of user ids.
+
+    Returns:
+        The query.
+    """
+    user_ids = compound.subquery()
+    return select(user_ids.c.user_id)
+
+
+def _where_group_names(query: Select, expression: MemberExpression) -> Select:
+    """Filter users by an expression evaluated on their denormalized group names.
+
+    Args:
+        query: The query of the users.
+        expression: The names of the groups the users must all be members of, must be a member
+            of at least one of and must not be members of.
+
+    Returns:
+        The filtered query.
+    """
+    all_of, any_of, none_of = expression
+    group_names = SAMLUser.__table__.c.group_names
+    if all_of:
+        query = query.where(group_names.contains(sorted(all_of)))
+    if any_of:
+        query = query.where(group_names.overlap(sorted(any_of)))
+    if none_of:
+        query = query.where(~group_names.overlap(sorted(none_of)))
+    return query
+
+
+def select_member_identifiers(
+    provider: str,
+    expression: MemberExpression,
+    *,
+    denormalized: bool = False,
+    hierarchical: bool = False,
+) -> Select:
+    """Select the identifiers of the members of all of, any of and none of the given groups.
+
+    The users whose denormalized group names have not been computed are read from the
+    memberships, also when evaluating the expression on the group names.
+
+    Args:
+        provider: The name of the identity provider of the groups.
+        expression: The names of the groups the users must all be members of, must be a member
+            of at least one of and must not be members of, see check_member_expression.
+        denormalized: Whether to evaluate the expression on the denormalized group names,
+            which is supported on PostgreSQL only and ignored for hierarchical groups.
+        hierarchical: Whether the members of a group include those of its descendants.
+
+    Returns:
+        The query of the identifiers, sorted.
+    """
+    all_of, any_of, none_of = expression
+    users = SAMLUser.__table__
+    query = select(users.c.identifier).where(users.c.provider == provider)
+    candidates = [_select_user_ids(provider, n, hierarchical) for n in sorted(all_of)]
+    if any_of:
+        candidates.append(
+            _flatten(union(*(_select_user_ids(provider, n, hierarchical) for n in sorted(any_of))))
+        )
+    user_ids = candidates[0] if len(candidates) == 1 else _flatten(intersect(*candidates))
+    if none_of:
+        excluded = union(*(_select_user_ids(provider, n, hierarchical) for n in sorted(none_of)))
+        user_ids = except_(user_ids, _flatten(excluded))
+    if not denormalized or hierarchical:
+        return query.where(users.c.id.in_(user_ids)).order_by(users.c.identifier)
+    computed = _where_group_names(query.where(users.c.group_names.isnot(None)), expression)
+    missing = query.where(users.c.group_names.is_(None), users.c.id.in_(user_ids))
+    identifiers = union_all(computed, missing).subquery()
+    return select(identifiers.c.identifier).order_by(identifiers.c.identifier)
@@ -0,0 +1,444 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+"""A group provider that splits users and their memberships across several SQL databases."""
+
+import heapq
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    TypeVar,
+)
+
+from flask_multipass import Group, IdentityInfo, IdentityProvider
+from sqlalchemy import create_engine, select
+from sqlalchemy.engine import Connection, Engine
+
+from flask_multipass_saml_groups.group_provider.base import (
+    GroupProvider,
+    check_member_expression,
+    get_pending_lookup,
+    sort_group_counts,
+)
+from flask_multipass_saml_groups.group_provider.bulk import (
+    WriteOptions,
+    delete_memberships,
+    get_group_ids,
+    get_groups_with_counts,
+    get_memberships,
+    insert_memberships,
+    is_member,
+    lock_key,
+    sync_memberships,
+)
+from flask_multipass_saml_groups.group_provider.routing import fill_pool
+from flask_multipass_saml_groups.group_provider.setops import select_member_identifiers
+from flask_multipass_saml_groups.group_provider.sql import GROUP_HIERARCHY_SEPARATOR_SETTING
+from flask_multipass_saml_groups.models.saml_groups import SCHEMA
+from flask_multipass_saml_groups.models.saml_groups import SAMLGroup as DBGroup
+from flask_multipass_saml_groups.models.saml_groups import SAMLUser, group_members_table
+
+SHARDS_SETTING = "shards"
+SYNC_LOCK_STRIPES = 64
+# the sharded provider never reads the denormalized group names nor the change log
+WRITE_OPTIONS = WriteOptions(group_names=False, change_log=False)
+
+_T = TypeVar("_T")
+
+
+def get_shard_index(key: str, shard_count: int) -> int:
+    """Get the shard of a user identifier or group name.
+
+    Args:
+        key: The user identifier or group name.
+        shard_count: The number of shards.
+
+    Returns:
+        The index of the shard, which is stable across processes.
+    """
+    return lock_key(key) % shard_count
+
+
+def get_shards(settings: Dict) -> List[Tuple[str, str]]:
+    """Read the shards setting of an identity provider.
+
+    Args:
+        settings: The settings of the identity provider.
+
+    Raise:
+        ValueError: If the shards setting is not a non-empty list of valid shards.
+
+    Returns:
+        The SQLAlchemy URI and the schema of the plugin tables of each shard.
+    """
+    shards = settings.get(SHARDS_SETTING)
+    if not isinstance(shards, list) or not shards:
+        raise ValueError(f"{SHARDS_SETTING} must be a non-empty list")
+    result = []
+    for shard in shards:
+        if not isinstance(shard, dict) or not isinstance(shard.get("uri"), str):
+            raise ValueError(f"{SHARDS_SETTING} entry {shard} must contain a uri")
+        schema = shard.get("schema", SCHEMA)
+        if not isinstance(schema, str):
+            raise ValueError(f"{SHARDS_SETTING} entry {shard} has an invalid schema")
+        result.append((shard["uri"], schema))
+    return result
+
+
+def _create_shard_engine(uri: str, schema: str) -> Engine:
+    """Create the engine of a shard.
+
+    Args:
+        uri: The SQLAlchemy URI of the shard.
+        schema: The schema of the plugin tables in the shard.
+
+    Returns:
+        The engine, which maps the plugin schema to the schema of the shard.
+    """
+    return create_engine(
+        uri,
+        pool_pre_ping=True,
+        execution_options={"schema_translate_map": {SCHEMA: schema}},
+    )
+
+
+class ShardedSQLGroup(Group):
+    """A group whose members are spread across the shards of a ShardedSQLGroupProvider.
+
+    Attrs:
+        supports_member_list (bool): If the group supports getting the list of members
+    """
+
+    supports_member_list = True
+
+    def __init__(
+        self,
+        provider: IdentityProvider,
+        name: str,
+        group_provider: "ShardedSQLGroupProvider",
+    ):
+        """Initialize the group.
+
+        Args:
+            provider: The associated identity provider.
+            name: The unique, case-sensitive name of this group.
+            group_provider: The group provider knowing the shards.
+        """
+        super().__init__(provider, name)
+        self._provider = provider
+        self._name = name
+        self._group_provider = group_provider
+
+    def get_members(self) -> Iterator[IdentityInfo]:
+        """Return the members of the group, collected from all shards in parallel.
+
+        Returns:
+            An iterator over IdentityInfo objects.
+        """
+        identifiers = self._group_provider.get_member_identifiers(self._name)
+        return iter(
+            [IdentityInfo(provider=self._provider, identifier=i) for i in sorted(identifiers)]
+        )
+
+    def has_member(self, identifier: str) -> bool:
+        """Check if a given identity is a member of the group.
+
+        Args:
+            identifier: The unique user identifier used by the provider.
+
+        Returns:
+            True if the user is a member of the group, False otherwise.
+        """
+        pending = get_pending_lookup(self._provider)(identifier)
+        if pending is not None:
+            return self._name in pending
+        return self._group_provider.is_user_member(identifier, self._name)
+
+
+class ShardedSQLGroupProvider(GroupProvider):
+    """Provide access to groups whose memberships are split across several SQL databases.
+
+    Each shard is a database, or a schema of a database, containing the plugin tables. A user
+    and all of their memberships live in the shard selected by a hash of the identifier, so
+    operations on a single user touch exactly one shard. Each shard stores the groups its users
+    are members of. Operations on all members of a group or on all groups query the shards in
+    parallel and merge the results. As with SQLGroupProvider, the groups and users are scoped by
+    the name of the identity provider.
+
+    The shards are configured by the shards setting, a list of dictionaries with the SQLAlchemy
+    uri of the shard and optionally the schema holding the plugin tables, which defaults to
+    plugin_saml_groups. The list must not be reordered or extended without moving the users to
+    their new shards.
+
+    Hierarchical groups are not supported, the group_hierarchy_separator setting is rejected.
+
+    Attrs:
+        group_class (class): The class to use for groups.
+    """
+
+    group_class = ShardedSQLGroup
+
+    def __init__(self, identity_provider: IdentityProvider):
+        """Initialize the group provider.
+
+        Args:
+            identity_provider: The identity provider this group provider is associated with.
+
+        Raise:
+            ValueError: If the shards setting is not a non-empty list of valid shards or the
+                group_hierarchy_separator setting is set.
+        """
+        super().__init__(identity_provider)
+        if identity_provider.settings.get(GROUP_HIERARCHY_SEPARATOR_SETTING) is not None:
+            raise ValueError(
+                f"{GROUP_HIERARCHY_SEPARATOR_SETTING} is not supported by the sharded provider"
+            )
+        self.engines: List[Engine] = [
+            _create_shard_engine(uri, schema)
+            for uri, schema in get_shards(identity_provider.settings)
+        ]
+        self._provider_name: str = identity_provider.name
+        self._executor = ThreadPoolExecutor(
+            max_workers=len(self.engines), thread_name_prefix="saml-groups-shard"
+        )
+        self._sync_locks = [Lock() for _ in range(SYNC_LOCK_STRIPES)]
+
+    def make_group(self, name: str) -> ShardedSQLGroup:
+        """Create a group object without checking that the group exists.
+
+        Args:
+            name: The name of the group.
+
+        Returns:
+            The group.
+        """
+        return ShardedSQLGroup(provider=self._identity_provider, name=name, group_provider=self)
+
+    def add_group(self, name: str) -> None:
+        """Add a group to the shard selected by the hash of its name.
+
+        Args:
+            name: The name of the group.
+        """
+        with self._get_engine(name).begin() as connection:
+            get_group_ids(connection, self._provider_name, [name])
+
+    def get_group(self, name: str) -> Optional[ShardedSQLGroup]:
+        """Get a group.
+
+        Args:
+            name: The name of the group.
+
+        Returns:
+            The group or None if it does not exist in any shard.
+        """
+        groups = DBGroup.__table__
+        query = select(groups.c.name).where(
+            groups.c.provider == self._provider_name, groups.c.name == name
+        )
+        if any(self._fan_out(lambda c: c.execute(query).first() is not None)):
+            return self.make_group(name)
+        return None
+
+    def get_groups(self) -> Iterable[ShardedSQLGroup]:
+        """Get all groups.
+
+        Returns:
+            An iterable of all groups.
+        """
+        groups = DBGroup.__table__
+        query = select(groups.c.name).where(groups.c.provider == self._provider_name)
+        names = set().union(*self._fan_out(lambda c: c.execute(query).scalars().all()))
+        return map(self.make_group, sorted(names))
+
+    def get_groups_with_counts(
+        self, by_size: bool = False, limit: Optional[int] = None
+    ) -> List[Tuple[str, int]]:
+        """Get the names of all groups with their numbers of members, summed over all shards.
+
+        Args:
+            by_size: Whether to order the groups by decreasing member count instead of by name.
+                Groups with the same count are ordered by name.
+            limit: The maximum number of groups to return, None for all.
+
+        Returns:
+            The group names and member counts.
+        """
+        totals: Counter = Counter()
+        for counts in self._fan_out(lambda c: get_groups_with_counts(c, self._provider_name)):
+            totals.update(dict(counts))
+        return sort_group_counts(totals.items(), by_size, limit)
+
+    def get_user_groups(self, identifier: str) -> Iterable[ShardedSQLGroup]:
+        """Get all groups a user is a member of.
+
+        Args:
+            identifier: The unique user identifier used by the provider.
+
+        Returns:
+                iterable: An iterable of groups the user is a member of.
+        """
+        return map(self.make_group, sorted(self.get_user_group_names(identifier)))
+
+    def get_user_group_names(self, identifier: str) -> Set[str]:
+        """Get the names of all groups a user is a member of from the shard of the user.
+
+        Args:
+            identifier: The unique user identifier used by the provider.
+
+        Returns:
+            The names of the groups.
+        """
+        with self._get_engine(identifier).connect() as connection:
+            memberships = get_memberships(connection, self._provider_name, [identifier])
+        return set(memberships.get(identifier, {}))
+
+    def is_user_member(self, identifier: str, group_name: str) -> bool:
+        """Check if a user is a member of a group in the shard of the user.
+
+        Args:
+            identifier: The unique user identifier used by the provider.
+            group_name: The name of the group.
+
+        Returns:
+            True if the user is a member of the group, False otherwise.
+        """
+        with self._get_engine(identifier).connect() as connection:
+            return is_member(connection, self._provider_name, identifier, group_name)
+
+    def get_member_identifiers(self, group_name: str) -> Set[str]:
+        """Get the identifiers of all members of a group from all shards.
+
+        Args:
+            group_name: The name of the group.
+
+        Returns:
+            The unique user identifiers of the members.
+        """
+        users = SAMLUser.__table__
+        groups = DBGroup.__table__
+        query = (
+            select(users.c.identifier)
+            .select_from(group_members_table.join(users).join(groups))
+            .where(groups.c.provider == self._provider_name, groups.c.name == group_name)
+        )
+        return set().union(*self._fan_out(lambda c: c.execute(query).scalars().all()))
+
+    def find_member_identifiers(
+        self, all_of: Iterable[str] = (), any_of: Iterable[str] = (), none_of: Iterable[str] = ()
+    ) -> Iterator[str]:
+        """Find the users who are members of all of, any of and none of the given groups.
+
+        As all memberships of a user live in the same shard, the expression is evaluated by
+        each shard in parallel and the sorted results are merged.
+
+        Args:
+            all_of: The names of the groups the users must all be members of.
+            any_of: The names of the groups the users must be a member of at least one of.
+            none_of: The names of the groups the users must not be members of.
+
+        Raise:
+            ValueError: If neither all_of nor any_of is given.
+
+        Returns:
+            An iterator over the sorted unique user identifiers.
+        """
+        query = select_member_identifiers(
+            self._provider_name, check_member_expression(all_of, any_of, none_of)
+        )
+        return heapq.merge(*self._fan_out(lambda c: c.execute(query).scalars().all()))
+
+    def add_group_member(self, identifier: str, group_name: str) -> None:
+        """Add a user to a group.
+
+        Args:
+            identifier: The unique user identifier used by the provider.
+            group_name: The name of the group.
+        """
+        with self._get_engine(identifier).begin() as connection:
+            insert_memberships(
+                connection, self._provider_name, [(identifier, group_name)], WRITE_OPTIONS
+            )
+
+    def remove_group_member(self, identifier: str, group_name: str) -> None:
+        """Remove a user from a group.
+
+        Args:
+            identifier: The unique user identifier used by the provider.
+            group_name: The name of the group.
+        """
+        with self._get_engine(identifier).begin() as connection:
+            delete_memberships(
+                connection, self._provider_name, [(identifier, group_name)], WRITE_OPTIONS
+            )
+
+    # pylint: disable-next=unused-argument
+    def sync_user_groups(
+        self, identifier: str, group_names: Sequence[str], attributes: Optional[Mapping] = None
+    ) -> None:
+        """Make the user a member of exactly the given groups in a transaction on its shard.
+
+        Args:
+            identifier: The unique user identifier used by the provider.
+            group_names: The names of all groups the user belongs to.
+            attributes: The identity attributes, which are not stored by this provider.
+        """
+        with self._sync_locks[hash(identifier) % SYNC_LOCK_STRIPES]:
+            with self._get_engine(identifier).begin() as connection:
+                sync_memberships(
+                    connection,
+                    self._provider_name,
+                    {identifier: group_names},
+                    options=WRITE_OPTIONS,
+                )
+
+    def warm_up(self, deadline: float) -> int:
+        """Open the connections of the pools of the shards.
+
+        Args:
+            deadline: The time.monotonic() value after which no more work is started.
+
+        Returns:
+            0, as the groups are not preloaded.
+        """
+        for engine in self.engines:
+            fill_pool(engine, deadline)
+        return 0
+
+    def _get_engine(self, key: str) -> Engine:
+        """Get the engine of the shard of a user identifier or group name.
+
+        Args:
+            key: The user identifier or group name.
+
+        Returns:
+            The engine of the shard.
+        """
+        return self.engines[get_shard_index(key, len(self.engines))]
+
+    def _fan_out(self, query: Callable[[Connection], _T]) -> List[_T]:
+        """Run a query on all shards in parallel.
+
+        Args:
+            query: The function running the query on the connection to a shard.
+
+        Returns:
+            The results of the shards, in the order of the shards.
+        """
+
+        def run(engine: Engine) -> _T:
+            with engine.connect() as connection:
+                return query(connection)
+
+        return list(self._executor.map(run, self.engines))
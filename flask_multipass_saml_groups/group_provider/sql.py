@@ -3,51 +3,250 @@
 
 """A group provider that persists groups and their members in a SQL database provided by Indico."""
 
-from typing import Iterable, Iterator, Optional
+import time
+from contextlib import contextmanager
+from threading import Lock
+from typing import (
+    Callable,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+from weakref import WeakValueDictionary
 
 from flask_multipass import Group, IdentityInfo, IdentityProvider
 from indico.core.db import db
-
-from flask_multipass_saml_groups.group_provider.base import GroupProvider
+from sqlalchemy import exists, select
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import Select
+
+from flask_multipass_saml_groups.group_provider.attributes import (
+    Attributes,
+    get_attributes,
+    search_attributes,
+    store_attributes,
+)
+from flask_multipass_saml_groups.group_provider.base import (
+    GroupProvider,
+    check_member_expression,
+    get_pending_lookup,
+    make_identity_info,
+    no_pending_group_names,
+)
+from flask_multipass_saml_groups.group_provider.bulk import (
+    WriteOptions,
+    delete_memberships,
+    get_ancestor_names,
+    get_group_ids,
+    get_groups_with_counts,
+    insert_memberships,
+    sync_memberships,
+)
+from flask_multipass_saml_groups.group_provider.changelog import (
+    DEFAULT_CHANGES_LIMIT,
+    MembershipChange,
+    get_changes,
+)
+from flask_multipass_saml_groups.group_provider.coalescing import CoalescingMembershipWriter
+from flask_multipass_saml_groups.group_provider.routing import PRIMARY, ReadRouter, fill_pool
+from flask_multipass_saml_groups.group_provider.setops import select_member_identifiers
 from flask_multipass_saml_groups.models.saml_groups import SAMLGroup as DBGroup
-from flask_multipass_saml_groups.models.saml_groups import SAMLUser
+from flask_multipass_saml_groups.models.saml_groups import (
+    SAMLUser,
+    get_identifier_key,
+    group_members_table,
+)
+
+WRITE_COALESCING_SETTING = "write_coalescing_ms"
+SYNC_LOCK_STRIPES = 64
+READ_REPLICA_SETTING = "read_replica_uri"
+READ_REPLICA_PINNING_SETTING = "read_replica_pinning"
+DEFAULT_READ_REPLICA_PINNING = 60
+DENORMALIZED_GROUP_NAMES_SETTING = "denormalized_group_names"
+GROUP_HIERARCHY_SEPARATOR_SETTING = "group_hierarchy_separator"
+CHANGE_LOG_SETTING = "membership_change_log"
+MEMBER_FETCH_SIZE = 1000
+WARM_UP_MAX_GROUPS = 10000
+
+
+def _get_denormalized_group_names(
+    session: Session, provider: str, identifier: str
+) -> Optional[List[str]]:
+    """Get the group names of a user from the denormalized column.
+
+    Args:
+        session: The session to query.
+        provider: The name of the identity provider of the user.
+        identifier: The unique user identifier used by the provider.
+
+    Returns:
+        The sorted group names, or None if they have not been computed for the user.
+    """
+    row = (
+        session.query(SAMLUser.group_names)
+        .filter_by(provider=provider, identifier_key=get_identifier_key(identifier))
+        .first()
+    )
+    if row is None:
+        return []
+    return None if row.group_names is None else sorted(row.group_names)
+
+
+def _with_ancestors(group_names: Iterable[str], separator: Optional[str]) -> List[str]:
+    """Add the names of the ancestors of hierarchical groups.
+
+    Args:
+        group_names: The names of the groups.
+        separator: The separator of hierarchical group names, None if the groups are not
+            hierarchical.
+
+    Returns:
+        The sorted names of the groups and, if hierarchical, of their ancestors.
+    """
+    names = set(group_names)
+    if separator:
+        names.update(a for name in list(names) for a in get_ancestor_names(name, separator))
+    return sorted(names)
+
+
+class GroupOptions(NamedTuple):
+    """The options of the groups of a SQLGroupProvider.
+
+    Attrs:
+        router: The router of the read-only queries.
+        denormalized: Whether to read the memberships from the denormalized group names.
+        separator: The separator of hierarchical group names, None if the groups are not
+            hierarchical.
+        pending: The function getting the groups of a user which a deferred sync has not
+            applied yet, including their ancestors, or None if there is no pending sync.
+        change_log: Whether the writes of the memberships are appended to the change log.
+    """
+
+    router: ReadRouter = PRIMARY
+    denormalized: bool = False
+    separator: Optional[str] = None
+    pending: Callable[[str], Optional[List[str]]] = no_pending_group_names
+    change_log: bool = False
 
 
 class SQLGroup(Group):
     """A group whose group membership is persisted in a SQL database.
 
+    The group and its members are looked up among those of its identity provider. The members
+    of a hierarchical group include the members of its descendants. While the groups asserted
+    at the login of a user have not been applied by a deferred sync, the membership checks of
+    the user are answered from these groups. The id of the group in the
+    database is resolved once and cached on the group, and checked to still belong to the name
+    of the group by the queries using it, since a deleted group can be created again with
+    another id.
+
     Attrs:
         supports_member_list (bool): If the group supports getting the list of members
+        group_id (int): The cached id of the group in the database, None if not resolved yet
     """
 
+    # the attributes of flask_multipass' Group are kept in its __dict__, which also provides the
+    # __weakref__ the interning of the groups relies on
+    __slots__ = ("_provider", "_name", "_options", "group_id")
+
     supports_member_list = True
 
-    def __init__(self, provider: IdentityProvider, name: str):
+    def __init__(
+        self,
+        provider: IdentityProvider,
+        name: str,
+        options: Optional[GroupOptions] = None,
+        group_id: Optional[int] = None,
+    ):
         """Initialize the group.
 
         Args:
             provider: The associated identity provider.
             name: The unique, case-sensitive name of this group.
+            options: The options of the group provider, None to read non-hierarchical groups
+                from the memberships on the primary.
+            group_id: The id of the group in the database if known, None to resolve it when
+                needed.
         """
         super().__init__(provider, name)
         self._provider = provider
         self._name = name
+        self._options = options or GroupOptions()
+        self.group_id = group_id
+
+    def _resolve_group_id(self, session: Session, refresh: bool) -> Optional[int]:
+        """Get the id of the group in the database, cached on the group.
+
+        Args:
+            session: The session to query.
+            refresh: Whether to read the id again, e.g. if the cached one is stale.
+
+        Returns:
+            The id, None if the group does not exist.
+        """
+        if self.group_id is None or refresh:
+            groups = DBGroup.__table__
+            self.group_id = session.execute(
+                select(groups.c.id).where(
+                    groups.c.provider == self._provider.name, groups.c.name == self._name
+                )
+            ).scalar()
+        return self.group_id
+
+    def _query_by_id(self, session: Session, query: Callable[[int], Select]) -> Optional[List]:
+        """Run a query on the cached id of the group, refreshing the id if it is stale.
+
+        Args:
+            session: The session to query.
+            query: The function creating the query from the group id. The query must return no
+                rows if the id does not belong to the group name anymore.
+
+        Returns:
+            The rows, None if the group does not exist.
+        """
+        for refresh in (False, True):
+            group_id = self._resolve_group_id(session, refresh)
+            if group_id is None:
+                return None
+            rows = session.execute(query(group_id)).all()
+            if rows:
+                return rows
+        return None
 
     def get_members(self) -> Iterator[IdentityInfo]:
-        """Return the members of the group.
+        """Return the members of the group with their stored identity attributes.
 
         Returns:
             An iterator over IdentityInfo objects.
         """
-        db_group = DBGroup.query.filter_by(name=self._name).first()
-        if db_group:
-            return iter(
-                map(
-                    lambda m: IdentityInfo(provider=self._provider, identifier=m.identifier),
-                    db_group.members,
+        with self._options.router.read_session() as session:
+            if self._options.separator:
+                # served by the primary keys of the closure and of the memberships
+                query = select_member_identifiers(
+                    self._provider.name, ({self._name}, set(), set()), hierarchical=True
                 )
-            )
-        return iter([])
+                identifiers = list(session.execute(query).scalars())
+            elif self._options.denormalized and session.get_bind().dialect.name == "postgresql":
+                # served by the GIN index on the group names and, for the users whose names have
+                # not been computed, by the primary key of the memberships
+                query = select_member_identifiers(
+                    self._provider.name, ({self._name}, set(), set()), denormalized=True
+                )
+                identifiers = list(session.execute(query).scalars())
+            else:
+                rows = self._query_by_id(session, self._select_members)
+                identifiers = [i for i, in rows or () if i is not None]
+            attributes = get_attributes(session.connection(), self._provider.name, identifiers)
+        return iter(
+            [make_identity_info(self._provider, i, attributes.get(i)) for i in identifiers]
+        )
 
     def has_member(self, identifier: str) -> bool:
         """Check if a given identity is a member of the group.
@@ -58,18 +257,100 @@ class SQLGroup(Group):
         Returns:
             True if the user is a member of the group, False otherwise.
         """
+        pending = self._options.pending(identifier)
+        if pending is not None:
+            return self._name in pending
+        with self._options.router.read_session(identifier) as session:
+            if self._options.denormalized:
+                names = _get_denormalized_group_names(session, self._provider.name, identifier)
+                if names is not None:
+                    return self._name in _with_ancestors(names, self._options.separator)
+            if self._options.separator:
+                query = select_member_identifiers(
+                    self._provider.name, ({self._name}, set(), set()), hierarchical=True
+                ).where(SAMLUser.identifier_key == get_identifier_key(identifier))
+                return session.execute(query.limit(1)).first() is not None
+            rows = self._query_by_id(
+                session, lambda group_id: self._select_is_member(group_id, identifier)
+            )
+            return bool(rows and rows[0][0])
+
+    def _select_members(self, group_id: int) -> Select:
+        """Select the identifiers of the members of the group by its id.
+
+        Args:
+            group_id: The id of the group.
+
+        Returns:
+            The query, returning a single None identifier for a group without members and no
+            rows if the id does not belong to the group.
+        """
+        groups = DBGroup.__table__
+        users = SAMLUser.__table__
         return (
-            DBGroup.query.filter_by(name=self._name)
-            .join(DBGroup.members)
-            .filter_by(identifier=identifier)
-            .first()
-            is not None
+            select(users.c.identifier)
+            .select_from(groups.outerjoin(group_members_table.join(users)))
+            .where(groups.c.id == group_id, groups.c.name == self._name)
+        )
+
+    def _select_is_member(self, group_id: int, identifier: str) -> Select:
+        """Select whether a user is a member of the group by its id.
+
+        Args:
+            group_id: The id of the group.
+            identifier: The unique user identifier used by the provider.
+
+        Returns:
+            The query, returning whether the user is a member and no rows if the id does not
+            belong to the group.
+        """
+        groups = DBGroup.__table__
+        users = SAMLUser.__table__
+        is_member = exists().where(
+            group_members_table.c.group_id == group_id,
+            group_members_table.c.user_id == users.c.id,
+            users.c.provider == self._provider.name,
+            users.c.identifier_key == get_identifier_key(identifier),
+        )
+        return select(is_member).where(
+            exists().where(groups.c.id == group_id, groups.c.name == self._name)
         )
 
 
 class SQLGroupProvider(GroupProvider):
     """Provide access to Groups persisted with a SQL database.
 
+    The group names and user identifiers are scoped by the name of the identity provider, so
+    that several identity providers share the tables without seeing each other's groups and
+    users. The lookups are served by indexes leading with the name of the identity provider.
+
+    Writes run in short-lived transactions on their own connection, so they neither flush nor
+    commit the state pending in Indico's session and hold their locks only briefly. The plugin's
+    objects loaded in Indico's session are expired after each write. The plugin tables must
+    therefore not be modified through Indico's session in the same request.
+
+    If the denormalized_group_names setting is enabled, the groups of a user are read from the
+    group names stored with the user, which are kept up to date by every write, and the members
+    of a group are found through the GIN index on them on PostgreSQL. Otherwise the writes clear
+    the names of the users they change, so that enabling the setting later never reads outdated
+    names. Users whose names are missing are read from the memberships.
+
+    If the group_hierarchy_separator setting is set, group names are paths such as
+    eng/platform/sre, whose ancestors eng and eng/platform are created with them. A user is a
+    member of the ancestors of their groups, which is checked through the closure of the
+    hierarchy written together with the groups.
+
+    Reads can be sent to a read replica. The reads concerning a user are pinned to the primary
+    for a while after the memberships of the user have been written.
+
+    The identity attributes of the users mapped at their last login are stored, so that
+    identities can be retrieved and searched without the users logging in.
+
+    The group objects are interned: a single object per group name is shared by all callers
+    as long as any of them holds it, so that the ACL checks of a request do not build a new
+    object for every lookup. The warm-up preloads the groups seen most recently with their ids
+    and keeps them for the lifetime of the provider.
+
     Attrs:
         group_class (class): The class to use for groups.
     """
@@ -78,15 +359,89 @@ class SQLGroupProvider(GroupProvider):
     # pylint: disable=no-member
 
     group_class = SQLGroup
+    supports_identity_attributes = True
 
     def __init__(self, identity_provider: IdentityProvider):
         """Initialize the group provider.
 
         Args:
             identity_provider: The identity provider this group provider is associated with.
+
+        Raise:
+            ValueError: If the write_coalescing_ms or read_replica_pinning setting is not a
+                non-negative number, the read_replica_uri setting is not a string, the
+                denormalized_group_names or membership_change_log setting is not a boolean or
+                the group_hierarchy_separator setting is not a non-empty string.
         """
         super().__init__(identity_provider)
-        self._identity_provider = identity_provider
+
+        separator = identity_provider.settings.get(GROUP_HIERARCHY_SEPARATOR_SETTING)
+        if separator is not None and (not isinstance(separator, str) or not separator):
+            raise ValueError(f"{GROUP_HIERARCHY_SEPARATOR_SETTING} must be a non-empty string")
+        self._provider_name: str = identity_provider.name
+        self._groups: "WeakValueDictionary[str, SQLGroup]" = WeakValueDictionary()
+        self._groups_lock = Lock()
+        self._warm_groups: List[SQLGroup] = []
+
+        replica_uri = identity_provider.settings.get(READ_REPLICA_SETTING)
+        if replica_uri is not None and not isinstance(replica_uri, str):
+            raise ValueError(f"{READ_REPLICA_SETTING} must be a string")
+        pinning = identity_provider.settings.get(
+            READ_REPLICA_PINNING_SETTING, DEFAULT_READ_REPLICA_PINNING
+        )
+        if not isinstance(pinning, (int, float)) or pinning < 0:
+            raise ValueError(
+                f"{READ_REPLICA_PINNING_SETTING} {pinning} must be a non-negative number"
+            )
+
+        denormalized = identity_provider.settings.get(DENORMALIZED_GROUP_NAMES_SETTING, False)
+        if not isinstance(denormalized, bool):
+            raise ValueError(f"{DENORMALIZED_GROUP_NAMES_SETTING} must be a boolean")
+        change_log = identity_provider.settings.get(CHANGE_LOG_SETTING, False)
+        if not isinstance(change_log, bool):
+            raise ValueError(f"{CHANGE_LOG_SETTING} must be a boolean")
+        self._options = GroupOptions(
+            ReadRouter(replica_uri, pinning),
+            denormalized,
+            separator,
+            get_pending_lookup(identity_provider),
+            change_log,
+        )
+
+        interval = identity_provider.settings.get(WRITE_COALESCING_SETTING, 0)
+        if not isinstance(interval, (int, float)) or interval < 0:
+            raise ValueError(
+                f"{WRITE_COALESCING_SETTING} {interval} must be a non-negative number"
+            )
+        self._writer = (
+            CoalescingMembershipWriter(interval / 1000, self._provider_name, self._write_options)
+            if interval
+            else None
+        )
+        self._sync_locks = [Lock() for _ in range(SYNC_LOCK_STRIPES)]
+
+    @property
+    def _write_options(self) -> WriteOptions:
+        """The settings of the identity provider affecting the membership writes.
+
+        The denormalized group names are only maintained if they are read and cleared otherwise.
+        """
+        return WriteOptions(
+            separator=self._options.separator,
+            group_names=self._options.denormalized,
+            change_log=self._options.change_log,
+        )
+
+    def expand_group_names(self, group_names: Iterable[str]) -> List[str]:
+        """Add the ancestors of hierarchical groups.
+
+        Args:
+            group_names: The names of the groups.
+
+        Returns:
+            The sorted distinct names of the groups and, if hierarchical, of their ancestors.
+        """
+        return _with_ancestors(group_names, self._options.separator)
 
     def add_group(self, name: str) -> None:
         """Add a group.
@@ -94,10 +449,8 @@ class SQLGroupProvider(GroupProvider):
         Args:
             name: The name of the group.
         """
-        grp = DBGroup.query.filter_by(name=name).first()
-        if not grp:
-            db.session.add(DBGroup(name=name))
-            db.session.commit()
+        with self._write_transaction() as connection:
+            get_group_ids(connection, self._provider_name, [name], self._options.separator)
 
     def get_group(self, name: str) -> Optional[SQLGroup]:
         """Get a group.
@@ -108,10 +461,14 @@ class SQLGroupProvider(GroupProvider):
         Returns:
             The group or None if it does not exist.
         """
-        grp = DBGroup.query.filter_by(name=name).first()
-        if grp:
-            return SQLGroup(provider=self._identity_provider, name=grp.name)
-        return None
+        groups = DBGroup.__table__
+        with self._options.router.read_session() as session:
+            group_id = session.execute(
+                select(groups.c.id).where(
+                    groups.c.provider == self._provider_name, groups.c.name == name
+                )
+            ).scalar()
+        return None if group_id is None else self.make_group(name, group_id)
 
     def get_groups(self) -> Iterable[SQLGroup]:
         """Get all groups.
@@ -119,13 +476,15 @@ class SQLGroupProvider(GroupProvider):
         Returns:
             An iterable of all groups.
         """
-        return map(
-            lambda g: SQLGroup(provider=self._identity_provider, name=g.name),
-            DBGroup.query.all(),
-        )
+        groups = DBGroup.__table__
+        with self._options.router.read_session() as session:
+            rows = session.execute(
+                select(groups.c.name, groups.c.id).where(groups.c.provider == self._provider_name)
+            ).all()
+        return [self.make_group(name, group_id) for name, group_id in rows]
 
     def get_user_groups(self, identifier: str) -> Iterable[SQLGroup]:
-        """Get all groups a user is a member of.
+        """Get all groups a user is a member of, including the ancestors of hierarchical groups.
 
         Args:
             identifier: The unique user identifier used by the provider.
@@ -133,13 +492,27 @@ class SQLGroupProvider(GroupProvider):
         Returns:
                 iterable: An iterable of groups the user is a member of.
         """
-        user = SAMLUser.query.filter_by(identifier=identifier).first()
-        if user:
-            return map(
-                lambda g: SQLGroup(name=g.name, provider=self._identity_provider),
-                user.groups,
+        with self._options.router.read_session(identifier) as session:
+            if self._options.denormalized:
+                names = _get_denormalized_group_names(session, self._provider_name, identifier)
+                if names is not None:
+                    return map(self.make_group, _with_ancestors(names, self._options.separator))
+            groups = DBGroup.__table__
+            users = SAMLUser.__table__
+            group_ids = dict(
+                session.execute(
+                    select(groups.c.name, groups.c.id)
+                    .select_from(users.join(group_members_table).join(groups))
+                    .where(
+                        users.c.provider == self._provider_name,
+                        users.c.identifier_key == get_identifier_key(identifier),
+                    )
+                ).all()
             )
-        return []
+        return [
+            self.make_group(name, group_ids.get(name))
+            for name in _with_ancestors(group_ids, self._options.separator)
+        ]
 
     def add_group_member(self, identifier: str, group_name: str) -> None:
         """Add a user to a group.
@@ -148,19 +521,13 @@ class SQLGroupProvider(GroupProvider):
             identifier: The unique user identifier used by the provider.
             group_name: The name of the group.
         """
-        user = SAMLUser.query.filter_by(identifier=identifier).first()
-        grp = DBGroup.query.filter_by(name=group_name).first()
-
-        if not user:
-            user = SAMLUser(identifier=identifier)
-            db.session.add(user)
-        if not grp:
-            grp = DBGroup(name=group_name)
-            db.session.add(grp)
-
-        if user not in grp.members:
-            grp.members.append(user)
-        db.session.commit()
+        with self._write_transaction([identifier]) as connection:
+            insert_memberships(
+                connection,
+                self._provider_name,
+                [(identifier, group_name)],
+                self._write_options,
+            )
 
     def remove_group_member(self, identifier: str, group_name: str) -> None:
         """Remove a user from a group.
@@ -169,9 +536,241 @@ class SQLGroupProvider(GroupProvider):
             identifier: The unique user identifier used by the provider.
             group_name: The name of the group.
         """
-        user = SAMLUser.query.filter_by(identifier=identifier).first()
-        grp = DBGroup.query.filter_by(name=group_name).first()
+        with self._write_transaction([identifier]) as connection:
+            delete_memberships(
+                connection, self._provider_name, [(identifier, group_name)], self._write_options
+            )
+
+    def sync_user_groups(
+        self, identifier: str, group_names: Sequence[str], attributes: Optional[Mapping] = None
+    ) -> None:
+        """Make the user a member of exactly the given groups and store its identity attributes.
+
+        The memberships and attributes are written in a single transaction holding a lock on the
+        identifier, so that concurrent syncs of the same user, e.g. from multiple tabs, are
+        applied one after the other. If write coalescing is enabled, they are written together
+        with those of concurrent logins.
+
+        Args:
+            identifier: The unique user identifier used by the provider.
+            group_names: The names of all groups the user belongs to.
+            attributes: The identity attributes mapped by the identity provider, None to keep
+                the stored ones.
+        """
+        if self._writer:
+            self._writer.sync(identifier, group_names, attributes)
+            self._expire_session_state()
+            self._options.router.pin([identifier])
+            return
+
+        with self._sync_locks[hash(identifier) % SYNC_LOCK_STRIPES]:
+            with self._write_transaction([identifier]) as connection:
+                if attributes is not None:
+                    store_attributes(connection, self._provider_name, identifier, attributes)
+                # last, as the sync appends to the change log
+                sync_memberships(
+                    connection,
+                    self._provider_name,
+                    {identifier: group_names},
+                    options=self._write_options,
+                )
+
+    def find_member_identifiers(
+        self, all_of: Iterable[str] = (), any_of: Iterable[str] = (), none_of: Iterable[str] = ()
+    ) -> Iterator[str]:
+        """Find the users who are members of all of, any of and none of the given groups.
+
+        The expression is evaluated by a single query, so only the identifiers of the result are
+        loaded. The members of hierarchical groups include those of their descendants.
+
+        Args:
+            all_of: The names of the groups the users must all be members of.
+            any_of: The names of the groups the users must be a member of at least one of.
+            none_of: The names of the groups the users must not be members of.
+
+        Raise:
+            ValueError: If neither all_of nor any_of is given.
+
+        Returns:
+            An iterator over the sorted unique user identifiers.
+        """
+        expression = check_member_expression(all_of, any_of, none_of)
+        with self._options.router.read_session() as session:
+            denormalized = (
+                self._options.denormalized and session.get_bind().dialect.name == "postgresql"
+            )
+            query = select_member_identifiers(
+                self._provider_name,
+                expression,
+                denormalized=denormalized,
+                hierarchical=bool(self._options.separator),
+            )
+            # fetched before the session is closed, so an abandoned iterator holds no connection
+            identifiers = session.execute(query).scalars().all()
+        return iter(identifiers)
+
+    def get_membership_changes(
+        self, since: int = 0, limit: int = DEFAULT_CHANGES_LIMIT
+    ) -> List[MembershipChange]:
+        """Get the changes of memberships written after a sequence number.
+
+        A consumer passes the sequence number of the last change it has seen to read only the
+        newer changes, none of which can become visible later below the last change returned. The
+        changes are read from the primary, waiting for the appends in flight. The sequence numbers
+        are shared with the other identity providers, so those of the changes of a provider have
+        gaps. Unless the membership_change_log setting is True, the logins do not append their
+        changes.
+
+        Args:
+            since: The sequence number of the last change seen by the caller, 0 for all changes.
+            limit: The maximum number of changes to return.
+
+        Returns:
+            The changes in the order of their sequence numbers.
+        """
+        with db.engine.begin() as connection:
+            return get_changes(connection, self._provider_name, since, limit)
+
+    def get_groups_with_counts(
+        self, by_size: bool = False, limit: Optional[int] = None
+    ) -> List[Tuple[str, int]]:
+        """Get the names of all groups with their numbers of direct members.
+
+        The counts are maintained by the writes of the memberships, so they are read without
+        counting the memberships. The members of the descendants of hierarchical groups are not
+        included.
+
+        Args:
+            by_size: Whether to order the groups by decreasing member count instead of by name.
+                Groups with the same count are ordered by name.
+            limit: The maximum number of groups to return, None for all.
+
+        Returns:
+            The group names and member counts.
+        """
+        with self._options.router.read_session() as session:
+            return get_groups_with_counts(
+                session.connection(), self._provider_name, by_size, limit
+            )
+
+    def set_identity_attributes(self, identifier: str, attributes: Mapping) -> None:
+        """Store the identity attributes of a user, writing them only if they have changed.
+
+        Args:
+            identifier: The unique user identifier used by the provider.
+            attributes: The identity attributes mapped by the identity provider.
+        """
+        with self._write_transaction([identifier]) as connection:
+            store_attributes(connection, self._provider_name, identifier, attributes)
+
+    def get_identity_attributes(self, identifier: str) -> Optional[Attributes]:
+        """Get the stored identity attributes of a user.
+
+        Args:
+            identifier: The unique user identifier used by the provider.
+
+        Returns:
+            The attributes, None if the user does not exist.
+        """
+        with self._options.router.read_session(identifier) as session:
+            return get_attributes(session.connection(), self._provider_name, [identifier]).get(
+                identifier
+            )
+
+    def search_identity_attributes(
+        self, criteria: Mapping[str, Set[str]], exact: bool = False, limit: Optional[int] = None
+    ) -> Tuple[List[Tuple[str, Attributes]], int]:
+        """Search users by their stored identity attributes.
+
+        Args:
+            criteria: The attribute names and the values to search for.
+            exact: Whether the attributes must be equal to the values instead of starting with
+                them.
+            limit: The maximum number of users to return, None for all.
+
+        Returns:
+            The identifiers and attributes of the matching users ordered by identifier, and the
+            total number of matching users.
+        """
+        with self._options.router.read_session() as session:
+            return search_attributes(
+                session.connection(), self._provider_name, criteria, exact, limit
+            )
+
+    def warm_up(self, deadline: float) -> int:
+        """Open the connections of the pools and preload the groups seen most recently.
+
+        Up to WARM_UP_MAX_GROUPS groups are interned with their ids, fetched in batches until the
+        deadline.
+
+        Args:
+            deadline: The time.monotonic() value after which no more work is started.
+
+        Returns:
+            The number of preloaded groups.
+        """
+        fill_pool(db.engine, deadline)
+        if self._options.router.engine is not None:
+            fill_pool(self._options.router.engine, deadline)
+        groups = DBGroup.__table__
+        warm_groups: List[SQLGroup] = []
+        with db.engine.connect() as connection:
+            result = connection.execution_options(
+                stream_results=True, max_row_buffer=MEMBER_FETCH_SIZE
+            ).execute(
+                select(groups.c.name, groups.c.id)
+                .where(groups.c.provider == self._provider_name)
+                .order_by(groups.c.last_seen_at.desc())
+                .limit(WARM_UP_MAX_GROUPS)
+            )
+            for batch in result.partitions(MEMBER_FETCH_SIZE):
+                if time.monotonic() >= deadline:
+                    break
+                warm_groups.extend(self.make_group(name, group_id) for name, group_id in batch)
+            result.close()
+        self._warm_groups = warm_groups
+        return len(warm_groups)
+
+    def make_group(self, name: str, group_id: Optional[int] = None) -> SQLGroup:
+        """Get the interned group of a name, reading through the router of the provider.
 
-        if grp and user in grp.members:
-            grp.members.remove(user)
-        db.session.commit()
+        Args:
+            name: The name of the group.
+            group_id: The id of the group in the database if known, which is cached on the group.
+
+        Returns:
+            The group.
+        """
+        with self._groups_lock:
+            group = self._groups.get(name)
+            if group is None:
+                group = SQLGroup(
+                    provider=self._identity_provider, name=name, options=self._options
+                )
+                self._groups[name] = group
+            if group_id is not None:
+                group.group_id = group_id
+            return group
+
+    @contextmanager
+    def _write_transaction(self, identifiers: Iterable[str] = ()) -> Iterator[Connection]:
+        """Run writes in a short-lived transaction on a dedicated connection.
+
+        Args:
+            identifiers: The unique user identifiers whose reads are pinned to the primary
+                after the write.
+
+        Yields:
+            The connection, whose transaction is committed when the block is left.
+        """
+        with db.engine.begin() as connection:
+            yield connection
+        self._expire_session_state()
+        self._options.router.pin(identifiers)
+
+    @staticmethod
+    def _expire_session_state() -> None:
+        """Expire the plugin's objects in Indico's session, which have been written elsewhere."""
+        for obj in list(db.session.identity_map.values()):
+            if isinstance(obj, (SAMLUser, DBGroup)):
+                db.session.expire(obj)
@@ -0,0 +1,293 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+"""Streaming export and import of the groups and their members.
+
+The memberships are exchanged as pairs of group names and user identifiers, the identifier being
+None for a group without members. They are read and written through generators, so that any
+number of memberships can be transferred in constant memory.
+"""
+
+import csv
+import io
+import json
+from typing import IO, Any, Dict, Iterable, Iterator, Optional, Tuple
+
+from indico.core.db.sqlalchemy import UTCDateTime
+from indico.util.date_time import now_utc
+from sqlalchemy import (
+    Integer,
+    LargeBinary,
+    String,
+    and_,
+    column,
+    func,
+    insert,
+    literal,
+    select,
+    table,
+    text,
+)
+from sqlalchemy.engine import Connection
+
+from flask_multipass_saml_groups.group_provider.bulk import (
+    add_member_counts_from_select,
+    chunked,
+    get_group_ids,
+    insert_ignore,
+    insert_memberships,
+    update_group_names,
+)
+from flask_multipass_saml_groups.group_provider.changelog import ADD, append_changes_from_select
+from flask_multipass_saml_groups.models.saml_groups import SAMLGroup as DBGroup
+from flask_multipass_saml_groups.models.saml_groups import (
+    SAMLUser,
+    get_identifier_key,
+    group_members_table,
+)
+
+FORMATS = ("jsonl", "csv")
+CSV_HEADER = ["group", "identifier"]
+DEFAULT_TRANSFER_BATCH_SIZE = 10000
+STAGING_TABLE = "saml_groups_import"
+ADDED_TABLE = "saml_groups_import_added"
+
+Membership = Tuple[str, Optional[str]]
+
+_staging = table(
+    STAGING_TABLE,
+    column("group_name", String),
+    column("identifier", String),
+    column("identifier_key", LargeBinary),
+)
+_added = table(ADDED_TABLE, column("group_id", Integer), column("user_id", Integer))
+
+
+def export_memberships(
+    connection: Connection, provider: str, batch_size: int = DEFAULT_TRANSFER_BATCH_SIZE
+) -> Iterator[Membership]:
+    """Read all groups of a provider and their members, ordered by group name and identifier.
+
+    The rows are fetched in batches through a server-side cursor where supported.
+
+    Args:
+        connection: The connection to use.
+        provider: The name of the identity provider of the groups.
+        batch_size: The number of rows fetched at once.
+
+    Yields:
+        The group names and the identifiers of their members, None for groups without members.
+    """
+    groups = DBGroup.__table__
+    users = SAMLUser.__table__
+    result = connection.execution_options(stream_results=True, max_row_buffer=batch_size).execute(
+        select(groups.c.name, users.c.identifier)
+        .select_from(groups.outerjoin(group_members_table.join(users)))
+        .where(groups.c.provider == provider)
+        .order_by(groups.c.name, users.c.identifier)
+    )
+    for group_name, identifier in result:
+        yield group_name, identifier
+
+
+def write_memberships(memberships: Iterable[Membership], file: IO[str], format_: str) -> int:
+    """Write memberships to a file.
+
+    Args:
+        memberships: The group names and identifiers.
+        file: The text file to write to.
+        format_: jsonl for one JSON object per line, csv for CSV with a header.
+
+    Raise:
+        ValueError: If the format is not supported.
+
+    Returns:
+        The number of written memberships.
+    """
+    count = 0
+    if format_ == "jsonl":
+        for count, (group_name, identifier) in enumerate(memberships, start=1):
+            file.write(json.dumps({"group": group_name, "identifier": identifier}) + "\n")
+    elif format_ == "csv":
+        writer = csv.writer(file, lineterminator="\n")
+        writer.writerow(CSV_HEADER)
+        for count, (group_name, identifier) in enumerate(memberships, start=1):
+            writer.writerow([group_name, identifier or ""])
+    else:
+        raise ValueError(f"Unsupported format {format_}")
+    return count
+
+
+def read_memberships(file: IO[str], format_: str) -> Iterator[Membership]:
+    """Read memberships from a file written by write_memberships.
+
+    Args:
+        file: The text file to read from.
+        format_: jsonl for one JSON object per line, csv for CSV with a header.
+
+    Raise:
+        ValueError: If the format is not supported or a record is invalid.
+
+    Yields:
+        The group names and identifiers, None for groups without members.
+    """
+    records: Iterable[Dict[str, Any]]
+    if format_ == "jsonl":
+        records = (json.loads(line) for line in file if line.strip())
+    elif format_ == "csv":
+        records = csv.DictReader(file)
+    else:
+        raise ValueError(f"Unsupported format {format_}")
+    for number, record in enumerate(records, start=1):
+        group_name = record.get("group")
+        identifier = record.get("identifier") or None
+        if not isinstance(group_name, str) or not group_name:
+            raise ValueError(f"Record {number} has no group")
+        if identifier is not None and not isinstance(identifier, str):
+            raise ValueError(f"Record {number} has an invalid identifier")
+        yield group_name, identifier
+
+
+def import_memberships(
+    connection: Connection,
+    provider: str,
+    memberships: Iterable[Membership],
+    batch_size: int = DEFAULT_TRANSFER_BATCH_SIZE,
+) -> int:
+    """Add the given memberships, creating the missing groups and users.
+
+    Existing memberships are kept. On PostgreSQL, the memberships are copied into a temporary
+    staging table with COPY and merged with set-based statements. Other databases insert them
+    in batches. The group names of the imported users and the member counts of their groups are
+    refreshed and the added memberships are appended to the change log.
+
+    Args:
+        connection: The connection to use, its transaction must be committed by the caller.
+        provider: The name of the identity provider of the groups and users.
+        memberships: The group names and identifiers, None for groups without members.
+        batch_size: The number of memberships sent to the database at once.
+
+    Returns:
+        The number of imported records.
+    """
+    if connection.dialect.name == "postgresql":
+        return _copy_and_merge(connection, provider, memberships, batch_size)
+    count = 0
+    for batch in chunked(memberships, batch_size):
+        get_group_ids(connection, provider, (group_name for group_name, _ in batch))
+        insert_memberships(connection, provider, ((i, n) for n, i in batch if i is not None))
+        count += len(batch)
+    return count
+
+
+def _copy_and_merge(
+    connection: Connection, provider: str, memberships: Iterable[Membership], batch_size: int
+) -> int:
+    """Copy memberships into a staging table and merge them into the plugin tables.
+
+    Args:
+        connection: The connection to a PostgreSQL database.
+        provider: The name of the identity provider of the groups and users.
+        memberships: The group names and identifiers, None for groups without members.
+        batch_size: The number of memberships copied at once.
+
+    Returns:
+        The number of imported records.
+    """
+    connection.execute(
+        text(
+            f"CREATE TEMPORARY TABLE {STAGING_TABLE} "
+            "(group_name text NOT NULL, identifier text, identifier_key bytea) ON COMMIT DROP"
+        )
+    )
+    count = 0
+    with connection.connection.cursor() as cursor:
+        for batch in chunked(memberships, batch_size):
+            buffer = io.StringIO()
+            csv.writer(buffer, lineterminator="\n").writerows(
+                (n, i, None if i is None else "\\x" + get_identifier_key(i).hex())
+                for n, i in batch
+            )
+            buffer.seek(0)
+            cursor.copy_expert(f"COPY {STAGING_TABLE} FROM STDIN WITH (FORMAT csv)", buffer)
+            count += len(batch)
+    connection.execute(text(f"ANALYZE {STAGING_TABLE}"))
+
+    now = literal(now_utc(), UTCDateTime())
+    provider_name = literal(provider, String())
+    groups = DBGroup.__table__
+    users = SAMLUser.__table__
+    connection.execute(
+        insert_ignore(connection, groups).from_select(
+            ["provider", "name", "last_seen_at"],
+            select(provider_name, _staging.c.group_name, now).distinct(),
+        )
+    )
+    connection.execute(
+        insert_ignore(connection, users).from_select(
+            ["provider", "identifier", "identifier_key", "last_seen_at"],
+            select(provider_name, _staging.c.identifier, _staging.c.identifier_key, now)
+            .where(_staging.c.identifier.isnot(None))
+            .distinct(),
+        )
+    )
+    # the added memberships are kept aside, as the change log must be appended to last
+    connection.execute(
+        text(
+            f"CREATE TEMPORARY TABLE {ADDED_TABLE} (group_id integer, user_id integer) "
+            "ON COMMIT DROP"
+        )
+    )
+    inserted = (
+        insert_ignore(connection, group_members_table)
+        .from_select(
+            ["group_id", "user_id"],
+            select(groups.c.id, users.c.id)
+            .select_from(
+                _staging.join(
+                    groups,
+                    and_(groups.c.provider == provider, groups.c.name == _staging.c.group_name),
+                ).join(
+                    users,
+                    and_(
+                        users.c.provider == provider,
+                        users.c.identifier_key == _staging.c.identifier_key,
+                    ),
+                )
+            )
+            .distinct()
+            .order_by(groups.c.id, users.c.id),
+        )
+        .returning(group_members_table.c.group_id, group_members_table.c.user_id)
+        .cte("inserted")
+    )
+    connection.execute(
+        insert(_added)
+        .from_select(["group_id", "user_id"], select(inserted.c.group_id, inserted.c.user_id))
+        .add_cte(inserted)
+    )
+    # the statistics of the plugin tables predate the import, with which the planner would scan
+    # the members table for every user while refreshing the group names
+    for plugin_table in (groups, users, group_members_table):
+        connection.execute(text(f"ANALYZE {plugin_table.schema}.{plugin_table.name}"))
+    update_group_names(
+        connection,
+        and_(
+            users.c.provider == provider,
+            users.c.identifier_key.in_(select(_staging.c.identifier_key)),
+        ),
+    )
+    add_member_counts_from_select(
+        connection,
+        select(_added.c.group_id, func.count())
+        .group_by(_added.c.group_id)
+        .order_by(_added.c.group_id),
+    )
+    append_changes_from_select(
+        connection,
+        select(provider_name, literal(ADD), groups.c.name, users.c.identifier, now)
+        .select_from(_added.join(groups, groups.c.id == _added.c.group_id))
+        .join(users, users.c.id == _added.c.user_id)
+        .order_by(users.c.identifier, groups.c.name),
+    )
+    return count
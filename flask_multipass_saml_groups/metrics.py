@@ -0,0 +1,79 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+"""Lightweight in-process metrics for the SAML Groups plugin."""
+
+from collections import Counter
+from threading import Lock
+from typing import Dict
+
+
+class CounterSet:
+    """A thread-safe set of named counters."""
+
+    def __init__(self) -> None:
+        """Initialize the counters."""
+        self._lock = Lock()
+        self._counts: Counter[str] = Counter()
+
+    def inc(self, name: str, amount: int = 1) -> None:
+        """Increment a counter.
+
+        Args:
+            name: The name of the counter.
+            amount: The amount to add to the counter.
+        """
+        with self._lock:
+            self._counts[name] += amount
+
+    def snapshot(self) -> Dict[str, int]:
+        """Return the current value of all counters.
+
+        Returns:
+            A mapping of counter names to their values.
+        """
+        with self._lock:
+            return dict(self._counts)
+
+
+class Histogram:
+    """A thread-safe histogram with fixed-width buckets.
+
+    Attrs:
+        bucket_width (int): The width of each bucket.
+    """
+
+    def __init__(self, bucket_width: int) -> None:
+        """Initialize the histogram.
+
+        Args:
+            bucket_width: The width of each bucket, must be positive.
+
+        Raise:
+            ValueError: If bucket_width is not positive.
+        """
+        if bucket_width <= 0:
+            raise ValueError(f"bucket_width {bucket_width} must be positive")
+        self.bucket_width = bucket_width
+        self._lock = Lock()
+        self._buckets: Counter[int] = Counter()
+
+    def observe(self, value: float) -> None:
+        """Record a value.
+
+        Args:
+            value: The observed value.
+        """
+        bucket = int(value // self.bucket_width) * self.bucket_width
+        with self._lock:
+            self._buckets[bucket] += 1
+
+    def snapshot(self) -> Dict[int, int]:
+        """Return the current bucket counts.
+
+        Returns:
+            A mapping of the lower bound of each bucket to the number of observed values,
+            ordered by bucket.
+        """
+        with self._lock:
+            return dict(sorted(self._buckets.items()))
@@ -0,0 +1,59 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+"""The Alembic environment running the migrations of the plugin on the shards.
+
+The migrations read the schema of the plugin tables with get_schema. It is the schema of the
+shard when the upgrade-shards command runs them in this environment, and plugin_saml_groups when
+indico db --plugin saml_groups upgrade runs them in the environment of Indico.
+"""
+
+import os
+
+from alembic import op
+from alembic.runtime.migration import MigrationContext
+from alembic.script import ScriptDirectory
+from sqlalchemy.engine import Connection
+
+from flask_multipass_saml_groups.models.saml_groups import SCHEMA
+
+MIGRATIONS_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "migrations")
+CONNECTION_ATTRIBUTE = "saml_groups_connection"
+SCHEMA_ATTRIBUTE = "saml_groups_schema"
+VERSION_TABLE = "alembic_version_plugin_saml_groups"
+# the version table of Indico's environment, shared by the shards using the default schema
+DEFAULT_VERSION_TABLE_SCHEMA = "public"
+
+
+def get_schema() -> str:
+    """Get the schema of the plugin tables the running migration applies to.
+
+    Returns:
+        The schema of the shard being upgraded, plugin_saml_groups outside of upgrade-shards.
+    """
+    config = op.get_context().config  # pylint: disable=no-member
+    if config is None:
+        return SCHEMA
+    return config.attributes.get(SCHEMA_ATTRIBUTE, SCHEMA)
+
+
+def is_up_to_date(connection: Connection) -> bool:
+    """Check if the plugin tables of the default schema have been upgraded to the latest revision.
+
+    Args:
+        connection: The connection to the database of Indico.
+
+    Returns:
+        True if the revision of the plugin tables is the head of the migrations.
+    """
+    context = MigrationContext.configure(
+        connection,
+        opts={
+            "version_table": VERSION_TABLE,
+            "version_table_schema": (
+                DEFAULT_VERSION_TABLE_SCHEMA if connection.dialect.name == "postgresql" else None
+            ),
+        },
+    )
+    script = ScriptDirectory(os.path.dirname(__file__), version_locations=[MIGRATIONS_PATH])
+    return set(context.get_current_heads()) == set(script.get_heads())
@@ -0,0 +1,36 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+"""Run the migrations of the plugin on the connection and schema of a shard.
+
+The shards using another schema than plugin_saml_groups keep their version table in that schema,
+so that several shards can share a database.
+"""
+
+# the members of alembic.context are only set while alembic runs the environment
+# pylint: disable=no-member
+
+from alembic import context
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateSchema
+
+from flask_multipass_saml_groups.migration_env import (
+    CONNECTION_ATTRIBUTE,
+    DEFAULT_VERSION_TABLE_SCHEMA,
+    SCHEMA_ATTRIBUTE,
+    VERSION_TABLE,
+)
+from flask_multipass_saml_groups.models.saml_groups import SCHEMA
+
+connection = context.config.attributes[CONNECTION_ATTRIBUTE]
+schema = context.config.attributes[SCHEMA_ATTRIBUTE]
+if schema not in inspect(connection).get_schema_names():
+    # created before the version table stored in it
+    connection.execute(CreateSchema(schema))
+context.configure(
+    connection=connection,
+    version_table=VERSION_TABLE,
+    version_table_schema=DEFAULT_VERSION_TABLE_SCHEMA if schema == SCHEMA else schema,
+)
+with context.begin_transaction():
+    context.run_migrations()
@@ -16,6 +16,8 @@ import sqlalchemy as sa
 from alembic import op
 from sqlalchemy.sql.ddl import CreateSchema, DropSchema
 
+from flask_multipass_saml_groups.migration_env import get_schema
+
 # revision identifiers, used by Alembic.
 revision = "ae387f5fc14a"
 down_revision = None
@@ -24,16 +26,19 @@ depends_on = None
 
 
 def upgrade():  # noqa
-    op.execute(CreateSchema("plugin_saml_groups"))
+    schema = get_schema()
+    # the environment of upgrade-shards creates the schema of a shard before its version table
+    if schema not in sa.inspect(op.get_bind()).get_schema_names():
+        op.execute(CreateSchema(schema))
     # ### commands auto generated by Alembic - please adjust! ###
     op.create_table(
         "saml_groups",
         sa.Column("id", sa.Integer(), nullable=False),
         sa.Column("name", sa.String(), nullable=False),
         sa.PrimaryKeyConstraint("id"),
-        schema="plugin_saml_groups",
+        schema=schema,
     )
-    with op.batch_alter_table("saml_groups", schema="plugin_saml_groups") as batch_op:
+    with op.batch_alter_table("saml_groups", schema=schema) as batch_op:
         batch_op.create_index(batch_op.f("ix_saml_groups_name"), ["name"], unique=True)
 
     op.create_table(
@@ -41,9 +46,9 @@ def upgrade():  # noqa
         sa.Column("id", sa.Integer(), nullable=False),
         sa.Column("identifier", sa.String(), nullable=False),
         sa.PrimaryKeyConstraint("id"),
-        schema="plugin_saml_groups",
+        schema=schema,
     )
-    with op.batch_alter_table("saml_users", schema="plugin_saml_groups") as batch_op:
+    with op.batch_alter_table("saml_users", schema=schema) as batch_op:
         batch_op.create_index(batch_op.f("ix_saml_users_identifier"), ["identifier"], unique=True)
 
     op.create_table(
@@ -52,16 +57,16 @@ def upgrade():  # noqa
         sa.Column("user_id", sa.Integer(), nullable=False),
         sa.ForeignKeyConstraint(
             ["group_id"],
-            ["plugin_saml_groups.saml_groups.id"],
+            [f"{schema}.saml_groups.id"],
         ),
         sa.ForeignKeyConstraint(
             ["user_id"],
-            ["plugin_saml_groups.saml_users.id"],
+            [f"{schema}.saml_users.id"],
         ),
         sa.PrimaryKeyConstraint("group_id", "user_id"),
-        schema="plugin_saml_groups",
+        schema=schema,
     )
-    with op.batch_alter_table("saml_group_members", schema="plugin_saml_groups") as batch_op:
+    with op.batch_alter_table("saml_group_members", schema=schema) as batch_op:
         batch_op.create_index(
             batch_op.f("ix_saml_group_members_group_id"), ["group_id"], unique=False
         )
@@ -72,19 +77,20 @@ def upgrade():  # noqa
 
 
 def downgrade():  # noqa
+    schema = get_schema()
     # ### commands auto generated by Alembic - please adjust! ###
-    with op.batch_alter_table("saml_group_members", schema="plugin_saml_groups") as batch_op:
+    with op.batch_alter_table("saml_group_members", schema=schema) as batch_op:
         batch_op.drop_index(batch_op.f("ix_saml_group_members_user_id"))
         batch_op.drop_index(batch_op.f("ix_saml_group_members_group_id"))
 
-    op.drop_table("saml_group_members", schema="plugin_saml_groups")
-    with op.batch_alter_table("saml_users", schema="plugin_saml_groups") as batch_op:
+    op.drop_table("saml_group_members", schema=schema)
+    with op.batch_alter_table("saml_users", schema=schema) as batch_op:
         batch_op.drop_index(batch_op.f("ix_saml_users_identifier"))
 
-    op.drop_table("saml_users", schema="plugin_saml_groups")
-    with op.batch_alter_table("saml_groups", schema="plugin_saml_groups") as batch_op:
+    op.drop_table("saml_users", schema=schema)
+    with op.batch_alter_table("saml_groups", schema=schema) as batch_op:
         batch_op.drop_index(batch_op.f("ix_saml_groups_name"))
 
-    op.drop_table("saml_groups", schema="plugin_saml_groups")
+    op.drop_table("saml_groups", schema=schema)
     # ### end Alembic commands ###
-    op.execute(DropSchema("plugin_saml_groups"))
+    op.execute(DropSchema(schema))
@@ -0,0 +1,131 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+# noqa  disable qa, because file is autogenerated
+# flake8: noqa
+# type: ignore
+
+"""partition group members by user
+
+Optional: converts plugin_saml_groups.saml_group_members into a table hash-partitioned on
+user_id if the SAML_GROUPS_MEMBER_PARTITIONS environment variable is set to the number of
+partitions. The primary key, foreign keys and indexes are kept. Without the variable or on
+databases other than PostgreSQL the migration does nothing.
+
+Revision ID: 4106b2115da2
+Revises: ae387f5fc14a
+Create Date: 2026-10-19 10:00:00.000000
+"""
+
+import os
+
+import sqlalchemy as sa
+from alembic import op
+
+from flask_multipass_saml_groups.migration_env import get_schema
+
+# revision identifiers, used by Alembic.
+revision = "4106b2115da2"
+down_revision = "ae387f5fc14a"
+branch_labels = None
+depends_on = None
+
+TABLE = "saml_group_members"
+PARTITIONS_ENV = "SAML_GROUPS_MEMBER_PARTITIONS"
+
+
+def _get_partition_count():
+    """Return the number of partitions requested by the environment, None if not requested."""
+    value = os.environ.get(PARTITIONS_ENV)
+    if not value:
+        return None
+    if not value.isdigit() or int(value) < 2:
+        raise ValueError(f"{PARTITIONS_ENV} {value} must be an integer greater than 1")
+    return int(value)
+
+
+def _is_partitioned(schema):
+    """Check if the members table in the schema is partitioned."""
+    return (
+        op.get_bind()
+        .execute(
+            sa.text("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:table)"),
+            {"table": f"{schema}.{TABLE}"},
+        )
+        .first()
+        is not None
+    )
+
+
+def _rebuild(schema, partitions):
+    """Recreate the members table in the schema with its constraints and indexes and copy the rows.
+
+    The table is hash-partitioned on user_id into the given number of partitions, or not
+    partitioned if partitions is None.
+    """
+    inspector = sa.inspect(op.get_bind())
+    pk = inspector.get_pk_constraint(TABLE, schema=schema)
+    fks = inspector.get_foreign_keys(TABLE, schema=schema)
+    indexes = inspector.get_indexes(TABLE, schema=schema)
+
+    old_table = f"{TABLE}_old"
+    op.rename_table(TABLE, old_table, schema=schema)
+    op.execute(
+        f'ALTER TABLE {schema}.{old_table} RENAME CONSTRAINT "{pk["name"]}" TO "{pk["name"]}_old"'
+    )
+    for index in indexes:
+        op.execute(f'ALTER INDEX {schema}."{index["name"]}" RENAME TO "{index["name"]}_old"')
+
+    op.create_table(
+        TABLE,
+        sa.Column("group_id", sa.Integer(), nullable=False),
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint(*pk["constrained_columns"], name=op.f(pk["name"])),
+        *(
+            sa.ForeignKeyConstraint(
+                fk["constrained_columns"],
+                [
+                    f"{fk['referred_schema']}.{fk['referred_table']}.{c}"
+                    for c in fk["referred_columns"]
+                ],
+                name=op.f(fk["name"]),
+            )
+            for fk in fks
+        ),
+        schema=schema,
+        postgresql_partition_by="HASH (user_id)" if partitions else None,
+    )
+    for remainder in range(partitions or 0):
+        op.execute(
+            f"CREATE TABLE {schema}.{TABLE}_p{remainder} PARTITION OF {schema}.{TABLE} "
+            f"FOR VALUES WITH (MODULUS {partitions}, REMAINDER {remainder})"
+        )
+    for index in indexes:
+        op.create_index(
+            op.f(index["name"]),
+            TABLE,
+            index["column_names"],
+            unique=index["unique"],
+            schema=schema,
+        )
+
+    op.execute(
+        f"INSERT INTO {schema}.{TABLE} (group_id, user_id) "
+        f"SELECT group_id, user_id FROM {schema}.{old_table}"
+    )
+    op.drop_table(old_table, schema=schema)
+
+
+def upgrade():  # noqa
+    schema = get_schema()
+    partitions = _get_partition_count()
+    if partitions is None or op.get_bind().dialect.name != "postgresql" or _is_partitioned(schema):
+        return
+    _rebuild(schema, partitions)
+
+
+def downgrade():  # noqa
+    schema = get_schema()
+    if op.get_bind().dialect.name != "postgresql" or not _is_partitioned(schema):
+        return
+    _rebuild(schema, None)
@@ -0,0 +1,74 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+# noqa  disable qa, because file is autogenerated
+# flake8: noqa
+# type: ignore
+
+"""replace group members indexes
+
+The index on group_id duplicates the leading column of the primary key (group_id, user_id).
+The index on user_id is replaced by an index on (user_id, group_id), which covers the lookups
+of the groups of a user. It is built concurrently on PostgreSQL, so that the logins are not
+blocked meanwhile, unless the table is partitioned.
+
+Revision ID: 90acf830045a
+Revises: 4106b2115da2
+Create Date: 2026-10-19 11:00:00.000000
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+from flask_multipass_saml_groups.migration_env import get_schema
+
+# revision identifiers, used by Alembic.
+revision = "90acf830045a"
+down_revision = "4106b2115da2"
+branch_labels = None
+depends_on = None
+
+
+def _is_partitioned(schema):
+    """Check if the members table in the schema is partitioned, see 4106b2115da2."""
+    if op.get_bind().dialect.name != "postgresql":
+        return False
+    return (
+        op.get_bind()
+        .execute(
+            sa.text("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:table)"),
+            {"table": f"{schema}.saml_group_members"},
+        )
+        .first()
+        is not None
+    )
+
+
+def upgrade():  # noqa
+    schema = get_schema()
+    # PostgreSQL cannot build the index of a partitioned table concurrently
+    concurrently = not _is_partitioned(schema)
+    with op.get_context().autocommit_block():
+        op.create_index(
+            op.f("ix_saml_group_members_user_id_group_id"),
+            "saml_group_members",
+            ["user_id", "group_id"],
+            unique=False,
+            schema=schema,
+            postgresql_concurrently=concurrently,
+        )
+    with op.batch_alter_table("saml_group_members", schema=schema) as batch_op:
+        batch_op.drop_index(batch_op.f("ix_saml_group_members_user_id"))
+        batch_op.drop_index(batch_op.f("ix_saml_group_members_group_id"))
+
+
+def downgrade():  # noqa
+    schema = get_schema()
+    with op.batch_alter_table("saml_group_members", schema=schema) as batch_op:
+        batch_op.create_index(
+            batch_op.f("ix_saml_group_members_group_id"), ["group_id"], unique=False
+        )
+        batch_op.create_index(
+            batch_op.f("ix_saml_group_members_user_id"), ["user_id"], unique=False
+        )
+        batch_op.drop_index(batch_op.f("ix_saml_group_members_user_id_group_id"))
@@ -0,0 +1,118 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+# noqa  disable qa, because file is autogenerated
+# flake8: noqa
+# type: ignore
+
+"""add identifier key
+
+Adds a fixed-width digest of the user identifier with a unique index, which replaces the
+unique index on the full identifier for lookups. The keys of existing users are backfilled
+online in batches, each committed on its own, and the index is built concurrently on
+PostgreSQL. Only the final pass over the users inserted meanwhile locks the table.
+
+Revision ID: 8b78ee7a1e9a
+Revises: 90acf830045a
+Create Date: 2026-10-19 12:00:00.000000
+"""
+
+from hashlib import blake2b
+
+import sqlalchemy as sa
+from alembic import op
+
+from flask_multipass_saml_groups.migration_env import get_schema
+
+# revision identifiers, used by Alembic.
+revision = "8b78ee7a1e9a"
+down_revision = "90acf830045a"
+branch_labels = None
+depends_on = None
+
+KEY_SIZE = 16
+BATCH_SIZE = 10000
+
+
+def _get_users(schema):
+    """Return the users table in the schema."""
+    return sa.table(
+        "saml_users",
+        sa.column("id", sa.Integer),
+        sa.column("identifier", sa.String),
+        sa.column("identifier_key", sa.LargeBinary),
+        schema=schema,
+    )
+
+
+def _backfill(users, condition):
+    """Compute the missing keys of the users matching the condition in batches ordered by id."""
+    bind = op.get_bind()
+    last_id = 0
+    while True:
+        rows = bind.execute(
+            sa.select(users.c.id, users.c.identifier)
+            .where(condition, users.c.id > last_id)
+            .order_by(users.c.id)
+            .limit(BATCH_SIZE)
+        ).all()
+        if not rows:
+            return
+        bind.execute(
+            users.update()
+            .where(users.c.id == sa.bindparam("b_id"))
+            .values(identifier_key=sa.bindparam("b_key")),
+            [
+                {"b_id": id_, "b_key": blake2b(identifier.encode(), digest_size=KEY_SIZE).digest()}
+                for id_, identifier in rows
+            ],
+        )
+        last_id = rows[-1].id
+
+
+def _get_identifier_indexes(schema):
+    """Return the names of the unique indexes on the full identifier."""
+    inspector = sa.inspect(op.get_bind())
+    return [
+        index["name"]
+        for index in inspector.get_indexes("saml_users", schema=schema)
+        if index["column_names"] == ["identifier"]
+    ]
+
+
+def upgrade():  # noqa
+    schema = get_schema()
+    users = _get_users(schema)
+    op.add_column(
+        "saml_users",
+        sa.Column("identifier_key", sa.LargeBinary(KEY_SIZE), nullable=True),
+        schema=schema,
+    )
+    with op.get_context().autocommit_block():
+        _backfill(users, sa.true())
+        op.create_index(
+            op.f("ix_uq_saml_users_identifier_key"),
+            "saml_users",
+            ["identifier_key"],
+            unique=True,
+            schema=schema,
+            postgresql_concurrently=True,
+        )
+
+    if op.get_bind().dialect.name == "postgresql":
+        op.execute(f"LOCK TABLE {schema}.saml_users IN SHARE ROW EXCLUSIVE MODE")
+    _backfill(users, users.c.identifier_key.is_(None))
+    with op.batch_alter_table("saml_users", schema=schema) as batch_op:
+        batch_op.alter_column(
+            "identifier_key", existing_type=sa.LargeBinary(KEY_SIZE), nullable=False
+        )
+        for name in _get_identifier_indexes(schema):
+            batch_op.drop_index(name)
+
+
+def downgrade():  # noqa
+    schema = get_schema()
+    with op.batch_alter_table("saml_users", schema=schema) as batch_op:
+        batch_op.create_index(batch_op.f("ix_saml_users_identifier"), ["identifier"], unique=True)
+        batch_op.drop_index(batch_op.f("ix_uq_saml_users_identifier_key"))
+        batch_op.drop_column("identifier_key")
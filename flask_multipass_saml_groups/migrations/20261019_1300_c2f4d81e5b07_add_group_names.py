@@ -0,0 +1,61 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+# noqa  disable qa, because file is autogenerated
+# flake8: noqa
+# type: ignore
+
+"""add group names
+
+Adds the names of the groups of each user, denormalized from the memberships, with a GIN index
+on PostgreSQL, which is built concurrently. The names of existing users are left empty, such
+users are read from the memberships until the names are computed by a login or by the
+repair-group-names command.
+
+Revision ID: c2f4d81e5b07
+Revises: 8b78ee7a1e9a
+Create Date: 2026-10-19 13:00:00.000000
+"""
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+from flask_multipass_saml_groups.migration_env import get_schema
+
+# revision identifiers, used by Alembic.
+revision = "c2f4d81e5b07"
+down_revision = "8b78ee7a1e9a"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():  # noqa
+    schema = get_schema()
+    op.add_column(
+        "saml_users",
+        sa.Column(
+            "group_names",
+            postgresql.ARRAY(sa.String()).with_variant(sa.JSON(), "sqlite"),
+            nullable=True,
+        ),
+        schema=schema,
+    )
+    if op.get_bind().dialect.name != "postgresql":
+        return
+    with op.get_context().autocommit_block():
+        op.create_index(
+            op.f("ix_saml_users_group_names"),
+            "saml_users",
+            ["group_names"],
+            schema=schema,
+            postgresql_using="gin",
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade():  # noqa
+    schema = get_schema()
+    if op.get_bind().dialect.name == "postgresql":
+        op.drop_index(op.f("ix_saml_users_group_names"), table_name="saml_users", schema=schema)
+    op.drop_column("saml_users", "group_names", schema=schema)
@@ -0,0 +1,51 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+# noqa  disable qa, because file is autogenerated
+# flake8: noqa
+# type: ignore
+
+"""add last seen at
+
+Adds when users and groups were last seen, which is set to the time of the upgrade for the
+existing rows. The value is given as constant default, so PostgreSQL adds the columns without
+rewriting the tables.
+
+Revision ID: 5d1c9a7e3f20
+Revises: c2f4d81e5b07
+Create Date: 2026-10-19 14:00:00.000000
+"""
+
+import sqlalchemy as sa
+from alembic import op
+from indico.core.db.sqlalchemy import UTCDateTime
+from indico.util.date_time import now_utc
+
+from flask_multipass_saml_groups.migration_env import get_schema
+
+# revision identifiers, used by Alembic.
+revision = "5d1c9a7e3f20"
+down_revision = "c2f4d81e5b07"
+branch_labels = None
+depends_on = None
+
+TABLES = ["saml_users", "saml_groups"]
+
+
+def upgrade():  # noqa
+    schema = get_schema()
+    now = now_utc().replace(tzinfo=None).isoformat(sep=" ")
+    for table in TABLES:
+        with op.batch_alter_table(table, schema=schema) as batch_op:
+            batch_op.add_column(
+                sa.Column("last_seen_at", UTCDateTime(), nullable=False, server_default=now)
+            )
+        with op.batch_alter_table(table, schema=schema) as batch_op:
+            batch_op.alter_column("last_seen_at", existing_type=UTCDateTime(), server_default=None)
+
+
+def downgrade():  # noqa
+    schema = get_schema()
+    for table in TABLES:
+        with op.batch_alter_table(table, schema=schema) as batch_op:
+            batch_op.drop_column("last_seen_at")
@@ -0,0 +1,46 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+# noqa  disable qa, because file is autogenerated
+# flake8: noqa
+# type: ignore
+
+"""add membership changes
+
+Adds the append-only log of the membership changes, which starts empty.
+
+Revision ID: e7b3a1c94d68
+Revises: 5d1c9a7e3f20
+Create Date: 2026-10-19 15:00:00.000000
+"""
+
+import sqlalchemy as sa
+from alembic import op
+from indico.core.db.sqlalchemy import UTCDateTime
+
+from flask_multipass_saml_groups.migration_env import get_schema
+
+# revision identifiers, used by Alembic.
+revision = "e7b3a1c94d68"
+down_revision = "5d1c9a7e3f20"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():  # noqa
+    schema = get_schema()
+    op.create_table(
+        "saml_membership_changes",
+        sa.Column("id", sa.BigInteger().with_variant(sa.Integer(), "sqlite"), nullable=False),
+        sa.Column("action", sa.String(), nullable=False),
+        sa.Column("group_name", sa.String(), nullable=False),
+        sa.Column("identifier", sa.String(), nullable=False),
+        sa.Column("changed_at", UTCDateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+        schema=schema,
+    )
+
+
+def downgrade():  # noqa
+    schema = get_schema()
+    op.drop_table("saml_membership_changes", schema=schema)
@@ -0,0 +1,60 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+# noqa  disable qa, because file is autogenerated
+# flake8: noqa
+# type: ignore
+
+"""add group ancestors
+
+Adds the closure of the hierarchy of the groups, which starts empty. It is filled when the
+group_hierarchy_separator setting is enabled, by the syncs and by the rebuild-group-hierarchy
+command.
+
+Revision ID: 3f6d2c8a9b41
+Revises: e7b3a1c94d68
+Create Date: 2026-10-19 16:00:00.000000
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+from flask_multipass_saml_groups.migration_env import get_schema
+
+# revision identifiers, used by Alembic.
+revision = "3f6d2c8a9b41"
+down_revision = "e7b3a1c94d68"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():  # noqa
+    schema = get_schema()
+    op.create_table(
+        "saml_group_ancestors",
+        sa.Column("ancestor_id", sa.Integer(), nullable=False),
+        sa.Column("group_id", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["ancestor_id"],
+            [f"{schema}.saml_groups.id"],
+        ),
+        sa.ForeignKeyConstraint(
+            ["group_id"],
+            [f"{schema}.saml_groups.id"],
+        ),
+        sa.PrimaryKeyConstraint("ancestor_id", "group_id"),
+        schema=schema,
+    )
+    with op.batch_alter_table("saml_group_ancestors", schema=schema) as batch_op:
+        batch_op.create_index(
+            batch_op.f("ix_saml_group_ancestors_group_id_ancestor_id"),
+            ["group_id", "ancestor_id"],
+            unique=False,
+        )
+
+
+def downgrade():  # noqa
+    schema = get_schema()
+    with op.batch_alter_table("saml_group_ancestors", schema=schema) as batch_op:
+        batch_op.drop_index(batch_op.f("ix_saml_group_ancestors_group_id_ancestor_id"))
+    op.drop_table("saml_group_ancestors", schema=schema)
@@ -0,0 +1,62 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+# noqa  disable qa, because file is autogenerated
+# flake8: noqa
+# type: ignore
+
+"""add user attributes
+
+Adds the identity attributes of the users with indexes for the search by prefix. It starts
+empty and is filled as the users log in.
+
+Revision ID: a6c9e2d47b15
+Revises: 3f6d2c8a9b41
+Create Date: 2026-10-19 17:00:00.000000
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+from flask_multipass_saml_groups.migration_env import get_schema
+
+# revision identifiers, used by Alembic.
+revision = "a6c9e2d47b15"
+down_revision = "3f6d2c8a9b41"
+branch_labels = None
+depends_on = None
+
+ATTRIBUTES = ("first_name", "last_name", "email", "affiliation")
+
+
+def upgrade():  # noqa
+    schema = get_schema()
+    op.create_table(
+        "saml_user_attributes",
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("first_name", sa.String(), nullable=True),
+        sa.Column("last_name", sa.String(), nullable=True),
+        sa.Column("email", sa.String(), nullable=True),
+        sa.Column("affiliation", sa.String(), nullable=True),
+        sa.ForeignKeyConstraint(
+            ["user_id"],
+            [f"{schema}.saml_users.id"],
+        ),
+        sa.PrimaryKeyConstraint("user_id"),
+        schema=schema,
+    )
+    with op.batch_alter_table("saml_user_attributes", schema=schema) as batch_op:
+        for attribute in ATTRIBUTES:
+            batch_op.create_index(
+                batch_op.f(f"ix_saml_user_attributes_{attribute}_lower"),
+                [sa.text(f"lower({attribute}) text_pattern_ops")],
+                unique=False,
+            )
+
+
+def downgrade():  # noqa
+    schema = get_schema()
+    with op.batch_alter_table("saml_user_attributes", schema=schema) as batch_op:
+        for attribute in ATTRIBUTES:
+            batch_op.drop_index(batch_op.f(f"ix_saml_user_attributes_{attribute}_lower"))
+    op.drop_table("saml_user_attributes", schema=schema)
@@ -0,0 +1,51 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+# noqa  disable qa, because file is autogenerated
+# flake8: noqa
+# type: ignore
+
+"""add group member counts
+
+Adds the member counts of the groups, which are computed from the existing memberships and then
+maintained by the writes of the memberships.
+
+Revision ID: d41b7f3e9c62
+Revises: a6c9e2d47b15
+Create Date: 2026-10-19 18:00:00.000000
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+from flask_multipass_saml_groups.migration_env import get_schema
+
+# revision identifiers, used by Alembic.
+revision = "d41b7f3e9c62"
+down_revision = "a6c9e2d47b15"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():  # noqa
+    schema = get_schema()
+    op.create_table(
+        "saml_group_member_counts",
+        sa.Column("group_id", sa.Integer(), nullable=False),
+        sa.Column("member_count", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["group_id"],
+            [f"{schema}.saml_groups.id"],
+        ),
+        sa.PrimaryKeyConstraint("group_id"),
+        schema=schema,
+    )
+    op.execute(
+        f"INSERT INTO {schema}.saml_group_member_counts (group_id, member_count) "
+        f"SELECT group_id, count(*) FROM {schema}.saml_group_members GROUP BY group_id"
+    )
+
+
+def downgrade():  # noqa
+    schema = get_schema()
+    op.drop_table("saml_group_member_counts", schema=schema)
@@ -0,0 +1,129 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+# noqa  disable qa, because file is autogenerated
+# flake8: noqa
+# type: ignore
+
+"""add provider
+
+Adds the name of the identity provider to the groups, the users and the membership changes, so
+that several identity providers of the plugin share the tables without their group names and
+identifiers colliding. The unique indexes on the group name and on the identifier key are
+replaced by unique indexes leading with the provider.
+
+The existing rows are assigned to the identity provider named by the SAML_GROUPS_PROVIDER
+environment variable, by default to the only identity provider of type saml_groups in
+IDENTITY_PROVIDERS. The column is added with that name as default, which PostgreSQL records
+without rewriting the tables, and the indexes are built concurrently. The downgrade fails if
+identity providers have groups or users with the same names or identifiers.
+
+Revision ID: b7e2f95c0a31
+Revises: d41b7f3e9c62
+Create Date: 2026-10-19 19:00:00.000000
+"""
+
+import os
+
+import sqlalchemy as sa
+from alembic import op
+from indico.core.config import config
+
+from flask_multipass_saml_groups.migration_env import get_schema
+
+# revision identifiers, used by Alembic.
+revision = "b7e2f95c0a31"
+down_revision = "d41b7f3e9c62"
+branch_labels = None
+depends_on = None
+
+PROVIDER_ENV = "SAML_GROUPS_PROVIDER"
+PROVIDER_TYPE = "saml_groups"
+TABLES = ("saml_groups", "saml_users", "saml_membership_changes")
+INDEXES = (
+    ("ix_uq_saml_groups_provider_name", "saml_groups", ["provider", "name"], True),
+    (
+        "ix_uq_saml_users_provider_identifier_key",
+        "saml_users",
+        ["provider", "identifier_key"],
+        True,
+    ),
+    (
+        "ix_saml_membership_changes_provider_id",
+        "saml_membership_changes",
+        ["provider", "id"],
+        False,
+    ),
+)
+
+
+def _has_rows(schema):
+    """Check if any of the tables getting the provider has rows."""
+    bind = op.get_bind()
+    return any(
+        bind.execute(sa.text(f"SELECT 1 FROM {schema}.{table} LIMIT 1")).first() is not None
+        for table in TABLES
+    )
+
+
+def _get_provider_name(schema):
+    """Return the name of the identity provider the existing rows are assigned to."""
+    name = os.environ.get(PROVIDER_ENV)
+    if name:
+        return name
+    names = [
+        name
+        for name, settings in config.IDENTITY_PROVIDERS.items()
+        if settings.get("type") == PROVIDER_TYPE
+    ]
+    if len(names) == 1:
+        return names[0]
+    if _has_rows(schema):
+        raise ValueError(
+            f"Set {PROVIDER_ENV} to the name of the identity provider of the existing groups, "
+            f"{len(names)} identity providers of type {PROVIDER_TYPE} are configured"
+        )
+    return ""
+
+
+def upgrade():  # noqa
+    schema = get_schema()
+    provider = _get_provider_name(schema)
+    for table in TABLES:
+        op.add_column(
+            table,
+            sa.Column("provider", sa.String(), nullable=False, server_default=provider),
+            schema=schema,
+        )
+        with op.batch_alter_table(table, schema=schema) as batch_op:
+            batch_op.alter_column("provider", existing_type=sa.String(), server_default=None)
+    with op.get_context().autocommit_block():
+        for name, table, columns, unique in INDEXES:
+            op.create_index(
+                op.f(name),
+                table,
+                columns,
+                unique=unique,
+                schema=schema,
+                postgresql_concurrently=True,
+            )
+    op.drop_index(op.f("ix_saml_groups_name"), table_name="saml_groups", schema=schema)
+    op.drop_index(op.f("ix_uq_saml_users_identifier_key"), table_name="saml_users", schema=schema)
+
+
+def downgrade():  # noqa
+    schema = get_schema()
+    op.create_index(
+        op.f("ix_uq_saml_users_identifier_key"),
+        "saml_users",
+        ["identifier_key"],
+        unique=True,
+        schema=schema,
+    )
+    op.create_index(
+        op.f("ix_saml_groups_name"), "saml_groups", ["name"], unique=True, schema=schema
+    )
+    for name, table, _, _ in reversed(INDEXES):
+        op.drop_index(op.f(name), table_name=table, schema=schema)
+    for table in reversed(TABLES):
+        op.drop_column(table, "provider", schema=schema)
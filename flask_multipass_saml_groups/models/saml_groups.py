@@ -3,12 +3,44 @@
 
 """The database models for the SAML Groups plugin."""
 
+from hashlib import blake2b
 from typing import List
 
 from indico.core.db import db
+from indico.core.db.sqlalchemy import UTCDateTime
+from indico.util.date_time import now_utc
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.engine.default import DefaultExecutionContext
 from sqlalchemy.orm import Mapped
 
 SCHEMA = "plugin_saml_groups"
+IDENTIFIER_KEY_SIZE = 16
+
+
+def get_identifier_key(identifier: str) -> bytes:
+    """Compute the compact lookup key of a user identifier.
+
+    Args:
+        identifier: The user's identifier from the identity provider.
+
+    Returns:
+        A fixed-width digest of the identifier.
+    """
+    return blake2b(identifier.encode(), digest_size=IDENTIFIER_KEY_SIZE).digest()
+
+
+def _default_identifier_key(context: DefaultExecutionContext) -> bytes:
+    """Compute the lookup key of an inserted user from its identifier.
+
+    Args:
+        context: The context of the INSERT statement.
+
+    Returns:
+        The lookup key.
+    """
+    return get_identifier_key(context.get_current_parameters()["identifier"])
+
+
 group_members_table = db.Table(
     "saml_group_members",
     db.metadata,
@@ -18,7 +50,6 @@ group_members_table = db.Table(
         db.ForeignKey(f"{SCHEMA}.saml_groups.id"),
         primary_key=True,
         nullable=False,
-        index=True,
     ),
     db.Column(
         "user_id",
@@ -26,8 +57,51 @@ group_members_table = db.Table(
         db.ForeignKey(f"{SCHEMA}.saml_users.id"),
         primary_key=True,
         nullable=False,
-        index=True,
     ),
+    # the primary key covers the lookups by group_id, this index the lookups by user_id
+    db.Index("ix_saml_group_members_user_id_group_id", "user_id", "group_id"),
+    schema=SCHEMA,
+)
+
+
+# the closure of the group hierarchy: a row for every group and each of its ancestors, including
+# the group itself, so that the members of a subtree are found with a join on the primary key
+group_ancestors_table = db.Table(
+    "saml_group_ancestors",
+    db.metadata,
+    db.Column(
+        "ancestor_id",
+        db.Integer,
+        db.ForeignKey(f"{SCHEMA}.saml_groups.id"),
+        primary_key=True,
+        nullable=False,
+    ),
+    db.Column(
+        "group_id",
+        db.Integer,
+        db.ForeignKey(f"{SCHEMA}.saml_groups.id"),
+        primary_key=True,
+        nullable=False,
+    ),
+    # the primary key covers the lookups of descendants, this index those of ancestors
+    db.Index("ix_saml_group_ancestors_group_id_ancestor_id", "group_id", "ancestor_id"),
+    schema=SCHEMA,
+)
+
+
+# the number of direct members of each group which has had members, maintained by the writes of
+# the memberships. The count is not indexed, so that its frequent updates stay HOT on PostgreSQL
+group_member_counts_table = db.Table(
+    "saml_group_member_counts",
+    db.metadata,
+    db.Column(
+        "group_id",
+        db.Integer,
+        db.ForeignKey(f"{SCHEMA}.saml_groups.id"),
+        primary_key=True,
+        nullable=False,
+    ),
+    db.Column("member_count", db.Integer, nullable=False),
     schema=SCHEMA,
 )
 
@@ -35,32 +109,64 @@ group_members_table = db.Table(
 class SAMLGroup(db.Model):  # pylint: disable=too-few-public-methods
     """The model containing the groups.
 
+    Group names are unique per identity provider.
+
     Attrs:
         id: The group's ID
+        provider: The name of the identity provider the group belongs to
         name: The group's name
+        last_seen_at: When the group was last asserted for one of its members, refreshed at
+            most once a day
     """
 
     __tablename__ = "saml_groups"
-    __table_args__ = {"schema": SCHEMA}
+    __table_args__ = (
+        db.Index("ix_uq_saml_groups_provider_name", "provider", "name", unique=True),
+        {"schema": SCHEMA},
+    )
 
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String, nullable=False, unique=True, index=True)
+    provider = db.Column(db.String, nullable=False)
+    name = db.Column(db.String, nullable=False)
+    last_seen_at = db.Column(UTCDateTime, nullable=False, default=now_utc)
 
 
 class SAMLUser(db.Model):  # pylint: disable=too-few-public-methods
     """The model containing the user identifiers.
 
+    Identifiers are unique per identity provider.
+
     Attrs:
         id: The user's ID in the database
+        provider: The name of the identity provider the user belongs to
         identifier: The user's identifier from the identity provider
+        identifier_key: The fixed-width digest of the identifier, used for lookups
+        group_names: The names of the groups the user is a member of, denormalized from the
+            memberships, or None if they have not been computed or are not maintained
+        last_seen_at: When the groups of the user were last synced, refreshed at most once a
+            day
         groups: The groups the user is a member of
     """
 
     __tablename__ = "saml_users"
-    __table_args__ = {"schema": SCHEMA}
+    __table_args__ = (
+        db.Index(
+            "ix_uq_saml_users_provider_identifier_key", "provider", "identifier_key", unique=True
+        ),
+        db.Index("ix_saml_users_group_names", "group_names", postgresql_using="gin"),
+        {"schema": SCHEMA},
+    )
 
     id = db.Column(db.Integer, primary_key=True)
-    identifier = db.Column(db.String, nullable=False, unique=True, index=True)
+    provider = db.Column(db.String, nullable=False)
+    identifier = db.Column(db.String, nullable=False)
+    identifier_key = db.Column(
+        db.LargeBinary(IDENTIFIER_KEY_SIZE),
+        nullable=False,
+        default=_default_identifier_key,
+    )
+    group_names = db.Column(ARRAY(db.String).with_variant(db.JSON, "sqlite"))
+    last_seen_at = db.Column(UTCDateTime, nullable=False, default=now_utc)
     groups: Mapped[List[SAMLGroup]] = db.relationship(
         SAMLGroup,
         secondary=group_members_table,
@@ -68,6 +174,70 @@ class SAMLUser(db.Model):  # pylint: disable=too-few-public-methods
     )
 
 
+class SAMLMembershipChange(db.Model):  # pylint: disable=too-few-public-methods
+    """The append-only log of the added and removed memberships.
+
+    The entries are not linked to the users and groups, so that they outlive them.
+
+    Attrs:
+        id: The sequence number of the change, increasing in the order of the commits
+        provider: The name of the identity provider of the group and the user
+        action: add or remove
+        group_name: The name of the group
+        identifier: The identifier of the user from the identity provider
+        changed_at: When the change was written
+    """
+
+    __tablename__ = "saml_membership_changes"
+    __table_args__ = (
+        db.Index("ix_saml_membership_changes_provider_id", "provider", "id"),
+        {"schema": SCHEMA},
+    )
+
+    id = db.Column(db.BigInteger().with_variant(db.Integer, "sqlite"), primary_key=True)
+    provider = db.Column(db.String, nullable=False)
+    action = db.Column(db.String, nullable=False)
+    group_name = db.Column(db.String, nullable=False)
+    identifier = db.Column(db.String, nullable=False)
+    changed_at = db.Column(UTCDateTime, nullable=False, default=now_utc)
+
+
+class SAMLUserAttributes(db.Model):  # pylint: disable=too-few-public-methods
+    """The identity attributes of the users, as mapped at their last login.
+
+    Attrs:
+        user_id: The ID of the user in the database
+        first_name: The user's first name
+        last_name: The user's last name
+        email: The user's email address
+        affiliation: The user's affiliation
+    """
+
+    __tablename__ = "saml_user_attributes"
+    __table_args__ = {"schema": SCHEMA}
+
+    user_id = db.Column(db.Integer, db.ForeignKey(f"{SCHEMA}.saml_users.id"), primary_key=True)
+    first_name = db.Column(db.String)
+    last_name = db.Column(db.String)
+    email = db.Column(db.String)
+    affiliation = db.Column(db.String)
+
+
+# the attributes are searched by prefix of their lower-cased value, which text_pattern_ops
+# supports independently of the collation on PostgreSQL
+for _column in (
+    SAMLUserAttributes.first_name,
+    SAMLUserAttributes.last_name,
+    SAMLUserAttributes.email,
+    SAMLUserAttributes.affiliation,
+):
+    db.Index(
+        f"ix_saml_user_attributes_{_column.key}_lower",
+        db.func.lower(_column).label(f"{_column.key}_lower"),
+        postgresql_ops={f"{_column.key}_lower": "text_pattern_ops"},
+    )
+
+
 SAMLGroup.members = db.relationship(
     SAMLUser,
     secondary=group_members_table,
@@ -2,11 +2,104 @@
 #  See LICENSE file for licensing details.
 """Marks the package in order to be used by the Indico plugin system."""
 
+import logging
+from threading import Lock
+from typing import Any
+
+from click import Group
+from flask import Flask
+from indico.core import signals
+from indico.core.auth import multipass
+from indico.core.db import db
 from indico.core.plugins import IndicoPlugin
 
+logger = logging.getLogger(__name__)
+
+
+def _warm_up_identity_providers() -> None:
+    """Warm up the identity providers of the plugin if the plugin tables are up to date.
+
+    The warm-up is skipped while the plugin tables have not been upgraded to the latest
+    revision, as its queries could fail on them.
+    """
+    # pylint: disable=import-outside-toplevel
+    from flask_multipass_saml_groups.migration_env import is_up_to_date
+    from flask_multipass_saml_groups.provider import SAMLGroupsIdentityProvider
+
+    providers = [
+        provider
+        for provider in multipass.identity_providers.values()
+        if isinstance(provider, SAMLGroupsIdentityProvider) and provider.warm_up_budget
+    ]
+    if not providers:
+        return
+    try:
+        with db.engine.connect() as connection:
+            up_to_date = is_up_to_date(connection)
+    except Exception:  # pylint: disable=broad-exception-caught
+        logger.exception("Failed to read the revision of the plugin tables")
+        return
+    if not up_to_date:
+        logger.warning(
+            "Skipped the warm-up, the plugin tables are not upgraded to the latest revision"
+        )
+        return
+    for provider in providers:
+        provider.warm_up()
+
 
 class SAMLGroupsPlugin(IndicoPlugin):
     """SAML Groups Plugin.
 
     The plugin provides an identity provider for SAML which supports groups.
     """
+
+    def init(self) -> None:
+        """Connect the plugin to the signals of Indico."""
+        super().init()
+        self.connect(signals.plugin.cli, self._extend_indico_cli)
+        self.connect(signals.core.app_created, self._register_warm_up)
+
+    # pylint: disable-next=unused-argument
+    def _register_warm_up(self, sender: Flask, **kwargs: Any) -> None:
+        """Warm up the identity providers of the plugin before the first request of the process.
+
+        The identity providers are created before Indico configures the database, so they are
+        warmed up once the application has been created. Only the web workers serve requests,
+        so the commands, e.g. indico db upgrade, and the Celery workers do not warm up, and a
+        web worker forked after the application has been created opens its own connections.
+
+        Args:
+            sender: The created application.
+            kwargs: The keyword arguments of the signal.
+        """
+        lock = Lock()
+        pending = True
+
+        def warm_up_once() -> None:
+            """Warm up the identity providers on the first request."""
+            nonlocal pending
+            if not pending:
+                return
+            with lock:
+                if pending:
+                    pending = False
+                    _warm_up_identity_providers()
+
+        sender.before_request(warm_up_once)
+
+    # pylint: disable-next=unused-argument
+    def _extend_indico_cli(self, sender: Any, **kwargs: Any) -> Group:
+        """Provide the command line commands of the plugin.
+
+        Args:
+            sender: The sender of the signal.
+            kwargs: The keyword arguments of the signal.
+
+        Returns:
+            The group of the plugin's commands.
+        """
+        # pylint: disable-next=import-outside-toplevel
+        from flask_multipass_saml_groups.cli import cli
+
+        return cli
@@ -2,9 +2,11 @@
 #  See LICENSE file for licensing details.
 #
 """SAML Groups Identity Provider."""
+import logging
 import operator
-from datetime import datetime, timedelta, timezone
-from typing import Dict, Iterable, Optional, Type
+import time
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple, Type
 
 from flask import current_app, redirect, request, session, url_for
 from flask_multipass import (
@@ -17,30 +19,58 @@ from flask_multipass import (
 )
 from werkzeug import Response
 
-from flask_multipass_saml_groups.group_provider.base import GroupProvider
-from flask_multipass_saml_groups.group_provider.sql import SQLGroupProvider
+from flask_multipass_saml_groups.group_filter import GroupFilter
+from flask_multipass_saml_groups.group_provider.base import GroupProvider, make_identity_info
+
+# the session expiry settings remain importable from the provider
+# pylint: disable-next=unused-import
+from flask_multipass_saml_groups.session_expiry import (  # noqa: F401
+    DEFAULT_SESSION_EXPIRY,
+    SESSION_EXPIRY_SETTING,
+    SessionExpiry,
+)
+from flask_multipass_saml_groups.sync import DeferredGroupSync
 
 DEFAULT_IDENTIFIER_FIELD = "_saml_nameid_qualified"
 SAML_GRP_ATTR_NAME = "urn:oasis:names:tc:SAML:2.0:profiles:attribute:DCE:groups"
-SESSION_EXPIRY_SETTING = "session_expiry"
-DEFAULT_SESSION_EXPIRY = 24 * 60 * 60  # 24 hours
 EXPIRY_SESSION_KEY = "_flask_multipass_saml_groups_session_expiry"
+SOFT_EXPIRY_SESSION_KEY = "_flask_multipass_saml_groups_session_soft_expiry"
+GROUP_SYNC_SETTING = "group_sync"
+GROUP_SYNC_IMMEDIATE = "immediate"
+GROUP_SYNC_DEFERRED = "deferred"
+GROUP_SYNC_WORKERS_SETTING = "group_sync_workers"
+DEFAULT_GROUP_SYNC_WORKERS = 4
+WARM_UP_BUDGET_SETTING = "warm_up_budget"
+SEARCH_ENABLED_SETTING = "search_enabled"
 
+logger = logging.getLogger(__name__)
 
-class SAMLGroupsIdentityProvider(IdentityProvider):
+
+class SAMLGroupsIdentityProvider(IdentityProvider):  # pylint: disable=too-many-instance-attributes
     """Provides identity information using SAML and supports groups.
 
     Attrs:
         supports_get (bool): If the provider supports getting identity information
-            based from an identifier
+            based from an identifier, from the attributes stored by the group provider
+        supports_search (bool): If the provider supports searching identities, by the attributes
+            stored by the group provider. Only enabled with the search_enabled setting
+        supports_search_ex (bool): If the provider supports searching identities with a limit
         supports_groups (bool): If the provider also provides groups and membership information
         supports_get_identity_groups (bool): If the provider supports getting the list of groups an
          identity belongs to
         group_class (class): The class to use for groups. Defaults to flask_multipass.Group but
             concrete class will be used from group_provider_class
+        session_expiry (SessionExpiry): When the web sessions created at login expire
+        warm_up_seconds (float): How long the last warm-up took, None if it has not run
+
+    With the deferred group_sync setting, the groups asserted at a login which have not been
+    applied yet are only known to the process which handled the login. Until they are applied,
+    the other processes answer the membership checks of the user from the database.
     """
 
-    supports_get = False
+    supports_get = True
+    supports_search = True
+    supports_search_ex = True
     supports_groups = True
     supports_get_identity_groups = True
 
@@ -51,7 +81,7 @@ class SAMLGroupsIdentityProvider(IdentityProvider):
         multipass: Multipass,
         name: str,
         settings: Dict,
-        group_provider_class: Type[GroupProvider] = SQLGroupProvider,
+        group_provider_class: Optional[Type[GroupProvider]] = None,
     ):
         """Initialize the identity provider.
 
@@ -60,24 +90,89 @@ class SAMLGroupsIdentityProvider(IdentityProvider):
             name: The name of this identity provider instance
             settings: The settings dictionary for this identity
                     provider instance
-            group_provider_class: The class to use for the group provider.
+            group_provider_class: The class to use for the group provider. Defaults to
+                SQLGroupProvider, which is imported here rather than at module load, so that
+                enumerating the identity providers does not import indico and the database models.
 
         Raise:
-            ValueError: If the session_expiry setting is not a positive integer.
+            ValueError: If the session_expiry setting is not a positive integer or the
+                session_expiry_jitter or session_soft_expiry settings are not non-negative
+                integers smaller than session_expiry or the group_sync, group_sync_workers,
+                warm_up_budget or group filter settings are invalid.
         """
+        # Searching is opt-in, so that existing deployments do not start listing the users of
+        # this provider in the user searches of Indico after an upgrade.
+        settings = {SEARCH_ENABLED_SETTING: False, **settings}
         super().__init__(multipass=multipass, name=name, settings=settings)
         self.id_field = self.settings.setdefault("identifier_field", DEFAULT_IDENTIFIER_FIELD)
+        if group_provider_class is None:
+            # pylint: disable-next=import-outside-toplevel
+            from flask_multipass_saml_groups.group_provider.sql import SQLGroupProvider
+
+            group_provider_class = SQLGroupProvider
         self._group_provider = group_provider_class(identity_provider=self)
         self.group_class = self._group_provider.group_class
+        if not self._group_provider.supports_identity_attributes:
+            self.supports_get = self.supports_search = self.supports_search_ex = False
 
-        self.session_expiry: int = self.settings.get(
-            SESSION_EXPIRY_SETTING, DEFAULT_SESSION_EXPIRY
-        )
-        if not isinstance(self.session_expiry, int) or self.session_expiry <= 0:
+        self.session_expiry = SessionExpiry(self.settings)
+        current_app.before_request(self._invalidate_session)
+        self._deferred_sync = self._get_deferred_sync()
+        self.group_filter = GroupFilter(self.settings)
+        self.warm_up_budget = self.settings.get(WARM_UP_BUDGET_SETTING, 0)
+        if not isinstance(self.warm_up_budget, (int, float)) or self.warm_up_budget < 0:
             raise ValueError(
-                f"{SESSION_EXPIRY_SETTING} {self.session_expiry} must be a positive integer"
+                f"{WARM_UP_BUDGET_SETTING} {self.warm_up_budget} must be a non-negative number"
             )
-        current_app.before_request(self._invalidate_session)
+        self.warm_up_seconds: Optional[float] = None
+
+    def _get_deferred_sync(self) -> Optional[DeferredGroupSync]:
+        """Create the deferred group sync if it is enabled by the group_sync setting.
+
+        Raise:
+            ValueError: If the group_sync or group_sync_workers settings are invalid.
+
+        Returns:
+            The deferred group sync or None if groups are synced immediately.
+        """
+        group_sync = self.settings.get(GROUP_SYNC_SETTING, GROUP_SYNC_IMMEDIATE)
+        if group_sync not in (GROUP_SYNC_IMMEDIATE, GROUP_SYNC_DEFERRED):
+            raise ValueError(
+                f"{GROUP_SYNC_SETTING} {group_sync} must be one of "
+                f"{GROUP_SYNC_IMMEDIATE}, {GROUP_SYNC_DEFERRED}"
+            )
+        if group_sync == GROUP_SYNC_IMMEDIATE:
+            return None
+        workers = self.settings.get(GROUP_SYNC_WORKERS_SETTING, DEFAULT_GROUP_SYNC_WORKERS)
+        if not isinstance(workers, int) or workers <= 0:
+            raise ValueError(f"{GROUP_SYNC_WORKERS_SETTING} {workers} must be a positive integer")
+        return DeferredGroupSync(self._group_provider, max_workers=workers)
+
+    def warm_up(self) -> Optional[float]:
+        """Open the database connections and preload the groups within the warm_up_budget setting.
+
+        The warm-up runs on the first request of each web worker, see the plugin. It only saves
+        work for the requests, so errors are logged and ignored.
+
+        Returns:
+            The number of seconds the warm-up took, None if it is disabled.
+        """
+        if not self.warm_up_budget:
+            return None
+        start = time.monotonic()
+        try:
+            groups = self._group_provider.warm_up(start + self.warm_up_budget)
+        except Exception:  # pylint: disable=broad-exception-caught
+            logger.exception("Failed to warm up the identity provider %s", self.name)
+            groups = 0
+        self.warm_up_seconds = time.monotonic() - start
+        logger.info(
+            "Warmed up the identity provider %s in %.3fs, preloaded %d groups",
+            self.name,
+            self.warm_up_seconds,
+            groups,
+        )
+        return self.warm_up_seconds
 
     def get_identity_from_auth(self, auth_info: AuthInfo) -> IdentityInfo:
         """Retrieve identity information after authentication.
@@ -111,34 +206,92 @@ class SAMLGroupsIdentityProvider(IdentityProvider):
                 # If only one group is returned, it is returned as a string by saml auth provider
                 grp_names = [grp_names]
 
-            if self.session_expiry:
-                self._set_flask_session_expiry(self.session_expiry)
+            self._set_flask_session_expiry()
 
         else:
             grp_names = []
+        grp_names = self.group_filter.apply(grp_names)
 
-        user_groups = self._group_provider.get_user_groups(identifier=identifier)
-        for group in user_groups:
-            if group.name not in grp_names:
-                self._group_provider.remove_group_member(
-                    group_name=group.name, identifier=identifier
-                )
-
-        for grp_name in grp_names:
-            self._group_provider.add_group_member(group_name=grp_name, identifier=identifier)
+        attributes = identity_info.data if self.supports_get else None
+        if self._deferred_sync:
+            self._deferred_sync.submit(identifier, grp_names, attributes)
+        else:
+            self._group_provider.sync_user_groups(identifier, grp_names, attributes)
 
         return identity_info
 
+    def get_identity(self, identifier: str) -> Optional[IdentityInfo]:
+        """Retrieve identity information from the attributes stored at the last login.
+
+        Args:
+            identifier: The unique user identifier used by the provider.
+
+        Returns:
+            The identity information or None if the user has never been synced.
+        """
+        attributes = self._group_provider.get_identity_attributes(identifier)
+        if attributes is None:
+            return None
+        return make_identity_info(self, identifier, attributes)
+
+    def search_identities(
+        self, criteria: Dict[str, Set[str]], exact: bool = False
+    ) -> Iterator[IdentityInfo]:
+        """Search identities by the attributes stored at the last login.
+
+        Args:
+            criteria: The attributes, mapped to the keys of the provider, and the values to
+                search for.
+            exact: If True, the attributes must be equal to the values instead of starting with
+                them. The comparison ignores the case.
+
+        Returns:
+            An iterator over the matching identities.
+        """
+        identities, _ = self.search_identities_ex(criteria, exact=exact)
+        return iter(identities)
+
+    def search_identities_ex(
+        self, criteria: Dict[str, Set[str]], exact: bool = False, limit: Optional[int] = None
+    ) -> Tuple[List[IdentityInfo], int]:
+        """Search identities by the attributes stored at the last login, up to a limit.
+
+        Args:
+            criteria: The attributes, mapped to the keys of the provider, and the values to
+                search for.
+            exact: If True, the attributes must be equal to the values instead of starting with
+                them. The comparison ignores the case.
+            limit: The maximum number of identities to return, None for all.
+
+        Returns:
+            The matching identities and their total number.
+        """
+        provider_keys = {v: k for k, v in self.settings["mapping"].items()}
+        found, total = self._group_provider.search_identity_attributes(
+            {provider_keys.get(k, k): v for k, v in criteria.items()}, exact=exact, limit=limit
+        )
+        return [make_identity_info(self, i, a) for i, a in found], total
+
     def get_group(self, name: str) -> Optional[Group]:
         """Return a specific group.
 
+        If the group does not exist yet but is asserted at a login whose groups have not been
+        applied yet, the group is returned too.
+
         Args:
             name: The name of the group.
 
         Returns:
             group: An instance of group_class or None if the group does not exist.
         """
-        return self._group_provider.get_group(name)
+        group = self._group_provider.get_group(name)
+        if (
+            group is None
+            and self._deferred_sync is not None
+            and self._deferred_sync.is_pending_group(name)
+        ):
+            return self._group_provider.make_group(name)
+        return group
 
     def search_groups(self, name: str, exact: bool = False) -> Iterable[Group]:
         """Search groups by name.
@@ -160,6 +313,9 @@ class SAMLGroupsIdentityProvider(IdentityProvider):
     def get_identity_groups(self, identifier: str) -> Iterable[Group]:
         """Retrieve the groups a user identity belongs to.
 
+        If the groups asserted at the last login of the user have not been applied yet, these
+        groups are returned, including the ancestors of hierarchical groups.
+
         Args:
             identifier: The unique user identifier used by the
                            provider.
@@ -167,28 +323,48 @@ class SAMLGroupsIdentityProvider(IdentityProvider):
         Returns:
              iterable: An iterable of groups
         """
+        pending = self.get_pending_group_names(identifier)
+        if pending is not None:
+            return [self._group_provider.make_group(name) for name in pending]
         return self._group_provider.get_user_groups(identifier=identifier)
 
-    def _set_flask_session_expiry(self, expiry: int) -> None:
-        """Set the flask session expiry.
+    def get_pending_group_names(self, identifier: str) -> Optional[List[str]]:
+        """Get the groups asserted at the last login of a user which have not been applied yet.
+
+        The groups of the group provider answer the membership checks of the user from them.
 
         Args:
-            expiry: The expiry time in seconds.
+            identifier: The unique user identifier used by the provider.
+
+        Returns:
+            The sorted names of the groups, including the ancestors of hierarchical groups, or
+            None if the groups are synced immediately or there is no pending sync for the user.
         """
-        session[EXPIRY_SESSION_KEY] = datetime.now(timezone.utc) + timedelta(seconds=expiry)
+        if self._deferred_sync is None:
+            return None
+        return self._deferred_sync.get_pending_group_names(identifier)
+
+    def _set_flask_session_expiry(self) -> None:
+        """Set the flask session expiry."""
+        session[EXPIRY_SESSION_KEY] = self.session_expiry.issue(datetime.now(timezone.utc))
+        draw = self.session_expiry.draw()
+        if draw is None:
+            session.pop(SOFT_EXPIRY_SESSION_KEY, None)
+        else:
+            session[SOFT_EXPIRY_SESSION_KEY] = draw
 
-    @staticmethod
-    def _invalidate_session() -> Optional[Response]:
+    def _invalidate_session(self) -> Optional[Response]:
         """Clear the session if it has expired and redirect to login.
 
         Returns:
             A redirect response if the session has expired, None otherwise.
         """
         expires = session.get(EXPIRY_SESSION_KEY)
-        if expires and expires < datetime.now(timezone.utc):
-            session.clear()
+        if not expires or not self.session_expiry.is_expired(
+            expires, datetime.now(timezone.utc), session.get(SOFT_EXPIRY_SESSION_KEY)
+        ):
+            return None
 
-            return redirect(
-                url_for(current_app.config["MULTIPASS_LOGIN_ENDPOINT"], next=request.url)
-            )
-        return None
+        session.clear()
+
+        return redirect(url_for(current_app.config["MULTIPASS_LOGIN_ENDPOINT"], next=request.url))
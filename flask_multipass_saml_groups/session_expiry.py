@@ -0,0 +1,137 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+"""Expiry of the web sessions created at login."""
+
+from datetime import datetime, timedelta
+from random import randint, random
+from typing import Dict, Optional
+
+from flask_multipass_saml_groups.metrics import CounterSet, Histogram
+
+SESSION_EXPIRY_SETTING = "session_expiry"
+DEFAULT_SESSION_EXPIRY = 24 * 60 * 60  # 24 hours
+SESSION_EXPIRY_JITTER_SETTING = "session_expiry_jitter"
+SESSION_SOFT_EXPIRY_SETTING = "session_soft_expiry"
+SESSION_EXPIRY_BUCKET = 60  # 1 minute
+
+
+class SessionExpiry:
+    """Decide when the web sessions expire.
+
+    Each session expires session_expiry seconds after the login, shortened by a random number of
+    up to session_expiry_jitter seconds. A session may also expire early at an instant within the
+    last session_soft_expiry seconds before the expiry, drawn uniformly once at login. Both spread
+    the re-authentication of sessions created at the same time.
+
+    Attrs:
+        seconds (int): The lifetime of a session before the jitter.
+        jitter (int): The maximum number of seconds a session is shortened by.
+        soft_expiry (int): The window before the expiry in which sessions may expire early.
+        metrics (CounterSet): The number of issued, hard_expired and soft_expired sessions.
+        histogram (Histogram): The lifetimes of the issued sessions in one-minute buckets.
+    """
+
+    def __init__(self, settings: Dict):
+        """Read the session expiry settings.
+
+        Args:
+            settings: The settings of the identity provider.
+
+        Raise:
+            ValueError: If the session_expiry setting is not a positive integer or the
+                session_expiry_jitter or session_soft_expiry settings are not non-negative
+                integers smaller than session_expiry.
+        """
+        self.seconds: int = settings.get(SESSION_EXPIRY_SETTING, DEFAULT_SESSION_EXPIRY)
+        if not isinstance(self.seconds, int) or self.seconds <= 0:
+            raise ValueError(f"{SESSION_EXPIRY_SETTING} {self.seconds} must be a positive integer")
+        self.jitter = self._get_window(settings, SESSION_EXPIRY_JITTER_SETTING)
+        self.soft_expiry = self._get_window(settings, SESSION_SOFT_EXPIRY_SETTING)
+        self.metrics = CounterSet()
+        self.histogram = Histogram(bucket_width=SESSION_EXPIRY_BUCKET)
+
+    def _get_window(self, settings: Dict, setting: str) -> int:
+        """Read a setting describing a window of time before the session expiry.
+
+        Args:
+            settings: The settings of the identity provider.
+            setting: The name of the setting.
+
+        Raise:
+            ValueError: If the setting is not a non-negative integer smaller than session_expiry.
+
+        Returns:
+            The window in seconds, 0 if the setting is not set.
+        """
+        window = settings.get(setting, 0)
+        if not isinstance(window, int) or not 0 <= window < self.seconds:
+            raise ValueError(
+                f"{setting} {window} must be a non-negative integer smaller than "
+                f"{SESSION_EXPIRY_SETTING}"
+            )
+        return window
+
+    def issue(self, now: datetime) -> datetime:
+        """Compute the expiry of a new session and count it.
+
+        Args:
+            now: The time of the login.
+
+        Returns:
+            When the session expires.
+        """
+        seconds = self.seconds
+        if self.jitter:
+            seconds -= randint(0, self.jitter)  # nosec B311 not used for security
+        self.metrics.inc("issued")
+        self.histogram.observe(seconds)
+        return now + timedelta(seconds=seconds)
+
+    def draw(self) -> Optional[float]:
+        """Draw where in the soft expiry window a new session expires.
+
+        Returns:
+            A random value in [0, 1) to store with the session, None if there is no soft expiry
+            window.
+        """
+        if not self.soft_expiry:
+            return None
+        return random()  # nosec B311 not used for security
+
+    def is_expired(self, expires: datetime, now: datetime, draw: Optional[float] = None) -> bool:
+        """Check whether a session has expired, counting the expired sessions.
+
+        Args:
+            expires: The expiry of the session.
+            now: The current time.
+            draw: The value drawn at login for the session, None if none was drawn.
+
+        Returns:
+            True if the session has expired or is expired early, False otherwise.
+        """
+        if expires < now:
+            self.metrics.inc("hard_expired")
+            return True
+        if self._is_soft_expired(expires, now, draw):
+            self.metrics.inc("soft_expired")
+            return True
+        return False
+
+    def _is_soft_expired(self, expires: datetime, now: datetime, draw: Optional[float]) -> bool:
+        """Decide whether a session has reached the early expiry drawn at login.
+
+        The session expires draw * session_soft_expiry seconds before its hard expiry, so the
+        decision does not change between the requests of a session.
+
+        Args:
+            expires: The hard expiry of the session.
+            now: The current time.
+            draw: The value drawn at login for the session, None if none was drawn.
+
+        Returns:
+            True if the session should be expired now, False otherwise.
+        """
+        if not self.soft_expiry or draw is None:
+            return False
+        return expires - timedelta(seconds=draw * self.soft_expiry) <= now
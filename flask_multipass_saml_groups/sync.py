@@ -0,0 +1,167 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+"""Deferred synchronisation of group memberships off the login request path."""
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition
+from typing import Dict, List, Mapping, Optional, Sequence, Set, Tuple
+
+from flask import Flask, current_app
+
+from flask_multipass_saml_groups.group_provider.base import GroupProvider
+
+SYNC_RETRY_DELAYS = (1.0, 4.0, 16.0)
+
+logger = logging.getLogger(__name__)
+
+
+class DeferredGroupSync:
+    """Apply group memberships asynchronously in a bounded pool of threads.
+
+    Only the latest asserted group set and identity attributes of a user are kept. If the same
+    user logs in again while a sync is running, the newer ones are applied by the same worker once
+    the running sync finishes, so the syncs of one user never run concurrently and the last login
+    wins. A failed sync is retried after each of the retry delays, and the groups and attributes
+    stay pending in the meantime. They are only dropped once the last retry failed.
+
+    The pending groups are kept in the memory of the process which handled the login, so the
+    other processes answer the membership checks of the user from the database until the groups
+    are applied.
+    """
+
+    def __init__(
+        self,
+        group_provider: GroupProvider,
+        max_workers: int,
+        retry_delays: Sequence[float] = SYNC_RETRY_DELAYS,
+    ):
+        """Initialize the deferred sync.
+
+        Args:
+            group_provider: The group provider applying the memberships.
+            max_workers: The maximum number of threads applying memberships.
+            retry_delays: The number of seconds to wait before each retry of a failed sync.
+        """
+        self._group_provider = group_provider
+        self._retry_delays = tuple(retry_delays)
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="saml-groups-sync"
+        )
+        self._lock = Condition()
+        self._pending: Dict[str, Tuple[str, ...]] = {}
+        self._attributes: Dict[str, Dict] = {}
+        self._running: Set[str] = set()
+
+    def submit(
+        self, identifier: str, group_names: Sequence[str], attributes: Optional[Mapping] = None
+    ) -> None:
+        """Record the asserted groups of a user and schedule applying them.
+
+        Must be called within a Flask app context, which is reused by the worker.
+
+        Args:
+            identifier: The unique user identifier used by the provider.
+            group_names: The names of all groups the user belongs to.
+            attributes: The identity attributes of the user to store, None to keep them.
+        """
+        # pylint: disable-next=protected-access
+        app = current_app._get_current_object()  # type: ignore[attr-defined]
+        with self._lock:
+            self._pending[identifier] = tuple(group_names)
+            if attributes is not None:
+                self._attributes[identifier] = dict(attributes)
+            if identifier in self._running:
+                return
+            self._running.add(identifier)
+        self._executor.submit(self._run, app, identifier)
+
+    def get_pending(self, identifier: str) -> Optional[Tuple[str, ...]]:
+        """Return the asserted groups of a user which have not been applied yet.
+
+        Args:
+            identifier: The unique user identifier used by the provider.
+
+        Returns:
+            The names of the groups or None if there is no pending sync for the user.
+        """
+        with self._lock:
+            return self._pending.get(identifier)
+
+    def get_pending_group_names(self, identifier: str) -> Optional[List[str]]:
+        """Get the groups asserted at the last login of a user which have not been applied yet.
+
+        Args:
+            identifier: The unique user identifier used by the provider.
+
+        Returns:
+            The sorted names of the groups, expanded by the expand_group_names of the group
+            provider, or None if there is no pending sync for the user.
+        """
+        pending = self.get_pending(identifier)
+        return None if pending is None else self._group_provider.expand_group_names(pending)
+
+    def is_pending_group(self, group_name: str) -> bool:
+        """Check if a group is asserted by a login whose groups have not been applied yet.
+
+        Args:
+            group_name: The name of the group.
+
+        Returns:
+            True if a pending sync makes a user a member of the group, False otherwise.
+        """
+        with self._lock:
+            group_names = set().union(*self._pending.values())
+        return group_name in self._group_provider.expand_group_names(group_names)
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Wait until all pending syncs have been applied.
+
+        Args:
+            timeout: The maximum number of seconds to wait, None to wait forever.
+
+        Returns:
+            True if all syncs have been applied, False if the timeout expired.
+        """
+        with self._lock:
+            return self._lock.wait_for(lambda: not self._running, timeout)
+
+    def _run(self, app: Flask, identifier: str) -> None:
+        """Apply the pending groups and attributes of a user until there are no newer ones.
+
+        A failed sync is retried after each of the retry delays, with the newest pending groups
+        and attributes.
+
+        Args:
+            app: The Flask app whose context is used to access the database.
+            identifier: The unique user identifier used by the provider.
+        """
+        attempt = 0
+        while True:
+            with self._lock:
+                group_names = self._pending[identifier]
+                attributes = self._attributes.pop(identifier, None)
+            try:
+                with app.app_context():
+                    self._group_provider.sync_user_groups(identifier, group_names, attributes)
+            except Exception:  # pylint: disable=broad-exception-caught
+                if attempt < len(self._retry_delays):
+                    logger.warning(
+                        "Failed to sync the groups of %s, retrying", identifier, exc_info=True
+                    )
+                    with self._lock:
+                        if attributes is not None:
+                            self._attributes.setdefault(identifier, attributes)
+                    time.sleep(self._retry_delays[attempt])
+                    attempt += 1
+                    continue
+                logger.exception("Failed to sync the groups of %s", identifier)
+            attempt = 0
+            with self._lock:
+                if self._pending[identifier] == group_names and identifier not in self._attributes:
+                    del self._pending[identifier]
+                    self._running.discard(identifier)
+                    self._lock.notify_all()
+                    return
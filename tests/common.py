@@ -2,32 +2,111 @@
 #  See LICENSE file for licensing details.
 """Add common functions for testing."""
 
+from pathlib import Path
+from typing import Callable, Optional
+
 from flask import Flask
 from indico.core.db import db
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from flask_multipass_saml_groups.models.saml_groups import (
+    SAMLGroup,
+    SAMLMembershipChange,
+    SAMLUser,
+    group_member_counts_table,
+    group_members_table,
+)
+
+PROVIDER = "saml_groups"
 
 
-def setup_sqlite(app: Flask):
+def setup_sqlite(app: Flask, db_dir: Optional[Path] = None):
     """Add sqlite to app config and setup the database.
 
     Args:
         app: The flask app.
+        db_dir: The directory to store the database files in. If not set, an in-memory database
+            is used, which shares a single connection between all threads.
     """
-    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+    app.config["SQLALCHEMY_DATABASE_URI"] = (
+        f"sqlite:///{db_dir}/indico.db" if db_dir else "sqlite://"
+    )
     with app.app_context():
         db.init_app(app)
         # pylint does not recognize the methods of db.session, which is a proxy object
         # pylint: disable=no-member
-        db.session.execute("attach ':memory:' as plugin_saml_groups;")
-        db.session.execute(
-            "CREATE TABLE plugin_saml_groups.saml_users "
-            "(id INTEGER PRIMARY KEY, identifier TEXT UNIQUE);"
-        )
-        db.session.execute(
-            "CREATE TABLE plugin_saml_groups.saml_groups "
-            "(id INTEGER PRIMARY KEY, name TEXT UNIQUE);"
-        )
-        db.session.execute(
-            "CREATE TABLE plugin_saml_groups.saml_group_members "
-            "(group_id INTEGER, user_id INTEGER);"
-        )
+        if db_dir:
+            attach_plugin_db(db.engine, db_dir / "plugin_saml_groups.db")
+        else:
+            db.session.execute("attach ':memory:' as plugin_saml_groups;")
+        create_plugin_tables(db.session.execute)
         db.session.commit()
+
+
+def attach_plugin_db(engine: Engine, plugin_db: Path):
+    """Attach the sqlite file of the plugin schema to each new connection of an engine.
+
+    Args:
+        engine: The engine of the main database.
+        plugin_db: The path of the database file of the plugin schema.
+    """
+
+    @event.listens_for(engine, "connect")
+    def _attach(dbapi_connection, _):  # pylint: disable=unused-variable
+        dbapi_connection.execute(f"attach '{plugin_db}' as plugin_saml_groups")
+
+
+def create_plugin_tables(execute: Callable):
+    """Create the tables of the plugin.
+
+    Args:
+        execute: The function executing a statement.
+    """
+    execute(
+        "CREATE TABLE plugin_saml_groups.saml_users (id INTEGER PRIMARY KEY, "
+        "provider TEXT NOT NULL, identifier TEXT, identifier_key BLOB, group_names JSON, "
+        "last_seen_at DATETIME, UNIQUE (provider, identifier_key));"
+    )
+    execute(
+        "CREATE TABLE plugin_saml_groups.saml_groups (id INTEGER PRIMARY KEY, "
+        "provider TEXT NOT NULL, name TEXT, last_seen_at DATETIME, UNIQUE (provider, name));"
+    )
+    execute(
+        "CREATE TABLE plugin_saml_groups.saml_group_members "
+        "(group_id INTEGER, user_id INTEGER, PRIMARY KEY (group_id, user_id));"
+    )
+    execute(
+        "CREATE TABLE plugin_saml_groups.saml_membership_changes (id INTEGER PRIMARY KEY, "
+        "provider TEXT NOT NULL, action TEXT, group_name TEXT, identifier TEXT, "
+        "changed_at DATETIME);"
+    )
+    execute(
+        "CREATE TABLE plugin_saml_groups.saml_group_ancestors "
+        "(ancestor_id INTEGER, group_id INTEGER, PRIMARY KEY (ancestor_id, group_id));"
+    )
+    execute(
+        "CREATE TABLE plugin_saml_groups.saml_group_member_counts "
+        "(group_id INTEGER PRIMARY KEY, member_count INTEGER NOT NULL);"
+    )
+    execute(
+        "CREATE TABLE plugin_saml_groups.saml_user_attributes (user_id INTEGER PRIMARY KEY, "
+        "first_name TEXT, last_name TEXT, email TEXT, affiliation TEXT);"
+    )
+
+
+def create_shard_tables(engine: Engine):
+    """Create the tables of the plugin used by the sharded group provider in a shard.
+
+    Args:
+        engine: The engine of the shard, which maps the plugin schema to the schema of the shard.
+    """
+    with engine.begin() as connection:
+        for table in (
+            SAMLUser.__table__,
+            SAMLGroup.__table__,
+            group_members_table,
+            group_member_counts_table,
+            SAMLMembershipChange.__table__,
+        ):
+            table.create(connection)
@@ -0,0 +1,227 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+"""Unit tests for the sharded sql group provider."""
+
+import time
+from unittest.mock import patch
+
+import pytest
+from flask import Flask
+from flask_multipass import IdentityProvider, Multipass
+from sqlalchemy import select
+
+from flask_multipass_saml_groups.group_provider.sharded import (
+    ShardedSQLGroup,
+    ShardedSQLGroupProvider,
+    get_shard_index,
+)
+from flask_multipass_saml_groups.models.saml_groups import SAMLUser
+from tests.common import create_shard_tables
+
+SHARD_COUNT = 3
+USERS = [f"user{i}" for i in range(12)]
+
+
+@pytest.fixture(name="app")
+def app_fixture():
+    """Create a flask app."""
+    return Flask("test")
+
+
+@pytest.fixture(name="group_provider")
+def group_provider_fixture(app, tmp_path):
+    """Setup a group provider with three sqlite shards.
+
+    Each user is a member of the group all and of the group of the parity of its number.
+    """
+    shards = [
+        {"uri": f"sqlite:///{tmp_path}/shard{i}.db", "schema": "main"} for i in range(SHARD_COUNT)
+    ]
+    with app.app_context():
+        group_provider = ShardedSQLGroupProvider(
+            identity_provider=IdentityProvider(
+                multipass=Multipass(app=app), name="saml_groups", settings={"shards": shards}
+            ),
+        )
+        for engine in group_provider.engines:
+            create_shard_tables(engine)
+        for i, identifier in enumerate(USERS):
+            group_provider.sync_user_groups(identifier, ["all", "even" if i % 2 == 0 else "odd"])
+
+        yield group_provider
+
+
+def _get_identifiers(engine):
+    """Get the identifiers of the users stored in a shard."""
+    with engine.connect() as connection:
+        return set(connection.execute(select(SAMLUser.__table__.c.identifier)).scalars())
+
+
+def test_users_are_split_across_shards(group_provider):
+    """
+    arrange: given a sharded group provider with users
+    act: read the users stored in each shard
+    assert: each user is stored only in the shard selected by the hash of its identifier
+    """
+    for index, engine in enumerate(group_provider.engines):
+        identifiers = _get_identifiers(engine)
+
+        assert identifiers
+        assert identifiers == {i for i in USERS if get_shard_index(i, SHARD_COUNT) == index}
+
+
+def test_user_operations_touch_one_shard(group_provider):
+    """
+    arrange: given a sharded group provider with users
+    act: sync, add, remove and read the groups of a user
+    assert: only the shard of the user is connected to
+    """
+    identifier = USERS[0]
+    shard = group_provider.engines[get_shard_index(identifier, SHARD_COUNT)]
+    other_shards = [e for e in group_provider.engines if e is not shard]
+
+    with patch.object(other_shards[0], "connect"), patch.object(other_shards[1], "connect"):
+        group_provider.sync_user_groups(identifier, ["all", "new"])
+        group_provider.add_group_member(identifier, "added")
+        group_provider.remove_group_member(identifier, "all")
+        groups = list(group_provider.get_user_groups(identifier))
+
+        assert [g.name for g in groups] == ["added", "new"]
+        assert groups[0].has_member(identifier)
+        for engine in other_shards:
+            engine.connect.assert_not_called()
+    assert not groups[0].has_member(USERS[2])
+
+
+def test_group_operations_fan_out(group_provider):
+    """
+    arrange: given a sharded group provider with users
+    act: get groups and their members
+    assert: the results of all shards are merged
+    """
+    group_provider.add_group("empty")
+
+    groups = list(group_provider.get_groups())
+    assert all(isinstance(g, ShardedSQLGroup) for g in groups)
+    assert [g.name for g in groups] == ["all", "empty", "even", "odd"]
+    assert {m.identifier for m in group_provider.get_group("all").get_members()} == set(USERS)
+    assert [m.identifier for m in group_provider.get_group("even").get_members()] == sorted(
+        USERS[::2]
+    )
+    assert not list(group_provider.get_group("empty").get_members())
+    assert group_provider.get_group("not_existing") is None
+
+
+def test_get_groups_with_counts(group_provider):
+    """
+    arrange: given a sharded group provider with users and a group without members
+    act: get the groups with their member counts ordered by name and by size
+    assert: the counts of all shards are summed
+    """
+    group_provider.add_group("empty")
+    odd = len(USERS) // 2
+
+    assert group_provider.get_groups_with_counts() == [
+        ("all", len(USERS)),
+        ("empty", 0),
+        ("even", len(USERS) - odd),
+        ("odd", odd),
+    ]
+    assert group_provider.get_groups_with_counts(by_size=True, limit=2) == [
+        ("all", len(USERS)),
+        ("even", len(USERS) - odd),
+    ]
+
+
+def test_find_member_identifiers(group_provider):
+    """
+    arrange: given a sharded group provider with users, one of them also in a staff group
+    act: find the members of all but not odd and the members of odd or staff
+    assert: the sorted identifiers of the members matching in all shards are returned
+    """
+    group_provider.add_group_member(USERS[2], "staff")
+
+    members = group_provider.find_member_identifiers(all_of=["all"], none_of=["odd"])
+
+    assert list(members) == sorted(USERS[::2])
+    assert list(group_provider.find_member_identifiers(any_of=["odd", "staff"])) == sorted(
+        USERS[1::2] + [USERS[2]]
+    )
+
+
+def test_make_group(group_provider):
+    """
+    arrange: given a sharded group provider
+    act: call make_group
+    assert: a group reading from the shards of the provider is returned
+    """
+    group = group_provider.make_group("odd")
+
+    assert isinstance(group, ShardedSQLGroup)
+    assert group.has_member(USERS[1])
+
+
+def test_warm_up_connects_to_every_shard(group_provider):
+    """
+    arrange: given a sharded group provider
+    act: warm up the group provider
+    assert: every shard is connected to and no group is preloaded
+    """
+    with patch(
+        "flask_multipass_saml_groups.group_provider.sharded.fill_pool", return_value=1
+    ) as fill_pool:
+        assert group_provider.warm_up(time.monotonic() + 10) == 0
+
+    assert [c.args[0] for c in fill_pool.call_args_list] == group_provider.engines
+
+
+@pytest.mark.parametrize(
+    "shards",
+    [
+        None,
+        [],
+        "sqlite://",
+        ["sqlite://"],
+        [{"schema": "main"}],
+        [{"uri": "sqlite://", "schema": 1}],
+    ],
+)
+def test_init_with_wrong_shards_setting_raises_value_error(app, shards):
+    """
+    arrange: given a wrong shards setting
+    act: create a ShardedSQLGroupProvider with the setting
+    assert: a ValueError is raised
+    """
+    with app.app_context():
+        identity_provider = IdentityProvider(
+            multipass=Multipass(app=app), name="saml_groups", settings={"shards": shards}
+        )
+        with pytest.raises(ValueError):
+            ShardedSQLGroupProvider(identity_provider=identity_provider)
+
+
+def test_init_with_group_hierarchy_separator_raises_value_error(app):
+    """
+    arrange: given valid shards and a group hierarchy separator
+    act: create a ShardedSQLGroupProvider with the settings
+    assert: a ValueError is raised, as hierarchical groups are not supported
+    """
+    with app.app_context():
+        identity_provider = IdentityProvider(
+            multipass=Multipass(app=app),
+            name="saml_groups",
+            settings={"shards": [{"uri": "sqlite://"}], "group_hierarchy_separator": "/"},
+        )
+        with pytest.raises(ValueError):
+            ShardedSQLGroupProvider(identity_provider=identity_provider)
+
+
+def test_get_shard_index_is_stable():
+    """
+    arrange: given an identifier
+    act: call get_shard_index
+    assert: the index does not depend on the process and is within the shard count
+    """
+    assert get_shard_index("user@example.com@https://site", 4) == 1
+    assert all(0 <= get_shard_index(i, SHARD_COUNT) < SHARD_COUNT for i in USERS)
@@ -14,3 +14,11 @@ def app_fixture():
     app = Flask("test")
     setup_sqlite(app)
     return app
+
+
+@pytest.fixture(name="file_app")
+def file_app_fixture(tmp_path):
+    """Create a flask app with a sqlite db stored in files to support concurrent connections."""
+    app = Flask("test")
+    setup_sqlite(app, tmp_path)
+    return app
@@ -0,0 +1,197 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+"""Unit tests for the storage and search of the identity attributes."""
+
+from typing import Dict
+
+from indico.core.db import db
+from sqlalchemy import event
+
+from flask_multipass_saml_groups.group_provider.attributes import (
+    Attributes,
+    get_attributes,
+    search_attributes,
+    store_attributes,
+)
+from flask_multipass_saml_groups.group_provider.bulk import insert_memberships
+from flask_multipass_saml_groups.models.saml_groups import SAMLUser, SAMLUserAttributes
+from tests.common import PROVIDER
+
+USERS: Dict[str, Attributes] = {
+    "user1": {
+        "first_name": "Alice",
+        "last_name": "Smith",
+        "email": "alice@example.com",
+        "affiliation": "ACME",
+    },
+    "user2": {
+        "first_name": "Bob",
+        "last_name": "Smithers",
+        "email": "bob@example.com",
+        "affiliation": "Initech",
+    },
+    "user3": {
+        "first_name": "Carol",
+        "last_name": "Jones",
+        "email": "carol_j@example.com",
+        "affiliation": "ACME",
+    },
+    "user4": {"first_name": "Dave", "last_name": "Smith", "email": None, "affiliation": None},
+}
+
+
+def _store_users(app):
+    """Store the attributes of the test users."""
+    with app.app_context():
+        with db.engine.begin() as connection:
+            for identifier, attributes in USERS.items():
+                store_attributes(connection, PROVIDER, identifier, attributes)
+
+
+def _search(app, criteria, **kwargs):
+    """Search the attributes and return the found identifiers and the total."""
+    with app.app_context():
+        with db.engine.connect() as connection:
+            found, total = search_attributes(connection, PROVIDER, criteria, **kwargs)
+    return [identifier for identifier, _ in found], total
+
+
+def test_store_attributes(app):
+    """
+    arrange: given a user with memberships and a user which does not exist yet
+    act: store the attributes of both, including an attribute which is not kept
+    assert: the user is created and the attributes of both are returned by get_attributes
+    """
+    with app.app_context():
+        with db.engine.begin() as connection:
+            insert_memberships(connection, PROVIDER, [("user1", "grp1")])
+            store_attributes(connection, PROVIDER, "user1", {**USERS["user1"], "phone": "123"})
+            store_attributes(connection, PROVIDER, "user2", {"email": "bob@example.com"})
+
+        with db.engine.connect() as connection:
+            attributes = get_attributes(connection, PROVIDER, ["user1", "user2", "user3"])
+        assert SAMLUser.query.count() == 2
+    assert attributes == {
+        "user1": USERS["user1"],
+        "user2": {
+            "first_name": None,
+            "last_name": None,
+            "email": "bob@example.com",
+            "affiliation": None,
+        },
+    }
+
+
+def test_store_attributes_updates_changed_attributes_only(app):
+    """
+    arrange: given a user with stored attributes
+    act: store the same attributes, then changed attributes
+    assert: the row of the user is only written for the changed attributes
+    """
+    _store_users(app)
+    with app.app_context():
+        updates = []
+
+        def count_updates(conn, cursor, statement, parameters, context, executemany):
+            # pylint: disable=unused-argument,too-many-arguments,too-many-positional-arguments
+            if context.isinsert and "saml_user_attributes" in statement:
+                updates.append(cursor.rowcount)
+
+        event.listen(db.engine, "after_cursor_execute", count_updates)
+        try:
+            with db.engine.begin() as connection:
+                store_attributes(connection, PROVIDER, "user1", USERS["user1"])
+                store_attributes(
+                    connection, PROVIDER, "user1", {**USERS["user1"], "last_name": "Jones"}
+                )
+        finally:
+            event.remove(db.engine, "after_cursor_execute", count_updates)
+
+        with db.engine.connect() as connection:
+            attributes = get_attributes(connection, PROVIDER, ["user1"])
+    assert updates == [0, 1]
+    assert attributes["user1"]["last_name"] == "Jones"
+
+
+def test_get_attributes_without_stored_attributes(app):
+    """
+    arrange: given a user without stored attributes
+    act: call get_attributes
+    assert: the user is returned with empty attributes
+    """
+    with app.app_context():
+        with db.engine.begin() as connection:
+            insert_memberships(connection, PROVIDER, [("user1", "grp1")])
+            attributes = get_attributes(connection, PROVIDER, ["user1"])
+    assert attributes == {"user1": dict.fromkeys(USERS["user1"])}
+
+
+def test_search_attributes_by_prefix(app):
+    """
+    arrange: given users with stored attributes
+    act: search by prefix of the email, the affiliation and the name, ignoring the case
+    assert: the matching users with an email address are returned ordered by identifier
+    """
+    _store_users(app)
+
+    assert _search(app, {"email": {"ALICE@"}}) == (["user1"], 1)
+    assert _search(app, {"email": {"alice", "bob"}}) == (["user1", "user2"], 2)
+    assert _search(app, {"affiliation": {"acme"}, "last_name": {"smi"}}) == (["user1"], 1)
+    assert _search(app, {"name": {"smith"}}) == (["user1", "user2"], 2)
+    assert _search(app, {"name": {"smith, al"}}) == (["user1"], 1)
+    assert _search(app, {"name": {"dave"}}) == ([], 0)
+    assert _search(app, {"name": {" , "}}) == ([], 0)
+
+
+def test_search_attributes_exact(app):
+    """
+    arrange: given users with stored attributes
+    act: search with exact matching
+    assert: only the users whose attributes are equal to the values ignoring the case are found
+    """
+    _store_users(app)
+
+    assert _search(app, {"last_name": {"SMITH"}}, exact=True) == (["user1"], 1)
+    assert _search(app, {"last_name": {"smi"}}, exact=True) == ([], 0)
+    assert _search(app, {"name": {"bob smithers"}}, exact=True) == (["user2"], 1)
+
+
+def test_search_attributes_escapes_wildcards(app):
+    """
+    arrange: given users with stored attributes, one of them with an underscore in the email
+    act: search with values containing the wildcards of LIKE
+    assert: the wildcards only match themselves
+    """
+    _store_users(app)
+
+    assert _search(app, {"email": {"carol_"}}) == (["user3"], 1)
+    assert _search(app, {"email": {"a_ice"}}) == ([], 0)
+    assert _search(app, {"email": {"%"}}) == ([], 0)
+
+
+def test_search_attributes_without_supported_criteria(app):
+    """
+    arrange: given users with stored attributes
+    act: search without criteria and by an attribute which is not stored
+    assert: no user is found
+    """
+    _store_users(app)
+
+    assert _search(app, {}) == ([], 0)
+    assert _search(app, {"phone": {"1"}}) == ([], 0)
+    assert _search(app, {"phone": {"1"}, "email": {"alice"}}) == ([], 0)
+
+
+def test_search_attributes_with_limit(app):
+    """
+    arrange: given users with stored attributes
+    act: search with a limit lower and higher than the number of matching users
+    assert: the users are returned up to the limit with the total number of matching users
+    """
+    _store_users(app)
+
+    assert _search(app, {"email": {""}}, limit=2) == (["user1", "user2"], 3)
+    assert _search(app, {"email": {""}}, limit=5) == (["user1", "user2", "user3"], 3)
+    with app.app_context():
+        assert SAMLUserAttributes.query.count() == 4
@@ -0,0 +1,545 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+"""Unit tests for the bulk membership statements."""
+
+from datetime import timedelta
+from unittest.mock import Mock
+
+import pytest
+from indico.core.db import db
+from indico.util.date_time import now_utc
+from sqlalchemy import event, select, update
+
+from flask_multipass_saml_groups.group_provider.bulk import (
+    IN_CHUNK_SIZE,
+    WriteOptions,
+    add_member_counts,
+    chunked,
+    delete_memberships,
+    get_ancestor_names,
+    get_group_ids,
+    get_groups_with_counts,
+    get_member_count_mismatches,
+    get_user_ids,
+    insert_ignore,
+    insert_memberships,
+    lock_identifiers,
+    lock_key,
+    rebuild_group_ancestors,
+    rebuild_group_names,
+    rebuild_member_counts,
+    sync_memberships,
+)
+from flask_multipass_saml_groups.models.saml_groups import SAMLGroup as DBGroup
+from flask_multipass_saml_groups.models.saml_groups import (
+    SAMLUser,
+    get_identifier_key,
+    group_ancestors_table,
+    group_member_counts_table,
+)
+from tests.common import PROVIDER
+
+
+def test_insert_memberships(app):
+    """
+    arrange: given an existing user in an existing group
+    act: call insert_memberships with the existing and new memberships
+    assert: the missing users, groups and memberships are created once
+    """
+    with app.app_context():
+        # pylint does not recognize the methods of db.session, which is a proxy object
+        # pylint: disable=no-member
+        user = SAMLUser(provider=PROVIDER, identifier="user1")
+        group = DBGroup(provider=PROVIDER, name="grp1")
+        group.members.append(user)
+        db.session.add(group)
+        db.session.commit()
+
+        with db.engine.begin() as connection:
+            insert_memberships(
+                connection,
+                PROVIDER,
+                [("user1", "grp1"), ("user1", "grp2"), ("user2", "grp2"), ("user2", "grp2")],
+            )
+
+        memberships = {(u.identifier, g.name) for u in SAMLUser.query.all() for g in u.groups}
+        assert memberships == {("user1", "grp1"), ("user1", "grp2"), ("user2", "grp2")}
+        assert DBGroup.query.count() == 2
+        assert SAMLUser.query.count() == 2
+
+
+def test_insert_memberships_without_memberships(app):
+    """
+    arrange: given an empty database
+    act: call insert_memberships and the id getters without any values
+    assert: nothing is created
+    """
+    with app.app_context():
+        with db.engine.begin() as connection:
+            insert_memberships(connection, PROVIDER, [])
+            assert not get_user_ids(connection, PROVIDER, [])
+            assert not get_group_ids(connection, PROVIDER, [])
+
+        assert not SAMLUser.query.count()
+        assert not DBGroup.query.count()
+
+
+def test_users_are_stored_with_identifier_keys(app):
+    """
+    arrange: given a user added through the ORM
+    act: call get_user_ids with the existing and a new user
+    assert: both users are stored with the fixed-width key of their identifier
+    """
+    with app.app_context():
+        # pylint does not recognize the methods of db.session, which is a proxy object
+        # pylint: disable=no-member
+        db.session.add(SAMLUser(provider=PROVIDER, identifier="user1"))
+        db.session.commit()
+
+        with db.engine.begin() as connection:
+            user_ids = get_user_ids(
+                connection, PROVIDER, ["user1", "user2@https://login.example.com"]
+            )
+
+        assert set(user_ids) == {"user1", "user2@https://login.example.com"}
+        for identifier, user_id in user_ids.items():
+            user = SAMLUser.query.get(user_id)
+            assert user.identifier == identifier
+            assert user.identifier_key == get_identifier_key(identifier)
+            assert len(user.identifier_key) == 16
+
+
+def test_delete_memberships(app):
+    """
+    arrange: given two users in two groups
+    act: call delete_memberships with existing and non-existing memberships
+    assert: only the existing memberships are removed, users and groups are kept
+    """
+    with app.app_context():
+        with db.engine.begin() as connection:
+            insert_memberships(
+                connection,
+                PROVIDER,
+                [("user1", "grp1"), ("user1", "grp2"), ("user2", "grp1"), ("user2", "grp2")],
+            )
+
+        with db.engine.begin() as connection:
+            delete_memberships(
+                connection,
+                PROVIDER,
+                [("user1", "grp1"), ("user2", "grp2"), ("user3", "grp1"), ("user1", "grp3")],
+            )
+            delete_memberships(connection, PROVIDER, [])
+
+        memberships = {(u.identifier, g.name) for u in SAMLUser.query.all() for g in u.groups}
+        assert memberships == {("user1", "grp2"), ("user2", "grp1")}
+        assert DBGroup.query.count() == 2
+        assert SAMLUser.query.count() == 2
+
+
+def test_insert_ignore_unsupported_database():
+    """
+    arrange: given a connection to an unsupported database
+    act: call insert_ignore
+    assert: a ValueError is raised
+    """
+    connection = Mock()
+    connection.dialect.name = "oracle"
+
+    with pytest.raises(ValueError):
+        insert_ignore(connection, SAMLUser.__table__)
+
+
+def test_sync_memberships(app):
+    """
+    arrange: given two users with groups
+    act: call sync_memberships for both users with changed groups
+    assert: the users are members of exactly the given groups
+    """
+    with app.app_context():
+        with db.engine.begin() as connection:
+            insert_memberships(
+                connection, PROVIDER, [("user1", "grp1"), ("user1", "grp2"), ("user2", "grp1")]
+            )
+
+        with db.engine.begin() as connection:
+            sync_memberships(
+                connection, PROVIDER, {"user1": ["grp2", "grp3"], "user2": [], "user3": []}
+            )
+
+        memberships = {(u.identifier, g.name) for u in SAMLUser.query.all() for g in u.groups}
+        assert memberships == {("user1", "grp2"), ("user1", "grp3")}
+        assert not SAMLUser.query.filter_by(identifier="user3").count()
+
+
+def test_sync_memberships_with_more_groups_than_a_chunk(app):
+    """
+    arrange: given a user in more groups than IN_CHUNK_SIZE
+    act: call sync_memberships replacing half of the groups
+    assert: the user is a member of exactly the given groups and the removed memberships are
+        deleted in chunks
+    """
+    with app.app_context():
+        group_names = [f"grp{i:05}" for i in range(4 * IN_CHUNK_SIZE + 1)]
+        replaced = group_names[::2] + [f"other{i:05}" for i in range(2 * IN_CHUNK_SIZE)]
+        with db.engine.begin() as connection:
+            sync_memberships(connection, PROVIDER, {"user1": group_names})
+        statements = []
+
+        with db.engine.begin() as connection:
+            event.listen(
+                connection,
+                "before_cursor_execute",
+                lambda conn, cursor, statement, *args: statements.append(statement),
+            )
+            sync_memberships(connection, PROVIDER, {"user1": replaced})
+
+        user = SAMLUser.query.filter_by(identifier="user1").one()
+        assert {g.name for g in user.groups} == set(replaced)
+        assert user.group_names == sorted(replaced)
+        assert sum(s.startswith("DELETE") for s in statements) == 2
+
+
+def test_chunked():
+    """
+    arrange: given a range of values
+    act: split it into chunks
+    assert: the chunks hold the values in order and all but the last one are full
+    """
+    assert list(chunked(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert not list(chunked([], 2))
+
+
+def test_sync_memberships_skips_applied_memberships(app):
+    """
+    arrange: given a user with groups
+    act: call sync_memberships with the same groups
+    assert: only the current memberships are read and nothing is written
+    """
+    with app.app_context():
+        with db.engine.begin() as connection:
+            insert_memberships(connection, PROVIDER, [("user1", "grp1"), ("user1", "grp2")])
+        statements = []
+
+        with db.engine.begin() as connection:
+            event.listen(
+                connection,
+                "before_cursor_execute",
+                lambda conn, cursor, statement, *args: statements.append(statement),
+            )
+            sync_memberships(connection, PROVIDER, {"user1": ["grp2", "grp1"]})
+
+        assert len(statements) == 1
+        assert statements[0].startswith("SELECT")
+
+
+def test_sync_memberships_refreshes_stale_last_seen_at(app):
+    """
+    arrange: given users and groups last seen two days ago, except for a recently seen group
+    act: sync the groups of one user
+    assert: the synced user and its stale groups are seen now, the others are unchanged
+    """
+    two_days_ago = now_utc() - timedelta(days=2)
+    with app.app_context():
+        with db.engine.begin() as connection:
+            insert_memberships(
+                connection,
+                PROVIDER,
+                [("user1", "grp1"), ("user1", "grp2"), ("user2", "grp3"), ("user2", "grp4")],
+            )
+            connection.execute(SAMLUser.__table__.update().values(last_seen_at=two_days_ago))
+            connection.execute(
+                DBGroup.__table__.update()
+                .where(DBGroup.__table__.c.name != "grp4")
+                .values(last_seen_at=two_days_ago)
+            )
+        recently = DBGroup.query.filter_by(name="grp4").one().last_seen_at
+
+        with db.engine.begin() as connection:
+            sync_memberships(connection, PROVIDER, {"user1": ["grp1", "grp3", "grp4"]})
+
+        users = {u.identifier: u.last_seen_at for u in SAMLUser.query.all()}
+        groups = {g.name: g.last_seen_at for g in DBGroup.query.all()}
+        assert users["user1"] > two_days_ago
+        assert users["user2"] == two_days_ago
+        assert groups["grp1"] > two_days_ago
+        assert groups["grp2"] == two_days_ago
+        assert groups["grp3"] > two_days_ago
+        assert groups["grp4"] == recently
+
+
+def test_writes_refresh_group_names(app):
+    """
+    arrange: given users with groups
+    act: insert, delete and sync memberships
+    assert: the group names of the users match their memberships after each write
+    """
+
+    def _get_group_names():
+        """Return the sorted group names of all users."""
+        return {u.identifier: sorted(u.group_names) for u in SAMLUser.query.all()}
+
+    with app.app_context():
+        with db.engine.begin() as connection:
+            insert_memberships(
+                connection, PROVIDER, [("user1", "grp2"), ("user1", "grp1"), ("user2", "grp1")]
+            )
+        assert _get_group_names() == {"user1": ["grp1", "grp2"], "user2": ["grp1"]}
+
+        with db.engine.begin() as connection:
+            delete_memberships(connection, PROVIDER, [("user2", "grp1")])
+        assert _get_group_names() == {"user1": ["grp1", "grp2"], "user2": []}
+
+        with db.engine.begin() as connection:
+            sync_memberships(connection, PROVIDER, {"user1": ["grp3"], "user2": ["grp2"]})
+        assert _get_group_names() == {"user1": ["grp3"], "user2": ["grp2"]}
+
+
+def test_writes_clear_group_names_if_disabled(app):
+    """
+    arrange: given users with group names and write options disabling the denormalized group
+        names
+    act: insert, delete and sync memberships
+    assert: the group names of the changed users are cleared
+    """
+    options = WriteOptions(group_names=False)
+
+    with app.app_context():
+        with db.engine.begin() as connection:
+            insert_memberships(
+                connection, PROVIDER, [("user1", "grp1"), ("user2", "grp1"), ("user3", "grp1")]
+            )
+        with db.engine.begin() as connection:
+            insert_memberships(connection, PROVIDER, [("user1", "grp2")], options)
+            delete_memberships(connection, PROVIDER, [("user2", "grp1")], options)
+            sync_memberships(connection, PROVIDER, {"user4": ["grp2"]}, options=options)
+
+        assert {u.identifier: u.group_names for u in SAMLUser.query.all()} == {
+            "user1": None,
+            "user2": None,
+            "user3": ["grp1"],
+            "user4": None,
+        }
+
+
+def test_rebuild_group_names(app):
+    """
+    arrange: given users with groups whose group names have not been computed
+    act: call rebuild_group_names for the range of the first user
+    assert: only the group names of the first user are computed
+    """
+    with app.app_context():
+        with db.engine.begin() as connection:
+            insert_memberships(connection, PROVIDER, [("user1", "grp1"), ("user2", "grp1")])
+            connection.execute(update(SAMLUser.__table__).values(group_names=None))
+        first_id = SAMLUser.query.filter_by(identifier="user1").one().id
+
+        with db.engine.begin() as connection:
+            rebuild_group_names(connection, first_id, first_id)
+
+        users = {u.identifier: u.group_names for u in SAMLUser.query.all()}
+        assert users == {"user1": ["grp1"], "user2": None}
+
+
+def test_lock_identifiers_on_postgresql():
+    """
+    arrange: given a connection to a PostgreSQL database
+    act: call lock_identifiers
+    assert: an advisory lock is taken for each distinct identifier in a stable order
+    """
+    connection = Mock()
+    connection.dialect.name = "postgresql"
+
+    lock_identifiers(connection, ["user2", "user1", "user2"])
+
+    keys = [
+        call.args[0].compile(compile_kwargs={"literal_binds": True}).string
+        for call in connection.execute.call_args_list
+    ]
+    assert len(keys) == 2
+    assert str(lock_key("user1")) in keys[0]
+    assert str(lock_key("user2")) in keys[1]
+
+
+def test_lock_key_is_stable():
+    """
+    arrange: given an identifier
+    act: call lock_key
+    assert: the key is a signed 64 bit integer which does not depend on the process
+    """
+    key = lock_key("user@example.com@https://site")
+
+    assert key == lock_key("user@example.com@https://site")
+    assert key == -3219130810435674663
+    assert -(2**63) <= key < 2**63
+
+
+def _get_ancestors():
+    """Return the pairs of group and ancestor names of the closure of the hierarchy."""
+    groups = DBGroup.__table__
+    ancestors = group_ancestors_table
+    ancestor_groups = groups.alias()
+    # pylint: disable-next=no-member
+    rows = db.session.execute(
+        select(groups.c.name, ancestor_groups.c.name)
+        .select_from(ancestors)
+        .join(groups, groups.c.id == ancestors.c.group_id)
+        .join(ancestor_groups, ancestor_groups.c.id == ancestors.c.ancestor_id)
+    )
+    return set(rows.all())
+
+
+def test_get_ancestor_names():
+    """
+    arrange: given hierarchical group names
+    act: get the names of their ancestors
+    assert: the ancestors are the prefixes of the name, from the root
+    """
+    assert get_ancestor_names("eng/platform/sre", "/") == ["eng", "eng/platform"]
+    assert get_ancestor_names("eng", "/") == []
+    assert get_ancestor_names("/eng::sre", "::") == ["/eng"]
+
+
+def test_get_group_ids_adds_ancestors(app):
+    """
+    arrange: given an existing group created without hierarchy
+    act: call get_group_ids with a separator for its descendant, twice
+    assert: the missing ancestor is created and the closure holds every group with each of its
+        ancestors and itself, once
+    """
+    with app.app_context():
+        with db.engine.begin() as connection:
+            get_group_ids(connection, PROVIDER, ["eng"])
+
+        for _ in range(2):
+            with db.engine.begin() as connection:
+                group_ids = get_group_ids(connection, PROVIDER, ["eng/platform/sre"], "/")
+
+        assert list(group_ids) == ["eng/platform/sre"]
+        assert {g.name for g in DBGroup.query.all()} == {"eng", "eng/platform", "eng/platform/sre"}
+        assert _get_ancestors() == {
+            ("eng", "eng"),
+            ("eng/platform", "eng"),
+            ("eng/platform", "eng/platform"),
+            ("eng/platform/sre", "eng"),
+            ("eng/platform/sre", "eng/platform"),
+            ("eng/platform/sre", "eng/platform/sre"),
+        }
+
+
+def test_rebuild_group_ancestors(app):
+    """
+    arrange: given groups whose closure was computed with another separator
+    act: call rebuild_group_ancestors for all groups with the new separator
+    assert: the closure matches the new separator
+    """
+    with app.app_context():
+        with db.engine.begin() as connection:
+            get_group_ids(connection, PROVIDER, ["eng:sre"], "/")
+
+        with db.engine.begin() as connection:
+            rebuild_group_ancestors(connection, PROVIDER, 1, 10, ":")
+
+        assert {g.name for g in DBGroup.query.all()} == {"eng", "eng:sre"}
+        assert _get_ancestors() == {("eng", "eng"), ("eng:sre", "eng"), ("eng:sre", "eng:sre")}
+
+
+def test_writes_maintain_member_counts(app):
+    """
+    arrange: given an empty database
+    act: insert, delete and sync memberships, including memberships which already exist
+    assert: the member counts of the groups match their memberships after each write
+    """
+    with app.app_context():
+        with db.engine.begin() as connection:
+            insert_memberships(
+                connection, PROVIDER, [("user1", "grp1"), ("user2", "grp1"), ("user2", "grp2")]
+            )
+            insert_memberships(connection, PROVIDER, [("user1", "grp1"), ("user3", "grp1")])
+            first = get_groups_with_counts(connection, PROVIDER)
+            delete_memberships(connection, PROVIDER, [("user2", "grp1"), ("user2", "grp3")])
+            second = get_groups_with_counts(connection, PROVIDER)
+            sync_memberships(connection, PROVIDER, {"user1": ["grp2", "grp3"], "user2": ["grp2"]})
+            third = get_groups_with_counts(connection, PROVIDER)
+            assert not get_member_count_mismatches(connection)
+
+    assert first == [("grp1", 3), ("grp2", 1)]
+    assert second == [("grp1", 2), ("grp2", 1)]
+    assert third == [("grp1", 1), ("grp2", 2), ("grp3", 1)]
+
+
+def test_get_groups_with_counts(app):
+    """
+    arrange: given groups with different numbers of members and a group without members
+    act: call get_groups_with_counts ordered by name and by size, with and without a limit
+    assert: the groups are returned with their counts in the requested order
+    """
+    with app.app_context():
+        with db.engine.begin() as connection:
+            get_group_ids(connection, PROVIDER, ["empty"])
+            insert_memberships(
+                connection,
+                PROVIDER,
+                [("user1", "b"), ("user2", "b"), ("user1", "c"), ("user2", "c"), ("user1", "a")],
+            )
+            by_name = get_groups_with_counts(connection, PROVIDER)
+            by_size = get_groups_with_counts(connection, PROVIDER, by_size=True)
+            largest = get_groups_with_counts(connection, PROVIDER, by_size=True, limit=1)
+
+    assert by_name == [("a", 1), ("b", 2), ("c", 2), ("empty", 0)]
+    assert by_size == [("b", 2), ("c", 2), ("a", 1), ("empty", 0)]
+    assert largest == [("b", 2)]
+
+
+def test_add_member_counts_locks_in_group_order(app):
+    """
+    arrange: given an empty database
+    act: add member counts for groups in unsorted order, with a delta summing to zero
+    assert: the counts are written in a single statement in the order of the group ids,
+        skipping the unchanged group
+    """
+    parameters = []
+    with app.app_context():
+        with db.engine.begin() as connection:
+            group_ids = get_group_ids(connection, PROVIDER, ["grp1", "grp2", "grp3"])
+            event.listen(
+                connection,
+                "before_cursor_execute",
+                lambda conn, cursor, statement, params, *args: parameters.append(params),
+            )
+            add_member_counts(
+                connection,
+                added=[group_ids["grp3"], group_ids["grp1"], group_ids["grp2"]],
+                removed=[group_ids["grp2"], group_ids["grp3"], group_ids["grp3"]],
+            )
+
+    assert len(parameters) == 1
+    assert [row[0] for row in parameters[0]] == [group_ids["grp1"], group_ids["grp3"]]
+
+
+def test_rebuild_member_counts(app):
+    """
+    arrange: given groups whose member counts are wrong or missing
+    act: verify the counts, then rebuild them
+    assert: the wrong counts are reported and recomputed from the memberships
+    """
+    with app.app_context():
+        with db.engine.begin() as connection:
+            insert_memberships(
+                connection, PROVIDER, [("user1", "grp1"), ("user2", "grp1"), ("user1", "grp2")]
+            )
+            group_ids = get_group_ids(connection, PROVIDER, ["grp2", "grp3"])
+            counts = group_member_counts_table
+            connection.execute(counts.update().values(member_count=5))
+            connection.execute(counts.delete().where(counts.c.group_id == group_ids["grp2"]))
+
+        with db.engine.begin() as connection:
+            mismatches = get_member_count_mismatches(connection)
+            rebuilt = rebuild_member_counts(connection)
+
+        with db.engine.connect() as connection:
+            assert not get_member_count_mismatches(connection)
+            counts = get_groups_with_counts(connection, PROVIDER)
+    assert mismatches == rebuilt == [("grp1", 5, 2), ("grp2", 0, 1)]
+    assert counts == [("grp1", 2), ("grp2", 1), ("grp3", 0)]
@@ -0,0 +1,145 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+"""Unit tests for the change log of the memberships."""
+
+from unittest.mock import Mock
+
+from indico.core.db import db
+
+from flask_multipass_saml_groups.group_provider.bulk import (
+    WriteOptions,
+    delete_memberships,
+    insert_memberships,
+    sync_memberships,
+)
+from flask_multipass_saml_groups.group_provider.changelog import (
+    ADD,
+    REMOVE,
+    append_changes,
+    get_changes,
+)
+from tests.common import PROVIDER
+
+
+def _get_changes(connection, since=0):
+    """Get the sequence numbers, actions, identifiers and group names of the changes."""
+    return [
+        (c.sequence, c.action, c.identifier, c.group_name)
+        for c in get_changes(connection, PROVIDER, since)
+    ]
+
+
+def test_writes_append_changes(app):
+    """
+    arrange: given a user in two groups
+    act: sync the user to one of the groups and a new group, add an existing and a new
+        membership and delete an existing and a missing membership
+    assert: only the memberships which were actually added or removed are appended to the
+        change log, with increasing sequence numbers
+    """
+    with app.app_context():
+        with db.engine.begin() as connection:
+            insert_memberships(connection, PROVIDER, [("user1", "grp1"), ("user1", "grp2")])
+
+        with db.engine.begin() as connection:
+            sync_memberships(connection, PROVIDER, {"user1": ["grp2", "grp3"]})
+            sync_memberships(connection, PROVIDER, {"user1": ["grp2", "grp3"]})
+            insert_memberships(connection, PROVIDER, [("user1", "grp2"), ("user2", "grp1")])
+            delete_memberships(connection, PROVIDER, [("user1", "grp2"), ("user1", "grp1")])
+
+        with db.engine.connect() as connection:
+            changes = _get_changes(connection, since=2)
+
+    assert changes == [
+        (3, REMOVE, "user1", "grp1"),
+        (4, ADD, "user1", "grp3"),
+        (5, ADD, "user2", "grp1"),
+        (6, REMOVE, "user1", "grp2"),
+    ]
+
+
+def test_writes_skip_change_log_if_disabled(app):
+    """
+    arrange: given write options disabling the change log
+    act: sync, insert and delete memberships
+    assert: no change is appended to the change log
+    """
+    options = WriteOptions(change_log=False)
+
+    with app.app_context():
+        with db.engine.begin() as connection:
+            sync_memberships(connection, PROVIDER, {"user1": ["grp1", "grp2"]}, options=options)
+            insert_memberships(connection, PROVIDER, [("user2", "grp1")], options)
+            delete_memberships(connection, PROVIDER, [("user1", "grp2")], options)
+
+        with db.engine.connect() as connection:
+            assert not _get_changes(connection)
+
+
+def test_get_changes_with_limit(app):
+    """
+    arrange: given five changes
+    act: read the changes in pages of two
+    assert: each page continues after the last sequence number of the previous one
+    """
+    with app.app_context():
+        with db.engine.begin() as connection:
+            append_changes(connection, PROVIDER, added=[(f"user{i}", "grp1") for i in range(5)])
+
+        pages = []
+        since = 0
+        with db.engine.connect() as connection:
+            while page := get_changes(connection, PROVIDER, since, limit=2):
+                pages.append([c.identifier for c in page])
+                since = page[-1].sequence
+
+    assert pages == [["user0", "user1"], ["user2", "user3"], ["user4"]]
+
+
+def test_append_changes_locks_change_log_on_postgresql():
+    """
+    arrange: given a connection to a PostgreSQL database
+    act: append changes
+    assert: the advisory lock of the change log is taken in shared mode before the changes are
+        inserted, so that appends do not wait for each other
+    """
+    connection = Mock()
+    connection.dialect.name = "postgresql"
+
+    append_changes(connection, PROVIDER, removed=[("user1", "grp1")])
+
+    statements = [str(c.args[0]) for c in connection.execute.call_args_list]
+    assert "pg_advisory_xact_lock_shared" in statements[0]
+    assert statements[1].startswith("INSERT INTO plugin_saml_groups.saml_membership_changes")
+
+
+def test_get_changes_locks_change_log_on_postgresql():
+    """
+    arrange: given a connection to a PostgreSQL database
+    act: get the changes
+    assert: the advisory lock of the change log is taken exclusively before the changes are
+        read, so that the appends in flight are waited for
+    """
+    connection = Mock()
+    connection.dialect.name = "postgresql"
+    connection.execute.return_value = []
+
+    get_changes(connection, PROVIDER)
+
+    statements = [str(c.args[0]) for c in connection.execute.call_args_list]
+    assert "pg_advisory_xact_lock(" in statements[0]
+    assert "FROM plugin_saml_groups.saml_membership_changes" in statements[1]
+
+
+def test_append_no_changes():
+    """
+    arrange: given a connection
+    act: append no changes
+    assert: nothing is executed
+    """
+    connection = Mock()
+
+    append_changes(connection, PROVIDER)
+
+    connection.execute.assert_not_called()
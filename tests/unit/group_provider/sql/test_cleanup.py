@@ -0,0 +1,194 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+"""Unit tests for the deletion of stale users and groups."""
+
+from datetime import timedelta
+
+from indico.core.db import db
+from indico.util.date_time import now_utc
+from sqlalchemy import select
+
+from flask_multipass_saml_groups.group_provider.attributes import get_attributes, store_attributes
+from flask_multipass_saml_groups.group_provider.bulk import (
+    delete_memberships,
+    get_group_ids,
+    get_groups_with_counts,
+    insert_memberships,
+)
+from flask_multipass_saml_groups.group_provider.changelog import REMOVE, get_changes
+from flask_multipass_saml_groups.group_provider.cleanup import (
+    DeletedBatch,
+    delete_old_changes,
+    delete_orphaned_groups,
+    delete_stale_users,
+)
+from flask_multipass_saml_groups.models.saml_groups import SAMLGroup as DBGroup
+from flask_multipass_saml_groups.models.saml_groups import (
+    SAMLMembershipChange,
+    SAMLUser,
+    SAMLUserAttributes,
+    group_ancestors_table,
+    group_member_counts_table,
+    group_members_table,
+)
+from tests.common import PROVIDER
+
+MEMBERSHIPS = [("user1", "grp1"), ("user2", "grp1"), ("user3", "grp2"), ("user4", "grp1")]
+
+
+def _set_last_seen(connection, table, names, last_seen_at):
+    """Set the last_seen_at of the users or groups with the given identifiers or names."""
+    column = table.c.identifier if table is SAMLUser.__table__ else table.c.name
+    connection.execute(table.update().where(column.in_(names)).values(last_seen_at=last_seen_at))
+
+
+def test_delete_stale_users(app):
+    """
+    arrange: given three users not seen for ten days and a recently seen user
+    act: delete the users not seen for a week in batches of two, each continuing after the
+        previous one
+    assert: the batches delete two and one stale users with their memberships, then find none,
+        the member counts of their groups are updated and the removed memberships are appended
+        to the change log
+    """
+    ten_days_ago = now_utc() - timedelta(days=10)
+    with app.app_context():
+        with db.engine.begin() as connection:
+            insert_memberships(connection, PROVIDER, MEMBERSHIPS)
+            _set_last_seen(
+                connection, SAMLUser.__table__, ["user1", "user2", "user3"], ten_days_ago
+            )
+
+        cutoff = now_utc() - timedelta(days=7)
+        batches = []
+        after_id = 0
+        for _ in range(3):
+            with db.engine.begin() as connection:
+                batches.append(delete_stale_users(connection, cutoff, 2, after_id))
+            after_id = batches[-1].last_id or after_id
+
+        assert [b.deleted for b in batches] == [2, 1, 0]
+        assert batches[2].last_id is None
+        assert [u.identifier for u in SAMLUser.query.all()] == ["user4"]
+        with db.engine.connect() as connection:
+            members = connection.execute(group_members_table.select()).all()
+            changes = get_changes(connection, PROVIDER, since=4)
+            counts = get_groups_with_counts(connection, PROVIDER)
+        assert len(members) == 1
+        assert counts == [("grp1", 1), ("grp2", 0)]
+        assert sorted((c.action, c.identifier, c.group_name) for c in changes) == [
+            (REMOVE, "user1", "grp1"),
+            (REMOVE, "user2", "grp1"),
+            (REMOVE, "user3", "grp2"),
+        ]
+
+
+def test_delete_stale_users_deletes_attributes(app):
+    """
+    arrange: given a stale and a recently seen user with stored attributes
+    act: delete the stale users
+    assert: only the attributes of the recently seen user are kept
+    """
+    ten_days_ago = now_utc() - timedelta(days=10)
+    with app.app_context():
+        with db.engine.begin() as connection:
+            store_attributes(connection, PROVIDER, "user1", {"email": "user1@example.com"})
+            store_attributes(connection, PROVIDER, "user2", {"email": "user2@example.com"})
+            _set_last_seen(connection, SAMLUser.__table__, ["user1"], ten_days_ago)
+
+        with db.engine.begin() as connection:
+            deleted, _ = delete_stale_users(connection, now_utc() - timedelta(days=7), 10)
+
+        with db.engine.connect() as connection:
+            attributes = get_attributes(connection, PROVIDER, ["user1", "user2"])
+    assert deleted == 1
+    assert {i: a["email"] for i, a in attributes.items()} == {"user2": "user2@example.com"}
+    with app.app_context():
+        assert SAMLUserAttributes.query.count() == 1
+
+
+def test_delete_orphaned_groups(app):
+    """
+    arrange: given groups not seen for ten days with and without members and a recently seen
+        group without members
+    act: delete the orphaned groups not seen for a week
+    assert: only the stale groups without members are deleted with their member counts
+    """
+    ten_days_ago = now_utc() - timedelta(days=10)
+    with app.app_context():
+        with db.engine.begin() as connection:
+            insert_memberships(
+                connection, PROVIDER, [("user1", "grp1"), ("user1", "grp2"), ("user1", "grp3")]
+            )
+            delete_memberships(connection, PROVIDER, [("user1", "grp3")])
+            connection.execute(
+                DBGroup.__table__.insert(), [{"provider": PROVIDER, "name": "grp4"}]
+            )
+            _set_last_seen(connection, DBGroup.__table__, ["grp1", "grp3"], ten_days_ago)
+
+        with db.engine.begin() as connection:
+            deleted, _ = delete_orphaned_groups(connection, now_utc() - timedelta(days=7), 10)
+
+        assert deleted == 1
+        assert {g.name for g in DBGroup.query.all()} == {"grp1", "grp2", "grp4"}
+        with db.engine.connect() as connection:
+            assert len(connection.execute(select(group_member_counts_table)).all()) == 2
+
+
+def test_delete_orphaned_groups_keeps_ancestors_with_descendants(app):
+    """
+    arrange: given hierarchical groups without members not seen for ten days
+    act: delete the orphaned groups not seen for a week in two passes
+    assert: the descendants are deleted before their ancestors
+    """
+    ten_days_ago = now_utc() - timedelta(days=10)
+    cutoff = now_utc() - timedelta(days=7)
+    with app.app_context():
+        with db.engine.begin() as connection:
+            get_group_ids(connection, PROVIDER, ["eng/platform", "ops"], "/")
+            _set_last_seen(connection, DBGroup.__table__, ["eng", "eng/platform"], ten_days_ago)
+
+        with db.engine.begin() as connection:
+            assert delete_orphaned_groups(connection, cutoff, 10).deleted == 1
+        assert {g.name for g in DBGroup.query.all()} == {"eng", "ops"}
+
+        with db.engine.begin() as connection:
+            assert delete_orphaned_groups(connection, cutoff, 10).deleted == 1
+        assert {g.name for g in DBGroup.query.all()} == {"ops"}
+        # pylint: disable-next=no-member
+        assert db.session.execute(select(group_ancestors_table)).all() == [
+            (DBGroup.query.one().id, DBGroup.query.one().id)
+        ]
+
+
+def test_delete_old_changes(app):
+    """
+    arrange: given three changes written ten days ago and a recent change
+    act: delete the changes older than a week in batches of two, each continuing after the
+        previous one
+    assert: the batches delete two and one old changes, then find none, and the recent change
+        is kept
+    """
+    with app.app_context():
+        with db.engine.begin() as connection:
+            insert_memberships(connection, PROVIDER, MEMBERSHIPS[:3])
+            connection.execute(
+                SAMLMembershipChange.__table__.update().values(
+                    changed_at=now_utc() - timedelta(days=10)
+                )
+            )
+            insert_memberships(connection, PROVIDER, MEMBERSHIPS[3:])
+
+        cutoff = now_utc() - timedelta(days=7)
+        batches = []
+        after_id = 0
+        for _ in range(3):
+            with db.engine.begin() as connection:
+                batches.append(delete_old_changes(connection, cutoff, 2, after_id))
+            after_id = batches[-1].last_id or after_id
+
+        assert batches == [DeletedBatch(2, 2), DeletedBatch(1, 3), DeletedBatch(0, None)]
+        with db.engine.connect() as connection:
+            changes = get_changes(connection, PROVIDER)
+        assert [(c.identifier, c.group_name) for c in changes] == [("user4", "grp1")]
@@ -0,0 +1,225 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+"""Unit tests for the coalescing membership writer."""
+
+import time
+from threading import Barrier, Thread
+from typing import Any, Dict, List, Tuple
+from unittest.mock import patch
+
+import pytest
+
+from flask_multipass_saml_groups.group_provider.bulk import sync_memberships
+from flask_multipass_saml_groups.group_provider.coalescing import CoalescingMembershipWriter
+from flask_multipass_saml_groups.models.saml_groups import SAMLUser
+from tests.common import PROVIDER
+
+SYNC_MEMBERSHIPS = "flask_multipass_saml_groups.group_provider.coalescing.sync_memberships"
+WAIT_TIMEOUT = 5
+
+
+def test_sync(app):
+    """
+    arrange: given a CoalescingMembershipWriter
+    act: call sync
+    assert: the memberships are committed when the call returns
+    """
+    writer = CoalescingMembershipWriter(interval=0.001, provider=PROVIDER)
+
+    with app.app_context():
+        writer.sync("user1", ["grp1", "grp2"])
+
+        user = SAMLUser.query.filter_by(identifier="user1").one()
+        assert {g.name for g in user.groups} == {"grp1", "grp2"}
+
+
+def test_sync_removes_memberships(app):
+    """
+    arrange: given a user who is a member of two groups
+    act: call sync with one of the groups
+    assert: the user is only a member of that group when the call returns
+    """
+    writer = CoalescingMembershipWriter(interval=0.001, provider=PROVIDER)
+
+    with app.app_context():
+        writer.sync("user1", ["grp1", "grp2"])
+        writer.sync("user1", ["grp2"])
+
+        user = SAMLUser.query.filter_by(identifier="user1").one()
+        assert [g.name for g in user.groups] == ["grp2"]
+
+
+def _sync_concurrently(app, writer, requests: List[Tuple[str, List[str]]]) -> Dict[str, Any]:
+    """Call sync for each request in its own thread at the same time.
+
+    Args:
+        app: The flask app.
+        writer: The CoalescingMembershipWriter.
+        requests: The identifiers and group names to sync.
+
+    Returns:
+        The exception raised by sync per identifier, None if it returned.
+    """
+    barrier = Barrier(len(requests))
+    results: Dict[str, Any] = {}
+
+    def _sync(identifier: str, group_names: List[str]) -> None:
+        with app.app_context():
+            barrier.wait()
+            try:
+                writer.sync(identifier, group_names)
+            except RuntimeError as exc:
+                results[identifier] = exc
+            else:
+                results[identifier] = None
+
+    threads = [Thread(target=_sync, args=request) for request in requests]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def _wait_for_queued_requests(writer, count: int) -> None:
+    """Wait until a number of requests are queued for the writer.
+
+    Args:
+        writer: The CoalescingMembershipWriter.
+        count: The number of requests.
+    """
+    deadline = time.monotonic() + WAIT_TIMEOUT
+    # pylint: disable-next=protected-access
+    while writer._queue.qsize() < count and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_sync_coalesces_concurrent_requests(app):
+    """
+    arrange: given a CoalescingMembershipWriter whose first transaction lasts until the other
+        requests are queued
+    act: call sync concurrently for several users with the same new group
+    assert: the memberships of the queued users are written in one transaction
+    """
+    writer = CoalescingMembershipWriter(interval=0.2, provider=PROVIDER)
+    requests = [("user1", ["grp1"]), ("user2", ["grp1", "grp2"]), ("user3", ["grp1"])]
+
+    def _sync_memberships(connection, provider, user_groups, **kwargs):
+        if sync_mock.call_count == 1:
+            # the other requests are queued while the first transaction lasts
+            _wait_for_queued_requests(writer, len(requests) - len(user_groups))
+        sync_memberships(connection, provider, user_groups, **kwargs)
+
+    with patch(SYNC_MEMBERSHIPS, side_effect=_sync_memberships) as sync_mock:
+        results = _sync_concurrently(app, writer, requests)
+
+    assert results == {"user1": None, "user2": None, "user3": None}
+    assert sync_mock.call_count <= 2
+    with app.app_context():
+        memberships = {(u.identifier, g.name) for u in SAMLUser.query.all() for g in u.groups}
+    assert memberships == {
+        ("user1", "grp1"),
+        ("user2", "grp1"),
+        ("user2", "grp2"),
+        ("user3", "grp1"),
+    }
+
+
+def test_sync_limits_batch_size(app):
+    """
+    arrange: given a CoalescingMembershipWriter with a maximum batch size of 2
+    act: call sync concurrently for three users
+    assert: no transaction writes more than two users and all memberships are written
+    """
+    writer = CoalescingMembershipWriter(interval=0.2, provider=PROVIDER, max_batch_size=2)
+    requests = [("user1", ["grp1"]), ("user2", ["grp1"]), ("user3", ["grp1"])]
+
+    with patch(SYNC_MEMBERSHIPS, wraps=sync_memberships) as sync_mock:
+        results = _sync_concurrently(app, writer, requests)
+
+    assert results == {"user1": None, "user2": None, "user3": None}
+    assert sync_mock.call_count >= 2
+    assert all(len(call.args[2]) <= 2 for call in sync_mock.call_args_list)
+    with app.app_context():
+        assert SAMLUser.query.count() == 3
+
+
+def test_sync_failure_only_affects_failing_request(file_app):
+    """
+    arrange: given a CoalescingMembershipWriter and a database with a connection per thread
+        rejecting the writes of one user
+    act: call sync concurrently for that user and another user
+    assert: only the sync of the rejected user raises and the other user's memberships are written
+    """
+    writer = CoalescingMembershipWriter(interval=0.2, provider=PROVIDER)
+
+    def _sync_memberships(connection, provider, user_groups, **kwargs):
+        if "bad" in user_groups:
+            raise RuntimeError("rejected")
+        sync_memberships(connection, provider, user_groups, **kwargs)
+
+    with patch(SYNC_MEMBERSHIPS, side_effect=_sync_memberships):
+        results = _sync_concurrently(file_app, writer, [("bad", ["grp1"]), ("user1", ["grp1"])])
+
+    assert isinstance(results["bad"], RuntimeError)
+    assert results["user1"] is None
+    with file_app.app_context():
+        user = SAMLUser.query.filter_by(identifier="user1").one()
+        assert [g.name for g in user.groups] == ["grp1"]
+        assert SAMLUser.query.filter_by(identifier="bad").first() is None
+
+
+def test_sync_failure(app):
+    """
+    arrange: given a CoalescingMembershipWriter and a failing database
+    act: call sync
+    assert: the error is raised to the caller
+    """
+    writer = CoalescingMembershipWriter(interval=0.001, provider=PROVIDER)
+
+    with (
+        app.app_context(),
+        patch(SYNC_MEMBERSHIPS, side_effect=RuntimeError("db down")),
+        pytest.raises(RuntimeError),
+    ):
+        writer.sync("user1", ["grp1"])
+
+
+def test_sync_restarts_stopped_writer(app):
+    """
+    arrange: given a CoalescingMembershipWriter whose writer thread fails outside a transaction
+    act: call sync twice
+    assert: the first call gets the error and the second call is written by a new writer
+    """
+    writer = CoalescingMembershipWriter(interval=0.001, provider=PROVIDER)
+
+    with app.app_context():
+        with (
+            patch.object(writer, "_write_batch", side_effect=RuntimeError("writer stopped")),
+            pytest.raises(RuntimeError),
+        ):
+            writer.sync("user1", ["grp1"])
+        writer.sync("user1", ["grp2"])
+
+        user = SAMLUser.query.filter_by(identifier="user1").one()
+        assert [g.name for g in user.groups] == ["grp2"]
+
+
+def test_sync_writes_directly_after_timeout(app):
+    """
+    arrange: given a CoalescingMembershipWriter whose writer thread does not take any request
+    act: call sync
+    assert: the caller writes the memberships itself after the timeout and the writer skips them
+    """
+    writer = CoalescingMembershipWriter(interval=0.001, provider=PROVIDER)
+    writer.timeout = 0.01
+
+    with app.app_context():
+        with patch.object(writer, "_ensure_started"):
+            writer.sync("user1", ["grp1"])
+
+        user = SAMLUser.query.filter_by(identifier="user1").one()
+        assert [g.name for g in user.groups] == ["grp1"]
+        request = writer._queue.get_nowait()  # pylint: disable=protected-access
+        assert request[3].cancelled()
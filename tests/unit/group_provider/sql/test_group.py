@@ -2,13 +2,20 @@
 #  See LICENSE file for licensing details.
 
 """Unit tests for the sql group."""
+
+import weakref
 from secrets import token_hex
 
 import pytest
 from flask_multipass import IdentityInfo, Multipass
+from indico.core.db import db
 
+from flask_multipass_saml_groups.group_provider.bulk import get_group_ids
 from flask_multipass_saml_groups.group_provider.sql import SQLGroup, SQLGroupProvider
+from flask_multipass_saml_groups.models.saml_groups import SAMLGroup as DBGroup
+from flask_multipass_saml_groups.models.saml_groups import group_members_table
 from flask_multipass_saml_groups.provider import SAMLGroupsIdentityProvider
+from tests.common import PROVIDER
 
 
 @pytest.fixture(name="group_name")
@@ -60,6 +67,27 @@ def test_get_members(group, group_provider, group_name):
     assert {member.identifier for member in members} == set(users)
 
 
+def test_get_members_with_attributes(app, group, group_provider, group_name):
+    """
+    arrange: given a group with a user whose attributes are stored and a mapping of the email
+    act: call get_members
+    assert: the identity information of the member contains the stored attributes
+    """
+    group_provider.add_group_member(group_name=group_name, identifier="user1")
+    group_provider.set_identity_attributes(
+        "user1", {"first_name": "Alice", "email": "alice@example.com"}
+    )
+    group.provider.settings["mapping"] = {"email": "mail"}
+
+    with app.app_context():
+        (member,) = group.get_members()
+
+    assert member.identifier == "user1"
+    assert member.data["first_name"] == "Alice"
+    assert member.data["email"] == "alice@example.com"
+    assert member.data["last_name"] is None
+
+
 def test_get_members_returns_empty_list(group, group_provider, group_name):
     """
     arrange: given no users
@@ -115,3 +143,37 @@ def test_has_member_returns_false_for_non_existing_group(group):
     """
     user_identifier = token_hex(16)
     assert not group.has_member(user_identifier)
+
+
+def test_group_id_is_refreshed_when_stale(group_provider, group_name):
+    """
+    arrange: given a group which has been deleted and created again with other members, its
+        cached id being reused by another group
+    act: call has_member and get_members
+    assert: the members of the new group are returned and the cached id is refreshed
+    """
+    group_provider.add_group_member(identifier="user1", group_name=group_name)
+    group = group_provider.get_group(group_name)
+    stale_id = group.group_id
+    with db.engine.begin() as connection:
+        connection.execute(group_members_table.delete())
+        connection.execute(DBGroup.__table__.delete())
+        get_group_ids(connection, PROVIDER, ["other"])
+        get_group_ids(connection, PROVIDER, [group_name])
+    group_provider.add_group_member(identifier="user2", group_name=group_name)
+
+    assert not group.has_member("user1")
+    assert group.has_member("user2")
+    assert [m.identifier for m in group.get_members()] == ["user2"]
+    assert group.group_id != stale_id
+
+
+def test_group_attributes_are_slotted(group):
+    """
+    arrange: given a group object
+    act: read the instance dictionary and take a weak reference to the group
+    assert: only the attributes of the flask_multipass base class are stored in it, and the
+        group can be referenced weakly for its interning
+    """
+    assert set(vars(group)) == {"provider", "name"}
+    assert weakref.ref(group)() is group
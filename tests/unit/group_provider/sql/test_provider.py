@@ -3,19 +3,44 @@
 
 """Unit tests for the sql group provider."""
 
-
+import gc
+import time
+import weakref
+from datetime import datetime, timedelta, timezone
 from secrets import token_hex
+from threading import Barrier, Thread
+from time import sleep
+from unittest.mock import patch
 
 import pytest
+from flask import session
 from flask_multipass import IdentityProvider, Multipass
 from indico.core.db import db
+from sqlalchemy import create_engine, event, select, text
+from sqlalchemy.pool import QueuePool
 
+from flask_multipass_saml_groups.group_provider.base import GroupProvider
+from flask_multipass_saml_groups.group_provider.bulk import get_sync_state, insert_memberships
+from flask_multipass_saml_groups.group_provider.changelog import ADD, REMOVE
+from flask_multipass_saml_groups.group_provider.routing import fill_pool
 from flask_multipass_saml_groups.group_provider.sql import SQLGroup, SQLGroupProvider
 from flask_multipass_saml_groups.models.saml_groups import SAMLGroup as DBGroup
 from flask_multipass_saml_groups.models.saml_groups import SAMLUser
+from tests.common import PROVIDER, attach_plugin_db, create_plugin_tables
 
 NOT_EXISTING_USER_IDENTIFIER = "user-3"
 NOT_EXISTING_GRP_NAME = "not_existing"
+OVERLAPPING_MEMBERSHIPS = [
+    ("user1", "A"),
+    ("user1", "B"),
+    ("user2", "A"),
+    ("user2", "B"),
+    ("user2", "C"),
+    ("user3", "C"),
+    ("user3", "D"),
+    ("user4", "A"),
+    ("user4", "D"),
+]
 
 
 @pytest.fixture(name="group_names")
@@ -42,20 +67,20 @@ def group_provider_fixture(app, group_names, user_identifiers):
         multipass = Multipass(app=app)
         group_provider = SQLGroupProvider(
             identity_provider=IdentityProvider(
-                multipass=multipass, name="saml_groups", settings={}
+                multipass=multipass, name="saml_groups", settings={"membership_change_log": True}
             ),
         )
-        user1 = SAMLUser(identifier=user_identifiers[0])
-        user2 = SAMLUser(identifier=user_identifiers[1])
+        user1 = SAMLUser(provider=PROVIDER, identifier=user_identifiers[0])
+        user2 = SAMLUser(provider=PROVIDER, identifier=user_identifiers[1])
 
         # pylint does not recognize the methods of db.session, which is a proxy object
         # pylint: disable=no-member
         db.session.add(user1)
         db.session.add(user2)
-        grp1 = DBGroup(name=group_names[0])
+        grp1 = DBGroup(provider=PROVIDER, name=group_names[0])
         grp1.members.append(user1)
         db.session.add(grp1)
-        db.session.add(DBGroup(name=group_names[1]))
+        db.session.add(DBGroup(provider=PROVIDER, name=group_names[1]))
         db.session.commit()
 
         yield group_provider
@@ -73,6 +98,74 @@ def test_get_group(group_provider, group_names):
     assert grp.name == group_names[0]
 
 
+def test_groups_are_interned(group_provider, user_identifiers, group_names):
+    """
+    arrange: given a group provider with groups
+    act: get the same group through make_group, get_group, get_groups and get_user_groups, then
+        drop all references to it
+    assert: the same object is returned as long as it is referenced, with the id of the group
+    """
+    group = group_provider.make_group(group_names[0])
+
+    assert group_provider.get_group(group_names[0]) is group
+    assert group in list(group_provider.get_groups())
+    assert list(group_provider.get_user_groups(user_identifiers[0])) == [group]
+    assert group.group_id == DBGroup.query.filter_by(name=group_names[0]).one().id
+    group_ref = weakref.ref(group)
+    del group
+    gc.collect()
+    assert group_ref() is None
+
+
+def test_warm_up_preloads_recent_groups(group_provider, group_names):
+    """
+    arrange: given a group provider with groups, the second one seen most recently
+    act: warm up the group provider allowing a single group, then drop all references to it
+    assert: the most recently seen group is interned with its id and kept
+    """
+    recent = DBGroup.query.filter_by(name=group_names[1]).one()
+    recent.last_seen_at = datetime.now(timezone.utc) + timedelta(days=1)
+    # pylint: disable-next=no-member
+    db.session.commit()
+
+    with patch("flask_multipass_saml_groups.group_provider.sql.WARM_UP_MAX_GROUPS", 1):
+        assert group_provider.warm_up(time.monotonic() + 10) == 1
+    gc.collect()
+
+    with patch.object(SQLGroup, "_resolve_group_id") as resolve:
+        assert group_provider.make_group(group_names[1]).group_id == recent.id
+        assert group_provider.make_group(group_names[0]).group_id is None
+    resolve.assert_not_called()
+
+
+def test_warm_up_stops_at_deadline(group_provider):
+    """
+    arrange: given a group provider with groups
+    act: warm up the group provider with a deadline in the past
+    assert: no group is preloaded
+    """
+    assert group_provider.warm_up(time.monotonic()) == 0
+
+
+def test_fill_pool(tmp_path):
+    """
+    arrange: given an engine with a pool of 3 connections, one of them in use
+    act: fill the pool twice, then with a deadline in the past
+    assert: the connections not in use are opened once and returned to the pool
+    """
+    engine = create_engine(f"sqlite:///{tmp_path}/pool.db", poolclass=QueuePool, pool_size=3)
+    connects = []
+    event.listen(engine, "connect", lambda *_: connects.append(1))
+
+    with engine.connect():
+        assert fill_pool(engine, time.monotonic() + 10) == 2
+        assert fill_pool(engine, time.monotonic() + 10) == 2
+        assert fill_pool(engine, time.monotonic()) == 0
+
+        assert len(connects) == 3
+        assert engine.pool.checkedin() == 2
+
+
 def test_get_group_not_found(group_provider):
     """
     arrange: given a GroupProvider instance
@@ -280,3 +373,628 @@ def test_remove_group_member_group_non_existing(group_provider, user_identifiers
 
     grp = group_provider.get_group(NOT_EXISTING_GRP_NAME)
     assert not grp
+
+
+@pytest.fixture(name="coalescing_group_provider")
+def coalescing_group_provider_fixture(app, group_provider):
+    """Setup a group provider with write coalescing on the same database as group_provider."""
+    # pylint: disable=protected-access
+    multipass = group_provider._identity_provider.multipass
+    with app.app_context():
+        yield SQLGroupProvider(
+            identity_provider=IdentityProvider(
+                multipass=multipass, name="saml_groups", settings={"write_coalescing_ms": 1}
+            ),
+        )
+
+
+def test_init_with_wrong_write_coalescing_setting_raises_value_error(app):
+    """
+    arrange: given wrong write_coalescing_ms settings
+    act: create a SQLGroupProvider with the settings
+    assert: a ValueError is raised
+    """
+    multipass = Multipass(app=app)
+
+    with app.app_context():
+        for wrong_setting in ["not a number", -1]:
+            identity_provider = IdentityProvider(
+                multipass=multipass,
+                name="saml_groups",
+                settings={"write_coalescing_ms": wrong_setting},
+            )
+            with pytest.raises(ValueError):
+                SQLGroupProvider(identity_provider=identity_provider)
+
+
+@pytest.mark.parametrize(
+    "settings",
+    [
+        {"read_replica_uri": 1},
+        {"read_replica_uri": "sqlite://", "read_replica_pinning": "not a number"},
+        {"read_replica_uri": "sqlite://", "read_replica_pinning": -1},
+    ],
+)
+def test_init_with_wrong_read_replica_settings_raises_value_error(app, settings):
+    """
+    arrange: given wrong read replica settings
+    act: create a SQLGroupProvider with the settings
+    assert: a ValueError is raised
+    """
+    multipass = Multipass(app=app)
+
+    with app.app_context():
+        identity_provider = IdentityProvider(
+            multipass=multipass, name="saml_groups", settings=settings
+        )
+        with pytest.raises(ValueError):
+            SQLGroupProvider(identity_provider=identity_provider)
+
+
+@pytest.mark.parametrize("provider_fixture", ["group_provider", "coalescing_group_provider"])
+def test_sync_user_groups(request, provider_fixture, user_identifiers, group_names):
+    """
+    arrange: given a user who belongs to the first group
+    act: call sync_user_groups with the second and a new group
+    assert: the user belongs exactly to the second and the new group
+    """
+    provider = request.getfixturevalue(provider_fixture)
+    user_identifier = user_identifiers[0]
+    assert [g.name for g in provider.get_user_groups(user_identifier)] == [group_names[0]]
+
+    provider.sync_user_groups(user_identifier, [group_names[1], NOT_EXISTING_GRP_NAME])
+
+    grps = provider.get_user_groups(user_identifier)
+    assert {g.name for g in grps} == {group_names[1], NOT_EXISTING_GRP_NAME}
+    assert not list(provider.get_group(group_names[0]).get_members())
+    members = list(provider.get_group(NOT_EXISTING_GRP_NAME).get_members())
+    assert [m.identifier for m in members] == [user_identifier]
+
+
+@pytest.mark.parametrize(
+    "expression, expected",
+    [
+        pytest.param({"all_of": ["A", "B"], "none_of": ["C"]}, ["user1"], id="A and B not C"),
+        pytest.param({"any_of": ["B", "C"]}, ["user1", "user2", "user3"], id="B or C"),
+        pytest.param(
+            {"all_of": ["A"], "any_of": ["B", "C"], "none_of": ["D"]},
+            ["user1", "user2"],
+            id="A and (B or C) not D",
+        ),
+        pytest.param({"all_of": ["A", "missing"]}, [], id="missing group"),
+    ],
+)
+def test_find_member_identifiers(app, group_provider, expression, expected):
+    """
+    arrange: given users in overlapping groups
+    act: call find_member_identifiers with a set expression and the implementation of the base
+        class intersecting the members in Python
+    assert: both return the sorted identifiers of the members matching the expression
+    """
+    with app.app_context():
+        with db.engine.begin() as connection:
+            insert_memberships(connection, PROVIDER, OVERLAPPING_MEMBERSHIPS)
+
+        identifiers = group_provider.find_member_identifiers(**expression)
+        base_identifiers = GroupProvider.find_member_identifiers(group_provider, **expression)
+
+        assert list(identifiers) == expected
+        assert list(base_identifiers) == expected
+
+
+def test_find_member_identifiers_without_positive_groups_raises_value_error(group_provider):
+    """
+    arrange: given a group provider
+    act: call find_member_identifiers with only none_of
+    assert: a ValueError is raised before the iterator is consumed
+    """
+    with pytest.raises(ValueError):
+        group_provider.find_member_identifiers(none_of=["C"])
+
+
+def test_get_membership_changes(group_provider, user_identifiers, group_names):
+    """
+    arrange: given a user whose groups are synced and who is then removed from a group
+    act: call get_membership_changes after no change, after the first change and with a limit
+    assert: the changes after the given sequence number are returned in order
+    """
+    user_identifier = user_identifiers[1]
+    group_provider.sync_user_groups(user_identifier, group_names)
+    group_provider.remove_group_member(user_identifier, group_names[0])
+
+    changes = group_provider.get_membership_changes()
+
+    assert [(c.sequence, c.action, c.group_name) for c in changes] == [
+        (1, ADD, min(group_names)),
+        (2, ADD, max(group_names)),
+        (3, REMOVE, group_names[0]),
+    ]
+    assert {c.identifier for c in changes} == {user_identifier}
+    assert group_provider.get_membership_changes(since=1, limit=1) == changes[1:2]
+    assert not group_provider.get_membership_changes(since=3)
+
+
+def test_get_groups_with_counts(group_provider, user_identifiers):
+    """
+    arrange: given users whose groups are synced
+    act: call get_groups_with_counts ordered by size with a limit
+    assert: the largest groups are returned by decreasing number of synced members
+    """
+    group_provider.sync_user_groups(user_identifiers[0], ["large"])
+    group_provider.sync_user_groups(user_identifiers[1], ["large", "small"])
+
+    counts = group_provider.get_groups_with_counts(by_size=True, limit=2)
+
+    assert counts == [("large", 2), ("small", 1)]
+
+
+def test_identity_attributes(group_provider, user_identifiers):
+    """
+    arrange: given a user whose attributes are stored and a user without stored attributes
+    act: get the attributes of the users and of a user which does not exist, and search them
+    assert: the stored attributes are returned and found, empty attributes for the user without
+        stored attributes and None for the user which does not exist
+    """
+    attributes = {
+        "first_name": "Alice",
+        "last_name": "Smith",
+        "email": "alice@example.com",
+        "affiliation": "ACME",
+    }
+    group_provider.set_identity_attributes(user_identifiers[0], attributes)
+
+    assert group_provider.get_identity_attributes(user_identifiers[0]) == attributes
+    assert group_provider.get_identity_attributes(user_identifiers[1]) == dict.fromkeys(attributes)
+    assert group_provider.get_identity_attributes("unknown") is None
+    assert group_provider.search_identity_attributes({"email": {"ALICE"}}, limit=10) == (
+        [(user_identifiers[0], attributes)],
+        1,
+    )
+    assert group_provider.search_identity_attributes({"email": {"alice"}}, exact=True) == ([], 0)
+
+
+@pytest.mark.parametrize(
+    "provider_fixture, module",
+    [("group_provider", "sql"), ("coalescing_group_provider", "coalescing")],
+)
+def test_sync_user_groups_stores_attributes_in_same_transaction(request, provider_fixture, module):
+    """
+    arrange: given a group provider whose write of the memberships fails once
+    act: sync the groups of a new user with attributes twice
+    assert: the failed sync stores neither the groups nor the attributes, the second sync
+        stores both
+    """
+    provider = request.getfixturevalue(provider_fixture)
+    attributes = {"first_name": "Alice", "last_name": None, "email": None, "affiliation": None}
+    target = f"flask_multipass_saml_groups.group_provider.{module}.sync_memberships"
+
+    with patch(target, side_effect=RuntimeError("write failed")):
+        with pytest.raises(RuntimeError):
+            provider.sync_user_groups("user9", ["grp1"], attributes)
+    assert provider.get_identity_attributes("user9") is None
+
+    provider.sync_user_groups("user9", ["grp1"], attributes)
+
+    assert provider.get_identity_attributes("user9") == attributes
+    assert [g.name for g in provider.get_user_groups("user9")] == ["grp1"]
+
+
+def test_sync_user_groups_concurrently(file_app):
+    """
+    arrange: given a group provider on a database supporting concurrent connections
+    act: sync the same user concurrently from many threads with different group sets, widening
+        the window between reading and writing the memberships
+    assert: no sync fails and the user ends up with exactly one of the asserted group sets
+    """
+    with file_app.app_context():
+        group_provider = SQLGroupProvider(
+            identity_provider=IdentityProvider(
+                multipass=Multipass(app=file_app), name="saml_groups", settings={}
+            ),
+        )
+    group_sets = [[f"grp{i}", f"grp{i + 1}", "common"] for i in range(8)]
+    barrier = Barrier(len(group_sets))
+    errors = []
+
+    def _login(group_names):
+        barrier.wait()
+        with file_app.app_context():
+            try:
+                group_provider.sync_user_groups("user", group_names)
+            except Exception as exc:  # pylint: disable=broad-exception-caught
+                errors.append(exc)
+
+    def _slow_get_sync_state(*args, **kwargs):
+        state = get_sync_state(*args, **kwargs)
+        sleep(0.01)
+        return state
+
+    threads = [Thread(target=_login, args=(group_names,)) for group_names in group_sets]
+    with patch(
+        "flask_multipass_saml_groups.group_provider.bulk.get_sync_state",
+        side_effect=_slow_get_sync_state,
+    ):
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert not errors
+    with file_app.app_context():
+        group_names = {g.name for g in group_provider.get_user_groups("user")}
+    assert group_names in [set(group_set) for group_set in group_sets]
+
+
+def test_writes_do_not_affect_indico_session(file_app):
+    """
+    arrange: given Indico's session with a pending object and a flushed but uncommitted row
+    act: write groups and memberships with the group provider
+    assert: the writes are committed, while the state of Indico's session is neither flushed
+        nor committed and can still be rolled back
+    """
+    # pylint does not recognize the methods of db.session, which is a proxy object
+    # pylint: disable=no-member
+    with file_app.app_context():
+        group_provider = SQLGroupProvider(
+            identity_provider=IdentityProvider(
+                multipass=Multipass(app=file_app), name="saml_groups", settings={}
+            ),
+        )
+        db.session.execute("CREATE TABLE indico_state (value TEXT)")
+        db.session.commit()
+        db.session.execute("INSERT INTO indico_state VALUES ('uncommitted')")
+        pending = DBGroup(provider=PROVIDER, name="pending")
+        db.session.add(pending)
+
+        group_provider.sync_user_groups("user1", ["grp1", "grp2"])
+        group_provider.add_group_member("user2", "grp1")
+        group_provider.remove_group_member("user1", "grp2")
+        group_provider.add_group("grp3")
+
+        assert pending in db.session.new
+        with db.engine.connect() as connection:
+            assert not connection.execute(text("SELECT * FROM indico_state")).all()
+            group_names = connection.execute(select(DBGroup.__table__.c.name)).scalars().all()
+            assert set(group_names) == {"grp1", "grp2", "grp3"}
+        db.session.rollback()
+        assert not db.session.execute(text("SELECT * FROM indico_state")).all()
+        group = group_provider.get_group("grp1")
+        assert group is not None
+        assert {m.identifier for m in group.get_members()} == {"user1", "user2"}
+        group = group_provider.get_group("grp2")
+        assert group is not None
+        assert not list(group.get_members())
+        assert not group_provider.get_group("pending")
+
+
+def test_writes_expire_loaded_plugin_objects(group_provider, user_identifiers, group_names):
+    """
+    arrange: given a user and its groups loaded in Indico's session
+    act: sync the groups of the user
+    assert: the loaded user reflects the new groups
+    """
+    user = SAMLUser.query.filter_by(identifier=user_identifiers[0]).one()
+    assert [g.name for g in user.groups] == [group_names[0]]
+
+    group_provider.sync_user_groups(user_identifiers[0], [group_names[1]])
+
+    assert [g.name for g in user.groups] == [group_names[1]]
+
+
+@pytest.fixture(name="replica_group_provider")
+def replica_group_provider_fixture(file_app, tmp_path, request):
+    """Setup a group provider reading from a replica which lags behind the primary.
+
+    user1 is a member of primary_grp on the primary and of replica_grp on the replica. The
+    settings of the provider can be overridden by indirect parametrization.
+    """
+    replica_dir = tmp_path / "replica"
+    replica_dir.mkdir()
+    settings = {"read_replica_uri": f"sqlite:///{replica_dir}/indico.db"}
+    settings.update(getattr(request, "param", {}))
+    file_app.secret_key = "secret"
+    with file_app.app_context():
+        group_provider = SQLGroupProvider(
+            identity_provider=IdentityProvider(
+                multipass=Multipass(app=file_app), name="saml_groups", settings=settings
+            ),
+        )
+        # pylint: disable-next=protected-access
+        replica_engine = group_provider._options.router.engine
+        assert replica_engine is not None
+        attach_plugin_db(replica_engine, replica_dir / "plugin_saml_groups.db")
+        with replica_engine.begin() as connection:
+            create_plugin_tables(connection.execute)
+            insert_memberships(connection, PROVIDER, [("user1", "replica_grp")])
+        with db.engine.begin() as connection:
+            insert_memberships(connection, PROVIDER, [("user1", "primary_grp")])
+
+        yield group_provider
+
+
+def test_reads_go_to_replica(replica_group_provider):
+    """
+    arrange: given a group provider with a replica
+    act: read groups and memberships
+    assert: the replica's state is returned
+    """
+    assert [g.name for g in replica_group_provider.get_groups()] == ["replica_grp"]
+    assert not replica_group_provider.get_group("primary_grp")
+    groups = list(replica_group_provider.get_user_groups("user1"))
+    assert [g.name for g in groups] == ["replica_grp"]
+    assert [m.identifier for m in groups[0].get_members()] == ["user1"]
+    assert groups[0].has_member("user1")
+
+
+def test_reads_of_synced_user_are_pinned_to_primary(replica_group_provider):
+    """
+    arrange: given a group provider with a replica
+    act: sync the groups of a user outside of a request
+    assert: the reads concerning the synced user go to the primary, all other reads go to the
+        replica
+    """
+    replica_group_provider.sync_user_groups("user2", ["primary_grp"])
+
+    groups = list(replica_group_provider.get_user_groups("user2"))
+    assert [g.name for g in groups] == ["primary_grp"]
+    assert groups[0].has_member("user2")
+    assert not groups[0].has_member("user1")
+    assert [m.identifier for m in groups[0].get_members()] == []
+    assert [g.name for g in replica_group_provider.get_user_groups("user1")] == ["replica_grp"]
+
+
+def test_reads_of_request_which_wrote_are_pinned_to_primary(file_app, replica_group_provider):
+    """
+    arrange: given a group provider with a replica
+    act: sync the groups of a user within a request and read in a later request of the same
+        session
+    assert: all reads of the session go to the primary
+    """
+    with file_app.test_request_context():
+        replica_group_provider.sync_user_groups("user2", ["primary_grp"])
+        session_state = dict(session)
+
+    with file_app.test_request_context():
+        session.update(session_state)
+        assert [g.name for g in replica_group_provider.get_groups()] == ["primary_grp"]
+        members = replica_group_provider.get_group("primary_grp").get_members()
+        assert {m.identifier for m in members} == {"user1", "user2"}
+
+    with file_app.test_request_context():
+        assert [g.name for g in replica_group_provider.get_groups()] == ["replica_grp"]
+
+
+def test_warm_up_with_replica(replica_group_provider):
+    """
+    arrange: given a group provider with a replica
+    act: warm up the group provider
+    assert: the pools of both databases are filled and the groups of the primary are preloaded
+    """
+    with patch("flask_multipass_saml_groups.group_provider.sql.fill_pool") as fill_pool_mock:
+        assert replica_group_provider.warm_up(time.monotonic() + 10) == 1
+
+    # pylint: disable-next=protected-access
+    engines = [db.engine, replica_group_provider._options.router.engine]
+    assert [c.args[0] for c in fill_pool_mock.call_args_list] == engines
+
+
+@pytest.mark.parametrize("replica_group_provider", [{"read_replica_pinning": 0}], indirect=True)
+def test_reads_are_not_pinned_after_window(file_app, replica_group_provider):
+    """
+    arrange: given a group provider with a replica and no pin window
+    act: sync the groups of a user within a request
+    assert: the reads of the user go to the replica
+    """
+    with file_app.test_request_context():
+        replica_group_provider.sync_user_groups("user1", ["primary_grp"])
+
+        groups = replica_group_provider.get_user_groups("user1")
+        assert [g.name for g in groups] == ["replica_grp"]
+
+
+@pytest.fixture(name="denormalized_group_provider")
+def denormalized_group_provider_fixture(app):
+    """Setup a group provider reading the denormalized group names.
+
+    user1 is a member of grp1 and grp2, user2 of grp2.
+    """
+    with app.app_context():
+        group_provider = SQLGroupProvider(
+            identity_provider=IdentityProvider(
+                multipass=Multipass(app=app),
+                name="saml_groups",
+                settings={"denormalized_group_names": True},
+            ),
+        )
+        group_provider.sync_user_groups("user1", ["grp2", "grp1"])
+        group_provider.sync_user_groups("user2", ["grp2"])
+
+        yield group_provider
+
+
+def test_denormalized_reads(denormalized_group_provider):
+    """
+    arrange: given a group provider reading the denormalized group names
+    act: read the groups and the memberships of the users
+    assert: the groups and memberships match the synced groups
+    """
+    groups = denormalized_group_provider.get_user_groups("user1")
+    assert [g.name for g in groups] == ["grp1", "grp2"]
+    assert not list(denormalized_group_provider.get_user_groups("user3"))
+    grp1 = denormalized_group_provider.get_group("grp1")
+    assert grp1.has_member("user1")
+    assert not grp1.has_member("user2")
+    assert not grp1.has_member("user3")
+    members = denormalized_group_provider.get_group("grp2").get_members()
+    assert {m.identifier for m in members} == {"user1", "user2"}
+
+
+def test_denormalized_reads_use_group_names(denormalized_group_provider):
+    """
+    arrange: given a group provider reading the denormalized group names and a user whose
+        group names differ from the memberships
+    act: read the groups and the memberships of the user
+    assert: the group names are used
+    """
+    with db.engine.begin() as connection:
+        connection.execute(
+            SAMLUser.__table__.update()
+            .where(SAMLUser.__table__.c.identifier == "user2")
+            .values(group_names=["grp3"])
+        )
+
+    assert [g.name for g in denormalized_group_provider.get_user_groups("user2")] == ["grp3"]
+    assert denormalized_group_provider.make_group("grp3").has_member("user2")
+
+
+def test_denormalized_reads_fall_back_to_memberships(denormalized_group_provider):
+    """
+    arrange: given a group provider reading the denormalized group names and a user whose
+        group names have not been computed
+    act: read the groups and the memberships of the user
+    assert: the memberships are used
+    """
+    with db.engine.begin() as connection:
+        connection.execute(SAMLUser.__table__.update().values(group_names=None))
+
+    assert [g.name for g in denormalized_group_provider.get_user_groups("user2")] == ["grp2"]
+    assert denormalized_group_provider.make_group("grp2").has_member("user2")
+    assert not denormalized_group_provider.make_group("grp1").has_member("user2")
+
+
+def test_group_names_are_only_written_if_denormalized(app, group_provider):
+    """
+    arrange: given a group provider without and one with denormalized group names
+    act: sync a user with each of them, then sync the second user with the first provider
+    assert: only the provider reading the group names writes them, the other one clears them
+    """
+    # pylint: disable-next=protected-access
+    multipass = group_provider._identity_provider.multipass
+    with app.app_context():
+        denormalized_group_provider = SQLGroupProvider(
+            identity_provider=IdentityProvider(
+                multipass=multipass,
+                name="saml_groups",
+                settings={"denormalized_group_names": True},
+            ),
+        )
+        group_provider.sync_user_groups("user3", ["grp1"])
+        denormalized_group_provider.sync_user_groups("user4", ["grp1"])
+        written = {u.identifier: u.group_names for u in SAMLUser.query.all()}
+        group_provider.sync_user_groups("user4", ["grp2"])
+        cleared = SAMLUser.query.filter_by(identifier="user4").one().group_names
+        groups = [g.name for g in denormalized_group_provider.get_user_groups("user4")]
+
+    assert (written["user3"], written["user4"]) == (None, ["grp1"])
+    assert (cleared, groups) == (None, ["grp2"])
+
+
+def test_changes_are_not_logged_by_default(app, group_provider):
+    """
+    arrange: given a group provider without the membership_change_log setting
+    act: sync the groups of a user
+    assert: the memberships are written but no change is appended to the change log
+    """
+    # pylint: disable-next=protected-access
+    multipass = group_provider._identity_provider.multipass
+    with app.app_context():
+        unlogged_group_provider = SQLGroupProvider(
+            identity_provider=IdentityProvider(
+                multipass=multipass, name="saml_groups", settings={}
+            ),
+        )
+        since = max((c.sequence for c in group_provider.get_membership_changes()), default=0)
+
+        unlogged_group_provider.sync_user_groups("user3", ["grp1"])
+
+        assert unlogged_group_provider.get_user_groups("user3")
+        assert not group_provider.get_membership_changes(since)
+
+
+@pytest.mark.parametrize("setting", ["denormalized_group_names", "membership_change_log"])
+def test_init_with_wrong_boolean_setting_raises_value_error(app, setting):
+    """
+    arrange: given a denormalized_group_names or membership_change_log setting which is not a
+        boolean
+    act: create a SQLGroupProvider with the setting
+    assert: a ValueError is raised
+    """
+    with app.app_context():
+        identity_provider = IdentityProvider(
+            multipass=Multipass(app=app),
+            name="saml_groups",
+            settings={setting: "yes"},
+        )
+        with pytest.raises(ValueError):
+            SQLGroupProvider(identity_provider=identity_provider)
+
+
+@pytest.fixture(name="hierarchical_group_provider", params=[False, True])
+def hierarchical_group_provider_fixture(app, request):
+    """Setup a group provider with hierarchical groups, reading the denormalized names or not.
+
+    user1 is a member of eng/platform/sre, user2 of eng/web and user3 of ops.
+    """
+    with app.app_context():
+        group_provider = SQLGroupProvider(
+            identity_provider=IdentityProvider(
+                multipass=Multipass(app=app),
+                name="saml_groups",
+                settings={
+                    "group_hierarchy_separator": "/",
+                    "denormalized_group_names": request.param,
+                },
+            ),
+        )
+        group_provider.sync_user_groups("user1", ["eng/platform/sre"])
+        group_provider.sync_user_groups("user2", ["eng/web"])
+        group_provider.sync_user_groups("user3", ["ops"])
+
+        yield group_provider
+
+
+def test_hierarchical_reads(hierarchical_group_provider):
+    """
+    arrange: given a group provider with hierarchical groups
+    act: read the groups and the members of the ancestors of the synced groups
+    assert: the ancestors exist and their members include those of their descendants
+    """
+    provider = hierarchical_group_provider
+    assert {g.name for g in provider.get_groups()} == {
+        "eng",
+        "eng/platform",
+        "eng/platform/sre",
+        "eng/web",
+        "ops",
+    }
+    groups = provider.get_user_groups("user1")
+    assert [g.name for g in groups] == ["eng", "eng/platform", "eng/platform/sre"]
+    eng = provider.get_group("eng")
+    assert eng.has_member("user1")
+    assert eng.has_member("user2")
+    assert not eng.has_member("user3")
+    assert not provider.get_group("eng/platform").has_member("user2")
+    assert {m.identifier for m in eng.get_members()} == {"user1", "user2"}
+    members = provider.get_group("eng/platform").get_members()
+    assert [m.identifier for m in members] == ["user1"]
+    found = provider.find_member_identifiers(any_of=["eng", "ops"], none_of=["eng/platform"])
+    assert list(found) == ["user2", "user3"]
+
+
+def test_init_with_wrong_group_hierarchy_separator_setting_raises_value_error(app):
+    """
+    arrange: given group_hierarchy_separator settings which are not non-empty strings
+    act: create a SQLGroupProvider with each setting
+    assert: a ValueError is raised
+    """
+    multipass = Multipass(app=app)
+
+    with app.app_context():
+        for wrong_setting in ["", 1]:
+            identity_provider = IdentityProvider(
+                multipass=multipass,
+                name="saml_groups",
+                settings={"group_hierarchy_separator": wrong_setting},
+            )
+            with pytest.raises(ValueError):
+                SQLGroupProvider(identity_provider=identity_provider)
@@ -0,0 +1,169 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+"""Unit tests for the reconciliation with an export of the identity provider."""
+
+import io
+from collections import Counter
+from datetime import timedelta
+
+import pytest
+from indico.core.db import db
+from indico.util.date_time import now_utc
+
+from flask_multipass_saml_groups.group_provider.bulk import insert_memberships
+from flask_multipass_saml_groups.group_provider.reconcile import (
+    ReconcileOptions,
+    diff_user_groups,
+    read_directory,
+    reconcile_memberships,
+    stream_user_groups,
+)
+from flask_multipass_saml_groups.models.saml_groups import SAMLUser
+from tests.common import PROVIDER
+
+
+@pytest.mark.parametrize(
+    "format_, content",
+    [
+        (
+            "jsonl",
+            '{"identifier": "user1", "groups": ["grp1", "grp2"]}\n'
+            '{"identifier": "user2", "groups": []}\n',
+        ),
+        ("csv", "identifier,group\nuser1,grp1\nuser1,grp2\nuser2,\n"),
+    ],
+)
+def test_read_directory(format_, content):
+    """
+    arrange: given an export with a user with groups and a user without groups
+    act: read the export
+    assert: the users and their groups are returned in order
+    """
+    users = list(read_directory(io.StringIO(content), format_))
+
+    assert users == [("user1", {"grp1", "grp2"}), ("user2", set())]
+
+
+@pytest.mark.parametrize(
+    "format_, content",
+    [
+        ("jsonl", '{"identifier": "user2", "groups": []}\n{"identifier": "user1", "groups": []}'),
+        ("jsonl", '{"identifier": "user1", "groups": "grp1"}\n'),
+        ("csv", "identifier,group\nuser1,grp1\nuser2,grp1\nuser1,grp2\n"),
+        ("csv", "identifier,group\n,grp1\n"),
+        ("xml", ""),
+    ],
+)
+def test_read_invalid_directory_raises_value_error(format_, content):
+    """
+    arrange: given an unsorted or invalid export or an unsupported format
+    act: read the export
+    assert: a ValueError is raised
+    """
+    with pytest.raises(ValueError):
+        list(read_directory(io.StringIO(content), format_))
+
+
+def test_diff_user_groups():
+    """
+    arrange: given stored users and an export which overlap partially
+    act: merge-join them
+    assert: the users whose groups differ are returned with the groups of the export and the
+        summary counts the differences
+    """
+    stored = [
+        ("user2", {"grp1"}),
+        ("user3", {"grp1", "grp2"}),
+        ("user5", {"grp1"}),
+        ("user6", set()),
+    ]
+    directory = [
+        ("user1", {"grp1"}),
+        ("user3", {"grp2", "grp3"}),
+        ("user4", {"grp1"}),
+        ("user5", {"grp1"}),
+        ("user7", {"grp1"}),
+        ("user8", {"grp1"}),
+    ]
+    summary: Counter = Counter()
+
+    changes = list(diff_user_groups(iter(stored), iter(directory), summary))
+
+    assert changes == [("user2", set()), ("user3", {"grp2", "grp3"})]
+    assert summary == {
+        "users_compared": 4,
+        "users_changed": 2,
+        "users_not_stored": 4,
+        "memberships_added": 1,
+        "memberships_removed": 2,
+    }
+
+
+def test_stream_user_groups_sorts_by_code_point(app):
+    """
+    arrange: given users whose identifiers sort differently by code point and by locale
+    act: stream the groups of the stored users
+    assert: the users are returned in code point order with their groups
+    """
+    with app.app_context():
+        with db.engine.begin() as connection:
+            insert_memberships(
+                connection, PROVIDER, [("b", "grp1"), ("B", "grp1"), ("a", "grp2"), ("a", "grp1")]
+            )
+            connection.execute(
+                SAMLUser.__table__.insert().values(provider=PROVIDER, identifier="é")
+            )
+
+        with db.engine.connect() as connection:
+            users = list(stream_user_groups(connection, PROVIDER, batch_size=2))
+
+    assert users == [("B", {"grp1"}), ("a", {"grp1", "grp2"}), ("b", {"grp1"}), ("é", set())]
+
+
+@pytest.mark.parametrize("dry_run", [False, True])
+def test_reconcile_memberships(file_app, dry_run):
+    """
+    arrange: given stored users last seen two days ago and an export differing from them
+    act: reconcile the memberships in batches of one user
+    assert: the differences are applied unless it is a dry run, the last_seen_at of the users
+        is unchanged and the summary counts the differences
+    """
+    two_days_ago = now_utc() - timedelta(days=2)
+    with file_app.app_context():
+        with db.engine.begin() as connection:
+            insert_memberships(
+                connection, PROVIDER, [("user1", "grp1"), ("user2", "grp1"), ("user3", "grp1")]
+            )
+            connection.execute(SAMLUser.__table__.update().values(last_seen_at=two_days_ago))
+        directory = [("user1", {"grp1"}), ("user2", {"grp2"}), ("user4", {"grp1"})]
+
+        summary = reconcile_memberships(
+            db.engine,
+            PROVIDER,
+            iter(directory),
+            options=ReconcileOptions(batch_size=1, dry_run=dry_run),
+        )
+
+        users = {
+            u.identifier: ({g.name for g in u.groups}, u.last_seen_at) for u in SAMLUser.query
+        }
+    assert summary == {
+        "users_compared": 3,
+        "users_changed": 2,
+        "users_not_stored": 1,
+        "memberships_added": 1,
+        "memberships_removed": 2,
+    }
+    if dry_run:
+        assert {i: groups for i, (groups, _) in users.items()} == {
+            "user1": {"grp1"},
+            "user2": {"grp1"},
+            "user3": {"grp1"},
+        }
+    else:
+        assert users == {
+            "user1": ({"grp1"}, two_days_ago),
+            "user2": ({"grp2"}, two_days_ago),
+            "user3": (set(), two_days_ago),
+        }
@@ -0,0 +1,60 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+"""Unit tests for the set algebra over the members of groups."""
+
+from sqlalchemy.dialects import postgresql
+
+from flask_multipass_saml_groups.group_provider.setops import select_member_identifiers
+from tests.common import PROVIDER
+
+
+def test_select_member_identifiers_uses_set_operations():
+    """
+    arrange: given an expression with groups in all_of, any_of and none_of
+    act: compile the query
+    assert: the user ids of the groups are combined by INTERSECT, UNION and EXCEPT
+    """
+    query = select_member_identifiers(PROVIDER, ({"A", "B"}, {"C", "D"}, {"E"}))
+
+    sql = str(query.compile(dialect=postgresql.dialect()))
+
+    assert sql.count("INTERSECT") == 2
+    assert sql.count("UNION") == 1
+    assert sql.count("EXCEPT") == 1
+
+
+def test_select_member_identifiers_on_denormalized_group_names():
+    """
+    arrange: given an expression with groups in all_of, any_of and none_of
+    act: compile the query on the denormalized group names for PostgreSQL
+    assert: the expression is compiled to the array operators served by the GIN index, and to
+        the set operations for the users whose group names have not been computed
+    """
+    query = select_member_identifiers(PROVIDER, ({"A", "B"}, {"C"}, {"E"}), denormalized=True)
+
+    compiled = query.compile(dialect=postgresql.dialect())
+
+    assert "group_names @> " in str(compiled)
+    assert "group_names && " in str(compiled)
+    assert "NOT plugin_saml_groups.saml_users.group_names && " in str(compiled)
+    assert "group_names IS NULL" in str(compiled)
+    assert "EXCEPT" in str(compiled)
+    group_names = [v for v in compiled.params.values() if isinstance(v, list)]
+    assert sorted(group_names) == [["A", "B"], ["C"], ["E"]]
+
+
+def test_select_member_identifiers_of_hierarchical_groups():
+    """
+    arrange: given an expression with groups in all_of and none_of
+    act: compile the query for hierarchical groups, with the denormalized group names enabled
+    assert: the members of each group are read through the closure of the hierarchy
+    """
+    query = select_member_identifiers(
+        PROVIDER, ({"A"}, set(), {"B"}), denormalized=True, hierarchical=True
+    )
+
+    sql = str(query.compile(dialect=postgresql.dialect()))
+
+    assert sql.count("JOIN plugin_saml_groups.saml_group_ancestors") == 2
+    assert "@>" not in sql
@@ -0,0 +1,148 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+"""Unit tests for the export and import of memberships."""
+
+import io
+from unittest.mock import MagicMock
+
+import pytest
+from indico.core.db import db
+
+from flask_multipass_saml_groups.group_provider.bulk import (
+    get_group_ids,
+    get_groups_with_counts,
+    insert_memberships,
+)
+from flask_multipass_saml_groups.group_provider.transfer import (
+    export_memberships,
+    import_memberships,
+    read_memberships,
+    write_memberships,
+)
+from flask_multipass_saml_groups.models.saml_groups import SAMLUser, get_identifier_key
+from tests.common import PROVIDER
+
+MEMBERSHIPS = [
+    ("empty", None),
+    ("grp 1", 'user,1\n"quoted"'),
+    ("grp 1", "user2"),
+    ("grp,2", "user2"),
+]
+
+
+def test_export_memberships(app):
+    """
+    arrange: given groups with and without members
+    act: export the memberships
+    assert: all groups and members are returned, ordered by group name and identifier
+    """
+    with app.app_context():
+        with db.engine.begin() as connection:
+            insert_memberships(
+                connection, PROVIDER, [(i, n) for n, i in reversed(MEMBERSHIPS) if i is not None]
+            )
+            get_group_ids(connection, PROVIDER, ["empty"])
+
+        with db.engine.connect() as connection:
+            memberships = list(export_memberships(connection, PROVIDER, batch_size=2))
+
+    assert memberships == MEMBERSHIPS
+
+
+@pytest.mark.parametrize("format_", ["jsonl", "csv"])
+def test_write_and_read_memberships(format_):
+    """
+    arrange: given memberships with special characters and a group without members
+    act: write the memberships to a file and read them back
+    assert: the same memberships are read
+    """
+    file = io.StringIO()
+
+    count = write_memberships(iter(MEMBERSHIPS), file, format_)
+    file.seek(0)
+
+    assert count == len(MEMBERSHIPS)
+    assert list(read_memberships(file, format_)) == MEMBERSHIPS
+
+
+@pytest.mark.parametrize(
+    "format_, content",
+    [
+        ("jsonl", '{"identifier": "user1"}\n'),
+        ("jsonl", '{"group": "grp1", "identifier": 1}\n'),
+        ("csv", "group,identifier\n,user1\n"),
+    ],
+)
+def test_read_invalid_memberships_raises_value_error(format_, content):
+    """
+    arrange: given a file with an invalid record
+    act: read the memberships
+    assert: a ValueError is raised
+    """
+    with pytest.raises(ValueError):
+        list(read_memberships(io.StringIO(content), format_))
+
+
+def test_unsupported_format_raises_value_error():
+    """
+    arrange: given an unsupported format
+    act: write and read memberships in that format
+    assert: a ValueError is raised
+    """
+    with pytest.raises(ValueError):
+        write_memberships(iter(MEMBERSHIPS), io.StringIO(), "xml")
+    with pytest.raises(ValueError):
+        list(read_memberships(io.StringIO(), "xml"))
+
+
+def test_import_memberships(app):
+    """
+    arrange: given an existing membership
+    act: import memberships in batches smaller than their number
+    assert: the imported memberships are added to the existing one with their group names and
+        the member counts of the groups
+    """
+    with app.app_context():
+        with db.engine.begin() as connection:
+            insert_memberships(connection, PROVIDER, [("user2", "grp3")])
+
+        with db.engine.begin() as connection:
+            count = import_memberships(connection, PROVIDER, iter(MEMBERSHIPS), batch_size=3)
+
+        with db.engine.connect() as connection:
+            memberships = list(export_memberships(connection, PROVIDER))
+            counts = get_groups_with_counts(connection, PROVIDER)
+        group_names = {u.identifier: sorted(u.group_names) for u in SAMLUser.query.all()}
+
+    assert count == len(MEMBERSHIPS)
+    assert memberships == MEMBERSHIPS + [("grp3", "user2")]
+    assert group_names == {'user,1\n"quoted"': ["grp 1"], "user2": ["grp 1", "grp,2", "grp3"]}
+    assert counts == [("empty", 0), ("grp 1", 2), ("grp,2", 1), ("grp3", 1)]
+
+
+def test_import_memberships_on_postgresql():
+    """
+    arrange: given a connection to a PostgreSQL database
+    act: import memberships in batches smaller than their number
+    assert: the memberships are copied in batches into the staging table with the identifier
+        keys, which is merged into the plugin tables by set-based statements, the member counts
+        are updated and the added memberships are appended to the change log last
+    """
+    connection = MagicMock()
+    connection.dialect.name = "postgresql"
+    cursor = connection.connection.cursor.return_value.__enter__.return_value
+
+    count = import_memberships(connection, PROVIDER, iter(MEMBERSHIPS), batch_size=3)
+
+    copied = "".join(c.args[1].getvalue() for c in cursor.copy_expert.call_args_list)
+    statements = [str(c.args[0]).split()[0] for c in connection.execute.call_args_list]
+    assert count == len(MEMBERSHIPS)
+    assert cursor.copy_expert.call_count == 2
+    assert copied.startswith("empty,,\n")
+    assert f"grp,2\",user2,\\x{get_identifier_key('user2').hex()}" in copied
+    assert statements == (
+        ["CREATE", "ANALYZE", "INSERT", "INSERT", "CREATE", "WITH"]
+        + ["ANALYZE"] * 3
+        + ["UPDATE", "INSERT", "SELECT", "INSERT"]
+    )
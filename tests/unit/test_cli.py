@@ -0,0 +1,405 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+"""Unit tests for the command line commands."""
+
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
+from flask import Flask
+from indico.core.db import db
+from indico.util.date_time import now_utc
+
+from flask_multipass_saml_groups.cli import MIGRATIONS_PATH, _upgrade_database, cli
+from flask_multipass_saml_groups.group_provider.bulk import (
+    get_group_ids,
+    get_groups_with_counts,
+    insert_memberships,
+)
+from flask_multipass_saml_groups.group_provider.setops import select_member_identifiers
+from flask_multipass_saml_groups.group_provider.transfer import export_memberships
+from flask_multipass_saml_groups.migration_env import CONNECTION_ATTRIBUTE, SCHEMA_ATTRIBUTE
+from flask_multipass_saml_groups.models.saml_groups import SAMLGroup as DBGroup
+from flask_multipass_saml_groups.models.saml_groups import (
+    SAMLMembershipChange,
+    SAMLUser,
+    group_member_counts_table,
+)
+from tests.common import PROVIDER, setup_sqlite
+
+
+def test_repair_group_names():
+    """
+    arrange: given users whose group names are missing or wrong
+    act: run the repair-group-names command in batches smaller than the number of users
+    assert: the group names of all users match their memberships
+    """
+    app = Flask("test")
+    setup_sqlite(app)
+    with app.app_context():
+        with db.engine.begin() as connection:
+            insert_memberships(
+                connection, PROVIDER, [("user1", "grp2"), ("user1", "grp1"), ("user2", "grp1")]
+            )
+            insert_memberships(connection, PROVIDER, [("user3", "grp1")])
+            connection.execute(
+                SAMLUser.__table__.update()
+                .where(SAMLUser.__table__.c.identifier != "user3")
+                .values(group_names=None)
+            )
+            connection.execute(
+                SAMLUser.__table__.update()
+                .where(SAMLUser.__table__.c.identifier == "user3")
+                .values(group_names=["grp3"])
+            )
+
+        result = app.test_cli_runner().invoke(cli, ["repair-group-names", "--batch-size", "2"])
+
+        assert result.exit_code == 0, result.output
+        users = {u.identifier: sorted(u.group_names) for u in SAMLUser.query.all()}
+        assert users == {"user1": ["grp1", "grp2"], "user2": ["grp1"], "user3": ["grp1"]}
+
+
+def test_cleanup():
+    """
+    arrange: given users not seen for ten days, whose groups have not been seen either and whose
+        changes were written then, and a recently seen user
+    act: run the cleanup command for users, groups and changes older than a week in batches of
+        one
+    assert: the stale users, the groups they leave without members and the old changes are
+        deleted
+    """
+    app = Flask("test")
+    setup_sqlite(app)
+    ten_days_ago = now_utc() - timedelta(days=10)
+    with app.app_context():
+        with db.engine.begin() as connection:
+            insert_memberships(
+                connection, PROVIDER, [("user1", "grp1"), ("user2", "grp2"), ("user3", "grp1")]
+            )
+            for table in (SAMLUser.__table__, DBGroup.__table__):
+                connection.execute(table.update().values(last_seen_at=ten_days_ago))
+            connection.execute(
+                SAMLMembershipChange.__table__.update().values(changed_at=ten_days_ago)
+            )
+            insert_memberships(connection, PROVIDER, [("user4", "grp1")])
+
+        result = app.test_cli_runner().invoke(
+            cli,
+            [
+                "cleanup",
+                "--days",
+                "7",
+                "--batch-size",
+                "1",
+                "--pause",
+                "0",
+                "--change-days",
+                "7",
+            ],
+        )
+
+        assert result.exit_code == 0, result.output
+        assert "Deleted 3 users and 1 groups" in result.output
+        assert "Deleted 3 changes" in result.output
+        assert [u.identifier for u in SAMLUser.query.all()] == ["user4"]
+        assert [g.name for g in DBGroup.query.all()] == ["grp1"]
+
+
+def test_cleanup_deletes_orphaned_ancestors():
+    """
+    arrange: given hierarchical groups without members not seen for ten days
+    act: run the cleanup command in batches of one
+    assert: the descendants and the ancestors they leave without descendants are deleted in
+        the same run
+    """
+    app = Flask("test")
+    setup_sqlite(app)
+    with app.app_context():
+        with db.engine.begin() as connection:
+            get_group_ids(connection, PROVIDER, ["eng/platform/sre"], "/")
+            connection.execute(
+                DBGroup.__table__.update().values(last_seen_at=now_utc() - timedelta(days=10))
+            )
+
+        result = app.test_cli_runner().invoke(
+            cli, ["cleanup", "--days", "7", "--batch-size", "1", "--pause", "0"]
+        )
+
+        assert result.exit_code == 0, result.output
+        assert "Deleted 0 users and 3 groups" in result.output
+        assert not DBGroup.query.all()
+
+
+@pytest.mark.parametrize("format_", ["jsonl", "csv"])
+def test_export_and_import(tmp_path, format_):
+    """
+    arrange: given groups with and without members
+    act: export them to a file with the export command and import the file into an empty
+        database with the import command
+    assert: the imported groups and members equal the exported ones
+    """
+    export_file = tmp_path / f"memberships.{format_}"
+    source = Flask("source")
+    setup_sqlite(source)
+    with source.app_context():
+        with db.engine.begin() as connection:
+            insert_memberships(connection, PROVIDER, [("user1", "grp1"), ("user2", "grp1")])
+            get_group_ids(connection, PROVIDER, ["empty"])
+
+        result = source.test_cli_runner().invoke(
+            cli, ["export", "--provider", PROVIDER, "--format", format_, str(export_file)]
+        )
+
+        assert result.exit_code == 0, result.output
+        with db.engine.connect() as connection:
+            exported = list(export_memberships(connection, PROVIDER))
+
+    target = Flask("target")
+    setup_sqlite(target)
+    with target.app_context():
+        result = target.test_cli_runner().invoke(
+            cli,
+            [
+                "import",
+                "--provider",
+                PROVIDER,
+                "--format",
+                format_,
+                "--batch-size",
+                "2",
+                str(export_file),
+            ],
+        )
+
+        assert result.exit_code == 0, result.output
+        assert "Imported 3 records" in result.output
+        with db.engine.connect() as connection:
+            assert list(export_memberships(connection, PROVIDER)) == exported
+
+
+def test_reconcile(tmp_path):
+    """
+    arrange: given stored users and a csv export in which the groups of a user differ
+    act: run the reconcile command with the export
+    assert: the summary is printed and the groups of the user equal the export
+    """
+    export_file = tmp_path / "directory.csv"
+    export_file.write_text("identifier,group\nuser1,grp1\nuser2,grp2\n")
+    app = Flask("test")
+    setup_sqlite(app)
+    with app.app_context():
+        with db.engine.begin() as connection:
+            insert_memberships(connection, PROVIDER, [("user1", "grp1"), ("user2", "grp1")])
+
+        result = app.test_cli_runner().invoke(
+            cli,
+            [
+                "reconcile",
+                "--provider",
+                PROVIDER,
+                "--format",
+                "csv",
+                "--pause",
+                "0",
+                str(export_file),
+            ],
+        )
+
+        assert result.exit_code == 0, result.output
+        assert "users_changed: 1\n" in result.output
+        assert "memberships_added: 1\n" in result.output
+        assert [g.name for g in SAMLUser.query.filter_by(identifier="user2").one().groups] == [
+            "grp2"
+        ]
+
+
+def test_rebuild_group_hierarchy():
+    """
+    arrange: given hierarchical groups stored without hierarchy, and a group of another
+        identity provider
+    act: run the rebuild-group-hierarchy command in batches smaller than the number of groups
+    assert: the missing ancestors are created and every group is found below its ancestors,
+        the group of the other identity provider is left unchanged
+    """
+    app = Flask("test")
+    setup_sqlite(app)
+    with app.app_context():
+        with db.engine.begin() as connection:
+            insert_memberships(
+                connection, PROVIDER, [("user1", "eng/platform/sre"), ("user2", "eng/web")]
+            )
+            insert_memberships(connection, "other", [("user3", "eng/ops")])
+
+        result = app.test_cli_runner().invoke(
+            cli,
+            ["rebuild-group-hierarchy", "--provider", PROVIDER, "--separator", "/"]
+            + ["--batch-size", "1"],
+        )
+
+        assert result.exit_code == 0, result.output
+        members = select_member_identifiers(PROVIDER, ({"eng"}, set(), set()), hierarchical=True)
+        # pylint: disable-next=no-member
+        assert db.session.execute(members).scalars().all() == ["user1", "user2"]
+        assert {g.name for g in DBGroup.query.filter_by(provider=PROVIDER)} == {
+            "eng",
+            "eng/platform",
+            "eng/platform/sre",
+            "eng/web",
+        }
+        assert [g.name for g in DBGroup.query.filter_by(provider="other")] == ["eng/ops"]
+
+
+def test_rebuild_group_hierarchy_with_empty_separator():
+    """
+    arrange: given an empty database
+    act: run the rebuild-group-hierarchy command with an empty separator
+    assert: the command fails
+    """
+    app = Flask("test")
+    setup_sqlite(app)
+    with app.app_context():
+        result = app.test_cli_runner().invoke(
+            cli, ["rebuild-group-hierarchy", "--provider", PROVIDER, "--separator", ""]
+        )
+
+        assert result.exit_code != 0
+        assert "must not be empty" in result.output
+
+
+@pytest.mark.parametrize(
+    "identity_providers, exit_code",
+    [
+        pytest.param({"saml": {"type": "saml"}, PROVIDER: {"type": "saml_groups"}}, 0, id="one"),
+        pytest.param({}, 2, id="none"),
+        pytest.param({"a": {"type": "saml_groups"}, "b": {"type": "saml_groups"}}, 2, id="two"),
+    ],
+)
+def test_provider_defaults_to_the_configured_identity_provider(identity_providers, exit_code):
+    """
+    arrange: given configured identity providers and groups of the saml_groups provider
+    act: run the export command without --provider
+    assert: the groups of the only identity provider of the plugin are exported, the command
+        fails unless exactly one is configured
+    """
+    app = Flask("test")
+    setup_sqlite(app)
+    with app.app_context():
+        with db.engine.begin() as connection:
+            insert_memberships(connection, PROVIDER, [("user1", "grp1")])
+
+        with patch(
+            "flask_multipass_saml_groups.cli.config",
+            SimpleNamespace(IDENTITY_PROVIDERS=identity_providers),
+        ):
+            result = app.test_cli_runner().invoke(cli, ["export"])
+
+        assert result.exit_code == exit_code, result.output
+        if exit_code == 0:
+            assert '{"group": "grp1", "identifier": "user1"}' in result.output
+        else:
+            assert "--provider" in result.output
+
+
+def test_verify_member_counts():
+    """
+    arrange: given groups whose member counts are correct
+    act: run the verify-member-counts command, then again after breaking a count, then with
+        --rebuild
+    assert: the command succeeds for correct counts, fails and prints the wrong count otherwise,
+        and the rebuild repairs it
+    """
+    app = Flask("test")
+    setup_sqlite(app)
+    with app.app_context():
+        with db.engine.begin() as connection:
+            insert_memberships(connection, PROVIDER, [("user1", "grp1"), ("user2", "grp1")])
+        runner = app.test_cli_runner()
+
+        correct = runner.invoke(cli, ["verify-member-counts"])
+        with db.engine.begin() as connection:
+            connection.execute(group_member_counts_table.update().values(member_count=1))
+        wrong = runner.invoke(cli, ["verify-member-counts"])
+        rebuilt = runner.invoke(cli, ["verify-member-counts", "--rebuild"])
+
+        assert correct.exit_code == 0, correct.output
+        assert wrong.exit_code == 1
+        assert "grp1: 1 counted, 2 members" in wrong.output
+        assert rebuilt.exit_code == 0, rebuilt.output
+        assert "Rebuilt the member counts of 1 groups" in rebuilt.output
+        with db.engine.connect() as connection:
+            assert get_groups_with_counts(connection, PROVIDER) == [("grp1", 2)]
+
+
+def test_upgrade_shards():
+    """
+    arrange: given a sharded identity provider with two shards
+    act: run the upgrade-shards command
+    assert: the plugin migrations are run on the schema of each shard in turn
+    """
+    app = Flask("test")
+    shards = [{"uri": "postgresql:///shard0"}, {"uri": "postgresql:///shard1", "schema": "s1"}]
+
+    with (
+        app.app_context(),
+        patch(
+            "flask_multipass_saml_groups.cli.config",
+            SimpleNamespace(IDENTITY_PROVIDERS={PROVIDER: {"type": PROVIDER, "shards": shards}}),
+        ),
+        patch("flask_multipass_saml_groups.cli._upgrade_database") as upgrade,
+    ):
+        result = app.test_cli_runner().invoke(cli, ["upgrade-shards", "--revision", "abc"])
+
+    assert result.exit_code == 0, result.output
+    assert [c.args for c in upgrade.call_args_list] == [
+        ("postgresql:///shard0", "plugin_saml_groups", "abc"),
+        ("postgresql:///shard1", "s1", "abc"),
+    ]
+
+
+def test_upgrade_database():
+    """
+    arrange: given the URI and schema of a shard
+    act: upgrade the database of the shard
+    assert: alembic upgrades the plugin migrations on a connection to the shard, with the schema
+        of the shard
+    """
+    with patch("flask_multipass_saml_groups.cli.alembic.command.upgrade") as upgrade:
+        _upgrade_database("sqlite://", "s1", "abc")
+
+    alembic_config, revision = upgrade.call_args.args
+    assert revision == "abc"
+    assert alembic_config.get_main_option("version_locations") == MIGRATIONS_PATH
+    assert alembic_config.attributes[SCHEMA_ATTRIBUTE] == "s1"
+    assert str(alembic_config.attributes[CONNECTION_ATTRIBUTE].engine.url) == "sqlite://"
+
+
+@pytest.mark.parametrize(
+    "settings",
+    [
+        pytest.param({}, id="not sharded"),
+        pytest.param({"shards": [{"uri": "postgresql:///shard0", "schema": 1}]}, id="schema"),
+    ],
+)
+def test_upgrade_shards_rejects_invalid_shards(settings):
+    """
+    arrange: given an identity provider without shards or with a shard with an invalid schema
+    act: run the upgrade-shards command
+    assert: the command fails without running any migration
+    """
+    app = Flask("test")
+
+    with (
+        app.app_context(),
+        patch(
+            "flask_multipass_saml_groups.cli.config",
+            SimpleNamespace(IDENTITY_PROVIDERS={PROVIDER: {"type": PROVIDER, **settings}}),
+        ),
+        patch("flask_multipass_saml_groups.cli._upgrade_database") as upgrade,
+    ):
+        result = app.test_cli_runner().invoke(cli, ["upgrade-shards"])
+
+    assert result.exit_code == 2, result.output
+    upgrade.assert_not_called()
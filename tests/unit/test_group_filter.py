@@ -0,0 +1,94 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+"""Unit tests for the filtering of the asserted groups."""
+
+import pytest
+
+from flask_multipass_saml_groups.group_filter import GroupFilter
+
+GROUP_NAMES = ["list-dev", "staff", "team-a", "team-b", "team-b-list", "staff"]
+
+
+@pytest.mark.parametrize(
+    "settings, expected",
+    [
+        pytest.param({}, ["list-dev", "staff", "team-a", "team-b", "team-b-list"], id="no filter"),
+        pytest.param(
+            {"group_include_patterns": ["^team-"], "group_exclude_patterns": ["list$"]},
+            ["team-a", "team-b"],
+            id="patterns",
+        ),
+        pytest.param(
+            {"group_include_prefixes": ["team-", "staff"], "group_exclude_prefixes": ["team-b"]},
+            ["staff", "team-a"],
+            id="prefixes",
+        ),
+        pytest.param(
+            {"group_include_patterns": ["^staff$"], "group_include_prefixes": ["team-a"]},
+            ["staff", "team-a"],
+            id="patterns and prefixes",
+        ),
+        pytest.param(
+            {"group_exclude_prefixes": ["list-"], "max_groups": 2},
+            ["staff", "team-a"],
+            id="max groups",
+        ),
+    ],
+)
+def test_apply(settings, expected):
+    """
+    arrange: given a group filter with include and exclude rules
+    act: apply it to asserted groups containing a duplicate
+    assert: the distinct groups matching the rules are returned sorted
+    """
+    group_filter = GroupFilter(settings)
+
+    assert group_filter.apply(GROUP_NAMES) == expected
+
+
+def test_apply_counts_dropped_groups():
+    """
+    arrange: given a group filter with all kinds of rules
+    act: apply it to the asserted groups of two logins
+    assert: the kept groups and the groups dropped for each reason are counted
+    """
+    group_filter = GroupFilter(
+        {
+            "group_include_prefixes": ["team-", "list-"],
+            "group_exclude_patterns": ["^list-"],
+            "max_groups": 1,
+        }
+    )
+
+    group_filter.apply(GROUP_NAMES)
+    group_filter.apply(["team-a"])
+
+    assert group_filter.metrics.snapshot() == {
+        "asserted": 6,
+        "kept": 2,
+        "not_included": 1,
+        "excluded": 1,
+        "over_limit": 2,
+    }
+    assert group_filter.group_count_histogram.snapshot() == {0: 2}
+
+
+@pytest.mark.parametrize(
+    "settings",
+    [
+        {"group_include_patterns": "^team-"},
+        {"group_exclude_patterns": ["[team"]},
+        {"group_include_prefixes": [1]},
+        {"max_groups": 0},
+        {"max_groups": "10"},
+    ],
+)
+def test_init_with_wrong_settings_raises_value_error(settings):
+    """
+    arrange: given wrong filter settings
+    act: create a group filter
+    assert: a ValueError is raised
+    """
+    with pytest.raises(ValueError):
+        GroupFilter(settings)
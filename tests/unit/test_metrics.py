@@ -0,0 +1,47 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+"""Unit tests for the metrics."""
+
+import pytest
+
+from flask_multipass_saml_groups.metrics import CounterSet, Histogram
+
+
+def test_counter_set():
+    """
+    arrange: given a CounterSet
+    act: increment some counters
+    assert: the snapshot contains the accumulated values
+    """
+    counters = CounterSet()
+
+    counters.inc("a")
+    counters.inc("a", 2)
+    counters.inc("b")
+
+    assert counters.snapshot() == {"a": 3, "b": 1}
+
+
+def test_histogram():
+    """
+    arrange: given a Histogram with a bucket width of 10
+    act: observe some values
+    assert: the values are counted in the buckets of their lower bound
+    """
+    histogram = Histogram(bucket_width=10)
+
+    for value in (25, 3, 9.9, 10, 21):
+        histogram.observe(value)
+
+    assert histogram.snapshot() == {0: 2, 10: 1, 20: 2}
+
+
+def test_histogram_with_wrong_bucket_width_raises_value_error():
+    """
+    arrange: given a non-positive bucket width
+    act: create a Histogram
+    assert: a ValueError is raised
+    """
+    with pytest.raises(ValueError):
+        Histogram(bucket_width=0)
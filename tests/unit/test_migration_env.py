@@ -0,0 +1,39 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+"""Unit tests for the Alembic environment of the plugin."""
+
+import os
+
+from alembic.script import ScriptDirectory
+from sqlalchemy import column, create_engine, table, text
+
+from flask_multipass_saml_groups import migration_env
+from flask_multipass_saml_groups.migration_env import (
+    MIGRATIONS_PATH,
+    VERSION_TABLE,
+    is_up_to_date,
+)
+
+
+def test_is_up_to_date():
+    """
+    arrange: given a database without version table, then with an older and the latest revision
+    act: call is_up_to_date
+    assert: only the latest revision is up to date
+    """
+    script = ScriptDirectory(
+        os.path.dirname(migration_env.__file__), version_locations=[MIGRATIONS_PATH]
+    )
+    head = script.get_revision("head")
+    version = table(VERSION_TABLE, column("version_num"))
+    engine = create_engine("sqlite://")
+    with engine.begin() as connection:
+        missing = is_up_to_date(connection)
+        connection.execute(text(f"CREATE TABLE {VERSION_TABLE} (version_num VARCHAR(32))"))
+        connection.execute(version.insert().values(version_num=head.down_revision))
+        older = is_up_to_date(connection)
+        connection.execute(version.update().values(version_num=head.revision))
+        latest = is_up_to_date(connection)
+
+    assert (missing, older, latest) == (False, False, True)
@@ -2,11 +2,15 @@
 #  See LICENSE file for licensing details.
 
 """Unit tests for the identity provider."""
+import subprocess  # nosec B404
+import sys
+import time
 from copy import deepcopy
 from datetime import datetime, timedelta, timezone
 from random import randint
 from secrets import token_hex
-from unittest.mock import Mock
+from typing import Any, Dict, List
+from unittest.mock import Mock, patch
 
 import pytest
 from flask import Flask, session, url_for
@@ -14,16 +18,25 @@ from flask_multipass import AuthInfo, IdentityRetrievalFailed, Multipass
 from freezegun import freeze_time
 from werkzeug.datastructures import MultiDict
 
+from flask_multipass_saml_groups.group_provider.sharded import (
+    ShardedSQLGroup,
+    ShardedSQLGroupProvider,
+)
+from flask_multipass_saml_groups.group_provider.sql import SQLGroup, SQLGroupProvider
 from flask_multipass_saml_groups.provider import (
     DEFAULT_IDENTIFIER_FIELD,
     DEFAULT_SESSION_EXPIRY,
     EXPIRY_SESSION_KEY,
     SAML_GRP_ATTR_NAME,
+    SOFT_EXPIRY_SESSION_KEY,
     SAMLGroupsIdentityProvider,
 )
-from tests.common import setup_sqlite
+from flask_multipass_saml_groups.session_expiry import SESSION_EXPIRY_BUCKET
+from tests.common import create_shard_tables, setup_sqlite
 
 USER_EMAIL = "user@example.com"
+# the own import time of the plugin modules, excluding flask, flask_multipass and their imports
+IMPORT_TIME_BUDGET_US = 50_000
 OTHER_USER_EMAIL = "other@example.com"
 
 
@@ -162,6 +175,55 @@ def test_init_provider_with_wrong_session_expiry_settings_raises_value_error(app
                 )
 
 
+def test_init_provider_with_wrong_session_expiry_window_settings_raises_value_error(app):
+    """
+    arrange: given dicts with wrong session_expiry_jitter and session_soft_expiry settings
+    act: call SAMLGroupsIdentityProvider with the settings
+    assert: a ValueError is raised
+    """
+    multipass = Multipass(app)
+    wrong_settings: List[Dict[str, Any]] = [
+        {"session_expiry_jitter": "not a number"},
+        {"session_expiry_jitter": -1},
+        {"session_expiry": 60, "session_expiry_jitter": 60},
+        {"session_soft_expiry": "not a number"},
+        {"session_soft_expiry": -1},
+        {"session_expiry": 60, "session_soft_expiry": 120},
+    ]
+
+    with app.app_context():
+        for wrong_setting in wrong_settings:
+            with pytest.raises(ValueError):
+                SAMLGroupsIdentityProvider(
+                    multipass=multipass, name="saml_groups", settings=wrong_setting
+                )
+
+
+def test_init_provider_with_wrong_group_sync_settings_raises_value_error(app):
+    """
+    arrange: given dicts with wrong group_sync, group_sync_workers, warm_up_budget and group
+        filter settings
+    act: call SAMLGroupsIdentityProvider with the settings
+    assert: a ValueError is raised
+    """
+    multipass = Multipass(app)
+    wrong_settings: List[Dict[str, Any]] = [
+        {"group_sync": "later"},
+        {"group_exclude_patterns": ["("]},
+        {"group_sync": "deferred", "group_sync_workers": 0},
+        {"group_sync": "deferred", "group_sync_workers": "not a number"},
+        {"warm_up_budget": -1},
+        {"warm_up_budget": "not a number"},
+    ]
+
+    with app.app_context():
+        for wrong_setting in wrong_settings:
+            with pytest.raises(ValueError):
+                SAMLGroupsIdentityProvider(
+                    multipass=multipass, name="saml_groups", settings=wrong_setting
+                )
+
+
 def test_get_identity_from_auth_returns_identity_info(provider, auth_info, saml_attrs):
     """
     arrange: given AuthInfo by AuthProvider
@@ -268,6 +330,28 @@ def test_get_identity_from_auth_adds_user_to_group(auth_info, provider, group_na
         assert members[0].identifier == auth_info.data[DEFAULT_IDENTIFIER_FIELD]
 
 
+def test_get_identity_from_auth_stores_filtered_groups(app, auth_info):
+    """
+    arrange: given AuthInfo with mailing lists and a provider excluding them
+    act: call get_identity_from_auth from SAMLGroupsIdentityProvider
+    assert: only the groups which are not excluded are stored and the dropped groups are counted
+    """
+    auth_info.data[SAML_GRP_ATTR_NAME] = ["staff", "list-announce", "list-dev", "admins"]
+    identifier = auth_info.data[DEFAULT_IDENTIFIER_FIELD]
+    multipass = Multipass(app)
+
+    with app.test_request_context("/sample", method="GET"):
+        provider = SAMLGroupsIdentityProvider(
+            multipass=multipass,
+            name="saml_groups",
+            settings={"group_exclude_prefixes": ["list-"]},
+        )
+        provider.get_identity_from_auth(auth_info)
+
+        assert [g.name for g in provider.get_identity_groups(identifier)] == ["admins", "staff"]
+        assert provider.group_filter.metrics.snapshot()["excluded"] == 2
+
+
 def test_get_identity_from_auth_adds_user_to_existing_group(
     auth_info, auth_info_other_user, provider, group_names
 ):
@@ -378,6 +462,57 @@ def test_get_identity_from_auth_sets_session_expiry(
     assert session.get(EXPIRY_SESSION_KEY) == dt_now + timedelta(seconds=session_expiry)
 
 
+@freeze_time("Jan 14th, 2024")
+def test_get_identity_from_auth_sets_jittered_session_expiry(app, auth_info):
+    """
+    arrange: given AuthInfo with User with groups and a provider with session_expiry_jitter set
+    act: call get_identity_from_auth from SAMLGroupsIdentityProvider
+    assert: the session expiry is shortened by the jitter and recorded in the metrics
+    """
+    dt_now = datetime.now(timezone.utc)
+    multipass = Multipass(app)
+
+    with app.test_request_context("/sample", method="GET"):
+        provider = SAMLGroupsIdentityProvider(
+            multipass=multipass,
+            name="saml_groups",
+            settings={"session_expiry": 3600, "session_expiry_jitter": 600},
+        )
+        with patch(
+            "flask_multipass_saml_groups.session_expiry.randint", return_value=90
+        ) as randint_:
+            provider.get_identity_from_auth(auth_info)
+
+        randint_.assert_called_once_with(0, 600)
+        assert session.get(EXPIRY_SESSION_KEY) == dt_now + timedelta(seconds=3600 - 90)
+        assert provider.session_expiry.metrics.snapshot() == {"issued": 1}
+        bucket = (3600 - 90) // SESSION_EXPIRY_BUCKET * SESSION_EXPIRY_BUCKET
+        assert provider.session_expiry.histogram.snapshot() == {bucket: 1}
+
+
+def test_get_identity_from_auth_draws_soft_session_expiry(app, auth_info):
+    """
+    arrange: given AuthInfo with User with groups and a provider with session_soft_expiry set
+    act: call get_identity_from_auth from SAMLGroupsIdentityProvider
+    assert: the early expiry of the session is drawn once and stored in the session
+    """
+    multipass = Multipass(app)
+
+    with app.test_request_context("/sample", method="GET"):
+        provider = SAMLGroupsIdentityProvider(
+            multipass=multipass,
+            name="saml_groups",
+            settings={"session_expiry": 3600, "session_soft_expiry": 100},
+        )
+        with patch(
+            "flask_multipass_saml_groups.session_expiry.random", return_value=0.4
+        ) as random_:
+            provider.get_identity_from_auth(auth_info)
+
+        random_.assert_called_once_with()
+        assert session.get(SOFT_EXPIRY_SESSION_KEY) == 0.4
+
+
 def test_get_identity_from_auth_sets_no_session_expiry_for_users_without_groups(
     provider_session_expiry, auth_info
 ):
@@ -393,6 +528,119 @@ def test_get_identity_from_auth_sets_no_session_expiry_for_users_without_groups(
     assert not session.get(EXPIRY_SESSION_KEY)
 
 
+def test_get_identity_from_auth_defers_group_sync(app, auth_info, group_names):
+    """
+    arrange: given AuthInfo by AuthProvider and a provider with deferred group sync
+    act: call get_identity_from_auth and get_identity_groups, then wait for the sync
+    assert: the asserted groups are returned, and their membership checks succeed, while the
+        sync is pending and the groups are persisted afterwards
+    """
+    multipass = Multipass(app)
+    identifier = auth_info.data[DEFAULT_IDENTIFIER_FIELD]
+
+    with app.test_request_context("/sample", method="GET"):
+        provider = SAMLGroupsIdentityProvider(
+            multipass=multipass, name="saml_groups", settings={"group_sync": "deferred"}
+        )
+        # pylint: disable=protected-access
+        deferred_sync = provider._deferred_sync
+        assert deferred_sync is not None
+        with patch.object(deferred_sync, "_executor") as executor:
+            provider.get_identity_from_auth(auth_info)
+            groups = list(provider.get_identity_groups(identifier))
+        assert {g.name for g in groups} == set(group_names)
+        pending_group = provider.get_group(group_names[0])
+        assert pending_group is not None
+        assert pending_group.has_member(identifier)
+        assert not pending_group.has_member(OTHER_USER_EMAIL)
+        assert provider.get_group("unknown") is None
+
+        _, app_, identifier_ = executor.submit.call_args.args
+        deferred_sync._run(app_, identifier_)
+
+        assert deferred_sync.wait(5)
+        groups = list(provider.get_identity_groups(identifier))
+        assert {g.name for g in groups} == set(group_names)
+        group = provider.get_group(group_names[0])
+        assert group is not None
+        assert [m.identifier for m in group.get_members()] == [identifier]
+
+
+def test_get_identity_groups_includes_ancestors_of_pending_groups(app, auth_info):
+    """
+    arrange: given a provider with deferred group sync and hierarchical groups, and a login
+        asserting a nested group whose sync is pending
+    act: call get_identity_groups and get_group for the ancestor
+    assert: the ancestors of the asserted group are returned and the user is a member of them
+    """
+    multipass = Multipass(app)
+    identifier = auth_info.data[DEFAULT_IDENTIFIER_FIELD]
+    auth_info.data[SAML_GRP_ATTR_NAME] = ["eng/platform/sre"]
+
+    with app.test_request_context("/sample", method="GET"):
+        provider = SAMLGroupsIdentityProvider(
+            multipass=multipass,
+            name="saml_groups",
+            settings={"group_sync": "deferred", "group_hierarchy_separator": "/"},
+        )
+        # pylint: disable-next=protected-access
+        with patch.object(provider._deferred_sync, "_executor"):
+            provider.get_identity_from_auth(auth_info)
+
+        groups = list(provider.get_identity_groups(identifier))
+        ancestor = provider.get_group("eng")
+
+    assert [g.name for g in groups] == ["eng", "eng/platform", "eng/platform/sre"]
+    assert ancestor is not None
+    assert ancestor.has_member(identifier)
+
+
+def test_sharded_group_provider(app, auth_info, group_names, tmp_path):
+    """
+    arrange: given AuthInfo by AuthProvider and a provider with a sharded group provider and
+        deferred group sync
+    act: call get_identity_from_auth and get_identity_groups, then wait for the sync
+    assert: the groups are served by the sharded group provider while the sync is pending and
+        afterwards
+    """
+    multipass = Multipass(app)
+    identifier = auth_info.data[DEFAULT_IDENTIFIER_FIELD]
+    settings = {
+        "group_sync": "deferred",
+        "shards": [{"uri": f"sqlite:///{tmp_path}/shard{i}.db", "schema": "main"} for i in (0, 1)],
+    }
+
+    with app.test_request_context("/sample", method="GET"):
+        provider = SAMLGroupsIdentityProvider(
+            multipass=multipass,
+            name="saml_groups",
+            settings=settings,
+            group_provider_class=ShardedSQLGroupProvider,
+        )
+        # pylint: disable=protected-access
+        group_provider = provider._group_provider
+        assert isinstance(group_provider, ShardedSQLGroupProvider)
+        for engine in group_provider.engines:
+            create_shard_tables(engine)
+        deferred_sync = provider._deferred_sync
+        assert deferred_sync is not None
+        with patch.object(deferred_sync, "_executor") as executor:
+            provider.get_identity_from_auth(auth_info)
+            groups = list(provider.get_identity_groups(identifier))
+        assert all(isinstance(g, ShardedSQLGroup) for g in groups)
+        assert {g.name for g in groups} == set(group_names)
+        assert all(g.has_member(identifier) for g in groups)
+
+        _, app_, identifier_ = executor.submit.call_args.args
+        deferred_sync._run(app_, identifier_)
+
+        groups = list(provider.get_identity_groups(identifier))
+        assert {g.name for g in groups} == set(group_names)
+        assert all(g.has_member(identifier) for g in groups)
+        assert not provider.supports_get
+        assert not provider.supports_search
+
+
 def test_get_group_returns_specific_group(auth_info, provider, group_names):
     """
     arrange: given AuthInfo by AuthProvider
@@ -429,6 +677,74 @@ def test_get_identity_groups(auth_info, provider, group_names):
     assert set(g.name for g in groups) == set(group_names)
 
 
+def test_get_identity_returns_stored_attributes(auth_info, provider):
+    """
+    arrange: given AuthInfo by AuthProvider
+    act: call get_identity_from_auth and afterwards get_identity for the user and another user
+    assert: the identity of the user is returned with its attributes, None for the other user
+    """
+    provider.get_identity_from_auth(auth_info)
+    identity = provider.get_identity(auth_info.data[DEFAULT_IDENTIFIER_FIELD])
+
+    assert identity.identifier == auth_info.data[DEFAULT_IDENTIFIER_FIELD]
+    assert identity.data["email"] == USER_EMAIL
+    assert provider.get_identity("unknown") is None
+
+
+def test_search_identities(app, auth_info, auth_info_other_user):
+    """
+    arrange: given AuthInfo of two users and a provider mapping the full name to the first name
+    act: call get_identity_from_auth for both and search identities with the criteria of the app
+    assert: the users matching all criteria are returned with their mapped attributes
+    """
+    multipass = Multipass(app)
+
+    with app.test_request_context("/sample", method="GET"):
+        provider = SAMLGroupsIdentityProvider(
+            multipass=multipass,
+            name="saml_groups",
+            settings={"mapping": {"first_name": "fullname"}, "search_enabled": True},
+        )
+        provider.get_identity_from_auth(auth_info)
+        provider.get_identity_from_auth(auth_info_other_user)
+
+        identities = list(
+            provider.search_identities(provider.map_search_criteria({"first_name": {"foo"}}))
+        )
+        found, total = provider.search_identities_ex(
+            provider.map_search_criteria({"first_name": {"foo"}, "email": {"USER@"}}), limit=1
+        )
+        exact = list(
+            provider.search_identities(
+                provider.map_search_criteria({"email": {"user@"}}), exact=True
+            )
+        )
+
+    assert {i.data["email"] for i in identities} == {USER_EMAIL, OTHER_USER_EMAIL}
+    assert total == 1
+    assert [(i.data["first_name"], i.data["email"]) for i in found] == [("Foo bar", USER_EMAIL)]
+    assert not exact
+
+
+def test_search_is_disabled_by_default(app):
+    """
+    arrange: given a provider without the search_enabled setting and one with search enabled
+    act: check which features the providers support
+    assert: searching is only supported if enabled, getting identities always is
+    """
+    multipass = Multipass(app)
+
+    with app.app_context():
+        provider = SAMLGroupsIdentityProvider(multipass=multipass, name="saml_groups", settings={})
+        enabled = SAMLGroupsIdentityProvider(
+            multipass=multipass, name="saml_groups_search", settings={"search_enabled": True}
+        )
+
+    assert not provider.supports_search and not provider.supports_search_ex
+    assert provider.supports_get
+    assert enabled.supports_search and enabled.supports_search_ex
+
+
 def test_search_groups_returns_all_matched_groups(auth_info, provider, group_names):
     """
     arrange: given AuthInfo by AuthProvider
@@ -525,3 +841,160 @@ def test_no_redirect_to_login_if_session_not_expired(client):
     resp = client.get("/sample")
     assert resp.status_code == 200
     assert not resp.location
+
+
+@pytest.mark.parametrize(
+    "draw, expired",
+    [
+        pytest.param(0.7, True, id="expired"),
+        pytest.param(0.3, False, id="not expired"),
+    ],
+)
+@freeze_time("Jan 14th, 2024")
+def test_session_is_soft_expired(app, draw, expired):
+    """
+    arrange: a provider with session_soft_expiry and a session in the soft expiry window
+    act: the before_request signal is triggered
+    assert: the session is cleared depending on the value drawn at login against the remaining
+        fraction of the window
+    """
+    multipass = Multipass(app)
+    dt_now = datetime.now(timezone.utc)
+    with app.app_context():
+        provider = SAMLGroupsIdentityProvider(
+            multipass=multipass,
+            name="saml_groups",
+            settings={"session_expiry": 3600, "session_soft_expiry": 100},
+        )
+
+    with app.test_request_context("/sample", method="GET"):
+        session[EXPIRY_SESSION_KEY] = dt_now + timedelta(seconds=50)
+        session[SOFT_EXPIRY_SESSION_KEY] = draw
+
+        app.preprocess_request()
+
+        assert (session == {}) is expired
+        assert provider.session_expiry.metrics.snapshot().get("soft_expired", 0) == int(expired)
+
+
+@freeze_time("Jan 14th, 2024")
+def test_session_is_not_soft_expired_before_window(app):
+    """
+    arrange: a provider with session_soft_expiry and a session before the soft expiry window
+    act: the before_request signal is triggered
+    assert: the session is not cleared
+    """
+    multipass = Multipass(app)
+    dt_now = datetime.now(timezone.utc)
+    with app.app_context():
+        SAMLGroupsIdentityProvider(
+            multipass=multipass,
+            name="saml_groups",
+            settings={"session_expiry": 3600, "session_soft_expiry": 100},
+        )
+
+    with app.test_request_context("/sample", method="GET"):
+        session[EXPIRY_SESSION_KEY] = dt_now + timedelta(seconds=101)
+        session[SOFT_EXPIRY_SESSION_KEY] = 0.99
+
+        app.preprocess_request()
+
+        assert session[EXPIRY_SESSION_KEY] == dt_now + timedelta(seconds=101)
+
+
+def test_import_does_not_load_the_database_models():
+    """
+    arrange: a fresh interpreter reporting the time spent importing each module
+    act: import the provider module, as flask-multipass does when enumerating its entry points
+    assert: neither indico nor the plugin models are imported and the plugin modules take less
+        than the import time budget
+    """
+    result = subprocess.run(  # nosec B603
+        [sys.executable, "-X", "importtime", "-c", "import flask_multipass_saml_groups.provider"],
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+
+    # the lines have the format "import time: <self us> | <cumulative us> | <indented module>"
+    imports = {}
+    for line in result.stderr.splitlines():
+        fields = line.split("|")
+        if line.startswith("import time:") and fields[0].split()[-1].isdigit():
+            imports[fields[2].strip()] = int(fields[0].split()[-1])
+    assert "flask_multipass_saml_groups.provider" in imports
+    assert not [m for m in imports if m == "indico" or m.startswith("indico.")]
+    assert "flask_sqlalchemy" not in imports
+    assert "flask_multipass_saml_groups.models.saml_groups" not in imports
+    assert "flask_multipass_saml_groups.group_provider.sql" not in imports
+    own = sum(t for m, t in imports.items() if m.startswith("flask_multipass_saml_groups"))
+    assert own < IMPORT_TIME_BUDGET_US
+
+
+def test_default_group_provider_is_sql(app):
+    """
+    arrange: given no group provider class
+    act: create the identity provider
+    assert: the SQL group provider is used
+    """
+    multipass = Multipass(app)
+    with app.app_context():
+        provider = SAMLGroupsIdentityProvider(multipass=multipass, name="saml_groups", settings={})
+
+    # pylint: disable-next=protected-access
+    assert isinstance(provider._group_provider, SQLGroupProvider)
+    assert provider.group_class is SQLGroup
+
+
+@pytest.mark.parametrize(
+    "settings, expected_budget",
+    [
+        pytest.param({}, None, id="disabled"),
+        pytest.param({"warm_up_budget": 5}, 5, id="enabled"),
+    ],
+)
+def test_warm_up(app, settings, expected_budget):
+    """
+    arrange: given an identity provider with or without warm_up_budget
+    act: warm up the identity provider
+    assert: the group provider is warmed up with a deadline within the budget and the duration
+        is reported, nothing happens if the warm-up is disabled
+    """
+    multipass = Multipass(app)
+    with app.app_context():
+        provider = SAMLGroupsIdentityProvider(
+            multipass=multipass, name="saml_groups", settings=settings
+        )
+
+        with patch.object(SQLGroupProvider, "warm_up", return_value=2) as warm_up:
+            start = time.monotonic()
+            seconds = provider.warm_up()
+
+    if expected_budget is None:
+        assert seconds is None
+        warm_up.assert_not_called()
+    else:
+        assert seconds is not None
+        assert 0 <= seconds < expected_budget
+        assert provider.warm_up_seconds == seconds
+        (deadline,), _ = warm_up.call_args
+        assert start < deadline <= time.monotonic() + expected_budget
+
+
+def test_warm_up_errors_are_logged(app, caplog):
+    """
+    arrange: given an identity provider whose group provider fails to warm up
+    act: warm up the identity provider
+    assert: the error is logged and the duration is reported
+    """
+    multipass = Multipass(app)
+    with app.app_context():
+        provider = SAMLGroupsIdentityProvider(
+            multipass=multipass, name="saml_groups", settings={"warm_up_budget": 1}
+        )
+
+        with patch.object(SQLGroupProvider, "warm_up", side_effect=RuntimeError("down")):
+            seconds = provider.warm_up()
+
+    assert seconds is not None
+    assert "Failed to warm up the identity provider saml_groups" in caplog.text
@@ -0,0 +1,91 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+"""Unit tests for the expiry of the web sessions."""
+
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+
+import pytest
+
+from flask_multipass_saml_groups.session_expiry import SESSION_EXPIRY_BUCKET, SessionExpiry
+
+NOW = datetime(2024, 1, 14, tzinfo=timezone.utc)
+
+
+def test_issue():
+    """
+    arrange: given a session expiry with a jitter
+    act: issue two sessions
+    assert: the sessions expire after the lifetime shortened by the jitter and are counted
+    """
+    session_expiry = SessionExpiry({"session_expiry": 3600, "session_expiry_jitter": 600})
+
+    with patch("flask_multipass_saml_groups.session_expiry.randint", side_effect=[0, 600]):
+        expires = [session_expiry.issue(NOW), session_expiry.issue(NOW)]
+
+    assert expires == [NOW + timedelta(seconds=3600), NOW + timedelta(seconds=3000)]
+    assert session_expiry.metrics.snapshot() == {"issued": 2}
+    assert session_expiry.histogram.snapshot() == {
+        3000 // SESSION_EXPIRY_BUCKET * SESSION_EXPIRY_BUCKET: 1,
+        3600: 1,
+    }
+
+
+def test_draw():
+    """
+    arrange: given session expiries with and without a soft expiry window
+    act: draw the early expiry of a new session
+    assert: a random value is drawn only with a soft expiry window
+    """
+    with patch("flask_multipass_saml_groups.session_expiry.random", return_value=0.4):
+        draws = [
+            SessionExpiry({"session_expiry": 3600, "session_soft_expiry": 100}).draw(),
+            SessionExpiry({"session_expiry": 3600}).draw(),
+        ]
+
+    assert draws == [0.4, None]
+
+
+@pytest.mark.parametrize(
+    "remaining, draw, expected, counter",
+    [
+        pytest.param(-1, None, True, "hard_expired", id="hard expired"),
+        pytest.param(25, 0.8, True, "soft_expired", id="soft expired"),
+        pytest.param(25, 0.25, True, "soft_expired", id="at the drawn instant"),
+        pytest.param(25, 0.2, False, None, id="before the drawn instant"),
+        pytest.param(25, None, False, None, id="nothing drawn"),
+        pytest.param(101, 0.99, False, None, id="before the window"),
+    ],
+)
+def test_is_expired(remaining, draw, expected, counter):
+    """
+    arrange: given a session expiry with a soft expiry window of 100 seconds
+    act: check sessions expiring at different times with different values drawn at login
+    assert: the sessions past their expiry, or past the instant drawn within the window, are
+        expired and counted
+    """
+    session_expiry = SessionExpiry({"session_expiry": 3600, "session_soft_expiry": 100})
+
+    expired = session_expiry.is_expired(NOW + timedelta(seconds=remaining), NOW, draw)
+
+    assert expired is expected
+    assert session_expiry.metrics.snapshot() == ({counter: 1} if counter else {})
+
+
+def test_is_expired_is_stable():
+    """
+    arrange: given a session expiry with a soft expiry window and a session in that window
+    act: check the session repeatedly before and after the instant drawn at login
+    assert: the decision only depends on the time, not on the number of checks
+    """
+    session_expiry = SessionExpiry({"session_expiry": 3600, "session_soft_expiry": 100})
+    expires = NOW + timedelta(seconds=50)
+
+    before = [session_expiry.is_expired(expires, NOW, 0.4) for _ in range(100)]
+    after = [
+        session_expiry.is_expired(expires, NOW + timedelta(seconds=11), 0.4) for _ in range(100)
+    ]
+
+    assert not any(before)
+    assert all(after)
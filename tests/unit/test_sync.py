@@ -0,0 +1,188 @@
+#  Copyright 2024 Canonical Ltd.
+#  See LICENSE file for licensing details.
+
+"""Unit tests for the deferred group sync."""
+
+from threading import Event
+from unittest.mock import Mock, call
+
+import pytest
+from flask import Flask
+
+from flask_multipass_saml_groups.sync import DeferredGroupSync
+
+WAIT_TIMEOUT = 5
+
+
+@pytest.fixture(name="app")
+def app_fixture():
+    """Create a flask app."""
+    return Flask("test")
+
+
+@pytest.fixture(name="blocking_group_provider")
+def blocking_group_provider_fixture():
+    """Create a group provider whose first sync blocks until the returned event is set."""
+    started = Event()
+    release = Event()
+    group_provider = Mock()
+    group_provider.expand_group_names.side_effect = lambda names: sorted(set(names))
+
+    def _sync_user_groups(*_):
+        if not started.is_set():
+            started.set()
+            release.wait(WAIT_TIMEOUT)
+
+    group_provider.sync_user_groups.side_effect = _sync_user_groups
+    return group_provider, started, release
+
+
+def test_submit_applies_groups(app):
+    """
+    arrange: given a DeferredGroupSync
+    act: submit the groups of a user and wait
+    assert: the groups are applied by the group provider and nothing is pending anymore
+    """
+    group_provider = Mock()
+    deferred_sync = DeferredGroupSync(group_provider, max_workers=1)
+
+    with app.app_context():
+        deferred_sync.submit("user", ["grp1", "grp2"])
+
+    assert deferred_sync.wait(WAIT_TIMEOUT)
+    group_provider.sync_user_groups.assert_called_once_with("user", ("grp1", "grp2"), None)
+    assert deferred_sync.get_pending("user") is None
+
+
+def test_get_pending_returns_groups_during_sync(app, blocking_group_provider):
+    """
+    arrange: given a DeferredGroupSync whose sync is blocked
+    act: submit the groups of a user
+    assert: the asserted groups are pending, for the user and among all pending groups, until
+        the sync has finished
+    """
+    group_provider, started, release = blocking_group_provider
+    deferred_sync = DeferredGroupSync(group_provider, max_workers=1)
+
+    with app.app_context():
+        deferred_sync.submit("user", ["grp1"])
+    assert started.wait(WAIT_TIMEOUT)
+
+    assert deferred_sync.get_pending("user") == ("grp1",)
+    assert deferred_sync.get_pending_group_names("user") == ["grp1"]
+    assert deferred_sync.is_pending_group("grp1")
+    assert not deferred_sync.wait(0)
+
+    release.set()
+    assert deferred_sync.wait(WAIT_TIMEOUT)
+    assert deferred_sync.get_pending("user") is None
+    assert not deferred_sync.is_pending_group("grp1")
+
+
+def test_submit_twice_during_sync_applies_latest_groups(app, blocking_group_provider):
+    """
+    arrange: given a DeferredGroupSync whose sync for a user is blocked
+    act: submit new groups for the same user twice and release the sync
+    assert: the running sync is followed by a single sync with the latest groups
+    """
+    group_provider, started, release = blocking_group_provider
+    deferred_sync = DeferredGroupSync(group_provider, max_workers=4)
+
+    with app.app_context():
+        deferred_sync.submit("user", ["grp1"])
+        assert started.wait(WAIT_TIMEOUT)
+        deferred_sync.submit("user", ["grp2"])
+        deferred_sync.submit("user", ["grp3"])
+    assert deferred_sync.get_pending("user") == ("grp3",)
+
+    release.set()
+
+    assert deferred_sync.wait(WAIT_TIMEOUT)
+    assert [c.args for c in group_provider.sync_user_groups.call_args_list] == [
+        ("user", ("grp1",), None),
+        ("user", ("grp3",), None),
+    ]
+
+
+def test_failed_sync_is_retried(app):
+    """
+    arrange: given a group provider which fails to sync twice
+    act: submit the groups and attributes of a user and wait
+    assert: the sync is retried with the same groups and attributes until it succeeds and nothing
+        is pending anymore
+    """
+    group_provider = Mock()
+    group_provider.sync_user_groups.side_effect = [RuntimeError("db down")] * 2 + [None]
+    deferred_sync = DeferredGroupSync(group_provider, max_workers=1, retry_delays=(0, 0))
+
+    with app.app_context():
+        deferred_sync.submit("user", ["grp1"], {"email": "user@example.com"})
+
+    assert deferred_sync.wait(WAIT_TIMEOUT)
+    assert group_provider.sync_user_groups.call_args_list == [
+        call("user", ("grp1",), {"email": "user@example.com"})
+    ] * 3
+    assert deferred_sync.get_pending("user") is None
+
+
+def test_failed_sync_is_dropped_after_the_retries(app):
+    """
+    arrange: given a group provider which always fails to sync
+    act: submit the groups of a user and wait
+    assert: the sync is attempted once and once per retry delay, then nothing is pending anymore
+    """
+    group_provider = Mock()
+    group_provider.sync_user_groups.side_effect = RuntimeError("db down")
+    deferred_sync = DeferredGroupSync(group_provider, max_workers=1, retry_delays=(0, 0))
+
+    with app.app_context():
+        deferred_sync.submit("user", ["grp1"])
+
+    assert deferred_sync.wait(WAIT_TIMEOUT)
+    assert group_provider.sync_user_groups.call_count == 3
+    assert deferred_sync.get_pending("user") is None
+
+
+def test_submit_applies_attributes(app):
+    """
+    arrange: given a DeferredGroupSync
+    act: submit the groups of a user with attributes, then without attributes, and wait
+    assert: the attributes are stored with the first sync only
+    """
+    group_provider = Mock()
+    deferred_sync = DeferredGroupSync(group_provider, max_workers=1)
+
+    with app.app_context():
+        deferred_sync.submit("user", ["grp1"], {"email": "user@example.com"})
+        assert deferred_sync.wait(WAIT_TIMEOUT)
+        deferred_sync.submit("user", ["grp1"])
+
+    assert deferred_sync.wait(WAIT_TIMEOUT)
+    assert [c.args for c in group_provider.sync_user_groups.call_args_list] == [
+        ("user", ("grp1",), {"email": "user@example.com"}),
+        ("user", ("grp1",), None),
+    ]
+
+
+def test_submit_same_groups_during_sync_applies_latest_attributes(app, blocking_group_provider):
+    """
+    arrange: given a DeferredGroupSync whose sync for a user is blocked
+    act: submit the same groups with new attributes twice and release the sync
+    assert: the running sync is followed by a single sync with the latest attributes
+    """
+    group_provider, started, release = blocking_group_provider
+    deferred_sync = DeferredGroupSync(group_provider, max_workers=1)
+
+    with app.app_context():
+        deferred_sync.submit("user", ["grp1"], {"email": "old@example.com"})
+        assert started.wait(WAIT_TIMEOUT)
+        deferred_sync.submit("user", ["grp1"], {"email": "new@example.com"})
+        deferred_sync.submit("user", ["grp1"], {"email": "newest@example.com"})
+
+    release.set()
+
+    assert deferred_sync.wait(WAIT_TIMEOUT)
+    assert [c.args for c in group_provider.sync_user_groups.call_args_list] == [
+        ("user", ("grp1",), {"email": "old@example.com"}),
+        ("user", ("grp1",), {"email": "newest@example.com"}),
+    ]